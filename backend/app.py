@@ -1,217 +1,417 @@
-from fastapi import FastAPI, Body
-from backend.steps import utils, step_one, step_two, step_three, step_four, step_five
+import time
+import asyncio
+import json
+from fastapi import FastAPI, Body, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from backend.steps import pipeline, batch, explore
+from backend.services import claude_client, model_router, metrics
+from backend.services.log import get_logger, preview
+from backend.services import structured_output
+from backend.services.result_cache import result_cache
+from backend.services.session_store import session_store
+from backend.services.session_journal import session_journal
+from backend.services.knowledge_base import knowledge_base
+from backend.services.blob_store import blob_store, BlobError
+from backend.services.sandbox import sandbox_pool
+from backend.services.admission import admission, AdmissionRejected, bind
 
 
 app = FastAPI()
-
-# ===== 简单内存缓存，key 可以是用户 id 或 session id =====
-# 实际生产建议用 Redis 或类似缓存
-step1_cache: dict[str, dict] = {}
-step2_cache: dict[str, dict] = {}
-step3_cache: dict[str, dict] = {}
-step4_cache: dict[str, dict] = {}
-step5_cache: dict[str, dict] = {}
-step6_cache: dict[str, dict] = {}
-
-@app.post("/step1")
-async def step1_endpoint(data: dict = Body(...)):
+logger = get_logger("app")
+
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """每个请求到返回响应头的耗时；路径用路由模板（/step{step}/stream），避免标签爆炸"""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.http_request_seconds.observe(
+            time.perf_counter() - start, method=request.method, status=status,
+            path=getattr(route, "path", "unmatched"))
+
+
+@metrics.registry.collector
+def _collect_runtime():
+    """抓取时现取：缓存命中率、活跃会话数、结构化输出计数、服务商熔断状态"""
+    cache = result_cache.stats()
+    yield metrics.gauge_from("truedebug_result_cache_hit_ratio", "结果缓存命中率", {"": cache["hit_ratio"]})
+    yield metrics.gauge_from("truedebug_result_cache_lookups", "结果缓存查询次数（累计）",
+                             {"hit": cache["hits"], "miss": cache["misses"]}, "result")
+    yield metrics.gauge_from("truedebug_result_cache_entries", "结果缓存条目数", {"": cache["entries"]})
+    yield metrics.gauge_from("truedebug_active_sessions", "会话存储里的会话数", {"": session_store.count()})
+    yield metrics.gauge_from("truedebug_inflight_steps", "正在计算的 step 数（含预取）", {"": len(pipeline._inflight)})
+    yield metrics.gauge_from("truedebug_structured_output_events", "结构化输出解析 / 修复计数（累计）",
+                             structured_output.stats(), "event")
+    yield metrics.gauge_from("truedebug_llm_breaker_open", "服务商熔断器是否打开（1 = open / half_open）",
+                             {name: int(s["breaker"] != "closed") for name, s in claude_client.llm_stats().items()},
+                             "provider")
+    yield metrics.gauge_from("truedebug_admission_queue_depth", "准入队列里排队的模型调用数",
+                             admission.queue_depth(), "priority")
+    yield metrics.gauge_from("truedebug_admission_active", "已放行、正在进行的模型调用数", {"": admission.active})
+
+# 轮询客户端是否断开的间隔（秒）
+DISCONNECT_POLL_INTERVAL = 0.5
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await claude_client.close_client()
+    await sandbox_pool.close()
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """排队超过上限：429 + Retry-After，客户端按它退避重试"""
+    return JSONResponse(status_code=429, headers={"Retry-After": str(exc.retry_seconds)},
+                        content={"error": str(exc), "retry_after": exc.retry_seconds, "reason": exc.reason})
+
+
+async def run_cancellable(request: Request, coro):
+    """
+    执行 step 处理协程，客户端断开时取消它（连同正在进行的 LLM 调用）
+
+    返回 (是否完成, 结果)
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return True, task.result()
+            if await request.is_disconnected():
+                logger.info("客户端已断开，取消正在进行的 step")
+                task.cancel()
+                return False, None
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
+
+def _resolve_blobs(codes: tuple) -> tuple[dict | None, list]:
+    missing = sorted({digest for code in codes for digest in blob_store.missing(code)})
+    if missing:
+        return {"error": f"未知的 blob: {', '.join(d[:12] for d in missing)}，请重新上传",
+                "missing_blobs": missing}, list(codes)
+    return None, [blob_store.expand(code) for code in codes]
+
+
+async def resolve_blobs(*codes) -> tuple[dict | None, list]:
+    """
+    把 code（bug report）里的 blob 引用换回内容，返回 (错误, 换好的 codes)
+
+    blob 存储是同步的 SQLite，每个请求在入口处放到线程里查一次，之后 pipeline 里读源码不再碰库。
+    引用了服务端没有的 blob（例如存储被清理过）时返回错误，客户端重新上传后重试
+    """
+    return await asyncio.to_thread(_resolve_blobs, codes)
+
+
+async def run_step_endpoint(request: Request, step: int, data: dict) -> dict:
+    """/stepN 的公共逻辑：校验 user_id，执行 step，客户端断开时取消"""
     ode = data.get("code")
-    print(f'Received code1: {ode}')
-    # # 输入"1", "2"
-    # choice = data.get("choice")  # 前端可能传 choice
-    # print(f'Received choice1: {choice}')
-    user_id: str = data.get("user_id")  # 前端必须传 user_id 来区分用户
-    print(f'user_id: {user_id}')
+    choice = data.get("choice")  # 前端可能传 choice
+    logger.debug("step%s choice=%s code=%s", step, choice, preview(ode))
 
+    user_id: str = data.get("user_id")  # 前端必须传 user_id 来区分用户
     if not user_id:
         return {"error": "必须提供 user_id"}
-    
-    # ======== 先检查 cache =========
-    cached_result = step1_cache.get(user_id)
-    if cached_result is not None:
-        print(f"[CACHE HIT] step1 for user_id={user_id}")
-        return {"result": cached_result}
-    
-    # result = await step_one.handle_step1(ode, choice)
-    result = await step_one.handle_step1(ode)
+    missing, (ode,) = await resolve_blobs(ode)
+    if missing is not None:
+        return missing
+
+    with admission.request(user_id, "interactive"):
+        completed, outcome = await run_cancellable(request, pipeline.execute_step(step, user_id, ode, choice))
+    if not completed:
+        return {"error": "客户端已断开"}
+    return outcome
 
 
-    # if choice is None or choice == "1":
-    step1_cache[user_id] = result  # 保存 step1 输出，用于 step2
+# ===== 会话存储，key 是 user_id =====
+# 后端、空闲超时和会话数上限见 backend/services/session_store.py
 
-    return {"result": result}
-    # return {"result": await step_one.run_step1(data["code"])}
+@app.post("/step1")
+async def step1_endpoint(request: Request, data: dict = Body(...)):
+    return await run_step_endpoint(request, 1, data)
 
 @app.post("/step2")
-async def step2_endpoint(data: dict = Body(...)):
-    ode = data.get("code")
-    print(f'Received code2: {ode}')
+async def step2_endpoint(request: Request, data: dict = Body(...)):
     # 输入"1", "2"
-    choice = data.get("choice")  # 前端可能传 choice
-    print(f'Received choice2: {choice}')
-
-    user_id: str = data.get("user_id")
-    if not user_id:
-        return {"error": "必须提供 user_id"}
-    
-    # ======== 先检查 cache =========
-    cached_result = step2_cache.get(user_id)
-    if cached_result is not None:
-        print(f"[CACHE HIT] step2 for user_id={user_id}")
-        return {"result": cached_result}
-    
-    step1_output = step1_cache.get(user_id)
-    if step1_output is None:
-        return {"error": "未找到步骤 1 输出，请先执行 step1"}
-
-    result = await step_one.handle_step2(ode, step1_output, choice)
-
-    step2_cache[user_id] = result  # 保存 step2 输出，用于后续步骤
-    print(f"user_id={user_id}, step2_cache keys={list(step2_cache.keys())}")
-
-    return {"result": result}
+    return await run_step_endpoint(request, 2, data)
 
 @app.post("/step3")
-async def step3_endpoint(data: dict = Body(...)):
-    ode = data.get("code")
-    print(f'Received code3: {ode}')
+async def step3_endpoint(request: Request, data: dict = Body(...)):
     # 输入"a", "b"
-    choice = data.get("choice")  # 前端可能传 choice
-    print(f'Received choice3: {choice}')
-
-    user_id: str = data.get("user_id")
-    if not user_id:
-        return {"error": "必须提供 user_id"}
-    
-    # ======== 先检查 cache =========
-    cached_result = step3_cache.get(user_id)
-    if cached_result is not None:
-        print(f"[CACHE HIT] step3 for user_id={user_id}")
-        return {"result": cached_result}
-    
-    # 获取步骤二中得到的假设成因
-    step2_output = step2_cache.get(user_id)
-    hypothesis = utils.extract_hypothesis(step2_output, choice)
-
-    if hypothesis is None:
-        return {"error": "未找到步骤 2 输出，请先执行 step2"}
-
-    result = await step_three.handle_step3(ode, hypothesis, choice)
-
-    step3_cache[user_id] = result  # 保存 step3 输出，用于后续步骤
-    return {"result": result}
+    return await run_step_endpoint(request, 3, data)
 
 @app.post("/step4")
-async def step4_endpoint(data: dict = Body(...)):
-    ode = data.get("code")
-    print(f'Received code4: {ode}')
+async def step4_endpoint(request: Request, data: dict = Body(...)):
     # 输入"1", "2"
     # "1"表示全部采纳，todo: "2"表示自定义组合--这个先不实现，有点难
-    choice = data.get("choice")  # 前端可能传 choice
-    print(f'Received choice4: {choice}')
+    return await run_step_endpoint(request, 4, data)
 
-    user_id: str = data.get("user_id")
-    if not user_id:
-        return {"error": "必须提供 user_id"}
-    
-    # ======== 先检查 cache =========
-    cached_result = step4_cache.get(user_id)
-    if cached_result is not None:
-        print(f"[CACHE HIT] step4 for user_id={user_id}")
-        return {"result": cached_result}
-    
-    # 获取步骤二中得到的假设成因
-    step2_output = step2_cache.get(user_id)
-    hypothesis = utils.extract_hypothesis(step2_output, choice)
+@app.post("/step5")
+async def step5_endpoint(request: Request, data: dict = Body(...)):
+    # 输入"1", "2"
+    # "1"表示是，"2"表示否
+    return await run_step_endpoint(request, 5, data)
 
-    # 获取步骤三中的插桩计划
-    step3_output = step3_cache.get(user_id)
+@app.post("/step6")
+async def step6_endpoint(request: Request, data: dict = Body(...)):
+    return await run_step_endpoint(request, 6, data)
 
-    if step3_output is None:
-        return {"error": "未找到步骤 3 输出，请先执行 step3"}
 
-    result = await step_four.handle_step4(ode, hypothesis, step3_output, choice)
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-    step4_cache[user_id] = result  # 保存 step4 输出，用于后续步骤
-    return {"result": result}
 
-@app.post("/step5")
-async def step5_endpoint(data: dict = Body(...)):
+@app.post("/step{step}/stream")
+async def step_stream_endpoint(step: int, data: dict = Body(...)):
+    """
+    /stepN 的流式版本（Server-Sent Events）
+
+    事件: token（文本增量）、field（已完整的字段）、result（完整结果）、error
+    客户端断开时 StreamingResponse 会取消生成器，模型调用随之中止
+    在途请求太多时直接返回 429；开始推流之后才排队超限的，以 error 事件（带 retry_after）结束
+    在途计数在生成器里进出：生成器没有被执行（客户端提前断开）时不会占着名额
+    """
     ode = data.get("code")
-    print(f'Received code5: {ode}')
-    # 输入"1", "2"
-    # "1"表示是，"2"表示否
-    choice = data.get("choice")  # 前端可能传 choice
-    print(f'Received choice4: {choice}')
+    choice = data.get("choice")
+    user_id: str = data.get("user_id")
+    if user_id:
+        admission.check(user_id, "interactive")
+
+    async def events():
+        if not user_id:
+            yield sse_event("error", "必须提供 user_id")
+            return
+        try:
+            context = admission.enter(user_id, "interactive")
+        except AdmissionRejected as e:
+            yield sse_event("error", {"error": str(e), "retry_after": e.retry_seconds})
+            return
+        try:
+            missing, (code,) = await resolve_blobs(ode)
+            if missing is not None:
+                yield sse_event("error", missing)
+                return
+            if not 1 <= step <= pipeline.LAST_STEP:
+                yield sse_event("error", f"无效的 step: {step}")
+                return
+            bind(context)
+            async for event, payload in pipeline.stream_step(step, user_id, code, choice):
+                yield sse_event(event, payload)
+        except AdmissionRejected as e:
+            yield sse_event("error", {"error": str(e), "retry_after": e.retry_seconds})
+        finally:
+            admission.leave(context)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/debug")
+async def debug_endpoint(request: Request, data: dict = Body(...)):
+    """
+    一次请求完成调试协议
+
+    mode = "auto"（默认）: 服务端按默认选择跑完 step1~6，choices 可覆盖，例如 {"3": "b"}
+    mode = "interactive": 执行 data["step"]（带 choice），返回后在后台按最可能的选择
+                          预取下一步，用户确认时结果通常已经算好
+    mode = "explore": 对 Step 2 的每个假设并行跑 Step 3~5（concurrency 限制并发，
+                      early_stop 默认开启），返回分支排名，最优分支写回会话
+    auto 的模型调用按 batch 优先级排队，interactive / explore 按 interactive，预取按 background
+    """
+    ode = data.get("code")
+    user_id: str = data.get("user_id")
+    if not user_id:
+        return {"error": "必须提供 user_id"}
 
+    missing, (ode,) = await resolve_blobs(ode)
+    if missing is not None:
+        return missing
+
+    mode = data.get("mode", "auto")
+    with admission.request(user_id, "batch" if mode == "auto" else "interactive"):
+        return await _debug(request, data, user_id, ode, mode)
+
+
+async def _debug(request: Request, data: dict, user_id: str, ode, mode: str) -> dict:
+    if mode == "auto":
+        completed, outcome = await run_cancellable(
+            request, pipeline.run_all(user_id, ode, data.get("choices")))
+        if not completed:
+            return {"error": "客户端已断开"}
+        return outcome
+
+    if mode == "interactive":
+        step = int(data.get("step", 1))
+        if not 1 <= step <= pipeline.LAST_STEP:
+            return {"error": f"无效的 step: {step}"}
+        choice = data.get("choice", pipeline.DEFAULT_CHOICES.get(step))
+        completed, outcome = await run_cancellable(
+            request, pipeline.execute_step(step, user_id, ode, choice))
+        if not completed:
+            return {"error": "客户端已断开"}
+        if "error" not in outcome and data.get("speculate", True):
+            outcome["prefetching"] = await pipeline.speculate_next(user_id, ode, step)
+        return outcome
+
+    if mode == "explore":
+        completed, outcome = await run_cancellable(request, explore.explore(
+            user_id, ode,
+            concurrency=int(data.get("concurrency") or explore.EXPLORE_CONCURRENCY),
+            early_stop=bool(data.get("early_stop", explore.EXPLORE_EARLY_STOP))))
+        if not completed:
+            return {"error": "客户端已断开"}
+        return outcome
+
+    return {"error": f"无效的 mode: {mode}"}
+
+
+@app.post("/batch")
+async def batch_endpoint(data: dict = Body(...)):
+    """
+    批量跑非交互协议，结果按完成顺序以 JSONL（application/x-ndjson）流式返回
+
+    请求: {"reports": [{"id": "...", "code": {...bug report...}}, ...],
+           "workers": 8, "choices": {"3": "b"}, "skip": ["已完成的 id", ...], "user_id": "ci"}
+    模型调用按 batch 优先级、记在 user_id（默认 "batch"）名下排队
+    每行一个结果记录，最后一行是 {"summary": {...吞吐、每一步的延迟直方图...}}
+    客户端断开时 StreamingResponse 取消生成器，正在跑的 report 一并取消
+    在途请求太多时直接返回 429；在途计数在生成器里进出，生成器没有被执行时不会占着名额
+    """
+    items = data.get("reports")
+    if not isinstance(items, list):
+        return {"error": "必须提供 reports 列表"}
+    skip = set(data.get("skip") or [])
+    reports = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        report_id = str(item.get("id") or f"item-{index}")
+        if report_id not in skip:
+            reports.append((report_id, item.get("code", item)))
+    missing, codes = await resolve_blobs(*(code for _, code in reports))
+    if missing is not None:
+        return missing
+    reports = [(report_id, code) for (report_id, _), code in zip(reports, codes)]
+    workers = min(int(data.get("workers") or batch.BATCH_WORKERS), batch.BATCH_WORKERS)
+    owner = str(data.get("user_id") or "batch")
+    admission.check(owner, "batch")
+
+    async def lines():
+        try:
+            context = admission.enter(owner, "batch")
+        except AdmissionRejected as e:
+            yield json.dumps({"error": str(e), "retry_after": e.retry_seconds}, ensure_ascii=False) + "\n"
+            return
+        stats = batch.BatchStats()
+        stats.total = len(items)
+        stats.skipped = len(items) - len(reports)
+        try:
+            async for record in batch.run_batch(reports, workers, data.get("choices"), stats, owner):
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+            yield json.dumps({"summary": stats.snapshot()}, ensure_ascii=False) + "\n"
+        finally:
+            admission.leave(context)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# ===== 源码 blob：上传一次，之后按哈希引用 =====
+# 见 backend/services/blob_store.py
+
+@app.post("/blobs")
+async def blob_upload_endpoint(data: dict = Body(...)):
+    """
+    上传源码，返回内容哈希
+
+    全文: {"content": "..."}
+    增量: {"base": "<已有 blob 的哈希>", "delta": [{"start": 10, "end": 12, "lines": [...]}], "hash": "<新哈希，可选>"}
+    返回: {"result": {"hash": "...", "size": 1234, "lines": 56, "created": true}}
+    """
+    try:
+        if "base" in data:
+            blob, created = await asyncio.to_thread(blob_store.put_delta, data["base"], data.get("delta"),
+                                                    data.get("hash"))
+        else:
+            blob, created = await asyncio.to_thread(blob_store.put, data.get("content"))
+    except BlobError as e:
+        return {"error": str(e)}
+    return {"result": {**blob.describe(), "created": created}}
+
+
+@app.get("/blobs/{digest}")
+async def blob_info_endpoint(digest: str, content: bool = False):
+    """blob 是否存在（客户端上传前先问一下）；content=true 时带上内容"""
+    blob = await asyncio.to_thread(blob_store.get, digest)
+    if blob is None:
+        return {"error": "blob 不存在", "missing_blobs": [digest]}
+    info = blob.describe()
+    if content:
+        info["content"] = blob.text
+    return {"result": info}
+
+
+# ===== 会话日志：历史、回退、分支 =====
+# 见 backend/services/session_journal.py
+
+@app.get("/session/{user_id}/journal")
+async def session_journal_endpoint(user_id: str):
+    if session_journal is None:
+        return {"error": "会话日志未开启（JOURNAL_ENABLED=0）"}
+    history = await asyncio.to_thread(session_journal.history, user_id)
+    return history if "error" in history else {"result": history}
+
+
+@app.post("/session/rollback")
+async def session_rollback_endpoint(data: dict = Body(...)):
+    """回退到 step 之前（新分支），之后重新请求 /stepN 会重新计算这一步"""
     user_id: str = data.get("user_id")
     if not user_id:
         return {"error": "必须提供 user_id"}
-    
-    # ======== 先检查 cache =========
-    cached_result = step5_cache.get(user_id)
-    if cached_result is not None:
-        print(f"[CACHE HIT] step5 for user_id={user_id}")
-        return {"result": cached_result}
-    
-    # 获取步骤二中得到的假设成因
-    step2_output = step2_cache.get(user_id)
-    hypothesis = utils.extract_hypothesis(step2_output, choice)
+    try:
+        step = int(data.get("step"))
+    except (TypeError, ValueError):
+        return {"error": "必须提供 step"}
+    return await pipeline.rollback(user_id, step)
 
-    # 获取步骤三中的插桩计划
-    step3_output = step3_cache.get(user_id)
 
-    # 获取步骤四中的修复补丁
-    step4_output = step4_cache.get(user_id)
+@app.post("/session/checkout")
+async def session_checkout_endpoint(data: dict = Body(...)):
+    """切换到已有分支，会话恢复成那个分支最新的状态"""
+    user_id: str = data.get("user_id")
+    branch = data.get("branch")
+    if not user_id or not branch:
+        return {"error": "必须提供 user_id 和 branch"}
+    return await pipeline.checkout(user_id, str(branch))
 
-    if step4_output is None:
-        return {"error": "未找到步骤 4 输出，请先执行 step4"}
 
-    result = await step_five.handle_step5(ode, hypothesis, step3_output, step4_output, choice)
+def _cache_stats() -> dict:
+    return {"result": result_cache.stats(),
+            "knowledge_base": knowledge_base.stats() if knowledge_base is not None else None,
+            "blobs": blob_store.stats()}
 
-    step5_cache[user_id] = result  # 保存 step4 输出，用于后续步骤
-    return {"result": result}
 
-@app.post("/step6")
-async def step6_endpoint(data: dict = Body(...)):
-    ode = data.get("code")
-    print(f'Received code5: {ode}')
+@app.get("/cache/stats")
+async def cache_stats_endpoint():
+    # 知识库和 blob 存储的统计要查 SQLite
+    return await asyncio.to_thread(_cache_stats)
 
-    user_id: str = data.get("user_id")
-    if not user_id:
-        return {"error": "必须提供 user_id"}  
-    
-    # ======== 先检查 cache =========
-    cached_result = step6_cache.get(user_id)
-    if cached_result is not None:
-        print(f"[CACHE HIT] step6 for user_id={user_id}")
-        return {"result": cached_result}
-
-    # 获取步骤一中的最小化可复现用例
-    step1_output = step1_cache.get(user_id)
- 
-    # 获取步骤三中的插桩计划
-    step3_output = step3_cache.get(user_id)
-
-    # 获取步骤四中的修复补丁
-    step4_output = step4_cache.get(user_id)
-
-    # 获取步骤五中的回归测试
-    step5_output = step5_cache.get(user_id)
-
-    step2_output = {"hypothesis": step3_output.get("hypothesis")} if isinstance(step3_output, dict) else None
-
-    result = {
-        "step": "Step 6/6",
-        "summary": {
-            "step1_minimal_case": step1_output,
-            "step2_hypothesis": step2_output,
-            "step3_instrument_plan": step3_output,
-            "step4_fix_patch": step4_output,
-            "step5_regression": step5_output,
-        }
-    }
-
-    step6_cache[user_id] = result
-
-    return {"result": result}
+
+@app.get("/llm/stats")
+async def llm_stats_endpoint():
+    return {"result": claude_client.llm_stats(), "routes": model_router.table(),
+            "replay": claude_client.replay_stats(), "admission": admission.stats()}
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus 文本格式的指标（活跃会话数要查会话存储，放到线程池里渲染）"""
+    return PlainTextResponse(await asyncio.to_thread(metrics.render), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,105 @@
+# backend/bench/bench_llm_client.py
+"""
+LLM 客户端基准测试：对比旧的同步调用与新的异步连接池客户端
+
+在本地假 LLM 服务上并发发起请求，输出吞吐 (req/s) 与 p50/p99 延迟。
+
+用法:
+    python -m backend.bench.bench_llm_client --requests 200 --concurrency 50 --latency 0.2
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from backend.bench.fake_llm_server import start_in_thread
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def make_sync_prompt(base_url: str):
+    """改造前的实现：async 函数里直接调用同步 OpenAI 客户端"""
+    from openai import OpenAI
+
+    client = OpenAI(api_key="bench", base_url=base_url)
+
+    async def sync_prompt(prompt: str) -> str:
+        completion = client.chat.completions.create(
+            model="openai/gpt-5",
+            messages=[{"role": "user", "content": prompt}],
+        )
+        return completion.choices[0].message.content
+
+    return sync_prompt
+
+
+def make_async_prompt(base_url: str):
+    """改造后的实现：backend.services.claude_client.claude_prompt"""
+    os.environ["OPENAI_API_BASE"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    from backend.services import claude_client
+
+    return claude_client.claude_prompt
+
+
+async def run_load(prompt_fn, total: int, concurrency: int) -> dict:
+    latencies: list[float] = []
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> None:
+        async with gate:
+            start = time.perf_counter()
+            await prompt_fn(f"bench request {i}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": total,
+        "elapsed_s": elapsed,
+        "rps": total / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def print_report(name: str, stats: dict) -> None:
+    print(
+        f"{name:<8} requests={stats['requests']:<5} "
+        f"elapsed={stats['elapsed_s']:.2f}s "
+        f"rps={stats['rps']:.1f} "
+        f"p50={stats['p50_ms']:.0f}ms "
+        f"p99={stats['p99_ms']:.0f}ms"
+    )
+
+
+async def main_async(args) -> None:
+    server = start_in_thread(port=args.port, latency=args.latency)
+    print(f"fake LLM: {server.base_url}, latency={args.latency}s, "
+          f"concurrency={args.concurrency}")
+    if not args.skip_before:
+        before = await run_load(make_sync_prompt(server.base_url), args.requests, args.concurrency)
+        print_report("before", before)
+    after = await run_load(make_async_prompt(server.base_url), args.requests, args.concurrency)
+    print_report("after", after)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="LLM 客户端基准测试")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--skip-before", action="store_true", help="只测改造后的客户端")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# backend/bench/bench_llm_scheduler.py
+"""
+模型请求调度基准测试：故障 / 长尾环境下对比直接调用与调度器（重试 + 对冲 + 故障转移）
+
+启动两个本地假服务：
+- primary：按 --error-rate 返回 503，按 --tail-rate 出现 --tail-latency 秒的长尾
+- backup：正常服务
+输出成功率和 p50/p95/p99 延迟，以及调度器里每个服务商的统计。
+
+用法:
+    python -m backend.bench.bench_llm_scheduler --requests 300 --concurrency 30
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from backend.bench.bench_llm_client import percentile
+from backend.bench.fake_llm_server import start_in_thread
+
+
+async def run_load(prompt_fn, total: int, concurrency: int) -> dict:
+    latencies: list[float] = []
+    failures = 0
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> None:
+        nonlocal failures
+        async with gate:
+            start = time.perf_counter()
+            try:
+                await prompt_fn(f"bench request {i}")
+            except Exception:
+                failures += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": total,
+        "failures": failures,
+        "elapsed_s": elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def print_report(name: str, stats: dict) -> None:
+    print(
+        f"{name:<10} requests={stats['requests']:<5} "
+        f"failures={stats['failures']:<4} "
+        f"elapsed={stats['elapsed_s']:.2f}s "
+        f"p50={stats['p50_ms']:.0f}ms "
+        f"p95={stats['p95_ms']:.0f}ms "
+        f"p99={stats['p99_ms']:.0f}ms"
+    )
+
+
+def make_direct_prompt(base_url: str):
+    """不做重试 / 对冲，只调用 primary"""
+    from openai import AsyncOpenAI
+
+    client = AsyncOpenAI(api_key="bench", base_url=base_url, max_retries=0)
+
+    async def direct_prompt(prompt: str) -> str:
+        completion = await client.chat.completions.create(
+            model="openai/gpt-5", messages=[{"role": "user", "content": prompt}],
+        )
+        return completion.choices[0].message.content
+
+    return direct_prompt
+
+
+def make_scheduled_prompt(primary_url: str, backup_url: str):
+    import httpx
+    from openai import AsyncOpenAI
+    from backend.services.llm_scheduler import LLMScheduler, Provider
+
+    http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=128))
+    providers = [
+        Provider(name, url, "openai/gpt-5",
+                 AsyncOpenAI(api_key="bench", base_url=url, http_client=http_client, max_retries=0))
+        for name, url in (("primary", primary_url), ("backup", backup_url))
+    ]
+    scheduler = LLMScheduler(providers, asyncio.Semaphore(128))
+
+    async def scheduled_prompt(prompt: str) -> str:
+        return await scheduler.complete([{"role": "user", "content": prompt}], 30)
+
+    return scheduled_prompt, scheduler
+
+
+async def main_async(args) -> None:
+    primary = start_in_thread(port=args.port, latency=args.latency, error_rate=args.error_rate,
+                              tail_rate=args.tail_rate, tail_latency=args.tail_latency, seed=1)
+    backup = start_in_thread(port=args.port + 1, latency=args.latency, seed=2)
+    print(f"primary: {primary.base_url} error_rate={args.error_rate} "
+          f"tail_rate={args.tail_rate} tail_latency={args.tail_latency}s")
+    print(f"backup:  {backup.base_url}")
+
+    direct = await run_load(make_direct_prompt(primary.base_url), args.requests, args.concurrency)
+    print_report("direct", direct)
+
+    scheduled_prompt, scheduler = make_scheduled_prompt(primary.base_url, backup.base_url)
+    # 先积累延迟样本，对冲延迟才有 p95 可用
+    await run_load(scheduled_prompt, args.warmup, args.concurrency)
+    scheduled = await run_load(scheduled_prompt, args.requests, args.concurrency)
+    print_report("scheduled", scheduled)
+    for name, stats in scheduler.stats().items():
+        print(f"  {name}: {stats}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="模型请求调度基准测试")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.1)
+    parser.add_argument("--tail-rate", type=float, default=0.05)
+    parser.add_argument("--tail-latency", type=float, default=2.0)
+    parser.add_argument("--port", type=int, default=9110)
+    args = parser.parse_args()
+    # 对冲的最小延迟要低于长尾，否则看不出效果；退避上限也调小，免得基准跑太久
+    os.environ.setdefault("LLM_HEDGE_MIN_DELAY", str(args.latency * 1.5))
+    os.environ.setdefault("LLM_BACKOFF_BASE", "0.05")
+    os.environ.setdefault("LLM_BACKOFF_MAX", "0.5")
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# backend/bench/bench_sessions.py
+"""
+端到端压测：N 个并发的模拟 CLI 会话依次请求 /step1 … /step6
+
+模型调用走录制 / 回放层（backend.services.llm_replay），不花钱也不用等真实模型：
+1. 夹具目录为空（或 --seed）时先录制一遍：
+   --record-from fake  本地假服务按 step 返回脚本化的回复（默认，完全离线）
+   --record-from live  真实模型（使用 OPENAI_API_BASE / LLM_PROVIDERS 的配置）
+2. 清空结果缓存，然后用回放模式 + 合成延迟跑压测
+
+知识库快速路径和静态规则默认关掉（KB_ENABLED=0、RULES_ENABLED=0），否则 Step 2~4 会绕过模型、
+什么也录不到；需要连它们一起压测时加 --with-kb / --with-rules。录制结束一条夹具都没有时直接失败。
+
+输出吞吐、每一步的 p50/p95/p99、错误数，以及进程 RSS / Python 堆的增长，
+用来离线发现并发和缓存行为上的退化。
+
+用法:
+    python -m backend.bench.bench_sessions --sessions 20 --rounds 3 --latency 0.3
+    python -m backend.bench.bench_sessions --sessions 20 --unique-code   # 每个会话代码不同，缓存不命中
+"""
+import argparse
+import asyncio
+import difflib
+import gc
+import json
+import os
+import re
+import resource
+import time
+import tracemalloc
+
+from backend.bench.bench_llm_client import percentile
+from backend.bench.fake_llm_server import start_in_thread
+from backend.services.llm_replay import LLM_REPLAY_DIR
+
+DEMO_FILE = "demo/buggy.py"
+DEMO_REPORT = "demo/bug_report.json"
+# 和 pipeline.DEFAULT_CHOICES 一致：确认复现、第一个假设、全部采纳插桩、跑回归
+STEP_CHOICES = {1: None, 2: "1", 3: "a", 4: "1", 5: "1", 6: None}
+
+
+# ===== 录制用的脚本化回复（针对 demo/buggy.py）=====
+
+def _demo_patch() -> str:
+    with open(DEMO_FILE, "r", encoding="utf-8") as f:
+        original = f.read()
+    fixed = original.replace("for i in range(len(items) + 1):", "for i in range(len(items)):")
+    return "".join(difflib.unified_diff(
+        original.splitlines(keepends=True), fixed.splitlines(keepends=True),
+        fromfile=f"a/{DEMO_FILE}", tofile=f"b/{DEMO_FILE}"))
+
+
+def demo_responder(prompt: str) -> str:
+    """按 prompt 里 JSON 模板的 "Step N/6" 返回这一步的合格回复"""
+    steps = re.findall(r'"step":\s*"Step (\d)/6"', prompt)
+    step = int(steps[-1]) if steps else 1
+    title = "循环边界 range(len(items) + 1) 多迭代一次，i == len(items) 时越界"
+    responses = {
+        1: {"step": "Step 1/6", "mre_file": "test_mre.py",
+            "run_result": "程序崩溃 (IndexError: list index out of range)",
+            "question": "确认此用例是否能复现问题?", "options": {"1": "确认", "2": "回退"}},
+        2: {"step": "Step 2/6", "hypotheses": [
+                {"id": "a", "title": title, "evidence": "traceback 指向 items[i]，循环上界是 len(items) + 1"},
+                {"id": "b", "title": "items 在处理过程中被修改", "evidence": "暂无直接证据"},
+            ], "question": "请选择可信假设，返回对应 id"},
+        3: {"step": "Step 3/6", "hypothesis": title,
+            "instrumentation_plan": ["在 process_items 的循环里打印 i 和 len(items)", "断言 0 <= i < len(items)"],
+            "question": "是否采纳这些插桩？", "options": {"1": "全部采纳", "2": "自定义组合上述插桩"}},
+        4: {"step": "Step 4/6", "patch": _demo_patch(), "impact_scope": ["process_items"],
+            "question": "是否应用此补丁？", "options": {"1": "确认", "2": "回退"}},
+        5: {"step": "Step 5/6", "regression_results": {"case_001": "✅", "fuzz_10x": "✅"},
+            "question": "是否确认进入最后一步?", "options": {"1": "确认", "2": "否"}},
+    }
+    return json.dumps(responses.get(step, responses[1]), ensure_ascii=False)
+
+
+# ===== 内存 =====
+
+def rss_bytes() -> int:
+    """当前 RSS；没有 /proc 时退回峰值 RSS"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+def _mb(value: int) -> str:
+    return f"{value / 1024 / 1024:.1f}MB"
+
+
+# ===== 会话 =====
+
+def load_demo_report(session: int, unique: bool) -> dict:
+    with open(DEMO_REPORT, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    with open(DEMO_FILE, "r", encoding="utf-8") as f:
+        source = f.read()
+    if unique:
+        # 改变代码哈希（结果缓存不命中），但不影响代码切片，回放仍能命中
+        source += f"\n# session {session}\n"
+    report["code_file"] = DEMO_FILE
+    report["source"] = source
+    return report
+
+
+async def run_session(client, session: int, unique: bool, latencies: dict, errors: dict) -> None:
+    report = load_demo_report(session, unique)
+    user_id = f"bench-{session}-{time.monotonic_ns()}"
+    for step in range(1, 7):
+        body = {"user_id": user_id, "code": report}
+        if STEP_CHOICES[step] is not None:
+            body["choice"] = STEP_CHOICES[step]
+        start = time.perf_counter()
+        response = await client.post(f"/step{step}", json=body, timeout=600)
+        latencies[step].append(time.perf_counter() - start)
+        data = response.json()
+        if response.status_code != 200 or "error" in data:
+            errors[step] = errors.get(step, 0) + 1
+            print(f"  session {session} step{step} 出错: {str(data.get('error', response.status_code))[:120]}")
+            return
+
+
+async def run_round(client, sessions: int, unique: bool, offset: int) -> dict:
+    latencies: dict[int, list[float]] = {step: [] for step in range(1, 7)}
+    errors: dict[int, int] = {}
+    start = time.perf_counter()
+    await asyncio.gather(*(run_session(client, offset + i, unique, latencies, errors)
+                           for i in range(sessions)))
+    return {"elapsed": time.perf_counter() - start, "latencies": latencies, "errors": errors}
+
+
+def print_round(name: str, sessions: int, outcome: dict) -> None:
+    elapsed = outcome["elapsed"]
+    print(f"{name}: {sessions} 个会话，用时 {elapsed:.2f}s，吞吐 {sessions / elapsed * 60:.1f} 会话/分钟，"
+          f"错误 {sum(outcome['errors'].values())}")
+    print(f"  {'step':<6}{'n':>5}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for step, samples in outcome["latencies"].items():
+        if samples:
+            print(f"  step{step:<2}{len(samples):>5}"
+                  f"{percentile(samples, 50) * 1000:>7.0f}ms{percentile(samples, 95) * 1000:>7.0f}ms"
+                  f"{percentile(samples, 99) * 1000:>7.0f}ms")
+
+
+# ===== 主流程 =====
+
+def _make_client(server: str):
+    import httpx
+
+    if server:
+        return httpx.AsyncClient(base_url=server)
+    from backend.app import app
+    # 进程内直接驱动 ASGI 应用：包含中间件和路由，但没有网络开销
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+
+
+async def main_async(args) -> int:
+    from backend.services.llm_replay import replayer
+    from backend.services.result_cache import result_cache
+
+    if args.seed or not (os.path.isdir(args.fixtures) and os.listdir(args.fixtures)):
+        print(f"录制夹具到 {args.fixtures}（来源: {args.record_from}）")
+        replayer.configure(mode="record", directory=args.fixtures)
+        async with _make_client("") as client:
+            seeded = await run_round(client, 1, False, 0)
+        if seeded["errors"]:
+            print(f"录制失败: {seeded['errors']}")
+            return 1
+        recorded = replayer.stats()["recorded"]
+        if not recorded:
+            print("录制失败: 没有任何模型调用被录下来（知识库 / 静态规则是否绕过了模型？）")
+            return 1
+        print(f"  录制了 {recorded} 条")
+
+    replayer.configure(mode="replay", directory=args.fixtures, latency=str(args.latency),
+                       jitter=args.jitter, miss="route" if args.unique_code else "error")
+    result_cache.clear()
+    if not replayer.stats()["fixtures"] and not args.server:
+        print(f"{args.fixtures} 里没有夹具，加 --seed 重新录制")
+        return 1
+    print(f"回放: {replayer.stats()['fixtures']} 条夹具，合成延迟 {args.latency}s ±{args.jitter * 100:.0f}%")
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    async with _make_client(args.server) as client:
+        outcomes = []
+        baseline_rss = heap_baseline = None
+        for index in range(args.rounds):
+            outcome = await run_round(client, args.sessions, args.unique_code, (index + 1) * args.sessions)
+            print_round(f"第 {index + 1} 轮", args.sessions, outcome)
+            outcomes.append(outcome)
+            gc.collect()
+            # 以第一轮结束后的内存作为基线，排除导入、连接池、沙箱进程预热
+            if index == 0:
+                baseline_rss = rss_bytes()
+                heap_baseline = tracemalloc.get_traced_memory()[0] if args.tracemalloc else None
+
+    merged = {"elapsed": sum(o["elapsed"] for o in outcomes),
+              "latencies": {s: [x for o in outcomes for x in o["latencies"][s]] for s in range(1, 7)},
+              "errors": {}}
+    for outcome in outcomes:
+        for step, count in outcome["errors"].items():
+            merged["errors"][step] = merged["errors"].get(step, 0) + count
+    print()
+    print_round("合计", args.sessions * args.rounds, merged)
+
+    if args.rounds > 1:
+        growth = rss_bytes() - baseline_rss
+        per_session = growth / (args.sessions * (args.rounds - 1))
+        print(f"内存: RSS 第 1 轮后 {_mb(baseline_rss)}，结束 {_mb(rss_bytes())}，"
+              f"增长 {_mb(growth)}（每会话 {per_session / 1024:.1f}KB）")
+        if args.tracemalloc:
+            heap = tracemalloc.get_traced_memory()[0] - heap_baseline
+            print(f"      Python 堆增长 {_mb(heap)}（每会话 {heap / (args.sessions * (args.rounds - 1)) / 1024:.1f}KB）")
+    print(f"回放统计: {replayer.stats()}")
+    print(f"结果缓存: {result_cache.stats()}")
+    return 1 if merged["errors"] else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="端到端会话压测（模型调用录制 / 回放）")
+    parser.add_argument("--sessions", type=int, default=20, help="每轮并发会话数")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.3, help="回放时每次模型调用的合成延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.2, help="合成延迟的相对抖动")
+    parser.add_argument("--fixtures", default=os.path.join(LLM_REPLAY_DIR, "demo"))
+    parser.add_argument("--seed", action="store_true", help="即使已有夹具也重新录制")
+    parser.add_argument("--record-from", choices=["fake", "live"], default="fake")
+    parser.add_argument("--unique-code", action="store_true", help="每个会话的代码哈希不同，结果缓存不命中")
+    parser.add_argument("--server", default="", help="压测已经运行的服务（默认在进程内驱动 ASGI 应用）")
+    parser.add_argument("--tracemalloc", action="store_true", help="同时统计 Python 堆增长（有额外开销）")
+    parser.add_argument("--port", type=int, default=9150)
+    parser.add_argument("--with-kb", action="store_true", help="保留知识库快速路径（默认关闭）")
+    parser.add_argument("--with-rules", action="store_true", help="保留静态规则快速路径（默认关闭）")
+    args = parser.parse_args()
+    if args.server and (args.seed or args.record_from == "live"):
+        parser.error("--server 模式下回放层在被测服务里，请在那边设置 LLM_REPLAY_MODE")
+    if args.record_from == "fake":
+        # 录制来源是本地假服务，必须在导入 claude_client 之前设置
+        fake = start_in_thread(port=args.port, latency=0.05, responder=demo_responder)
+        os.environ["OPENAI_API_BASE"] = fake.base_url
+        os.environ["LLM_PROVIDERS"] = ""
+        os.environ.setdefault("OPENAI_API_KEY", "bench")
+    # 同样要在导入 backend.app 之前设置；--server 模式下由被测服务自己的环境决定
+    os.environ["KB_ENABLED"] = "1" if args.with_kb else "0"
+    os.environ["RULES_ENABLED"] = "1" if args.with_rules else "0"
+    raise SystemExit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
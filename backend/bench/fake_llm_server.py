@@ -0,0 +1,184 @@
+# backend/bench/fake_llm_server.py
+"""
+本地假 LLM 服务，模拟 OpenAI 兼容的 /chat/completions 接口
+
+只依赖标准库，支持 HTTP/1.1 keep-alive，用固定延迟模拟模型耗时。
+可以注入故障：按概率返回错误状态码（error_rate / error_status），
+按概率出现长尾延迟（tail_rate / tail_latency），用来测试重试、对冲和熔断。
+responder(prompt) -> str 可以按 prompt 生成回复（例如按 step 返回不同的 JSON），代替固定的 content。
+
+用法:
+    python -m backend.bench.fake_llm_server --port 9100 --latency 0.2
+    python -m backend.bench.fake_llm_server --port 9101 --error-rate 0.2 --tail-rate 0.05 --tail-latency 3
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from typing import Callable, Optional
+
+DEFAULT_CONTENT = json.dumps({
+    "step": "Step 1/6",
+    "mre_file": "test_mre.py",
+    "run_result": "程序崩溃 (IndexError: list index out of range)",
+    "question": "确认此用例是否能复现问题?",
+    "options": {"1": "确认", "2": "回退"}
+}, ensure_ascii=False)
+
+
+def build_completion(content: str, model: str, prompt_tokens: int = 0) -> dict:
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        # 粗略按 4 个字符一个 token 估计
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4,
+                  "total_tokens": prompt_tokens + len(content) // 4},
+    }
+
+
+class FakeLLMServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 9100, latency: float = 0.2,
+                 content: str = DEFAULT_CONTENT, error_rate: float = 0.0, error_status: int = 503,
+                 tail_rate: float = 0.0, tail_latency: float = 0.0, seed: int | None = None,
+                 responder: Optional[Callable[[str], str]] = None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.content = content
+        self.responder = responder
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._server = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # port=0 时由系统分配空闲端口
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                body = await reader.readexactly(length) if length else b""
+
+                self.requests += 1
+                model = "fake"
+                prompt = ""
+                try:
+                    request = json.loads(body or b"{}")
+                    model = request.get("model", model)
+                    prompt = "\n".join(str(m.get("content", "")) for m in request.get("messages", []))
+                except ValueError:
+                    pass
+                content = self.responder(prompt) if self.responder is not None else self.content
+
+                slow = self._random.random() < self.tail_rate
+                failed = self._random.random() < self.error_rate
+                await asyncio.sleep(self.tail_latency if slow else self.latency)
+                if failed:
+                    self.errors += 1
+                    status = f"{self.error_status} Injected Error"
+                    payload = json.dumps({"error": {"message": "injected failure", "type": "server_error"}}).encode()
+                else:
+                    status = "200 OK"
+                    payload = json.dumps(build_completion(content, model, len(body) // 4), ensure_ascii=False).encode()
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n".encode()
+                    + b"Content-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+
+def start_in_thread(**kwargs) -> FakeLLMServer:
+    """
+    在独立线程的事件循环里启动假服务
+
+    基准测试需要这样做：改造前的同步客户端会阻塞调用方的事件循环，
+    如果假服务和它在同一个循环里就会互相卡死。
+    """
+    server = FakeLLMServer(**kwargs)
+    ready = threading.Event()
+
+    def run() -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name="fake-llm-server", daemon=True).start()
+    ready.wait()
+    return server
+
+
+async def _serve(args) -> None:
+    server = FakeLLMServer(args.host, args.port, args.latency, error_rate=args.error_rate,
+                           error_status=args.error_status, tail_rate=args.tail_rate,
+                           tail_latency=args.tail_latency)
+    await server.start()
+    print(f"fake LLM server listening on {server.base_url} (latency={args.latency}s, "
+          f"error_rate={args.error_rate}, tail_rate={args.tail_rate})")
+    await asyncio.Event().wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="本地假 LLM 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.2, help="每个请求的模拟延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误状态码的概率")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="出现长尾延迟的概率")
+    parser.add_argument("--tail-latency", type=float, default=0.0, help="长尾请求的延迟（秒）")
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+# backend/services/admission.py
+"""
+模型调用的准入控制：按用户公平排队、交互请求优先，排队太长时拒绝（HTTP 429 + Retry-After）
+
+claude_prompt / claude_stream 调模型之前先在这里拿一个名额（slot()）：
+- 同时放行的调用不超过 ADMISSION_CONCURRENCY，其余排队
+- 每个用户一个令牌桶，按估计的 prompt token 数扣减：限制单个用户的持续速率（ADMISSION_USER_RATE），
+  允许短时突发（ADMISSION_USER_BURST）；桶空了的用户留在队里，等令牌补上再放行
+- 同一优先级内按加权公平排队（WFQ）：每个调用的虚拟完成时间 = max(全局虚拟时间, 该用户上一个调用的完成时间)
+  + 代价 / 权重，最小的先放行。一个用户一次排上几十个调用，也只是排在他自己的队尾，不会挡住别人
+- 优先级：interactive（逐步交互的 CLI / 前端）> batch（/batch、/debug auto）> background（预取），
+  高优先级有能放行的调用时不放行低优先级
+- 单个用户排队数超过 ADMISSION_USER_QUEUE、或某个优先级的总排队数超过 ADMISSION_QUEUE_LIMIT 时
+  抛 AdmissionRejected，HTTP 层转成 429，Retry-After 按令牌桶补足 / 队列排空的预计时间给出
+- HTTP 层另外限制每个用户同时在途的请求数（ADMISSION_USER_INFLIGHT，见 enter()）
+
+调用属于哪个用户、什么优先级，通过 contextvar 传下来：endpoint 里 request() / bind()，
+之后创建的 task 继承创建时的上下文。没有上下文的调用（命令行工具、测试）记在 anonymous / interactive 下。
+"""
+import os
+import json
+import time
+import math
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+
+from backend.services import metrics
+from backend.services.log import get_logger
+
+logger = get_logger("admission")
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+# 同时放行的模型调用数，默认和 LLM_MAX_CONCURRENCY 一致
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", os.getenv("LLM_MAX_CONCURRENCY", "32")))
+# 每个用户令牌桶的补充速率（估计的 prompt token / 秒）和容量
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "2000"))
+ADMISSION_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", "60000"))
+# 单个用户最多排队的调用数、每个优先级最多排队的调用数
+ADMISSION_USER_QUEUE = int(os.getenv("ADMISSION_USER_QUEUE", "16"))
+ADMISSION_QUEUE_LIMIT = int(os.getenv("ADMISSION_QUEUE_LIMIT", "256"))
+# 单个用户同时在途的 HTTP 请求数
+ADMISSION_USER_INFLIGHT = int(os.getenv("ADMISSION_USER_INFLIGHT", "8"))
+# 用户权重（JSON），例如 {"ci-bot": 0.5, "alice": 2}；不在表里的用户权重为 1
+ADMISSION_USER_WEIGHTS = json.loads(os.getenv("ADMISSION_USER_WEIGHTS", "") or "{}")
+
+PRIORITIES = ("interactive", "batch", "background")
+_RANK = {name: rank for rank, name in enumerate(PRIORITIES)}
+
+
+class AdmissionRejected(Exception):
+    """排队超过上限（或在途请求太多），retry_after 秒之后再试"""
+
+    def __init__(self, message: str, retry_after: float, reason: str, priority: str):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+        self.priority = priority
+
+    @property
+    def retry_seconds(self) -> int:
+        """Retry-After 头只能是整数秒"""
+        return max(1, math.ceil(self.retry_after))
+
+
+class CallContext:
+    """调用方是谁、什么优先级；预取任务被交互请求等待时会被提升（promote）"""
+    __slots__ = ("user", "priority")
+
+    def __init__(self, user: str, priority: str = "interactive"):
+        self.user = str(user)
+        self.priority = priority if priority in _RANK else "interactive"
+
+
+_current: contextvars.ContextVar[Optional[CallContext]] = contextvars.ContextVar("admission_context", default=None)
+
+
+def current() -> Optional[CallContext]:
+    return _current.get()
+
+
+def bind(context: CallContext) -> contextvars.Token:
+    """把当前 task（以及之后从它创建的 task）的调用记在 context 名下"""
+    return _current.set(context)
+
+
+def promote(context: Optional[CallContext], to: Optional[CallContext] = None) -> None:
+    """context 的优先级提升到不低于 to（默认当前上下文）的优先级；还在排队的调用立即按新优先级排"""
+    to = to or current()
+    if context is None or to is None or _RANK[to.priority] >= _RANK[context.priority]:
+        return
+    logger.debug("提升 %s 的优先级: %s → %s", context.user, context.priority, to.priority)
+    context.priority = to.priority
+
+
+def estimate_cost(prompt: str) -> float:
+    """粗略按 4 个字符一 token 估计 prompt 的代价"""
+    return max(1.0, len(prompt or "") / 4)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, cost: float) -> float:
+        """还要等多久才够扣 cost（调用前先 refill）"""
+        return max(0.0, (min(cost, self.capacity) - self.tokens) / self.rate) if self.rate > 0 else 0.0
+
+    def take(self, cost: float) -> None:
+        self.tokens -= min(cost, self.capacity)
+
+
+class _Ticket:
+    """一个排队中的调用"""
+    __slots__ = ("context", "cost", "start", "finish", "seq", "future", "enqueued_at")
+
+    def __init__(self, context: CallContext, cost: float, start: float, finish: float, seq: int):
+        self.context = context
+        self.cost = cost
+        self.start = start
+        self.finish = finish
+        self.seq = seq
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.perf_counter()
+
+
+class FairScheduler:
+    def __init__(self, capacity: int = ADMISSION_CONCURRENCY, rate: float = ADMISSION_USER_RATE,
+                 burst: float = ADMISSION_USER_BURST, user_queue: int = ADMISSION_USER_QUEUE,
+                 queue_limit: int = ADMISSION_QUEUE_LIMIT, user_inflight: int = ADMISSION_USER_INFLIGHT,
+                 weights: Optional[dict] = None):
+        self.capacity = capacity
+        self.rate = rate
+        self.burst = burst
+        self.user_queue = user_queue
+        self.queue_limit = queue_limit
+        self.user_inflight = user_inflight
+        self.weights = weights if weights is not None else ADMISSION_USER_WEIGHTS
+        self.active = 0
+        self.granted = 0
+        self.rejected = 0
+        self._waiting: list[_Ticket] = []
+        self._buckets: dict[str, TokenBucket] = {}
+        self._last_finish: dict[str, float] = {}
+        self._inflight: dict[str, int] = {}
+        self._virtual_time = 0.0
+        self._seq = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # 一次调用占用名额的平均时长（指数滑动平均），估计 Retry-After 用
+        self._service_time = 1.0
+
+    # ----- HTTP 层：每个用户同时在途的请求数 -----
+
+    def check(self, user: str, priority: str = "interactive") -> CallContext:
+        """只检查不计数：超过 ADMISSION_USER_INFLIGHT 时抛 AdmissionRejected"""
+        context = CallContext(user, priority)
+        if ADMISSION_ENABLED and self._inflight.get(context.user, 0) >= self.user_inflight:
+            self._reject(context, "inflight", self._service_time,
+                         f"用户 {context.user} 同时在途的请求超过 {self.user_inflight} 个")
+        return context
+
+    def enter(self, user: str, priority: str = "interactive") -> CallContext:
+        """endpoint 开始处理一个请求；超过 ADMISSION_USER_INFLIGHT 时抛 AdmissionRejected"""
+        context = self.check(user, priority)
+        self._inflight[context.user] = self._inflight.get(context.user, 0) + 1
+        return context
+
+    def leave(self, context: CallContext) -> None:
+        left = self._inflight.get(context.user, 0) - 1
+        if left > 0:
+            self._inflight[context.user] = left
+        else:
+            self._inflight.pop(context.user, None)
+
+    @contextmanager
+    def request(self, user: str, priority: str = "interactive"):
+        """endpoint 用：计入在途请求数，并把之后的模型调用记在 (user, priority) 名下"""
+        context = self.enter(user, priority)
+        token = bind(context)
+        try:
+            yield context
+        finally:
+            _current.reset(token)
+            self.leave(context)
+
+    # ----- 模型调用：排队和放行 -----
+
+    @asynccontextmanager
+    async def slot(self, prompt: str):
+        """claude_prompt / claude_stream 用：拿到名额才调用模型，结束后归还"""
+        if not ADMISSION_ENABLED:
+            yield
+            return
+        context = current() or CallContext("anonymous")
+        await self.acquire(context, estimate_cost(prompt))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._service_time += 0.1 * (time.perf_counter() - start - self._service_time)
+            self.release()
+
+    async def acquire(self, context: CallContext, cost: float) -> None:
+        ticket = self._enqueue(context, cost)
+        self._dispatch()
+        outcome = "cancelled"
+        try:
+            await ticket.future
+            outcome = "granted"
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # 刚放行就被取消：名额要还回去
+                self.release()
+            elif ticket in self._waiting:
+                self._waiting.remove(ticket)
+            raise
+        finally:
+            metrics.admission_wait_seconds.observe(time.perf_counter() - ticket.enqueued_at,
+                                                   priority=ticket.context.priority, outcome=outcome)
+
+    def release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    def _enqueue(self, context: CallContext, cost: float) -> _Ticket:
+        cost = min(cost, self.burst)
+        user = context.user
+        queued = [t for t in self._waiting if t.context.user == user]
+        if len(queued) >= self.user_queue:
+            bucket = self._bucket(user)
+            bucket.refill(time.monotonic())
+            backlog = sum(t.cost for t in queued) + cost
+            wait = max(bucket.wait_time(backlog), self._drain_time(context.priority))
+            self._reject(context, "user_queue", wait, f"用户 {user} 排队的模型调用超过 {self.user_queue} 个")
+        if sum(1 for t in self._waiting if t.context.priority == context.priority) >= self.queue_limit:
+            self._reject(context, "queue", self._drain_time(context.priority),
+                         f"{context.priority} 队列排队的模型调用超过 {self.queue_limit} 个")
+
+        start = max(self._virtual_time, self._last_finish.get(user, 0.0))
+        finish = start + cost / float(self.weights.get(user, 1) or 1)
+        self._last_finish[user] = finish
+        self._seq += 1
+        ticket = _Ticket(context, cost, start, finish, self._seq)
+        self._waiting.append(ticket)
+        return ticket
+
+    def _reject(self, context: CallContext, reason: str, wait: float, message: str) -> None:
+        self.rejected += 1
+        metrics.admission_rejections.inc(priority=context.priority, reason=reason)
+        logger.warning("准入拒绝 (%s): %s，%.1fs 后重试", reason, message, wait)
+        raise AdmissionRejected(message, max(1.0, wait), reason, context.priority)
+
+    def _drain_time(self, priority: str) -> float:
+        """排在 priority 及更高优先级里的调用全部放行的预计时间"""
+        ahead = sum(1 for t in self._waiting if _RANK[t.context.priority] <= _RANK[priority])
+        return (ahead + 1) * self._service_time / max(self.capacity, 1)
+
+    def _bucket(self, user: str) -> TokenBucket:
+        bucket = self._buckets.get(user)
+        if bucket is None:
+            bucket = self._buckets[user] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _dispatch(self) -> None:
+        """有空闲名额时，按 (优先级, 虚拟完成时间) 放行令牌够用的调用"""
+        now = time.monotonic()
+        while self.active < self.capacity and self._waiting:
+            best: Optional[_Ticket] = None
+            soonest = math.inf
+            for ticket in self._waiting:
+                if ticket.future.done():
+                    continue
+                bucket = self._bucket(ticket.context.user)
+                bucket.refill(now)
+                wait = bucket.wait_time(ticket.cost)
+                if wait > 0:
+                    soonest = min(soonest, wait)
+                    continue
+                if best is None or ((_RANK[ticket.context.priority], ticket.finish, ticket.seq)
+                                    < (_RANK[best.context.priority], best.finish, best.seq)):
+                    best = ticket
+            if best is None:
+                # 排着的都在等令牌：到最早能补足的时间再来
+                if soonest < math.inf:
+                    self._schedule(soonest)
+                return
+            self._waiting.remove(best)
+            self._bucket(best.context.user).take(best.cost)
+            self._virtual_time = max(self._virtual_time, best.start)
+            self.active += 1
+            self.granted += 1
+            best.future.set_result(None)
+        self._prune()
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+
+        def fire() -> None:
+            self._timer = None
+            self._dispatch()
+
+        self._timer = asyncio.get_running_loop().call_later(delay, fire)
+
+    def _prune(self) -> None:
+        """没有排队、令牌已经补满的用户不用再记着"""
+        if len(self._buckets) <= 1024:
+            return
+        now = time.monotonic()
+        busy = {t.context.user for t in self._waiting}
+        for user, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if user not in busy and bucket.tokens >= bucket.capacity:
+                del self._buckets[user]
+                if self._last_finish.get(user, 0.0) <= self._virtual_time:
+                    self._last_finish.pop(user, None)
+
+    def queue_depth(self) -> dict[str, int]:
+        depth = {name: 0 for name in PRIORITIES}
+        for ticket in self._waiting:
+            depth[ticket.context.priority] += 1
+        return depth
+
+    def stats(self) -> dict:
+        return {
+            "enabled": ADMISSION_ENABLED,
+            "capacity": self.capacity,
+            "active": self.active,
+            "queued": self.queue_depth(),
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "users_inflight": len(self._inflight),
+            "avg_service_seconds": round(self._service_time, 3),
+        }
+
+
+# 进程内共享的准入调度器
+admission = FairScheduler()
@@ -0,0 +1,284 @@
+# backend/services/blob_store.py
+"""
+内容寻址的源码存储：客户端每个文件只上传一次，之后的请求只带 sha256
+
+- POST /blobs 上传全文，或者上传相对已有 blob 的增量（按行替换），返回新内容的哈希
+- bug report 里用哈希代替内容（见 backend/steps/utils.py）:
+    {"code_file": "demo/buggy.py", "source_blob": "<sha256>"}
+    {"code_contents": [{"fileName": "a.py", "filePath": "src/a.py", "blob": "<sha256>", "success": true}]}
+    {"tests_blob": "<sha256>", "test_file": "test_a.py"}
+  请求体只剩几个哈希，结果缓存 key 的计算量也随之变小，而且和内容一一对应
+- 解码后的文本、按行切分和 AST 都在进程内 LRU 里缓存（Blob），
+  prompt 切片、静态规则检测对同一份源码只解析一次（parse()，内联上传的源码同样走这里）
+- 持久化是本地 SQLite（WAL 模式），多个 worker 共享；BLOB_RETAIN 秒没被用到的 blob 在写入时顺带清理
+"""
+import os
+import ast
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+from backend.services.data_dir import data_path, ensure_parent
+from backend.services.log import get_logger
+
+logger = get_logger("blob_store")
+
+BLOB_PATH = os.getenv("BLOB_PATH", data_path("blob_store.db"))
+# 单个 blob 的大小上限（字节）
+BLOB_MAX_BYTES = int(os.getenv("BLOB_MAX_BYTES", str(8 * 1024 * 1024)))
+# 进程内缓存的 blob 数（含解析好的 AST）
+BLOB_CACHE_ENTRIES = int(os.getenv("BLOB_CACHE_ENTRIES", "128"))
+# 多久没被用到的 blob 会被清理（秒），默认 7 天；清理检查的间隔
+BLOB_RETAIN = float(os.getenv("BLOB_RETAIN", str(7 * 24 * 3600)))
+BLOB_PRUNE_INTERVAL = float(os.getenv("BLOB_PRUNE_INTERVAL", "3600"))
+# 记录 used_at 的最小间隔，避免每次读取都写库
+_TOUCH_INTERVAL = 600
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS blobs ("
+    " hash TEXT PRIMARY KEY,"
+    " data TEXT NOT NULL,"
+    " size INTEGER NOT NULL,"
+    " created_at REAL NOT NULL,"
+    " used_at REAL NOT NULL)",
+)
+
+
+class BlobError(Exception):
+    """上传的内容或增量无效（太大、基准 blob 不存在、行号越界、哈希对不上）"""
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class Blob:
+    """一份源码：文本、按行切分、AST 都是按需计算一次"""
+    __slots__ = ("hash", "text", "_lines", "_tree", "_parsed")
+
+    def __init__(self, digest: str, text: str):
+        self.hash = digest
+        self.text = text
+        self._lines: Optional[list[str]] = None
+        self._tree: Optional[ast.Module] = None
+        self._parsed = False
+
+    @property
+    def lines(self) -> list[str]:
+        if self._lines is None:
+            self._lines = self.text.split("\n")
+        return self._lines
+
+    @property
+    def tree(self) -> Optional[ast.Module]:
+        """解析好的 AST，有语法错误时为 None；调用方只读，不能原地修改"""
+        if not self._parsed:
+            try:
+                self._tree = ast.parse(self.text)
+            except (SyntaxError, ValueError):
+                self._tree = None
+            self._parsed = True
+        return self._tree
+
+    def describe(self) -> dict:
+        return {"hash": self.hash, "size": len(self.text.encode("utf-8")), "lines": len(self.lines)}
+
+
+def apply_delta(lines: list[str], delta: Any) -> list[str]:
+    """
+    按行替换：delta = [{"start": 10, "end": 12, "lines": ["新的第 11 行", ...]}, ...]
+
+    start / end 是基准内容里从 0 开始的半开区间 [start, end)，各段互不重叠
+    """
+    if not isinstance(delta, list):
+        raise BlobError("delta 必须是列表")
+    edits = []
+    for edit in delta:
+        if not isinstance(edit, dict):
+            raise BlobError(f"无效的 delta 段: {edit!r}")
+        start, end, new = edit.get("start"), edit.get("end", edit.get("start")), edit.get("lines") or []
+        if not (isinstance(start, int) and isinstance(end, int) and 0 <= start <= end <= len(lines)):
+            raise BlobError(f"delta 行号越界: [{start}, {end})，基准共 {len(lines)} 行")
+        if not isinstance(new, list) or not all(isinstance(line, str) for line in new):
+            raise BlobError("delta 的 lines 必须是字符串列表")
+        edits.append((start, end, new))
+    edits.sort(key=lambda item: item[0])
+    for (_, prev_end, _), (start, _, _) in zip(edits, edits[1:]):
+        if start < prev_end:
+            raise BlobError("delta 各段不能重叠")
+    result = list(lines)
+    for start, end, new in reversed(edits):
+        result[start:end] = new
+    return result
+
+
+class BlobStore:
+    def __init__(self, path: str = BLOB_PATH, cache_entries: int = BLOB_CACHE_ENTRIES,
+                 retain: float = BLOB_RETAIN, prune_interval: float = BLOB_PRUNE_INTERVAL):
+        self.path = path
+        self.cache_entries = cache_entries
+        self.retain = retain
+        self.prune_interval = prune_interval
+        self.hits = 0
+        self.misses = 0
+        self._last_prune = time.time()
+        self._touched: dict[str, float] = {}
+        self._cache: "OrderedDict[str, Blob]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._open_lock = threading.Lock()
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """第一次用到时才打开数据库"""
+        if self._db is None:
+            with self._open_lock:
+                if self._db is None:
+                    conn = sqlite3.connect(ensure_parent(self.path), check_same_thread=False, isolation_level=None)
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                    for statement in _SCHEMA:
+                        conn.execute(statement)
+                    self._db = conn
+        return self._db
+
+    # ===== 进程内缓存 =====
+
+    def _remember(self, blob: Blob) -> Blob:
+        with self._lock:
+            self._cache[blob.hash] = blob
+            self._cache.move_to_end(blob.hash)
+            while len(self._cache) > self.cache_entries:
+                self._cache.popitem(last=False)
+        return blob
+
+    def _cached(self, digest: str) -> Optional[Blob]:
+        with self._lock:
+            blob = self._cache.get(digest)
+            if blob is not None:
+                self._cache.move_to_end(digest)
+            return blob
+
+    def parse(self, text: str) -> Optional[ast.Module]:
+        """任意源码的 AST（按内容哈希缓存），有语法错误时返回 None；调用方只读"""
+        digest = content_hash(text)
+        blob = self._cached(digest) or self._remember(Blob(digest, text))
+        return blob.tree
+
+    # ===== 读写 =====
+
+    def put(self, text: str) -> tuple[Blob, bool]:
+        """存一份内容，返回 (blob, 是否新建)"""
+        if not isinstance(text, str):
+            raise BlobError("content 必须是字符串")
+        if len(text.encode("utf-8")) > BLOB_MAX_BYTES:
+            raise BlobError(f"内容超过 {BLOB_MAX_BYTES} 字节")
+        digest = content_hash(text)
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO blobs (hash, data, size, created_at, used_at) VALUES (?, ?, ?, ?, ?)",
+                (digest, text, len(text.encode("utf-8")), now, now))
+            created = bool(cur.rowcount)
+            if not created:
+                self._conn.execute("UPDATE blobs SET used_at = ? WHERE hash = ?", (now, digest))
+            self._touched[digest] = now
+        if created:
+            logger.debug("新 blob %s（%d 字节）", digest[:12], len(text))
+        self._maybe_prune()
+        return self._cached(digest) or self._remember(Blob(digest, text)), created
+
+    def put_delta(self, base: str, delta: Any, expected: Optional[str] = None) -> tuple[Blob, bool]:
+        """在基准 blob 上应用按行增量并存下结果；expected 是客户端算出的新哈希，对不上时报错"""
+        base_blob = self.get(base)
+        if base_blob is None:
+            raise BlobError(f"基准 blob 不存在: {base}")
+        text = "\n".join(apply_delta(base_blob.lines, delta))
+        if expected and content_hash(text) != expected:
+            raise BlobError(f"应用增量后的哈希 {content_hash(text)} 和 {expected} 不一致")
+        return self.put(text)
+
+    def get(self, digest: Any) -> Optional[Blob]:
+        if not isinstance(digest, str):
+            return None
+        blob = self._cached(digest)
+        now = time.time()
+        if blob is None:
+            with self._lock:
+                row = self._conn.execute("SELECT data FROM blobs WHERE hash = ?", (digest,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            blob = self._remember(Blob(digest, row[0]))
+        self.hits += 1
+        if now - self._touched.get(digest, 0) > _TOUCH_INTERVAL:
+            with self._lock:
+                self._conn.execute("UPDATE blobs SET used_at = ? WHERE hash = ?", (now, digest))
+                self._touched[digest] = now
+        return blob
+
+    def text(self, digest: Any) -> Optional[str]:
+        blob = self.get(digest)
+        return blob.text if blob is not None else None
+
+    def missing(self, code: Any) -> list[str]:
+        """code（bug report）里引用了、但这里没有的 blob 哈希"""
+        return [digest for digest in references(code) if self.get(digest) is None]
+
+    def expand(self, code: Any) -> Any:
+        """把 code 里的 blob 引用换回内容，用于需要原样把 bug report 交给模型的场景"""
+        if not isinstance(code, dict) or not references(code):
+            return code
+        expanded = dict(code)
+        for ref, field in (("source_blob", "source"), ("tests_blob", "tests")):
+            if ref in expanded:
+                expanded[field] = self.text(expanded.pop(ref))
+        if isinstance(code.get("code_contents"), list):
+            expanded["code_contents"] = [
+                {**{k: v for k, v in item.items() if k != "blob"}, "fullContent": self.text(item["blob"])}
+                if isinstance(item, dict) and item.get("blob") else item
+                for item in code["code_contents"]]
+        return expanded
+
+    # ===== 清理 =====
+
+    def _maybe_prune(self) -> None:
+        if time.time() - self._last_prune < self.prune_interval:
+            return
+        self._last_prune = time.time()
+        self.prune()
+
+    def prune(self, retain: Optional[float] = None) -> int:
+        """删除 retain 秒没被用到的 blob，返回删除条数"""
+        cutoff = time.time() - (self.retain if retain is None else retain)
+        with self._lock:
+            deleted = self._conn.execute("DELETE FROM blobs WHERE used_at < ?", (cutoff,)).rowcount
+            self._touched = {digest: at for digest, at in self._touched.items() if at >= cutoff}
+        if deleted:
+            logger.info("清理了 %d 个过期 blob", deleted)
+        return deleted
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            cached = len(self._cache)
+        return {"path": self.path, "blobs": count, "bytes": size, "cached": cached,
+                "hits": self.hits, "misses": self.misses}
+
+
+def references(code: Any) -> list[str]:
+    """bug report 里引用的全部 blob 哈希"""
+    if not isinstance(code, dict):
+        return []
+    found = [code[ref] for ref in ("source_blob", "tests_blob") if isinstance(code.get(ref), str)]
+    for item in code.get("code_contents") or []:
+        if isinstance(item, dict) and isinstance(item.get("blob"), str):
+            found.append(item["blob"])
+    return found
+
+
+# 进程内共享的实例
+blob_store = BlobStore()
@@ -0,0 +1,401 @@
+# backend/services/bug_patterns.py
+"""
+基于 AST 的常见 bug 模式检测，进程内几毫秒就能跑完
+
+每个检测器找出一类 bug，给出假设（标题、证据）、插桩计划和修复（按行替换 / 插入）:
+    off_by_one        range(len(x) + 1) / while i <= len(x) 循环里用 x[i] 取值
+    unguarded_index   参数可能是空列表，却直接取 x[0] / x[-1]
+    mutable_default   可变对象作为参数默认值（[] / {} / set() ...），多次调用之间共享
+    none_after_get    d.get(k) 的结果没判空就取属性 / 下标 / 参与运算
+
+置信度 = 检测器的基础分，再按 Step 1 的真实运行结果修正：异常类型对得上、traceback 最内层的用户代码行
+落在这个模式的范围里时提高；程序抛了别的异常时降低；没有这样的佐证时不超过 UNCORROBORATED_CAP，
+单凭代码形状的命中不会绕过模型。
+"""
+import ast
+import re
+from typing import Optional
+
+from backend.services import patcher
+from backend.services.blob_store import blob_store
+
+_INDENT = re.compile(r"^[ \t]*")
+
+# 没有 Step 1 异常佐证的命中，置信度上限（低于 pattern_rules 的 RULES_MIN_CONFIDENCE 默认值）
+UNCORROBORATED_CAP = 0.8
+
+
+class Finding:
+    """一个检测结果；edits 是 [(起始行, 结束行, 替换成的行)]，行号从 1 开始，结束行 < 起始行 表示插入"""
+    __slots__ = ("rule", "line", "end_line", "function", "title", "evidence", "confidence", "exceptions",
+                 "plan", "edits", "corroborated")
+
+    def __init__(self, rule: str, line: int, end_line: int, function: Optional[str], title: str, evidence: str,
+                 confidence: float, exceptions: tuple[str, ...], plan: list[str],
+                 edits: list[tuple[int, int, list[str]]]):
+        self.rule = rule
+        self.line = line
+        self.end_line = end_line
+        self.function = function
+        self.title = title
+        self.evidence = evidence
+        self.confidence = confidence
+        self.exceptions = exceptions
+        self.plan = plan
+        self.edits = edits
+        self.corroborated = False
+
+    def to_dict(self) -> dict:
+        return {
+            "rule": self.rule,
+            "line": self.line,
+            "function": self.function,
+            "title": self.title,
+            "evidence": self.evidence,
+            "confidence": round(self.confidence, 2),
+            "corroborated": self.corroborated,
+        }
+
+
+# ===== 工具 =====
+
+class _Source:
+    """源码行 + 按行号 / 列号（UTF-8 字节偏移，和 ast 一致）取片段"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.lines = text.split("\n")
+
+    def segment(self, node: ast.AST) -> str:
+        return ast.get_source_segment(self.text, node) or ""
+
+    def replace_node(self, node: ast.AST, new_text: str) -> Optional[tuple[int, int, list[str]]]:
+        """单行节点原地替换成 new_text，多行节点不处理"""
+        if node.lineno != node.end_lineno:
+            return None
+        raw = self.lines[node.lineno - 1].encode("utf-8")
+        line = raw[:node.col_offset].decode("utf-8") + new_text + raw[node.end_col_offset:].decode("utf-8")
+        return node.lineno, node.lineno, [line]
+
+    def indent(self, line: int) -> str:
+        return _INDENT.match(self.lines[line - 1]).group(0)
+
+
+def _body_start(func: ast.AST) -> int:
+    """函数体第一条语句的行号（跳过 docstring），守卫语句插在它前面"""
+    body = func.body
+    if len(body) > 1 and isinstance(body[0], ast.Expr) and isinstance(getattr(body[0], "value", None), ast.Constant) \
+            and isinstance(body[0].value.value, str):
+        return body[1].lineno
+    return body[0].lineno
+
+
+def _guard(src: _Source, func: ast.AST, lines: list[str]) -> tuple[int, int, list[str]]:
+    """在函数体开头插入几行（和函数体同样缩进）"""
+    at = _body_start(func)
+    indent = src.indent(at)
+    return at, at - 1, [indent + line for line in lines]
+
+
+def _is_len_of(node: ast.AST) -> Optional[ast.AST]:
+    """len(x) → x"""
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "len" \
+            and len(node.args) == 1 and not node.keywords:
+        return node.args[0]
+    return None
+
+
+def _is_one(node: ast.AST) -> bool:
+    return isinstance(node, ast.Constant) and node.value == 1 and not isinstance(node.value, bool)
+
+
+def _same(a: ast.AST, b: ast.AST) -> bool:
+    return ast.dump(a, annotate_fields=False) == ast.dump(b, annotate_fields=False)
+
+
+def _names_in(node: ast.AST) -> set[str]:
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+
+
+def _functions(tree: ast.Module):
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            yield node
+
+
+def _enclosing_function(tree: ast.Module, line: int) -> Optional[str]:
+    best = None
+    for func in _functions(tree):
+        if func.lineno <= line <= func.end_lineno and (best is None or func.lineno > best.lineno):
+            best = func
+    return best.name if best is not None else None
+
+
+def _indexes(body: list[ast.stmt], seq: ast.AST, index: str) -> Optional[ast.Subscript]:
+    """body 里第一个 seq[index] 形式的取值"""
+    for stmt in body:
+        for node in ast.walk(stmt):
+            if isinstance(node, ast.Subscript) and _same(node.value, seq) and isinstance(node.slice, ast.Name) \
+                    and node.slice.id == index:
+                return node
+    return None
+
+
+def _loop_guarded(body: list[ast.stmt], seq: ast.AST, index: str) -> bool:
+    """循环体里有同时提到 index 和 len(seq) 的判断，例如 if i == len(items): break"""
+    for stmt in body:
+        for node in ast.walk(stmt):
+            if isinstance(node, (ast.If, ast.IfExp, ast.Assert)) and index in _names_in(node.test) \
+                    and any(_is_len_of(n) is not None and _same(_is_len_of(n), seq) for n in ast.walk(node.test)):
+                return True
+    return False
+
+
+_MUTATING_METHODS = {"append", "extend", "insert", "pop", "remove", "clear", "add", "update", "discard",
+                     "setdefault", "popitem", "appendleft", "extendleft", "popleft", "sort", "reverse"}
+
+
+def _mutated(func: ast.AST, name: str) -> bool:
+    """函数里原地修改了 name：调用修改方法、下标 / 属性赋值、del、+= 等"""
+    for node in ast.walk(func):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+                and isinstance(node.func.value, ast.Name) and node.func.value.id == name \
+                and node.func.attr in _MUTATING_METHODS:
+            return True
+        targets = node.targets if isinstance(node, (ast.Assign, ast.Delete)) else \
+            [node.target] if isinstance(node, ast.AugAssign) else []
+        for target in targets:
+            if isinstance(node, ast.AugAssign) and isinstance(target, ast.Name) and target.id == name:
+                return True
+            if isinstance(target, (ast.Subscript, ast.Attribute)) and isinstance(target.value, ast.Name) \
+                    and target.value.id == name:
+                return True
+    return False
+
+
+def _tested_between(func: ast.AST, name: str, start: int, end: int) -> bool:
+    """(start, end] 之间有判断 name 的条件，例如 if x is None / x and x.y / x.y if x else None"""
+    for node in ast.walk(func):
+        if not start < getattr(node, "lineno", 0) <= end:
+            continue
+        if isinstance(node, (ast.If, ast.While, ast.IfExp, ast.Assert)) and name in _names_in(node.test):
+            return True
+        if isinstance(node, ast.BoolOp) and name in _names_in(node.values[0]):
+            return True
+        if isinstance(node, ast.Try):
+            return True
+    return False
+
+
+def _guarded_before(func: ast.AST, name: str, line: int) -> bool:
+    """line 之前的条件判断 / 断言 / try 里提到过 name"""
+    for node in ast.walk(func):
+        if getattr(node, "lineno", line) >= line:
+            continue
+        if isinstance(node, (ast.If, ast.While, ast.IfExp, ast.Assert)) and name in _names_in(node.test):
+            return True
+        if isinstance(node, ast.Try) and node.end_lineno >= line:
+            return True
+    return False
+
+
+# ===== 检测器 =====
+
+def _off_by_one(tree: ast.Module, src: _Source) -> list[Finding]:
+    found = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.For) and isinstance(node.target, ast.Name) and isinstance(node.iter, ast.Call) \
+                and isinstance(node.iter.func, ast.Name) and node.iter.func.id == "range" and node.iter.args:
+            stop = node.iter.args[1] if len(node.iter.args) > 1 else node.iter.args[0]
+            if not (isinstance(stop, ast.BinOp) and isinstance(stop.op, ast.Add)):
+                continue
+            seq_node, one = (stop.left, stop.right) if _is_len_of(stop.left) is not None else (stop.right, stop.left)
+            seq = _is_len_of(seq_node)
+            if seq is None or not _is_one(one):
+                continue
+            index = node.target.id
+            if _loop_guarded(node.body, seq, index):
+                continue
+            use = _indexes(node.body, seq, index)
+            edit = src.replace_node(stop, src.segment(seq_node))
+            if edit is None:
+                continue
+            seq_text, bound = src.segment(seq), src.segment(stop)
+            found.append(Finding(
+                "off_by_one", node.lineno, node.end_lineno, None,
+                f"循环边界多了一次: range({bound}) 让 {index} 取到 len({seq_text})，{seq_text}[{index}] 越界",
+                f"第 {node.lineno} 行 for {index} in range({bound})"
+                + (f"，第 {use.lineno} 行用 {src.segment(use)} 取值" if use is not None else ""),
+                0.9 if use is not None else 0.6, ("IndexError",),
+                [f"在第 {node.lineno} 行的循环里打印 {index} 和 len({seq_text})",
+                 f"取 {seq_text}[{index}] 之前断言 0 <= {index} < len({seq_text})"],
+                [edit]))
+        elif isinstance(node, ast.While) and isinstance(node.test, ast.Compare) and len(node.test.ops) == 1 \
+                and isinstance(node.test.ops[0], ast.LtE) and isinstance(node.test.left, ast.Name):
+            seq = _is_len_of(node.test.comparators[0])
+            index = node.test.left.id
+            use = _indexes(node.body, seq, index) if seq is not None else None
+            if use is None or _loop_guarded(node.body, seq, index):
+                continue
+            test = src.segment(node.test)
+            edit = src.replace_node(node.test, re.sub(r"<=", "<", test, count=1))
+            if edit is None:
+                continue
+            seq_text = src.segment(seq)
+            found.append(Finding(
+                "off_by_one", node.lineno, node.end_lineno, None,
+                f"循环条件 {test} 让 {index} 取到 len({seq_text})，{seq_text}[{index}] 越界",
+                f"第 {node.lineno} 行 while {test}，第 {use.lineno} 行用 {src.segment(use)} 取值",
+                0.9, ("IndexError",),
+                [f"在第 {node.lineno} 行的循环里打印 {index} 和 len({seq_text})",
+                 f"取 {seq_text}[{index}] 之前断言 0 <= {index} < len({seq_text})"],
+                [edit]))
+    return found
+
+
+def _unguarded_index(tree: ast.Module, src: _Source) -> list[Finding]:
+    found = []
+    for func in _functions(tree):
+        params = {a.arg for a in func.args.args + func.args.kwonlyargs} - {"self", "cls"}
+        reported: set[str] = set()
+        for node in ast.walk(func):
+            if not (isinstance(node, ast.Subscript) and isinstance(node.ctx, ast.Load)
+                    and isinstance(node.value, ast.Name) and node.value.id in params):
+                continue
+            key, wanted = node.slice, 0
+            if isinstance(key, ast.UnaryOp) and isinstance(key.op, ast.USub):
+                key, wanted = key.operand, 1
+            # 只看 x[0] / x[-1]：空列表上必然越界，而 "if not x" 的守卫正好能修
+            if not (isinstance(key, ast.Constant) and key.value == wanted and not isinstance(key.value, bool)):
+                continue
+            name = node.value.id
+            if name in reported or _guarded_before(func, name, node.lineno):
+                continue
+            reported.add(name)
+            found.append(Finding(
+                "unguarded_index", node.lineno, node.lineno, func.name,
+                f"{func.name} 没有处理 {name} 为空的情况，直接取 {src.segment(node)} 会越界",
+                f"第 {node.lineno} 行 {src.segment(node)} 之前没有检查 {name} 是否为空",
+                0.55, ("IndexError",),
+                [f"在 {func.name} 入口打印 len({name})", f"断言 {name} 非空"],
+                [_guard(src, func, [f"if not {name}:", "    return None"])]))
+    return found
+
+
+_MUTABLE_CALLS = {"list", "dict", "set", "defaultdict", "OrderedDict", "deque"}
+
+
+def _mutable_default(tree: ast.Module, src: _Source) -> list[Finding]:
+    found = []
+    for func in _functions(tree):
+        positional = func.args.posonlyargs + func.args.args
+        pairs = list(zip(positional[len(positional) - len(func.args.defaults):], func.args.defaults))
+        pairs += [(arg, default) for arg, default in zip(func.args.kwonlyargs, func.args.kw_defaults) if default]
+        for arg, default in pairs:
+            mutable = isinstance(default, (ast.List, ast.Dict, ast.Set)) or (
+                isinstance(default, ast.Call) and isinstance(default.func, ast.Name)
+                and default.func.id in _MUTABLE_CALLS)
+            # 只读的默认值（例如 opts={} 只用来查询）不会在调用之间串数据
+            if not mutable or not _mutated(func, arg.arg):
+                continue
+            edit = src.replace_node(default, "None")
+            if edit is None:
+                continue
+            text = src.segment(default)
+            guard = _guard(src, func, [f"if {arg.arg} is None:", f"    {arg.arg} = {text}"])
+            found.append(Finding(
+                "mutable_default", func.lineno, func.end_lineno, func.name,
+                f"{func.name} 的参数 {arg.arg} 默认值 {text} 在多次调用之间共享，上一次调用的修改会带到下一次",
+                f"第 {default.lineno} 行 def {func.name}(..., {arg.arg}={text})",
+                0.88, (),
+                [f"在 {func.name} 入口打印 id({arg.arg}) 和 {arg.arg}", f"连续调用两次 {func.name}，对比 {arg.arg} 的内容"],
+                [edit, guard]))
+    return found
+
+
+def _none_after_get(tree: ast.Module, src: _Source) -> list[Finding]:
+    found = []
+    for func in _functions(tree):
+        for assign in ast.walk(func):
+            if not (isinstance(assign, ast.Assign) and len(assign.targets) == 1
+                    and isinstance(assign.targets[0], ast.Name) and isinstance(assign.value, ast.Call)
+                    and isinstance(assign.value.func, ast.Attribute) and assign.value.func.attr == "get"
+                    and len(assign.value.args) == 1 and not assign.value.keywords):
+                continue
+            name = assign.targets[0].id
+            use = None
+            for node in ast.walk(func):
+                if getattr(node, "lineno", 0) <= assign.lineno:
+                    continue
+                target = None
+                if isinstance(node, (ast.Attribute, ast.Subscript)):
+                    target = node.value
+                elif isinstance(node, ast.BinOp):
+                    target = node.left if isinstance(node.left, ast.Name) and node.left.id == name else node.right
+                elif isinstance(node, ast.Call):
+                    target = node.func
+                if isinstance(target, ast.Name) and target.id == name and (use is None or node.lineno < use.lineno):
+                    use = node
+            if use is None or _tested_between(func, name, assign.lineno, use.lineno):
+                continue
+            indent = src.indent(assign.lineno)
+            found.append(Finding(
+                "none_after_get", assign.lineno, use.lineno, func.name,
+                f"{src.segment(assign.value)} 在 key 不存在时返回 None，{name} 没判空就在第 {use.lineno} 行使用",
+                f"第 {assign.lineno} 行 {name} = {src.segment(assign.value)}，第 {use.lineno} 行 {src.segment(use)}",
+                0.6, ("AttributeError", "TypeError"),
+                [f"在第 {assign.lineno} 行之后打印 {name}", f"断言 {name} is not None"],
+                [(assign.end_lineno + 1, assign.end_lineno, [f"{indent}if {name} is None:", f"{indent}    return None"])]))
+    return found
+
+
+DETECTORS = (_off_by_one, _unguarded_index, _mutable_default, _none_after_get)
+
+
+# ===== 对外接口 =====
+
+def _corroborate(finding: Finding, exception_type: Optional[str], frame_line: Optional[int]) -> None:
+    """用 Step 1 的真实运行结果修正置信度"""
+    if exception_type and exception_type in finding.exceptions and frame_line is not None \
+            and finding.line <= frame_line <= finding.end_line:
+        finding.corroborated = True
+        finding.confidence = min(0.99, max(finding.confidence + 0.1, 0.9))
+        finding.evidence += f"；Step 1 在第 {frame_line} 行抛出 {exception_type}"
+        return
+    finding.confidence = min(finding.confidence, UNCORROBORATED_CAP)
+    if exception_type:
+        # 程序抛了别的异常，或者异常不在这个模式的范围里：多半不是这次要找的 bug
+        finding.confidence -= 0.3
+
+
+def detect(source: str, exception_type: Optional[str] = None, frame_line: Optional[int] = None) -> list[Finding]:
+    """
+    跑全部检测器，按置信度从高到低返回；源码有语法错误时返回空列表
+
+    exception_type / frame_line: Step 1 真实运行抛出的异常类型，以及 traceback 里最内层的用户代码行号
+    """
+    tree = blob_store.parse(source)
+    if tree is None:
+        return []
+    src = _Source(source)
+    findings: list[Finding] = []
+    for detector in DETECTORS:
+        for finding in detector(tree, src):
+            if finding.function is None:
+                finding.function = _enclosing_function(tree, finding.line)
+            _corroborate(finding, exception_type, frame_line)
+            findings.append(finding)
+    findings.sort(key=lambda f: (-f.confidence, f.line))
+    return findings
+
+
+def apply_fix(source: str, finding: Finding, file_name: str = "main.py") -> Optional[str]:
+    """按 finding 的修改生成修复后的源码；结果编译不过时返回 None"""
+    lines = source.split("\n")
+    # 从后往前改，前面的行号不受影响
+    for start, end, new_lines in sorted(finding.edits, key=lambda e: e[0], reverse=True):
+        lines[start - 1:max(end, start - 1)] = new_lines
+    patched = "\n".join(lines)
+    if patcher.check_syntax(patched, file_name) is not None:
+        return None
+    return patched
@@ -1,58 +1,157 @@
 # backend/services/claude_client.py
 import os
 import json
+import time
 import asyncio
+import httpx
 from openai import AsyncOpenAI
 
-# ==== 配置 ====
-API_KEY = os.getenv("OPENAI_API_KEY", "sk-ai-v1-bf85085ef129d72264c1fb94c07cda86046eb505e9d42ddda34be83b54bdf654")  # 可直接写死测试
-API_BASE = os.getenv("OPENAI_API_BASE", "https://zenmux.ai/api/v1")
-GPT_MODEL = "openai/gpt-5"
-
-client = AsyncOpenAI(api_key=API_KEY, base_url=API_BASE)
-
-
-# async def claude_prompt(prompt: str, max_tokens: int = 500, temperature: float = 0) -> str:
-#     """
-#     调用 Claude (gpt-4o) 接口获取文本结果
-#     返回字符串
-#     """
-#     try:
-#         completion = await client.chat.completions.create(
-#             model=GPT_MODEL,
-#             messages=[{"role": "user", "content": prompt}],
-#             max_tokens=max_tokens,
-#             temperature=temperature,
-#             timeout=30,
-#             n=1,
-#             stream=False,
-#             response_format={"type": "text"}  # 返回普通字符串
-#         )
-#         print("3")
-#         return completion.choices[0].message.content
-#     except Exception as e:
-#         return f"请求 Claude 接口失败: {e}"
-# backend/services/claude_client.py
-import os
-import json
-import asyncio
-from openai import OpenAI
+from backend.services import metrics
+from backend.services.admission import admission, AdmissionRejected
+from backend.services.llm_replay import replayer
+from backend.services.llm_scheduler import LLMScheduler, Provider
 
 # ==== 配置 ====
 API_KEY = os.getenv("OPENAI_API_KEY", "sk-ai-v1-bf85085ef129d72264c1fb94c07cda86046eb505e9d42ddda34be83b54bdf654")  # 可写死测试
 API_BASE = os.getenv("OPENAI_API_BASE", "https://zenmux.ai/api/v1")
-GPT_MODEL = "openai/gpt-5"  # 使用你当前的模型
-
-client = OpenAI(api_key=API_KEY, base_url=API_BASE)
-
-async def claude_prompt(prompt: str) -> str:
-    completion = client.chat.completions.create(
-    model="openai/gpt-5", 
-    messages=[
-        {
-            "role": "user",
-            "content": prompt
-        }
+GPT_MODEL = os.getenv("GPT_MODEL", "openai/gpt-5")  # 使用你当前的模型
+
+# ==== 连接池与并发控制 ====
+# 同时在途的模型请求上限，超出的请求在信号量上排队，而不是把上游打满
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+# 单次调用的超时时间（秒），包含排队之后的整个往返
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+# 共享 HTTP 连接池大小
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "64"))
+
+# ==== 多服务商故障转移 ====
+# 按顺序尝试的服务商列表（JSON），前一个不可用（熔断 / 重试用尽 / 鉴权失败）时换下一个，例如
+# [{"name": "zenmux", "base_url": "https://zenmux.ai/api/v1", "api_key": "...", "model": "openai/gpt-5"},
+#  {"name": "backup", "base_url": "http://10.0.0.2:8000/v1", "api_key": "...", "model": "gpt-5",
+#   "models": {"openai/gpt-5-mini": "gpt-5-mini"}}]
+# 不配置时只有 OPENAI_API_BASE + GPT_MODEL 一个
+# 路由表（model_router）里的模型名是按第一个服务商写的，只原样发给它；后面的服务商用 models 映射，
+# 没有映射的用自己的 model
+LLM_PROVIDERS = os.getenv("LLM_PROVIDERS", "")
+
+# 所有请求复用同一个连接池（keep-alive），避免每次调用都重新握手
+_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+    ),
+    timeout=httpx.Timeout(LLM_TIMEOUT, connect=10.0),
+)
+
+_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+
+def _load_providers() -> list[Provider]:
+    configs = json.loads(LLM_PROVIDERS) if LLM_PROVIDERS else [
+        {"name": "default", "base_url": API_BASE, "api_key": API_KEY, "model": GPT_MODEL}
     ]
-    )
-    return completion.choices[0].message.content
+    providers = []
+    for index, config in enumerate(configs):
+        base_url = config.get("base_url", API_BASE)
+        # 重试交给调度器（带退避、对冲和故障转移），SDK 自己不再重试
+        provider_client = AsyncOpenAI(
+            api_key=config.get("api_key", API_KEY), base_url=base_url,
+            http_client=_http_client, max_retries=0,
+        )
+        providers.append(Provider(config.get("name") or f"provider{index}", base_url,
+                                  config.get("model", GPT_MODEL), provider_client,
+                                  models=config.get("models"), accept_routes=index == 0))
+    return providers
+
+
+scheduler = LLMScheduler(_load_providers(), _semaphore)
+# 首选服务商的客户端
+client = scheduler.providers[0].client
+
+
+async def claude_prompt(prompt: str, timeout: float | None = None, route=None) -> str:
+    """
+    异步调用模型接口，返回文本结果
+
+    route: model_router.Route，指定模型、超时和输出 token 上限；None 时用默认模型
+
+    - 先经过准入控制（backend/services/admission.py）按用户公平排队，排队过长时抛 AdmissionRejected
+    - 并发受 LLM_MAX_CONCURRENCY 限制
+    - 每次尝试的超时为 timeout，超时 / 连接错误 / 429 / 5xx 会退避重试、对冲或换服务商
+    - 所有服务商都失败时抛出 LLMUnavailableError
+    - 调用方所在的 task 被取消时（例如客户端断开），底层 HTTP 请求会一并取消
+    - 开启录制 / 回放（LLM_REPLAY_MODE）时经过 llm_replay
+    """
+    timeout = timeout or (route.timeout if route is not None else LLM_TIMEOUT)
+    start = time.perf_counter()
+    outcome = "error"
+
+    def live():
+        return scheduler.complete(
+            [{"role": "user", "content": prompt}], timeout,
+            model=route.model if route is not None else None,
+            max_tokens=route.max_tokens if route is not None else None,
+        )
+
+    try:
+        async with admission.slot(prompt):
+            content = await (replayer.complete(prompt, route, live) if replayer.active else live())
+        outcome = "ok"
+        return content
+    except AdmissionRejected:
+        outcome = "rejected"
+        raise
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        metrics.llm_call_seconds.observe(time.perf_counter() - start, kind="prompt", outcome=outcome,
+                                         route=route.name if route is not None else "default")
+
+
+async def claude_stream(prompt: str, timeout: float | None = None, route=None):
+    """
+    流式调用模型接口，逐段产出文本增量
+
+    与 claude_prompt 共享准入队列和并发信号量，整个流结束前一直占用一个名额；
+    只有在第一个增量到达之前失败才会重试 / 换服务商
+    """
+    timeout = timeout or (route.timeout if route is not None else LLM_TIMEOUT)
+    start = time.perf_counter()
+    outcome = "error"
+
+    def live():
+        return scheduler.stream(
+            [{"role": "user", "content": prompt}], timeout,
+            model=route.model if route is not None else None,
+            max_tokens=route.max_tokens if route is not None else None,
+        )
+
+    try:
+        async with admission.slot(prompt):
+            async for delta in (replayer.stream(prompt, route, live) if replayer.active else live()):
+                yield delta
+        outcome = "ok"
+    except AdmissionRejected:
+        outcome = "rejected"
+        raise
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    finally:
+        metrics.llm_call_seconds.observe(time.perf_counter() - start, kind="stream", outcome=outcome,
+                                         route=route.name if route is not None else "default")
+
+
+def llm_stats() -> dict:
+    """每个服务商的熔断状态、延迟分位数、失败和对冲次数"""
+    return scheduler.stats()
+
+
+def replay_stats() -> dict:
+    return replayer.stats()
+
+
+async def close_client() -> None:
+    """关闭共享连接池，在服务退出时调用"""
+    await _http_client.aclose()
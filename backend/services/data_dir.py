@@ -0,0 +1,21 @@
+# backend/services/data_dir.py
+"""
+本地数据文件（知识库、源码 blob、会话日志这些 SQLite 库）所在的目录
+
+各模块的 *_PATH 没有单独配置时放在 DATA_DIR（默认 ./data）下；
+目录在第一次打开数据库时才创建，导入模块不会在工作目录里留下文件。
+"""
+import os
+
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+
+def data_path(name: str) -> str:
+    return os.path.join(DATA_DIR, name)
+
+
+def ensure_parent(path: str) -> str:
+    """创建 path 所在的目录，返回 path"""
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    return path
@@ -0,0 +1,357 @@
+# backend/services/fault_localization.py
+"""
+频谱故障定位（SBFL）：在模型提出假设之前先在本地圈出可疑代码行
+
+1. 在沙箱里逐个执行测试用例（以及文件自带的 __main__ 入口），记录每次执行覆盖了被调试文件的哪些行
+   - Python 3.12+ 用 sys.monitoring 的 LINE 事件：每个位置第一次命中后返回 DISABLE，
+     之后不再回调，开销远小于 settrace；每次执行前 restart_events() 重新打开
+   - 更早的版本退回 sys.settrace，只在被调试文件的帧里装局部 tracer
+2. 判定每次执行通过还是失败：用例失败 / 出错，或者有异常从被调试文件的函数里抛出去
+   （即使被测试的 assertRaises 接住也算，demo 的用例就是这样断言 IndexError 的）
+3. 按 Ochiai / Tarantula 给每一行打分，只把排名最前的几行放进 Step 2 的 prompt
+
+    ochiai(s)    = ef / sqrt(F * (ef + ep))
+    tarantula(s) = (ef / F) / (ef / F + ep / P)
+
+ef / ep 是覆盖这一行的失败 / 通过执行数，F / P 是失败 / 通过执行总数。
+同分时异常抛出点排在前面。
+"""
+import os
+import json
+import math
+import time
+import shutil
+import asyncio
+import tempfile
+from typing import Optional
+
+from backend.services.log import get_logger
+from backend.services.regression import discover_tests, module_name, REGRESSION_WORKERS
+from backend.services.sandbox import sandbox_pool
+
+logger = get_logger("fault_localization")
+
+# 排序用的公式：ochiai / tarantula
+SBFL_FORMULA = os.getenv("SBFL_FORMULA", "ochiai")
+# 放进 prompt 的可疑行数
+SBFL_TOP_N = int(os.getenv("SBFL_TOP_N", "5"))
+# 报告里保留的可疑行数（客户端展示用）
+SBFL_MAX_LINES = int(os.getenv("SBFL_MAX_LINES", "20"))
+SBFL_TIMEOUT = float(os.getenv("SBFL_TIMEOUT", "30"))
+SBFL_CPU_SECONDS = int(os.getenv("SBFL_CPU_SECONDS", "20"))
+
+FORMULAS = ("ochiai", "tarantula")
+
+_COVERAGE_RUNNER = '''
+import io, os, sys, json, time, runpy, unittest, contextlib
+PARAMS = json.loads(__PARAMS__)
+TARGET = os.path.realpath(PARAMS["target"])
+_known = {}
+lines, raised, seen = set(), [], set()
+unwound = [False]
+
+
+def _is_target(code):
+    name = code.co_filename
+    hit = _known.get(name)
+    if hit is None:
+        hit = _known[name] = os.path.realpath(name) == TARGET
+    return hit
+
+
+def _raised_at(exc, line):
+    # 异常每穿过一层栈帧都会再报告一次，只记录最初抛出的位置
+    if id(exc) not in seen:
+        seen.add(id(exc))
+        raised.append(line)
+
+
+monitoring = getattr(sys, "monitoring", None)
+if monitoring is not None:
+    TOOL = monitoring.COVERAGE_ID
+    EVENTS = monitoring.events
+    monitoring.use_tool_id(TOOL, "truedebug-sbfl")
+
+    def _line_of(code, offset):
+        for start, end, line in code.co_lines():
+            if start <= offset < end:
+                return line
+        return None
+
+    def _on_line(code, line):
+        if _is_target(code):
+            lines.add(line)
+        # 同一位置本次执行里只需要知道“覆盖过”，之后不再回调
+        return monitoring.DISABLE
+
+    def _on_raise(code, offset, exc):
+        if _is_target(code):
+            _raised_at(exc, _line_of(code, offset))
+
+    def _on_unwind(code, offset, exc):
+        if _is_target(code):
+            unwound[0] = True
+
+    monitoring.register_callback(TOOL, EVENTS.LINE, _on_line)
+    monitoring.register_callback(TOOL, EVENTS.RAISE, _on_raise)
+    monitoring.register_callback(TOOL, EVENTS.PY_UNWIND, _on_unwind)
+
+    def _start():
+        monitoring.restart_events()
+        monitoring.set_events(TOOL, EVENTS.LINE | EVENTS.RAISE | EVENTS.PY_UNWIND)
+
+    def _stop():
+        monitoring.set_events(TOOL, 0)
+
+    BACKEND = "sys.monitoring"
+else:
+    pending = set()
+
+    def _local(frame, event, arg):
+        if event == "line":
+            lines.add(frame.f_lineno)
+            pending.discard(frame)
+        elif event == "exception":
+            _raised_at(arg[1], frame.f_lineno)
+            pending.add(frame)
+        elif event == "return" and frame in pending:
+            # 异常之后没有再执行任何一行就返回：异常从这个帧抛出去了
+            unwound[0] = True
+            pending.discard(frame)
+        return _local
+
+    def _global(frame, event, arg):
+        return _local if _is_target(frame.f_code) else None
+
+    def _start():
+        pending.clear()
+        sys.settrace(_global)
+
+    def _stop():
+        sys.settrace(None)
+
+    BACKEND = "settrace"
+
+
+def _execute(run):
+    lines.clear()
+    raised.clear()
+    seen.clear()
+    unwound[0] = False
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        _start()
+        try:
+            status = run()
+        except SystemExit as e:
+            status = "pass" if e.code in (None, 0) else "fail"
+        except BaseException:
+            status = "fail"
+        finally:
+            _stop()
+    return {"status": status, "lines": sorted(lines), "raised": [l for l in raised if l is not None],
+            "unwound": unwound[0], "duration_ms": round((time.perf_counter() - start) * 1000, 3)}
+
+
+def _test(suite):
+    def run():
+        outcome = unittest.TestResult()
+        suite.run(outcome)
+        if outcome.failures or outcome.errors:
+            return "fail"
+        return "skip" if outcome.skipped else "pass"
+    return run
+
+
+def _main():
+    runpy.run_path(TARGET, run_name="__main__")
+    return "pass"
+
+
+# 先导入全部模块再开始记录，模块顶层的代码不算到某一个用例头上
+suites = []
+for test_id in PARAMS["tests"]:
+    try:
+        suites.append((test_id, unittest.defaultTestLoader.loadTestsFromName(test_id)))
+    except Exception:
+        suites.append((test_id, None))
+
+results = []
+for test_id, suite in suites:
+    if suite is None:
+        results.append({"id": test_id, "status": "error", "lines": [], "raised": [], "unwound": False})
+        continue
+    results.append(dict(_execute(_test(suite)), id=test_id))
+if PARAMS["main"]:
+    results.append(dict(_execute(_main), id="__main__"))
+__sandbox_result__ = {"backend": BACKEND, "executions": results}
+'''
+
+
+def _runner(params: dict) -> str:
+    return _COVERAGE_RUNNER.replace("__PARAMS__", repr(json.dumps(params, ensure_ascii=False)))
+
+
+def _write(root: str, rel_path: str, content: str) -> None:
+    path = os.path.join(root, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+
+def has_main_entry(source: str) -> bool:
+    return "if __name__ ==" in source and "__main__" in source
+
+
+def is_failing(execution: dict) -> bool:
+    return execution["status"] in ("fail", "error") or bool(execution.get("unwound"))
+
+
+# ===== 打分 =====
+
+def ochiai(ef: int, ep: int, failed: int) -> float:
+    if not ef or not failed:
+        return 0.0
+    return ef / math.sqrt(failed * (ef + ep))
+
+
+def tarantula(ef: int, ep: int, failed: int, passed: int) -> float:
+    if not ef or not failed:
+        return 0.0
+    fail_ratio = ef / failed
+    pass_ratio = ep / passed if passed else 0.0
+    return fail_ratio / (fail_ratio + pass_ratio)
+
+
+def rank_lines(executions: list[dict], source: str, formula: str = SBFL_FORMULA,
+               limit: int = SBFL_MAX_LINES) -> tuple[int, int, list[dict]]:
+    """返回 (失败执行数, 通过执行数, 按可疑度排好的行)；跳过的用例不参与计算"""
+    counted = [e for e in executions if e["status"] != "skip"]
+    failing = [e for e in counted if is_failing(e)]
+    failed, passed = len(failing), len(counted) - len(failing)
+
+    ef: dict[int, int] = {}
+    ep: dict[int, int] = {}
+    raised: dict[int, int] = {}
+    for execution in counted:
+        bucket = ef if is_failing(execution) else ep
+        for line in execution["lines"]:
+            bucket[line] = bucket.get(line, 0) + 1
+        for line in execution.get("raised", []):
+            raised[line] = raised.get(line, 0) + 1
+
+    text = source.splitlines()
+    ranking = []
+    for line, fail_hits in ef.items():
+        pass_hits = ep.get(line, 0)
+        ranking.append({
+            "line": line,
+            "code": text[line - 1].strip() if 0 < line <= len(text) else "",
+            "ochiai": round(ochiai(fail_hits, pass_hits, failed), 4),
+            "tarantula": round(tarantula(fail_hits, pass_hits, failed, passed), 4),
+            "ef": fail_hits,
+            "ep": pass_hits,
+            "raised": raised.get(line, 0),
+        })
+    ranking.sort(key=lambda r: (-r[formula], -r["raised"], -r["ef"], r["line"]))
+    return failed, passed, ranking[:limit]
+
+
+# ===== 运行 =====
+
+async def _collect(workspace: str, file_name: str, test_ids: list[str],
+                   main: bool) -> tuple[Optional[str], list[dict]]:
+    """把用例分片到多个沙箱 worker 并行采集覆盖；__main__ 入口单独算一片"""
+    jobs: list[tuple[list[str], bool]] = []
+    if test_ids:
+        shard_count = min(REGRESSION_WORKERS, len(test_ids))
+        jobs.extend((test_ids[i::shard_count], False) for i in range(shard_count))
+    if main:
+        jobs.append(([], True))
+    target = os.path.join(workspace, file_name)
+    runs = await asyncio.gather(*(
+        sandbox_pool.run(_runner({"target": target, "tests": tests, "main": with_main}),
+                         "sbfl_runner.py", timeout=SBFL_TIMEOUT,
+                         extra={"sys_path": [workspace], "cpu_seconds": SBFL_CPU_SECONDS})
+        for tests, with_main in jobs
+    ))
+
+    backend = None
+    executions = []
+    for (tests, with_main), run in zip(jobs, runs):
+        payload = run.get("payload")
+        if isinstance(payload, dict):
+            backend = payload.get("backend")
+            executions.extend(payload.get("executions", []))
+            continue
+        # 整片没跑完（超时、rlimit）：没有覆盖数据，不参与打分
+        logger.warning("覆盖采集失败: status=%s %s", run.get("status"), run.get("exception_message"))
+    return backend, executions
+
+
+async def localize(file_name: str, source: str, tests: list[tuple[str, str]],
+                   formula: str = SBFL_FORMULA, limit: int = SBFL_MAX_LINES) -> dict:
+    """
+    对被调试文件做频谱故障定位
+
+    返回:
+        {
+          "formula": "ochiai",
+          "backend": "sys.monitoring" / "settrace",
+          "executions": {"failed": 5, "passed": 3},
+          "ranking": [{"line": 17, "code": "item = items[i]", "ochiai": 1.0, "tarantula": 1.0,
+                       "ef": 5, "ep": 0, "raised": 5}, ...],
+          "duration_ms": 总耗时
+        }
+        没有任何失败执行时 ranking 为空并带上 note；参数不对时返回 {"error": ...}
+    """
+    if formula not in FORMULAS:
+        return {"error": f"未知的 SBFL 公式: {formula}（可选 {', '.join(FORMULAS)}）"}
+    start = time.perf_counter()
+    test_ids = [t for rel_path, content in tests for t in discover_tests(rel_path, content)]
+    main = has_main_entry(source)
+    if not test_ids and not main:
+        return {"error": "没有可执行的测试用例或 __main__ 入口"}
+
+    workspace = tempfile.mkdtemp(prefix="truedebug-sbfl-")
+    try:
+        _write(workspace, file_name, source)
+        for rel_path, content in tests:
+            if rel_path != file_name:
+                _write(workspace, rel_path, content)
+        backend, executions = await _collect(workspace, file_name, test_ids, main)
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    failed, passed, ranking = rank_lines(executions, source, formula, limit)
+    report = {
+        "formula": formula,
+        "backend": backend,
+        "module": module_name(file_name),
+        "executions": {"failed": failed, "passed": passed},
+        "ranking": ranking,
+        "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+    }
+    if not failed:
+        report["note"] = "没有失败的执行，无法定位可疑代码行"
+    logger.info("SBFL: %s failed=%d passed=%d backend=%s %.0fms", file_name, failed, passed, backend,
+                report["duration_ms"])
+    return report
+
+
+def summarize_ranking(report: Optional[dict], top_n: int = SBFL_TOP_N) -> Optional[str]:
+    """把排名最前的 top_n 行压缩成给模型看的文字"""
+    if not report or report.get("error"):
+        return None
+    if report.get("note"):
+        return report["note"]
+    counts = report["executions"]
+    formula = report["formula"]
+    lines = [f"失败执行 {counts['failed']} 次、通过执行 {counts['passed']} 次，按 {formula} 排序："]
+    for rank, row in enumerate(report["ranking"][:top_n], 1):
+        detail = f"失败执行覆盖 {row['ef']}/{counts['failed']}，通过执行覆盖 {row['ep']}/{counts['passed']}"
+        if row["raised"]:
+            detail += f"，在此抛出异常 {row['raised']} 次"
+        lines.append(f"{rank}. 第 {row['line']} 行 `{row['code']}`: "
+                     f"ochiai={row['ochiai']:.2f} tarantula={row['tarantula']:.2f}（{detail}）")
+    return "\n".join(lines)
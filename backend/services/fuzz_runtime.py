@@ -0,0 +1,537 @@
+# backend/services/fuzz_runtime.py
+"""
+覆盖率引导 fuzz 的运行时部分：按参数类型生成 / 变异输入、跟踪分支覆盖、最小化崩溃输入
+
+这个文件不导入 backend 包：fuzzer.py 会把它的源码原样拼进沙箱运行脚本里，
+进程内（推断类型、调试）和沙箱里用的是同一份实现。
+
+类型描述（spec）是能 JSON 序列化的字典:
+    {"kind": "int"} / "float" / "str" / "bytes" / "bool" / "none" / "any"
+    {"kind": "list", "item": spec}            {"kind": "set", "item": spec}
+    {"kind": "tuple", "items": [spec, ...]}   定长元组；{"kind": "tuple", "item": spec} 变长
+    {"kind": "dict", "key": spec, "value": spec}
+    {"kind": "union", "options": [spec, ...]}
+输入（一组实参）以 repr 字符串传递和持久化，ast.literal_eval 还原，元组、bytes、集合都能原样往返。
+
+覆盖率按"边"统计：目标模块里同一个栈帧相邻执行的两行 (上一行, 这一行)，
+函数入口记为 (-首行号, 行号)，抛出异常记为 (行号, -1)。新边出现的输入进语料，之后优先变异它们。
+"""
+import io
+import ast
+import sys
+import copy
+import math
+import time
+import random
+import signal
+import importlib
+import contextlib
+
+# 生成的字符串 / 容器的长度上限，嵌套深度上限
+MAX_LEN = 64
+MAX_DEPTH = 4
+# 单条语料 repr 的长度上限，太长的输入不进语料
+MAX_INPUT_REPR = 4096
+MAX_CORPUS = 1024
+
+_INTERESTING_INTS = [0, 1, -1, 2, 3, 7, 8, 16, 32, 64, 100, 127, 128, 255, 256, 1000, 1024,
+                     65535, 2 ** 31 - 1, -2 ** 31, 2 ** 63 - 1]
+_INTERESTING_FLOATS = [0.0, -0.0, 1.0, -1.0, 0.5, 1e-9, 1e9, -1e9, 3.14]
+_CHARS = "abcxyzABC0129 -_./\\:,;'\"%{}[]<>\n\t\x00é中"
+_SIMPLE_KINDS = ["int", "str", "none", "float", "bool", "list"]
+
+
+class FuzzTimeout(Exception):
+    """单个输入执行超过时限"""
+
+
+class _Null(io.TextIOBase):
+    """丢掉目标函数的输出（fuzz 时每秒成千上万次调用）"""
+
+    def write(self, text):
+        return len(text)
+
+
+# ===== 生成 =====
+
+def _kind_of(value):
+    if value is None:
+        return "none"
+    for kind, types in (("bool", bool), ("int", int), ("float", float), ("str", str), ("bytes", bytes),
+                        ("list", list), ("tuple", tuple), ("set", (set, frozenset)), ("dict", dict)):
+        if isinstance(value, types):
+            return kind
+    return "any"
+
+
+def _spec_for(value, spec):
+    """union / any 里和 value 实际类型对应的那个 spec"""
+    kind = spec.get("kind", "any")
+    if kind == "union":
+        actual = _kind_of(value)
+        return next((o for o in spec.get("options") or [] if o.get("kind") == actual), {"kind": actual})
+    if kind == "any":
+        return {"kind": _kind_of(value)}
+    return spec
+
+
+def _words(words, kind):
+    return (words or {}).get(kind) or []
+
+
+def _random_str(rng, words, limit=16):
+    chars = _CHARS + "".join(_words(words, "str"))[:200]
+    return "".join(rng.choice(chars) for _ in range(rng.randint(0, limit)))
+
+
+def generate(spec, rng, words=None, depth=0):
+    """按 spec 随机生成一个值"""
+    kind = spec.get("kind", "any")
+    if kind == "any":
+        kind = rng.choice(_SIMPLE_KINDS if depth < MAX_DEPTH else _SIMPLE_KINDS[:-1])
+        spec = {"kind": kind, "item": {"kind": "any"}}
+    if kind == "union":
+        options = spec.get("options") or [{"kind": "none"}]
+        return generate(rng.choice(options), rng, words, depth)
+    if kind == "none":
+        return None
+    if kind == "bool":
+        return rng.random() < 0.5
+    if kind == "int":
+        pool = _INTERESTING_INTS + _words(words, "int")
+        return rng.choice(pool) if rng.random() < 0.6 else rng.randint(-1000, 1000)
+    if kind == "float":
+        return rng.choice(_INTERESTING_FLOATS) if rng.random() < 0.5 else rng.uniform(-1e3, 1e3)
+    if kind == "str":
+        choice = rng.random()
+        if choice < 0.3 and _words(words, "str"):
+            return rng.choice(_words(words, "str"))
+        return "" if choice < 0.4 else _random_str(rng, words)
+    if kind == "bytes":
+        return bytes(rng.randrange(256) for _ in range(rng.randint(0, 16)))
+    length = 0 if depth >= MAX_DEPTH else rng.choice([0, 1, 2, 3, rng.randint(0, 16)])
+    if kind == "tuple" and "items" in spec:
+        return tuple(generate(s, rng, words, depth + 1) for s in spec["items"])
+    if kind in ("list", "tuple"):
+        items = [generate(spec.get("item") or {"kind": "any"}, rng, words, depth + 1) for _ in range(length)]
+        return tuple(items) if kind == "tuple" else items
+    if kind == "set":
+        items = set()
+        for _ in range(length):
+            item = generate(spec.get("item") or {"kind": "int"}, rng, words, depth + 1)
+            try:
+                items.add(item)
+            except TypeError:  # 不可哈希的元素
+                pass
+        return items
+    if kind == "dict":
+        result = {}
+        for _ in range(length):
+            key = generate(spec.get("key") or {"kind": "str"}, rng, words, depth + 1)
+            try:
+                result[key] = generate(spec.get("value") or {"kind": "any"}, rng, words, depth + 1)
+            except TypeError:
+                pass
+        return result
+    return None
+
+
+# ===== 变异 =====
+
+def _mutate_int(value, rng, words):
+    op = rng.randrange(6)
+    if op == 0:
+        return value + rng.choice([-1, 1]) * rng.randint(1, 16)
+    if op == 1:
+        return value ^ (1 << rng.randrange(32))
+    if op == 2:
+        return rng.choice(_INTERESTING_INTS)
+    if op == 3 and _words(words, "int"):
+        return rng.choice(_words(words, "int"))
+    if op == 4:
+        return -value
+    return rng.randint(-1000, 1000)
+
+
+def _mutate_float(value, rng):
+    op = rng.randrange(4)
+    if op == 0:
+        result = value * rng.uniform(-2, 2)
+    elif op == 1:
+        result = value + rng.uniform(-10, 10)
+    elif op == 2:
+        result = rng.choice(_INTERESTING_FLOATS)
+    else:
+        result = float(round(value))
+    return result if math.isfinite(result) else 0.0
+
+
+def _mutate_sequence(value, rng, make_item, mutate_item, others):
+    """list / str / bytes 共用的变异：插入、删除、替换、复制片段、截断、清空、和别的语料拼接"""
+    items = list(value)
+    op = rng.randrange(9)
+    pos = rng.randrange(len(items) + 1)
+    if op == 0 or not items:
+        items.insert(pos, make_item())
+    elif op == 1:
+        end = min(len(items), pos + rng.randint(1, 4))
+        del items[min(pos, len(items) - 1):max(end, pos + 1)]
+    elif op == 2:
+        index = rng.randrange(len(items))
+        items[index] = mutate_item(items[index])
+    elif op == 3:
+        start = rng.randrange(len(items))
+        chunk = items[start:start + rng.randint(1, 8)]
+        items[pos:pos] = chunk
+    elif op == 4:
+        del items[rng.randrange(len(items) + 1):]
+    elif op == 5:
+        items = []
+    elif op == 6 and len(items) > 1:
+        i, j = rng.randrange(len(items)), rng.randrange(len(items))
+        items[i], items[j] = items[j], items[i]
+    elif op == 7 and others:
+        other = list(rng.choice(others))
+        cut, other_cut = rng.randrange(len(items) + 1), rng.randrange(len(other) + 1)
+        items = items[:cut] + other[other_cut:]
+    else:
+        items = items + items[:MAX_LEN]
+    return items[:MAX_LEN * 4]
+
+
+def mutate(value, spec, rng, words=None, corpus_values=None, depth=0):
+    """在 value 上做一次随机变异，返回新值（不修改原值）"""
+    # 偶尔整个换成新生成的值（union 会顺带换成别的类型）
+    if rng.random() < 0.08 or depth > MAX_DEPTH:
+        return generate(spec, rng, words, depth)
+    spec = _spec_for(value, spec)
+    if isinstance(value, bool):
+        return not value
+    if isinstance(value, int):
+        return _mutate_int(value, rng, words)
+    if isinstance(value, float):
+        return _mutate_float(value, rng)
+    others = [v for v in corpus_values or () if type(v) is type(value) and v]
+    if isinstance(value, str):
+        if rng.random() < 0.15 and _words(words, "str"):
+            word = rng.choice(_words(words, "str"))
+            pos = rng.randrange(len(value) + 1)
+            return (value[:pos] + word + value[pos:]) if rng.random() < 0.5 else word
+        chars = _CHARS + "".join(_words(words, "str"))[:200]
+        return "".join(_mutate_sequence(value, rng, lambda: rng.choice(chars),
+                                        lambda c: rng.choice(chars), others))
+    if isinstance(value, bytes):
+        return bytes(_mutate_sequence(value, rng, lambda: rng.randrange(256),
+                                      lambda b: b ^ (1 << rng.randrange(8)), others))
+    if isinstance(value, tuple) and "items" in spec:
+        if not value:
+            return value
+        index = rng.randrange(len(value))
+        items = spec["items"]
+        item_spec = items[index] if index < len(items) else {"kind": "any"}
+        return value[:index] + (mutate(value[index], item_spec, rng, words, None, depth + 1),) + value[index + 1:]
+    if isinstance(value, (list, tuple)):
+        item_spec = spec.get("item") or {"kind": "any"}
+        items = _mutate_sequence(value, rng, lambda: generate(item_spec, rng, words, depth + 1),
+                                 lambda v: mutate(v, item_spec, rng, words, None, depth + 1), others)
+        return tuple(items) if isinstance(value, tuple) else items
+    if isinstance(value, (set, frozenset)):
+        items = set(value)
+        if items and rng.random() < 0.5:
+            items.discard(rng.choice(sorted(items, key=repr)))
+        else:
+            try:
+                items.add(generate(spec.get("item") or {"kind": "int"}, rng, words, depth + 1))
+            except TypeError:
+                pass
+        return type(value)(items)
+    if isinstance(value, dict):
+        result = dict(value)
+        op = rng.randrange(3)
+        if result and op == 0:
+            del result[rng.choice(list(result))]
+        elif result and op == 1:
+            key = rng.choice(list(result))
+            result[key] = mutate(result[key], spec.get("value") or {"kind": "any"}, rng, words, None, depth + 1)
+        else:
+            try:
+                result[generate(spec.get("key") or {"kind": "str"}, rng, words, depth + 1)] = \
+                    generate(spec.get("value") or {"kind": "any"}, rng, words, depth + 1)
+            except TypeError:
+                pass
+        return result
+    return generate(spec, rng, words, depth)
+
+
+def havoc(args, specs, rng, words=None, corpus=None):
+    """叠加 1~4 次变异，每次随机挑一个参数"""
+    args = list(args)
+    if not args:
+        return args
+    for _ in range(rng.choice([1, 1, 2, 3, 4])):
+        index = rng.randrange(len(args))
+        spec = specs[index] if index < len(specs) else {"kind": "any"}
+        pool = [entry[index] for entry in corpus or () if len(entry) > index]
+        args[index] = mutate(args[index], spec, rng, words, pool[-32:])
+    return args
+
+
+# ===== 执行与覆盖 =====
+
+class Coverage:
+    """sys.settrace 跟踪目标文件里的边，别的文件的栈帧直接跳过"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.current = set()
+
+    def tracer(self, frame, event, arg):
+        if frame.f_code.co_filename != self.filename:
+            return None
+        edges = self.current
+        last = [-frame.f_code.co_firstlineno]
+
+        def local(frame, event, arg):
+            if event == "line":
+                line = frame.f_lineno
+                edges.add((last[0], line))
+                last[0] = line
+            elif event == "exception":
+                edges.add((last[0], -1))
+            return local
+        return local
+
+
+def _alarm(signum, frame):
+    raise FuzzTimeout("单个输入执行超时")
+
+
+def execute(func, args, timeout, coverage=None):
+    """执行一次，返回 (异常或 None, 覆盖到的边)"""
+    args = copy.deepcopy(args)
+    edges = set()
+    timed = timeout and hasattr(signal, "setitimer")
+    error = None
+    if coverage is not None:
+        coverage.current = edges
+        sys.settrace(coverage.tracer)
+    if timed:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        with contextlib.redirect_stdout(_Null()), contextlib.redirect_stderr(_Null()):
+            func(*args)
+    except BaseException as e:  # 目标函数的 SystemExit 也算崩溃
+        error = e
+    finally:
+        if timed:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        sys.settrace(None)
+    return error, edges
+
+
+def crash_signature(error, filename, target):
+    """异常类型 + 目标文件里最内层的出错位置；超时不区分位置"""
+    if isinstance(error, FuzzTimeout):
+        return f"FuzzTimeout@{target}"
+    tb, site = error.__traceback__, None
+    while tb is not None:
+        if tb.tb_frame.f_code.co_filename == filename:
+            site = f"{tb.tb_frame.f_code.co_name}:{tb.tb_lineno}"
+        tb = tb.tb_next
+    return f"{type(error).__name__}@{site or target}"
+
+
+# ===== 最小化 =====
+
+def shrink(value):
+    """比 value 更简单的候选，越激进的越先给出"""
+    if isinstance(value, bool):
+        if value:
+            yield False
+        return
+    if isinstance(value, int):
+        for candidate in (0, 1, value // 2, value - (1 if value > 0 else -1)):
+            if abs(candidate) < abs(value) or (candidate == 1 and value not in (0, 1, -1)):
+                yield candidate
+        return
+    if isinstance(value, float):
+        for candidate in (0.0, float(int(value)), value / 2 if abs(value) > 1 else 0.0):
+            if candidate != value:
+                yield candidate
+        return
+    if isinstance(value, (str, bytes, list)):
+        size = len(value)
+        if size:
+            yield value[:0]
+        chunk = size // 2
+        while chunk >= 1:
+            for start in range(0, size, chunk):
+                candidate = value[:start] + value[start + chunk:]
+                if len(candidate) < size:
+                    yield candidate
+            chunk //= 2
+        if isinstance(value, list):
+            for index, item in enumerate(value):
+                for count, smaller in enumerate(shrink(item)):
+                    if count >= 3:
+                        break
+                    yield value[:index] + [smaller] + value[index + 1:]
+        return
+    if isinstance(value, tuple):
+        for index, item in enumerate(value):
+            for count, smaller in enumerate(shrink(item)):
+                if count >= 3:
+                    break
+                yield value[:index] + (smaller,) + value[index + 1:]
+        return
+    if isinstance(value, (set, frozenset)):
+        if value:
+            yield type(value)()
+        for item in sorted(value, key=repr):
+            yield type(value)(value - {item})
+        return
+    if isinstance(value, dict):
+        if value:
+            yield {}
+        for key in list(value):
+            yield {k: v for k, v in value.items() if k != key}
+        for key, item in value.items():
+            for count, smaller in enumerate(shrink(item)):
+                if count >= 3:
+                    break
+                yield {**value, key: smaller}
+
+
+def minimize(func, args, signature, filename, target, timeout, deadline):
+    """在 deadline 之前尽量缩小输入，缩小后必须仍以同一个签名崩溃"""
+    best = list(args)
+    changed = True
+    while changed and time.perf_counter() < deadline:
+        changed = False
+        for index in range(len(best)):
+            for smaller in shrink(best[index]):
+                if time.perf_counter() >= deadline:
+                    return best
+                candidate = best[:index] + [smaller] + best[index + 1:]
+                error, _ = execute(func, candidate, timeout)
+                if error is not None and crash_signature(error, filename, target) == signature:
+                    best = candidate
+                    changed = True
+                    break
+            if changed:
+                break
+    return best
+
+
+# ===== fuzz 主循环 =====
+
+def _decode(text, arity):
+    try:
+        args = ast.literal_eval(text)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return None
+    return list(args) if isinstance(args, (list, tuple)) and len(args) == arity else None
+
+
+def fuzz_target(func, filename, target, specs, seeds, deadline, rng, words=None,
+                timeout=1.0, minimize_seconds=2.0, max_crashes=20, plateau=0.0):
+    """
+    对一个函数跑到 deadline，返回执行次数、覆盖的边、新发现的语料和（去重、最小化后的）崩溃
+
+    seeds: 测试里的实参样本和持久化语料（repr 字符串）；种子先按原样跑一遍建立覆盖基线
+    plateau: 种子跑完之后连续这么多秒没有新边就提前结束（0 表示跑满 deadline）
+    """
+    arity = len(specs)
+    queue = [args for args in (_decode(text, arity) for text in seeds) if args is not None]
+    if not queue:
+        queue = [[generate(spec, rng, words) for spec in specs] for _ in range(4)]
+    corpus: list = []
+    covered: set = set()
+    new_inputs: list = []
+    crashes: dict = {}
+    coverage = Coverage(filename)
+    # 已知会超时的输入不再重跑，每次都要白等 timeout 秒
+    hung: set = set()
+    execs = 0
+    last_new = time.perf_counter()
+    while time.perf_counter() < deadline:
+        if plateau and not queue and time.perf_counter() - last_new >= plateau:
+            break
+        if queue:
+            args, fresh = queue.pop(0), False
+        elif not corpus or rng.random() < 0.1:
+            args, fresh = [generate(spec, rng, words) for spec in specs], True
+        else:
+            # 一半概率挑最近加入的语料（刚发现新边，附近更可能还有没走过的分支）
+            parent = rng.choice(corpus[-16:] if rng.random() < 0.5 else corpus)
+            args, fresh = havoc(parent, specs, rng, words, corpus), True
+        text = repr(args)
+        if text in hung:
+            continue
+        error, edges = execute(func, args, timeout, coverage)
+        execs += 1
+        if not edges <= covered:
+            covered |= edges
+            last_new = time.perf_counter()
+            if len(text) <= MAX_INPUT_REPR and len(corpus) < MAX_CORPUS:
+                corpus.append(args)
+                if fresh:
+                    new_inputs.append(text)
+        if error is None:
+            continue
+        signature = crash_signature(error, filename, target)
+        if isinstance(error, FuzzTimeout):
+            hung.add(text)
+        if signature in crashes:
+            crashes[signature]["count"] += 1
+            continue
+        if len(crashes) >= max_crashes:
+            continue
+        smallest = args
+        if not isinstance(error, FuzzTimeout):
+            smallest = minimize(func, args, signature, filename, target, timeout,
+                                min(deadline, time.perf_counter() + minimize_seconds))
+        crashes[signature] = {
+            "signature": signature,
+            "exception_type": type(error).__name__,
+            "exception_message": str(error)[:500],
+            "args": repr(smallest)[:MAX_INPUT_REPR],
+            "original_args": repr(args)[:500],
+            "count": 1,
+        }
+    return {
+        "execs": execs,
+        "edges": sorted(covered),
+        "corpus": len(corpus),
+        "new_inputs": new_inputs,
+        "crashes": list(crashes.values()),
+    }
+
+
+def run(params):
+    """
+    沙箱里的入口：按 params 对模块里的每个目标函数依次 fuzz，预算平分
+
+    params: {"module": "demo.buggy", "targets": [{"name": ..., "specs": [...], "seeds": [...]}],
+             "budget": 10, "seed": 0, "words": {"int": [...], "str": [...]}, "timeout": 1.0,
+             "minimize_seconds": 2.0, "max_crashes": 20, "plateau": 0.5}
+    """
+    module = importlib.import_module(params["module"])
+    filename = module.__file__
+    if hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, _alarm)
+    rng = random.Random(params.get("seed", 0))
+    targets = params["targets"]
+    share = float(params["budget"]) / max(len(targets), 1)
+    start = time.perf_counter()
+    results = {}
+    for index, target in enumerate(targets):
+        func = getattr(module, target["name"], None)
+        if not callable(func):
+            continue
+        deadline = start + share * (index + 1)
+        results[target["name"]] = fuzz_target(
+            func, filename, target["name"], target["specs"], target.get("seeds") or [], deadline, rng,
+            params.get("words"), params.get("timeout", 1.0), params.get("minimize_seconds", 2.0),
+            params.get("max_crashes", 20), params.get("plateau", 0.0))
+    return {"targets": results, "duration_ms": round((time.perf_counter() - start) * 1000, 3)}
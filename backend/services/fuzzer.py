@@ -0,0 +1,487 @@
+# backend/services/fuzzer.py
+"""
+Step 5 的覆盖率引导 fuzz：在固定的墙钟预算里找崩溃，结果是 通过/不通过 + 去重后的崩溃数
+
+1. 推断目标函数每个参数的类型（fuzz_runtime 里的 spec）：
+   类型注解（list[str]、Optional[int]、dict[str, int] ...） > 测试里的实参样本 > 默认值；
+   有参数推断不出类型的函数不 fuzz —— 乱传类型得到的 TypeError 不是 bug
+2. 从源码和测试里收集常量（字符串、整数）作为变异字典，容易走进 startswith("重要") 这类分支
+3. FUZZ_WORKERS 个沙箱 worker 并行跑同一组目标（随机种子不同），每个 worker 在预算内
+   生成 / 变异输入，走到新边的输入进语料，崩溃按 (异常类型, 出错行) 去重并最小化；
+   连续 FUZZ_PLATEAU 秒没有新边就提前结束这个目标
+4. 语料按项目持久化（FUZZ_CORPUS_DIR/<项目>/<模块>.<函数>.jsonl），下次从已有语料热启动；
+   崩溃输入也存进去，修复之后第一时间复查。没有给项目名时按提交的源码哈希分目录，
+   不同用户的同名文件不会共用语料
+"""
+import os
+import ast
+import json
+import hashlib
+import time
+import asyncio
+import re
+import threading
+from typing import Any, Optional
+
+from backend.services.sandbox import sandbox_pool
+from backend.services.data_dir import data_path
+from backend.services.log import get_logger
+
+logger = get_logger("fuzzer")
+
+# 每次 fuzz 的墙钟预算（秒），由全部 worker 并行消耗；0 表示不 fuzz
+FUZZ_BUDGET = float(os.getenv("FUZZ_BUDGET", "2"))
+# 覆盖率停滞这么久（秒）就提前结束一个目标，不把预算耗完
+FUZZ_PLATEAU = float(os.getenv("FUZZ_PLATEAU", "0.5"))
+FUZZ_WORKERS = int(os.getenv("FUZZ_WORKERS", str(min(os.cpu_count() or 2, 4))))
+FUZZ_CORPUS_DIR = os.getenv("FUZZ_CORPUS_DIR", data_path("fuzz_corpus"))
+# 每个目标函数最多保留的语料条数（崩溃输入总是保留）
+FUZZ_CORPUS_MAX = int(os.getenv("FUZZ_CORPUS_MAX", "512"))
+# 单个输入的执行时限（秒），超时记为 FuzzTimeout 崩溃
+FUZZ_EXEC_TIMEOUT = float(os.getenv("FUZZ_EXEC_TIMEOUT", "1"))
+# 每个崩溃输入最小化的时间上限（秒），算在预算之内
+FUZZ_MINIMIZE_SECONDS = float(os.getenv("FUZZ_MINIMIZE_SECONDS", "2"))
+# 预算之外，给沙箱启动、导入目标模块留的余量（秒）
+_SLACK = 10
+
+_RUNTIME_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fuzz_runtime.py")
+with open(_RUNTIME_PATH, "r", encoding="utf-8") as _f:
+    _RUNTIME_SOURCE = _f.read()
+
+_RUNNER = _RUNTIME_SOURCE + '''
+import json
+__sandbox_result__ = run(json.loads(__PARAMS__))
+'''
+
+
+# ===== 类型推断 =====
+
+_MISSING = object()
+
+
+def _literal(node: ast.AST) -> Any:
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return _MISSING
+
+
+def collect_call_samples(test_sources: list[str], func_name: str) -> list[list[Any]]:
+    """
+    在测试代码里找 func_name(...) 的调用，还原每次调用的实参（字面量或之前赋值的字面量变量）
+    """
+    samples = []
+    for source in test_sources:
+        try:
+            tree = ast.parse(source)
+        except SyntaxError:
+            continue
+        for func in ast.walk(tree):
+            if not isinstance(func, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                continue
+            assigned: dict[str, Any] = {}
+            for node in ast.walk(func):
+                if isinstance(node, ast.Assign) and len(node.targets) == 1 \
+                        and isinstance(node.targets[0], ast.Name):
+                    value = _literal(node.value)
+                    if value is not _MISSING:
+                        assigned[node.targets[0].id] = value
+            for node in ast.walk(func):
+                if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+                        and node.func.id == func_name) or node.keywords:
+                    continue
+                args = []
+                for arg in node.args:
+                    value = _literal(arg)
+                    if value is _MISSING and isinstance(arg, ast.Name):
+                        value = assigned.get(arg.id, _MISSING)
+                    args.append(value)
+                if args and all(a is not _MISSING for a in args):
+                    samples.append(args)
+    return samples
+
+
+_ANY = {"kind": "any"}
+_HINT_KINDS = {
+    "int": "int", "float": "float", "complex": "float", "str": "str", "bytes": "bytes", "bool": "bool",
+    "None": "none", "NoneType": "none", "Any": "any", "object": "any",
+    "list": "list", "List": "list", "Sequence": "list", "MutableSequence": "list", "Iterable": "list",
+    "Iterator": "list", "Collection": "list",
+    "tuple": "tuple", "Tuple": "tuple",
+    "set": "set", "Set": "set", "frozenset": "set", "FrozenSet": "set", "AbstractSet": "set",
+    "dict": "dict", "Dict": "dict", "Mapping": "dict", "MutableMapping": "dict",
+}
+
+
+def union(*specs: dict) -> dict:
+    options: list[dict] = []
+    for spec in specs:
+        for option in spec["options"] if spec.get("kind") == "union" else [spec]:
+            if option not in options:
+                options.append(option)
+    return options[0] if len(options) == 1 else {"kind": "union", "options": options}
+
+
+def spec_from_annotation(node: Optional[ast.AST]) -> Optional[dict]:
+    """类型注解 → spec；认不出的注解返回 None"""
+    if node is None:
+        return None
+    if isinstance(node, ast.Constant):
+        if node.value is None:
+            return {"kind": "none"}
+        if isinstance(node.value, str):  # 字符串形式的前向引用
+            try:
+                return spec_from_annotation(ast.parse(node.value, mode="eval").body)
+            except SyntaxError:
+                return None
+        return None
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitOr):
+        left, right = spec_from_annotation(node.left), spec_from_annotation(node.right)
+        return union(left, right) if left and right else None
+    if isinstance(node, (ast.Name, ast.Attribute)):
+        kind = _HINT_KINDS.get(node.id if isinstance(node, ast.Name) else node.attr)
+        if kind in ("list", "set"):
+            return {"kind": kind, "item": _ANY}
+        if kind == "tuple":
+            return {"kind": "tuple", "item": _ANY}
+        if kind == "dict":
+            return {"kind": "dict", "key": {"kind": "str"}, "value": _ANY}
+        return {"kind": kind} if kind else None
+    if not isinstance(node, ast.Subscript):
+        return None
+    base = node.value.id if isinstance(node.value, ast.Name) else \
+        node.value.attr if isinstance(node.value, ast.Attribute) else None
+    args = node.slice.elts if isinstance(node.slice, ast.Tuple) else [node.slice]
+    specs = [spec_from_annotation(arg) for arg in args]
+    if base == "Optional":
+        return union(specs[0], {"kind": "none"}) if specs[0] else None
+    if base == "Union":
+        return union(*specs) if all(specs) else None
+    if base == "Annotated":
+        return specs[0]
+    kind = _HINT_KINDS.get(base)
+    if kind in ("list", "set"):
+        return {"kind": kind, "item": specs[0] or _ANY}
+    if kind == "tuple":
+        if len(args) == 2 and isinstance(args[1], ast.Constant) and args[1].value is Ellipsis:
+            return {"kind": "tuple", "item": specs[0] or _ANY}
+        return {"kind": "tuple", "items": [s or _ANY for s in specs]}
+    if kind == "dict" and len(specs) == 2:
+        return {"kind": "dict", "key": specs[0] or {"kind": "str"}, "value": specs[1] or _ANY}
+    return None
+
+
+def spec_from_value(value: Any) -> dict:
+    """由一个样本值推断 spec，容器的元素类型取所有元素的合并"""
+    if value is None:
+        return {"kind": "none"}
+    for kind, types in (("bool", bool), ("int", int), ("float", float), ("str", str), ("bytes", bytes)):
+        if isinstance(value, types):
+            return {"kind": kind}
+    if isinstance(value, tuple):
+        return {"kind": "tuple", "items": [spec_from_value(v) for v in value]}
+    if isinstance(value, (list, set, frozenset)):
+        item = merge(*(spec_from_value(v) for v in value)) if value else _ANY
+        return {"kind": "list" if isinstance(value, list) else "set", "item": item}
+    if isinstance(value, dict):
+        key = merge(*(spec_from_value(k) for k in value)) if value else {"kind": "str"}
+        item = merge(*(spec_from_value(v) for v in value.values())) if value else _ANY
+        return {"kind": "dict", "key": key, "value": item}
+    return _ANY
+
+
+def merge(*specs: dict) -> dict:
+    """合并同一位置的多个 spec：同种容器合并元素类型，不同种类合成 union"""
+    result = specs[0]
+    for spec in specs[1:]:
+        if spec == result:
+            continue
+        kind = result.get("kind")
+        if kind == "any" or spec.get("kind") == "any":
+            result = result if spec.get("kind") == "any" else spec
+        elif kind == spec.get("kind") and kind in ("list", "set"):
+            result = {"kind": kind, "item": merge(result["item"], spec["item"])}
+        elif kind == spec.get("kind") == "dict":
+            result = {"kind": "dict", "key": merge(result["key"], spec["key"]),
+                      "value": merge(result["value"], spec["value"])}
+        elif kind == spec.get("kind") == "tuple":
+            if "items" in result and "items" in spec and len(result["items"]) == len(spec["items"]):
+                result = {"kind": "tuple", "items": [merge(a, b) for a, b in zip(result["items"], spec["items"])]}
+            else:
+                items = result.get("items", [result.get("item", _ANY)]) + spec.get("items", [spec.get("item", _ANY)])
+                result = {"kind": "tuple", "item": merge(*items)}
+        else:
+            result = union(result, spec)
+    return result
+
+
+def infer_specs(func: ast.FunctionDef, samples: list[list[Any]]) -> Optional[list[dict]]:
+    """每个位置参数的 spec；有参数推断不出类型时返回 None（这个函数不 fuzz）"""
+    params = func.args.posonlyargs + func.args.args
+    if params and params[0].arg in ("self", "cls"):
+        return None
+    defaults = [None] * (len(params) - len(func.args.defaults)) + list(func.args.defaults)
+    specs = []
+    for index, (param, default) in enumerate(zip(params, defaults)):
+        spec = spec_from_annotation(param.annotation)
+        if spec is None:
+            seen = [spec_from_value(sample[index]) for sample in samples if len(sample) > index]
+            spec = merge(*seen) if seen else None
+        if spec is None and default is not None:
+            value = _literal(default)
+            if value is not _MISSING:
+                spec = spec_from_value(value)
+        if spec is None:
+            if default is not None:
+                break  # 后面都是有默认值的参数，用默认值就行
+            return None
+        specs.append(spec)
+    return specs or None
+
+
+def harvest_words(sources: list[str], limit: int = 64) -> dict:
+    """源码和测试里出现的字符串、整数常量，作为变异字典"""
+    words: dict[str, list] = {"str": [], "int": []}
+    for source in sources:
+        try:
+            tree = ast.parse(source)
+        except SyntaxError:
+            continue
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Constant) or isinstance(node.value, bool):
+                continue
+            if isinstance(node.value, str) and 0 < len(node.value) <= 32 and "\n" not in node.value:
+                bucket = words["str"]
+            elif isinstance(node.value, int) and abs(node.value) < 2 ** 63:
+                bucket = words["int"]
+            else:
+                continue
+            if node.value not in bucket and len(bucket) < limit:
+                bucket.append(node.value)
+    return words
+
+
+def discover_targets(source: str, test_sources: list[str]) -> dict[str, dict]:
+    """
+    能 fuzz 的顶层函数: {name: {"specs": [...], "samples": [...]}}
+
+    参数类型要么有注解，要么能从测试里的实参样本推断
+    """
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return {}
+    targets = {}
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef) or node.name == "main" or node.name.startswith("_"):
+            continue
+        if not (node.args.posonlyargs or node.args.args):
+            continue
+        samples = collect_call_samples(test_sources, node.name)
+        specs = infer_specs(node, samples)
+        if specs:
+            targets[node.name] = {"specs": specs, "samples": [s for s in samples if len(s) == len(specs)]}
+    return targets
+
+
+# ===== 语料 =====
+
+def project_key(file_name: str, project: Optional[str] = None, source: Optional[str] = None) -> str:
+    """
+    语料按项目分目录：显式给的项目名；否则是 文件名-源码哈希，
+    只有提交了同一份代码的请求才共用语料（source 传打补丁之前的源码）
+    """
+    if not project:
+        digest = hashlib.sha256(f"{file_name}\0{source or ''}".encode("utf-8")).hexdigest()[:16]
+        stem = os.path.splitext(file_name.replace("\\", "/").rsplit("/", 1)[-1])[0]
+        project = f"{stem}-{digest}"
+    return re.sub(r"[^\w.-]+", "_", project).strip("._") or "default"
+
+
+class CorpusStore:
+    """每个目标函数一个 JSONL 文件，一行一条输入: {"args": "<repr>", "crash": 签名或 null, "at": 时间}"""
+
+    def __init__(self, root: str = FUZZ_CORPUS_DIR, max_entries: int = FUZZ_CORPUS_MAX):
+        self.root = root
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def _path(self, project: str, target: str) -> str:
+        return os.path.join(self.root, project, re.sub(r"[^\w.-]+", "_", target) + ".jsonl")
+
+    def _read(self, path: str) -> list[dict]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return []
+        entries = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:  # 写到一半的行
+                continue
+            if isinstance(entry, dict) and isinstance(entry.get("args"), str):
+                entries.append(entry)
+        return entries
+
+    def load(self, project: str, target: str) -> list[dict]:
+        with self._lock:
+            return self._read(self._path(project, target))
+
+    def add(self, project: str, target: str, entries: list[dict]) -> int:
+        """追加新输入（按 args 去重），超过上限时压缩：保留崩溃输入和最近的语料；返回新增条数"""
+        path = self._path(project, target)
+        with self._lock:
+            existing = self._read(path)
+            known = {entry["args"] for entry in existing}
+            fresh = []
+            for entry in entries:
+                if entry["args"] not in known:
+                    known.add(entry["args"])
+                    fresh.append(dict(entry, at=time.time()))
+            if not fresh:
+                return 0
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            combined = existing + fresh
+            if len(combined) <= self.max_entries:
+                with open(path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(entry, ensure_ascii=False) + "\n" for entry in fresh)
+                return len(fresh)
+            crashes = [entry for entry in combined if entry.get("crash")]
+            plain = [entry for entry in combined if not entry.get("crash")]
+            kept = crashes + plain[max(len(plain) - max(self.max_entries - len(crashes), 0), 0):]
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(entry, ensure_ascii=False) + "\n" for entry in kept)
+            os.replace(tmp, path)
+            return len(fresh)
+
+    def stats(self) -> dict:
+        files = entries = 0
+        for root, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(".jsonl"):
+                    files += 1
+                    with open(os.path.join(root, name), "rb") as f:
+                        entries += sum(1 for _ in f)
+        return {"path": self.root, "targets": files, "entries": entries}
+
+
+# ===== 执行 =====
+
+def _runner(params: dict) -> str:
+    return _RUNNER.replace("__PARAMS__", repr(json.dumps(params, ensure_ascii=False)))
+
+
+async def _run_worker(workspace: str, params: dict) -> dict:
+    limit = params["budget"] + FUZZ_MINIMIZE_SECONDS + _SLACK
+    return await sandbox_pool.run(_runner(params), "fuzz_runner.py", timeout=limit,
+                                  extra={"sys_path": [workspace], "cpu_seconds": int(limit)})
+
+
+def _merge_crash(crashes: dict, crash: dict) -> None:
+    """同一签名的崩溃只留一个，保留最小的输入，出现次数累加"""
+    known = crashes.get(crash["signature"])
+    if known is None:
+        crashes[crash["signature"]] = dict(crash)
+        return
+    known["count"] += crash.get("count", 1)
+    if crash.get("args") and len(crash["args"]) < len(known.get("args") or "~" * 10 ** 6):
+        known["args"] = crash["args"]
+
+
+async def fuzz(workspace: str, module: str, file_name: str, source: str, test_sources: list[str],
+               budget: float = FUZZ_BUDGET, project: Optional[str] = None, workers: int = FUZZ_WORKERS,
+               corpus: Optional[CorpusStore] = None) -> dict:
+    """
+    对 workspace 里的 module 做覆盖率引导 fuzz（workspace 里是打过补丁的代码）
+
+    返回:
+        {
+          "passed": 没有发现崩溃,
+          "unique_crashes": 去重后的崩溃数,
+          "execs": 总执行次数, "budget_s": 预算, "workers": 并行 worker 数,
+          "targets": {函数名: {"execs", "edges", "corpus", "new_inputs", "crashes": [...], "duration_ms"}}
+        }
+    没有可 fuzz 的目标函数时 targets 为空、passed 为 None
+    """
+    start = time.perf_counter()
+    targets = discover_targets(source, test_sources)
+    summary = {"passed": None, "unique_crashes": 0, "execs": 0, "budget_s": budget, "workers": 0, "targets": {}}
+    if not targets or budget <= 0:
+        return summary
+    corpus = corpus or corpus_store
+    project = project_key(file_name, project, source)
+    seeds = {}
+    for name, target in targets.items():
+        stored = corpus.load(project, f"{module}.{name}")
+        # 先复查以前的崩溃输入，再跑测试样本和历史语料
+        stored.sort(key=lambda entry: not entry.get("crash"))
+        seeds[name] = [entry["args"] for entry in stored] + [repr(sample) for sample in target["samples"]]
+    words = harvest_words([source] + test_sources)
+    workers = max(1, workers)
+    # worker 各自独占一个沙箱进程，并行消耗同一段墙钟预算
+    runs = await asyncio.gather(*(
+        _run_worker(workspace, {
+            "module": module,
+            "targets": [{"name": name, "specs": target["specs"],
+                         # 种子语料分给各个 worker，崩溃输入每个 worker 都复查
+                         "seeds": seeds[name][index::workers] if index else seeds[name]}
+                        for name, target in targets.items()],
+            "budget": budget,
+            "seed": index,
+            "words": words,
+            "timeout": FUZZ_EXEC_TIMEOUT,
+            "minimize_seconds": FUZZ_MINIMIZE_SECONDS,
+            "plateau": FUZZ_PLATEAU,
+        })
+        for index in range(workers)
+    ))
+
+    report: dict[str, dict] = {name: {"execs": 0, "edges": set(), "new_inputs": [], "crashes": {}}
+                               for name in targets}
+    for run in runs:
+        payload = run.get("payload")
+        results = payload.get("targets") if isinstance(payload, dict) else None
+        if not isinstance(results, dict):
+            # 整个 worker 没跑完（超时、被 rlimit 杀掉、目标模块导入失败）：每个目标记一次崩溃
+            kind = run.get("exception_type") or run.get("status")
+            for name in targets:
+                _merge_crash(report[name]["crashes"], {
+                    "signature": f"{kind}@{name}", "exception_type": kind,
+                    "exception_message": run.get("exception_message"), "args": None, "count": 1})
+            continue
+        for name, result in results.items():
+            entry = report[name]
+            entry["execs"] += result["execs"]
+            entry["edges"].update(tuple(edge) for edge in result["edges"])
+            entry["new_inputs"].extend(result["new_inputs"])
+            for crash in result["crashes"]:
+                _merge_crash(entry["crashes"], crash)
+
+    duration_ms = round((time.perf_counter() - start) * 1000, 3)
+    for name, entry in report.items():
+        crashes = list(entry["crashes"].values())
+        saved = corpus.add(project, f"{module}.{name}",
+                           [{"args": text, "crash": None} for text in entry["new_inputs"]]
+                           + [{"args": c["args"], "crash": c["signature"]} for c in crashes if c.get("args")])
+        summary["targets"][name] = {
+            "execs": entry["execs"],
+            "edges": len(entry["edges"]),
+            "corpus": len(seeds[name]) + saved,
+            "new_inputs": saved,
+            "crashes": crashes,
+            "duration_ms": duration_ms,
+        }
+        summary["execs"] += entry["execs"]
+        summary["unique_crashes"] += len(crashes)
+    summary["workers"] = workers
+    summary["passed"] = summary["unique_crashes"] == 0
+    logger.info("fuzz %s: %d 次执行, %d 个独立崩溃 (%.1fs, %d worker)",
+                module, summary["execs"], summary["unique_crashes"], duration_ms / 1000, workers)
+    return summary
+
+
+# 进程内共享的实例
+corpus_store = CorpusStore()
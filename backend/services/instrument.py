@@ -0,0 +1,509 @@
+# backend/services/instrument.py
+"""
+自动插桩引擎：把 Step 3 的插桩计划真正应用到代码上
+
+1. 把自由文本的计划条目（"在 loop 入口打印 i, len(list)"）解析成结构化探针：
+   watch  变量赋值后记录取值
+   loop   循环每次进入循环体时记录循环变量和相关长度
+   assert 在循环入口 / 赋值后检查条件，只记录不成立的情况
+2. 静态分析源码，决定每个探针插在哪些语句前后（锚点用 行号+列号 表示）
+3. 在沙箱里按锚点改写 AST 并运行（行号保持不变），命中记录进列式环形缓冲区
+4. 把 trace 压缩成一段文字证据，交给 Step 4 的 prompt
+
+计划里解析不出的条目原样放进 skipped 并说明原因，不会瞎插。
+"""
+import os
+import re
+import ast
+import json
+import builtins
+from typing import Any, Optional
+
+from backend.services.sandbox import sandbox_pool
+from backend.services.probe_runtime import apply_probes
+from backend.services.log import get_logger
+
+logger = get_logger("instrument")
+
+INSTRUMENT_TRACE_CAPACITY = int(os.getenv("INSTRUMENT_TRACE_CAPACITY", "1024"))
+INSTRUMENT_TIMEOUT = float(os.getenv("INSTRUMENT_TIMEOUT", "10"))
+INSTRUMENT_MAX_PROBES = int(os.getenv("INSTRUMENT_MAX_PROBES", "16"))
+# 每个探针最多插入的位置数，避免一条 "打印 x" 把整个文件插满
+INSTRUMENT_MAX_SITES = int(os.getenv("INSTRUMENT_MAX_SITES", "32"))
+
+_RUNTIME_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "probe_runtime.py")
+with open(_RUNTIME_PATH, "r", encoding="utf-8") as _f:
+    _RUNTIME_SOURCE = _f.read()
+
+_RUNNER = _RUNTIME_SOURCE + '''
+import json, builtins
+PARAMS = json.loads(__PARAMS__)
+_trace = TraceBuffer(PARAMS["capacity"], asserts=PARAMS["asserts"])
+builtins.__probe__ = _trace.hit
+# 源码落盘，traceback 里才能显示出错的那一行
+with open(PARAMS["filename"], "w", encoding="utf-8") as _f:
+    _f.write(PARAMS["source"])
+_tree = apply_probes(ast.parse(PARAMS["source"], PARAMS["filename"]), PARAMS["insertions"])
+try:
+    exec(compile(_tree, PARAMS["filename"], "exec"),
+         {"__name__": "__main__", "__file__": PARAMS["filename"], "__builtins__": builtins})
+finally:
+    __sandbox_result__ = _trace.export()
+'''
+
+_KIND_KEYWORDS = (
+    ("assert", ("断言", "assert", "检查", "校验")),
+    ("loop", ("循环", "loop", "迭代", "每次", "每轮")),
+    ("watch", ("打印", "print", "记录", "log", "输出", "观察", "监视", "watch")),
+)
+# 计划文本里的 ASCII 片段，候选的 Python 表达式
+_EXPR_SPAN = re.compile(r"[A-Za-z_][A-Za-z0-9_.\[\]()+\-*/%<>=!, ]*")
+# 探针里允许调用的内置函数：不改状态，不会因为插桩改变程序行为
+_SAFE_CALLS = {"len", "type", "repr", "str", "int", "float", "bool", "abs", "min", "max",
+               "sum", "sorted", "list", "tuple", "set", "dict", "isinstance", "id", "hash"}
+_BUILTINS = set(dir(builtins))
+# 计划文本里常见的英文描述词，不当作变量名
+_PLAN_WORDS = {"assert", "loop", "print", "log", "watch", "and", "or", "not", "in", "is", "if", "for", "while"}
+_MAX_EXPRS = 6
+
+
+class Probe:
+    __slots__ = ("id", "kind", "text", "exprs", "functions", "sites", "labels")
+
+    def __init__(self, probe_id: int, kind: str, text: str, exprs: list[str], functions: list[str]):
+        self.id = probe_id
+        self.kind = kind
+        self.text = text
+        self.exprs = exprs
+        # 计划里点名的函数，为空表示整个文件
+        self.functions = functions
+        # 实际插入的行号，以及每个位置记录的表达式（不同位置可见的变量不同）
+        self.sites: list[int] = []
+        self.labels: dict[int, list[str]] = {}
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "kind": self.kind, "text": self.text, "exprs": self.exprs,
+                "functions": self.functions, "lines": self.sites,
+                "labels": {str(line): exprs for line, exprs in self.labels.items()}}
+
+
+# ===== 源码分析 =====
+
+class _Scope:
+    """一个函数（或模块顶层）里绑定的名字、赋值语句和循环"""
+    __slots__ = ("name", "node", "params", "bound", "assigns", "loops")
+
+    def __init__(self, name: Optional[str], node: ast.AST):
+        self.name = name
+        self.node = node
+        self.params: list[str] = []
+        self.bound: set[str] = set()
+        self.assigns: list[tuple[ast.stmt, set[str]]] = []
+        self.loops: list[ast.stmt] = []
+
+
+def _own_nodes(node: ast.AST):
+    """遍历 node 内部的节点，不进入嵌套的函数 / 类 / lambda"""
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+            continue
+        yield child
+        yield from _own_nodes(child)
+
+
+def _stored_names(target: ast.AST) -> set[str]:
+    return {n.id for n in ast.walk(target) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)}
+
+
+def _collect_scopes(tree: ast.Module) -> list[_Scope]:
+    scopes = [_Scope(None, tree)]
+    scopes += [_Scope(node.name, node) for node in ast.walk(tree)
+               if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))]
+    for scope in scopes:
+        if scope.name is not None:
+            args = scope.node.args
+            scope.params = [a.arg for a in args.posonlyargs + args.args + args.kwonlyargs]
+            scope.params += [a.arg for a in (args.vararg, args.kwarg) if a is not None]
+            scope.bound.update(scope.params)
+        for node in _own_nodes(scope.node):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+                scope.bound.add(node.id)
+            if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                names = set().union(*(_stored_names(t) for t in targets))
+                if names:
+                    scope.assigns.append((node, names))
+            elif isinstance(node, (ast.For, ast.AsyncFor, ast.While)):
+                scope.loops.append(node)
+        # 函数、类、import 也是模块顶层可见的名字
+        for node in ast.iter_child_nodes(scope.node):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                scope.bound.add(node.name)
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                scope.bound.update((a.asname or a.name).split(".")[0] for a in node.names)
+    return scopes
+
+
+def _names(expr: str) -> set[str]:
+    return {n.id for n in ast.walk(ast.parse(expr, mode="eval")) if isinstance(n, ast.Name)}
+
+
+def _is_safe(tree: ast.AST) -> bool:
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if not (isinstance(node.func, ast.Name) and node.func.id in _SAFE_CALLS):
+                return False
+        elif isinstance(node, (ast.NamedExpr, ast.Lambda, ast.Await, ast.Yield, ast.YieldFrom)):
+            return False
+    return True
+
+
+def _parse_expr(text: str) -> Optional[ast.expr]:
+    try:
+        return ast.parse(text, mode="eval").body
+    except SyntaxError:
+        return None
+
+
+def _split_top_level(span: str) -> list[str]:
+    """按不在括号里的逗号切分"""
+    parts, depth, current = [], 0, ""
+    for ch in span:
+        if ch in "([":
+            depth += 1
+        elif ch in ")]":
+            depth -= 1
+        if ch == "," and depth == 0:
+            parts.append(current)
+            current = ""
+        else:
+            current += ch
+    parts.append(current)
+    return [p.strip() for p in parts if p.strip()]
+
+
+def extract_exprs(text: str, user_names: set[str], functions: set[str]) -> list[str]:
+    """
+    从计划文本里挑出能在源码上求值的表达式
+
+    表达式里至少要引用一个源码里出现过的名字，其余名字只能是内置函数，
+    "loop"、"case_003"、"len(list)" 这类描述性的词会被过滤掉
+    """
+    found: list[str] = []
+    for span in _EXPR_SPAN.findall(text):
+        for piece in _split_top_level(span):
+            words = piece.split()
+            # "print i and len(x)" 这种前面带英文描述词的，逐个去掉开头的词再试
+            for start in range(len(words)):
+                candidate = " ".join(words[start:])
+                node = _parse_expr(candidate)
+                if node is None:
+                    continue
+                names = _names(candidate)
+                if isinstance(node, ast.Name) and node.id in functions:
+                    break
+                if names & user_names and names <= user_names | _BUILTINS and _is_safe(node):
+                    normalized = ast.unparse(node)
+                    if normalized not in found:
+                        found.append(normalized)
+                break
+    return found
+
+
+def _unknown_names(text: str, user_names: set[str]) -> Optional[list[str]]:
+    """计划里写了英文名字、但没有一个在源码里出现时返回这些名字（例如 "全局变量 X"）"""
+    words = set(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", text)) - _PLAN_WORDS - _BUILTINS
+    if words and not words & user_names:
+        return sorted(words)
+    return None
+
+
+def _classify(text: str) -> Optional[str]:
+    lowered = text.lower()
+    for kind, keywords in _KIND_KEYWORDS:
+        if any(k in lowered for k in keywords):
+            return kind
+    return None
+
+
+def parse_plan(plan: list, tree: ast.Module) -> tuple[list[Probe], list[dict]]:
+    """把 Step 3 的 instrumentation_plan 解析成探针，返回 (probes, skipped)"""
+    scopes = _collect_scopes(tree)
+    functions = {s.name for s in scopes if s.name is not None}
+    # 只认源码自己绑定的名字（参数、赋值、def、import），内置函数名不算
+    user_names = set().union(*(s.bound for s in scopes))
+
+    probes: list[Probe] = []
+    skipped: list[dict] = []
+    for entry in plan or []:
+        text = entry if isinstance(entry, str) else json.dumps(entry, ensure_ascii=False)
+        kind = _classify(text)
+        if kind is None:
+            skipped.append({"text": text, "reason": "无法识别插桩类型（打印 / 循环 / 断言）"})
+            continue
+        if len(probes) >= INSTRUMENT_MAX_PROBES:
+            skipped.append({"text": text, "reason": f"探针数量超过上限 {INSTRUMENT_MAX_PROBES}"})
+            continue
+        unknown = _unknown_names(text, user_names)
+        if unknown is not None:
+            skipped.append({"text": text, "reason": f"计划引用的名字在源码里不存在: {', '.join(unknown)}"})
+            continue
+        mentioned = [f for f in sorted(functions) if re.search(rf"(?<![A-Za-z0-9_]){re.escape(f)}(?![A-Za-z0-9_])", text)]
+        exprs = extract_exprs(text, user_names, functions)
+        if kind == "assert":
+            exprs = [e for e in exprs if isinstance(_parse_expr(e), (ast.Compare, ast.BoolOp, ast.UnaryOp))]
+        elif kind == "watch" and not exprs:
+            skipped.append({"text": text, "reason": "没有找到源码里存在的变量或表达式"})
+            continue
+        probes.append(Probe(len(probes) + 1, kind, text, exprs, mentioned))
+    return probes, skipped
+
+
+# ===== 锚点选择 =====
+
+def _visible(expr: str, scope: _Scope, module: _Scope) -> bool:
+    return _names(expr) <= scope.bound | module.bound | _BUILTINS
+
+
+def _loop_body_anchor(loop: ast.stmt) -> ast.stmt:
+    return loop.body[0]
+
+
+def _loop_exprs(loop: ast.stmt) -> list[str]:
+    """循环自己的上下文：循环变量、range(len(x)) 里的长度、while 条件里的变量"""
+    exprs: list[str] = []
+    if isinstance(loop, (ast.For, ast.AsyncFor)):
+        exprs += sorted(_stored_names(loop.target))
+        source = loop.iter
+    else:
+        source = loop.test
+        exprs += sorted({n.id for n in ast.walk(loop.test) if isinstance(n, ast.Name)} - _BUILTINS)
+    for node in ast.walk(source):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "len" \
+                and _is_safe(node):
+            exprs.append(ast.unparse(node))
+    return exprs
+
+
+def _derive_bound_checks(loop: ast.stmt) -> list[str]:
+    """for i in range(...len(x)...) 且循环体里有 x[i] 时，推出 0 <= i < len(x)"""
+    if not isinstance(loop, (ast.For, ast.AsyncFor)) or not isinstance(loop.target, ast.Name):
+        return []
+    index = loop.target.id
+    sized = {node.args[0].id for node in ast.walk(loop.iter)
+             if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "len"
+             and len(node.args) == 1 and isinstance(node.args[0], ast.Name)}
+    checks = []
+    for stmt in loop.body:
+        for node in ast.walk(stmt):
+            if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) \
+                    and node.value.id in sized and isinstance(node.slice, ast.Name) and node.slice.id == index:
+                check = f"0 <= {index} < len({node.value.id})"
+                if check not in checks:
+                    checks.append(check)
+    return checks
+
+
+def _function_entry(scope: _Scope) -> tuple[ast.stmt, str]:
+    body = scope.node.body
+    first = body[0]
+    is_doc = isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) \
+        and isinstance(first.value.value, str)
+    if is_doc and len(body) == 1:
+        return first, "after"
+    return (body[1] if is_doc else first), "before"
+
+
+def _call(probe_id: int, line: int, exprs: list[str]) -> str:
+    return f"__probe__({probe_id}, {line}, lambda: ({', '.join(exprs)},))"
+
+
+def plan_insertions(probes: list[Probe], tree: ast.Module) -> tuple[list[dict], list[Probe], list[dict]]:
+    """
+    为每个探针挑选插入位置
+
+    返回 (insertions, 实际插入的探针, 找不到位置而跳过的条目)
+    """
+    scopes = _collect_scopes(tree)
+    module = scopes[0]
+    insertions: list[dict] = []
+    placed: list[Probe] = []
+    skipped: list[dict] = []
+
+    def add(probe: Probe, anchor: ast.stmt, where: str, exprs: list[str]) -> None:
+        if len(probe.sites) >= INSTRUMENT_MAX_SITES:
+            return
+        line = anchor.lineno if where == "before" else anchor.end_lineno
+        insertions.append({"line": anchor.lineno, "col": anchor.col_offset, "where": where,
+                           "call": _call(probe.id, line, exprs)})
+        probe.sites.append(line)
+        probe.labels[line] = exprs
+
+    for probe in probes:
+        targets = [s for s in scopes if not probe.functions or s.name in probe.functions]
+
+        if probe.kind == "loop":
+            for scope in targets:
+                for loop in scope.loops:
+                    exprs = [e for e in probe.exprs if _visible(e, scope, module)]
+                    exprs += [e for e in _loop_exprs(loop) if e not in exprs]
+                    if exprs:
+                        add(probe, _loop_body_anchor(loop), "before", exprs[:_MAX_EXPRS])
+
+        elif probe.kind == "assert":
+            given = list(probe.exprs)
+            for scope in targets:
+                for loop in scope.loops:
+                    if given:
+                        conds = [e for e in given if _visible(e, scope, module)]
+                    else:
+                        # 计划里没写条件：从循环下标推导边界检查
+                        conds = _derive_bound_checks(loop)
+                        probe.exprs += [c for c in conds if c not in probe.exprs]
+                    for cond in conds:
+                        add(probe, _loop_body_anchor(loop), "before", [cond])
+            if not probe.sites:
+                # 没有循环：在条件里的变量被赋值之后检查
+                for scope in targets:
+                    for stmt, names in scope.assigns:
+                        for cond in probe.exprs:
+                            if _names(cond) & names and _visible(cond, scope, module):
+                                add(probe, stmt, "after", [cond])
+
+        else:  # watch
+            roots = set().union(*(_names(e) for e in probe.exprs)) - _BUILTINS
+            for scope in targets:
+                exprs = [e for e in probe.exprs if _visible(e, scope, module)]
+                if not exprs:
+                    continue
+                entry_exprs = [e for e in exprs if _names(e) - _BUILTINS <= set(scope.params) | module.bound]
+                if scope.name is not None and roots & set(scope.params) and entry_exprs:
+                    anchor, where = _function_entry(scope)
+                    add(probe, anchor, where, entry_exprs)
+                for stmt, names in scope.assigns:
+                    if names & roots:
+                        add(probe, stmt, "after", exprs)
+                for loop in scope.loops:
+                    if isinstance(loop, (ast.For, ast.AsyncFor)) and _stored_names(loop.target) & roots:
+                        add(probe, _loop_body_anchor(loop), "before", exprs)
+
+        if probe.sites:
+            placed.append(probe)
+        else:
+            reason = "没有可推导的断言条件" if probe.kind == "assert" and not probe.exprs \
+                else "源码里找不到可以插入的位置"
+            skipped.append({"text": probe.text, "reason": reason})
+    return insertions, placed, skipped
+
+
+def instrument_source(source: str, plan: list, file_name: str = "main.py") -> dict:
+    """
+    只做静态部分：解析计划、选锚点、生成插桩后的源码（给用户看，运行时在沙箱里重新改写）
+    """
+    tree = ast.parse(source, file_name)
+    probes, skipped = parse_plan(plan, tree)
+    insertions, placed, unplaced = plan_insertions(probes, tree)
+    instrumented = apply_probes(ast.parse(source, file_name), insertions)
+    return {
+        "probes": placed,
+        "skipped": skipped + unplaced,
+        "insertions": insertions,
+        "instrumented_source": ast.unparse(instrumented),
+    }
+
+
+# ===== 运行与证据 =====
+
+def _runner(params: dict) -> str:
+    return _RUNNER.replace("__PARAMS__", repr(json.dumps(params, ensure_ascii=False)))
+
+
+async def run_instrumented(file_name: str, source: str, plan: list,
+                           capacity: int = INSTRUMENT_TRACE_CAPACITY) -> dict:
+    """
+    应用插桩计划并在沙箱里运行，返回探针、运行结果、trace 和文字证据
+
+    源码有语法错误时返回 {"error": ...}
+    """
+    try:
+        static = instrument_source(source, plan, file_name)
+    except SyntaxError as e:
+        return {"error": f"源码无法解析: {e}"}
+    probes: list[Probe] = static["probes"]
+    report: dict[str, Any] = {
+        "probes": [p.to_dict() for p in probes],
+        "skipped": static["skipped"],
+    }
+    if not probes:
+        report["run"] = None
+        report["trace"] = None
+        report["evidence"] = summarize_trace(report)
+        return report
+
+    run = await sandbox_pool.run(_runner({
+        "filename": os.path.basename(file_name),
+        "source": source,
+        "insertions": static["insertions"],
+        "capacity": capacity,
+        "asserts": [p.id for p in probes if p.kind == "assert"],
+    }), "instrument_runner.py", timeout=INSTRUMENT_TIMEOUT)
+    logger.info("插桩运行: probes=%d status=%s wall_ms=%s", len(probes), run.get("status"), run.get("wall_ms"))
+
+    report["run"] = {
+        "status": run.get("status"),
+        "exception_type": run.get("exception_type"),
+        "exception_message": run.get("exception_message"),
+        "duration_ms": run.get("wall_ms"),
+    }
+    report["trace"] = run.get("payload") if isinstance(run.get("payload"), dict) else None
+    report["evidence"] = summarize_trace(report)
+    return report
+
+
+def _format_row(exprs: list[str], values: list[str]) -> str:
+    if len(values) == len(exprs):
+        return ", ".join(f"{e}={v}" for e, v in zip(exprs, values))
+    return ", ".join(values)
+
+
+def summarize_trace(report: dict, samples: int = 3) -> str:
+    """
+    把 trace 压缩成给模型看的证据：每个探针的命中次数、最早和最近几次的取值、断言失败
+    """
+    lines: list[str] = []
+    trace = report.get("trace") or {}
+    run = report.get("run") or {}
+    probes = {p["id"]: p for p in report.get("probes", [])}
+    rows: dict[int, list[tuple[int, list[str]]]] = {}
+    for probe_id, line, values in zip(trace.get("probe", []), trace.get("line", []), trace.get("values", [])):
+        rows.setdefault(probe_id, []).append((line, values))
+
+    for probe_id, probe in probes.items():
+        hits = (trace.get("hits") or {}).get(str(probe_id), 0)
+        header = f"探针#{probe_id} [{probe['kind']}] {probe['text']} (第 {', '.join(map(str, probe['lines']))} 行)"
+        if probe["kind"] == "assert":
+            violations = (trace.get("violations") or {}).get(str(probe_id), 0)
+            lines.append(f"{header}: 检查 {hits} 次, 不成立 {violations} 次")
+            for line, values in rows.get(probe_id, [])[:samples]:
+                cond = ", ".join(probe["labels"].get(str(line), []))
+                lines.append(f"  第 {line} 行 {cond} 不成立 (求值结果: {', '.join(values)})")
+            continue
+        lines.append(f"{header}: 命中 {hits} 次")
+        hit_rows = rows.get(probe_id, [])
+        shown = hit_rows if len(hit_rows) <= samples * 2 else hit_rows[:samples] + [None] + hit_rows[-samples:]
+        for item in shown:
+            if item is None:
+                lines.append("  ...")
+                continue
+            line, values = item
+            lines.append(f"  第 {line} 行: {_format_row(probe['labels'].get(str(line), []), values)}")
+
+    if trace.get("dropped"):
+        lines.append(f"(环形缓冲区容量 {trace.get('capacity')}，最早的 {trace['dropped']} 条记录已被覆盖)")
+    if run.get("exception_type"):
+        lines.append(f"插桩运行结束: {run['exception_type']}: {run.get('exception_message')}")
+    elif run:
+        lines.append(f"插桩运行结束: {run.get('status')}")
+    for item in report.get("skipped", []):
+        lines.append(f"未应用: {item['text']}（{item['reason']}）")
+    return "\n".join(lines)
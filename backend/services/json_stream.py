@@ -0,0 +1,146 @@
+# backend/services/json_stream.py
+"""
+模型输出 JSON 的增量解析
+
+模型是一个 token 一个 token 吐出 JSON 的，这里边收边扫描，
+顶层字段（例如 run_result、patch）一完整就产出，
+顶层数组（例如 hypotheses）的每个元素一完整也单独产出，
+不必等整个回复结束再 json.loads。
+
+    parser = JsonFieldStream()
+    for delta in deltas:
+        for path, value in parser.feed(delta):
+            ...  # ("run_result", "..."), ("hypotheses[0]", {...}), ("hypotheses", [...])
+"""
+import json
+from typing import Any
+
+
+class JsonFieldStream:
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._started = False
+        self.done = False
+
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+        # 顶层对象里的状态: key -> colon -> value_start -> value -> key ...
+        self._state = "key"
+        self._key = None
+        self._key_start = None
+        self._value_start = None
+
+        # 顶层数组值的元素跟踪
+        self._value_is_array = False
+        self._elem_start = None
+        self._elem_index = 0
+
+    def feed(self, chunk: str) -> list[tuple[str, Any]]:
+        self._text += chunk
+        events: list[tuple[str, Any]] = []
+        text = self._text
+        i = self._pos
+
+        while i < len(text) and not self.done:
+            c = text[i]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._state == "key_string":
+                        self._key = self._loads(text[self._key_start:i + 1])
+                        self._state = "colon"
+
+            elif not self._started:
+                # 跳过 ```json 之类的前缀
+                if c == "{":
+                    self._started = True
+                    self._depth = 1
+
+            elif c == '"':
+                self._in_string = True
+                self._mark_value_start(i)
+                if self._depth == 1 and self._state == "key":
+                    self._key_start = i
+                    self._state = "key_string"
+
+            elif c in "{[":
+                self._mark_value_start(i, is_array=(c == "["))
+                self._depth += 1
+
+            elif c in "}]":
+                if self._depth == 2 and self._value_is_array and c == "]":
+                    self._emit_element(events, i)
+                self._depth -= 1
+                if self._depth == 0:
+                    self._emit_field(events, i)
+                    self.done = True
+
+            elif c == ":":
+                if self._depth == 1 and self._state == "colon":
+                    self._state = "value_start"
+
+            elif c == ",":
+                if self._depth == 1 and self._state == "value":
+                    self._emit_field(events, i)
+                elif self._depth == 2 and self._value_is_array:
+                    self._emit_element(events, i)
+
+            elif not c.isspace():
+                # 数字、true/false/null
+                self._mark_value_start(i)
+
+            i += 1
+
+        self._pos = i
+        return events
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    def _mark_value_start(self, i: int, is_array: bool = False) -> None:
+        if self._depth == 1 and self._state == "value_start":
+            self._value_start = i
+            self._state = "value"
+            self._value_is_array = is_array
+            self._elem_start = None
+            self._elem_index = 0
+        elif self._depth == 2 and self._value_is_array and self._elem_start is None:
+            self._elem_start = i
+
+    def _emit_field(self, events: list, end: int) -> None:
+        if self._state != "value" or self._value_start is None:
+            return
+        value = self._loads(self._text[self._value_start:end])
+        if value is not _INVALID:
+            events.append((self._key, value))
+        self._state = "key"
+        self._value_start = None
+        self._value_is_array = False
+
+    def _emit_element(self, events: list, end: int) -> None:
+        if self._elem_start is None:
+            return
+        value = self._loads(self._text[self._elem_start:end])
+        if value is not _INVALID:
+            events.append((f"{self._key}[{self._elem_index}]", value))
+        self._elem_index += 1
+        self._elem_start = None
+
+    @staticmethod
+    def _loads(fragment: str) -> Any:
+        try:
+            return json.loads(fragment.strip())
+        except ValueError:
+            return _INVALID
+
+
+_INVALID = object()
@@ -0,0 +1,249 @@
+# backend/services/knowledge_base.py
+"""
+历史调试会话的知识库：按代码相似度（MinHash + LSH）找近似重复的 bug
+
+Step 6 汇总完成后记下一条：规范化后的代码切片、异常签名、用户采纳的假设、插桩计划、
+校验通过的补丁和回归结果。新会话在 Step 1~4 调模型之前先查这里（见 backend/steps/recall.py）。
+
+- 代码先去掉注释，标识符 / 字符串 / 数字分别归一成占位符（变量改名不影响相似度），
+  再取 KB_SHINGLE 个 token 的滑动窗口作为特征集合
+- MinHash 签名 KB_NUM_PERM 维，估计两份代码特征集合的 Jaccard 相似度
+- LSH：签名切成 KB_BANDS 段，任意一段完全相同的条目才进入候选，查询不随条目数线性增长
+- 存储是本地 SQLite（WAL 模式），多个 worker 共享，重启不丢
+"""
+import os
+import re
+import json
+import time
+import array
+import random
+import sqlite3
+import hashlib
+import keyword
+import builtins
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from backend.services.data_dir import data_path, ensure_parent
+from backend.services.log import get_logger
+
+logger = get_logger("knowledge_base")
+
+KB_ENABLED = os.getenv("KB_ENABLED", "1") == "1"
+KB_PATH = os.getenv("KB_PATH", data_path("knowledge_base.db"))
+# 估计的 Jaccard 相似度达到这个值才算命中
+KB_THRESHOLD = float(os.getenv("KB_THRESHOLD", "0.8"))
+KB_NUM_PERM = int(os.getenv("KB_NUM_PERM", "64"))
+KB_BANDS = int(os.getenv("KB_BANDS", "16"))
+KB_SHINGLE = int(os.getenv("KB_SHINGLE", "5"))
+KB_MAX_RESULTS = int(os.getenv("KB_MAX_RESULTS", "3"))
+
+_MERSENNE = (1 << 61) - 1
+_rng = random.Random(20240611)
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE), _rng.randrange(0, _MERSENNE)) for _ in range(KB_NUM_PERM)]
+
+_COMMENT = re.compile(r"#[^\n]*")
+_TOKEN = re.compile(r"""[A-Za-z_]\w*|\d[\d_]*(?:\.\d+)?|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|[^\s\w]""")
+# 保留原样的名字：关键字和内置函数决定了代码的"形状"，例如 range(len(x) + 1)
+_KEEP = set(keyword.kwlist) | set(dir(builtins))
+_EXCEPTION = re.compile(r"\b([A-Z]\w*(?:Error|Exception|Interrupt|Exit))\b")
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS entries ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    " fingerprint TEXT NOT NULL,"
+    " patch_hash TEXT NOT NULL,"
+    " exception TEXT,"
+    " signature TEXT,"
+    " file_name TEXT,"
+    " minhash BLOB NOT NULL,"
+    " data TEXT NOT NULL,"
+    " confirmations INTEGER NOT NULL DEFAULT 0,"
+    " created_at REAL NOT NULL,"
+    " UNIQUE (fingerprint, patch_hash))",
+    "CREATE TABLE IF NOT EXISTS bands ("
+    " band INTEGER NOT NULL,"
+    " bucket TEXT NOT NULL,"
+    " entry INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS idx_bands_bucket ON bands(band, bucket)",
+)
+
+
+# ===== 特征 =====
+
+def tokens(text: str) -> list[str]:
+    """代码 → 归一化的 token 序列"""
+    result = []
+    for token in _TOKEN.findall(_COMMENT.sub("", text or "")):
+        if token[0] in "\"'":
+            result.append("S")
+        elif token[0].isdigit():
+            result.append("N")
+        elif (token[0].isalpha() or token[0] == "_") and token not in _KEEP:
+            result.append("v")
+        else:
+            result.append(token)
+    return result
+
+
+def shingles(text: str, size: int = KB_SHINGLE) -> set[str]:
+    seq = tokens(text)
+    if len(seq) <= size:
+        return {" ".join(seq)} if seq else set()
+    return {" ".join(seq[i:i + size]) for i in range(len(seq) - size + 1)}
+
+
+def minhash(features: set[str]) -> list[int]:
+    if not features:
+        return [_MERSENNE] * KB_NUM_PERM
+    hashes = [int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little")
+              for f in features]
+    return [min((a * h + b) % _MERSENNE for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def similarity(left: list[int], right: list[int]) -> float:
+    """两个 MinHash 签名估计的 Jaccard 相似度"""
+    return sum(1 for x, y in zip(left, right) if x == y) / max(len(left), 1)
+
+
+def _buckets(signature: list[int]) -> list[tuple[int, str]]:
+    rows = max(1, len(signature) // KB_BANDS)
+    return [(band, hashlib.blake2b(array.array("Q", signature[band * rows:(band + 1) * rows]).tobytes(),
+                                   digest_size=8).hexdigest())
+            for band in range(KB_BANDS)]
+
+
+def exception_signature(exception_type: Optional[str], message: Optional[str]) -> Optional[str]:
+    """异常类型 + 去掉具体数值 / 字符串的消息，例如 IndexError: list index out of range"""
+    if not exception_type:
+        return None
+    text = re.sub(r"'[^']*'|\"[^\"]*\"", "S", message or "")
+    return f"{exception_type}: {re.sub(r'[0-9]+', 'N', text)}".strip().rstrip(":")
+
+
+def exception_from_text(text: Optional[str]) -> Optional[str]:
+    """没有结构化的异常信息时（模型模拟运行的结果），从文本里找异常类型"""
+    found = _EXCEPTION.findall(text or "")
+    return found[-1] if found else None
+
+
+# ===== 存储 =====
+
+class KnowledgeBase:
+    def __init__(self, path: str = KB_PATH, threshold: float = KB_THRESHOLD, max_results: int = KB_MAX_RESULTS):
+        self.path = path
+        self.threshold = threshold
+        self.max_results = max_results
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # 同一份代码在 Step 1~4 里会被查好几次，签名按文本哈希缓存一小段
+        self._signatures: "OrderedDict[str, list[int]]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._open_lock = threading.Lock()
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """第一次用到时才打开数据库"""
+        if self._db is None:
+            with self._open_lock:
+                if self._db is None:
+                    conn = sqlite3.connect(ensure_parent(self.path), check_same_thread=False, isolation_level=None)
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                    for statement in _SCHEMA:
+                        conn.execute(statement)
+                    self._db = conn
+        return self._db
+
+    def signature(self, text: str) -> list[int]:
+        # 查询在多个线程里并发进行（见 pipeline.prepare_for），缓存的读写要加锁，MinHash 本身在锁外算
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        with self._lock:
+            cached = self._signatures.get(digest)
+            if cached is not None:
+                self._signatures.move_to_end(digest)
+                return cached
+        cached = minhash(shingles(text))
+        with self._lock:
+            self._signatures[digest] = cached
+            if len(self._signatures) > 256:
+                self._signatures.popitem(last=False)
+        return cached
+
+    def add(self, fingerprint: str, exception: Optional[str], signature: Optional[str], file_name: Optional[str],
+            patch: str, data: dict) -> Optional[int]:
+        """记下一次完成的会话；同一份代码的同一个补丁只存一条，返回条目 id（重复时为 None）"""
+        sig = self.signature(fingerprint)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self._conn.execute(
+                    "INSERT OR IGNORE INTO entries (fingerprint, patch_hash, exception, signature, file_name, minhash,"
+                    " data, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (hashlib.sha256(fingerprint.encode("utf-8")).hexdigest(),
+                     hashlib.sha256(patch.encode("utf-8")).hexdigest(), exception, signature, file_name,
+                     array.array("Q", sig).tobytes(), json.dumps(data, ensure_ascii=False, default=str),
+                     time.time()))
+                entry_id = cur.lastrowid if cur.rowcount else None
+                if entry_id is not None:
+                    self._conn.executemany("INSERT INTO bands (band, bucket, entry) VALUES (?, ?, ?)",
+                                           [(band, bucket, entry_id) for band, bucket in _buckets(sig)])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        if entry_id is not None:
+            logger.info("知识库新增 #%s: %s %s", entry_id, file_name, signature)
+        return entry_id
+
+    def confirm(self, entry_id: int) -> None:
+        """复用这条记录的会话又走完了一遍，排名时优先"""
+        with self._lock:
+            self._conn.execute("UPDATE entries SET confirmations = confirmations + 1 WHERE id = ?", (entry_id,))
+
+    def lookup(self, fingerprint: str, exception: Optional[str] = None) -> list[dict]:
+        """
+        找近似重复的历史会话，按 相似度 → 回归通过数 → 被复用确认的次数 排序
+
+        exception 给定时只要异常类型相同的记录。返回:
+            [{"id": 3, "similarity": 0.94, "exception": "IndexError", "signature": "...",
+              "file_name": "...", "confirmations": 1, "data": {...}}, ...]
+        """
+        start = time.perf_counter()
+        sig = self.signature(fingerprint)
+        buckets = _buckets(sig)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, exception, signature, file_name, minhash, data, confirmations FROM entries"
+                " WHERE id IN (SELECT entry FROM bands WHERE %s)" % " OR ".join(["(band = ? AND bucket = ?)"] * len(buckets)),
+                [value for pair in buckets for value in pair]).fetchall()
+        matches = []
+        for entry_id, exc, signature, file_name, blob, data, confirmations in rows:
+            if exception and exc and exc != exception:
+                continue
+            score = similarity(sig, array.array("Q", blob).tolist())
+            if score < self.threshold:
+                continue
+            matches.append({"id": entry_id, "similarity": round(score, 3), "exception": exc, "signature": signature,
+                            "file_name": file_name, "confirmations": confirmations, "data": json.loads(data)})
+        matches.sort(key=lambda m: (-m["similarity"], -m["data"].get("passed", 0), -m["confirmations"], m["id"]))
+        matches = matches[:self.max_results]
+        if matches:
+            self.hits += 1
+        else:
+            self.misses += 1
+        logger.debug("知识库查询: 候选 %d, 命中 %d, %.1fms", len(rows), len(matches),
+                     (time.perf_counter() - start) * 1000)
+        return matches
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {"path": self.path, "entries": entries, "threshold": self.threshold,
+                "hits": self.hits, "misses": self.misses}
+
+
+# 进程内共享的实例；KB_ENABLED=0 时为 None
+knowledge_base = KnowledgeBase() if KB_ENABLED else None
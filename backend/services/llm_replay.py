@@ -0,0 +1,190 @@
+# backend/services/llm_replay.py
+"""
+模型调用的录制 / 回放
+
+基准测试和回归测试不想每次都付费、等真实模型：
+- record：照常调用模型，把回复存成夹具（按 模型 + prompt 的哈希 命名的 JSON 文件）
+- replay：直接返回夹具里的回复，按配置的合成延迟 sleep，不发任何请求
+
+LLM_REPLAY_LATENCY 是固定延迟（秒），设成 "recorded" 时按录制时的真实耗时回放；
+LLM_REPLAY_JITTER 是相对抖动（0.2 表示 ±20%）。
+
+回放时找不到夹具（LLM_REPLAY_MISS）：
+- error：抛出 ReplayMiss
+- route：回放同一条路由（step）最近录制的一条，用于代码带随机扰动的压测
+- live：调用真实模型（record 模式下顺便录下来）
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+from typing import Any, Callable, Optional
+
+from backend.services.log import get_logger
+from backend.services.data_dir import data_path
+
+logger = get_logger("llm_replay")
+
+# "" 关闭 / "record" / "replay"
+LLM_REPLAY_MODE = os.getenv("LLM_REPLAY_MODE", "")
+LLM_REPLAY_DIR = os.getenv("LLM_REPLAY_DIR", data_path("llm_fixtures"))
+LLM_REPLAY_LATENCY = os.getenv("LLM_REPLAY_LATENCY", "0")
+LLM_REPLAY_JITTER = float(os.getenv("LLM_REPLAY_JITTER", "0"))
+LLM_REPLAY_MISS = os.getenv("LLM_REPLAY_MISS", "error")
+# 回放流式调用时切成多少段
+LLM_REPLAY_STREAM_CHUNKS = int(os.getenv("LLM_REPLAY_STREAM_CHUNKS", "20"))
+
+
+class ReplayMiss(Exception):
+    """回放模式下没有对应的夹具"""
+
+
+def fixture_key(prompt: str, model: Optional[str]) -> str:
+    return hashlib.sha256(f"{model or ''}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+class FixtureStore:
+    """一个目录，每条夹具一个 <key>.json；启动时全部读进内存，并按路由建索引"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._fixtures: dict[str, dict] = {}
+        self._by_route: dict[str, str] = {}
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(".json"):
+                    try:
+                        with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                            self._index(name[:-5], json.load(f))
+                    except (OSError, ValueError) as e:
+                        logger.warning("跳过损坏的夹具 %s: %s", name, e)
+
+    def _index(self, key: str, fixture: dict) -> None:
+        self._fixtures[key] = fixture
+        if fixture.get("route"):
+            self._by_route[fixture["route"]] = key
+
+    def __len__(self) -> int:
+        return len(self._fixtures)
+
+    def get(self, key: str) -> Optional[dict]:
+        return self._fixtures.get(key)
+
+    def latest_for_route(self, route: Optional[str]) -> Optional[dict]:
+        key = self._by_route.get(route or "")
+        return self._fixtures.get(key) if key else None
+
+    def put(self, key: str, fixture: dict) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{key}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(fixture, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+        self._index(key, fixture)
+
+
+class Replayer:
+    def __init__(self):
+        self.configure()
+
+    def configure(self, mode: str = LLM_REPLAY_MODE, directory: str = LLM_REPLAY_DIR,
+                  latency: str = LLM_REPLAY_LATENCY, jitter: float = LLM_REPLAY_JITTER,
+                  miss: str = LLM_REPLAY_MISS) -> None:
+        """压测脚本可以直接调用这个方法切换模式，不必设置环境变量"""
+        if mode not in ("", "record", "replay"):
+            raise ValueError(f"未知的 LLM_REPLAY_MODE: {mode}")
+        self.mode = mode
+        self.store = FixtureStore(directory) if mode else None
+        self.latency = str(latency)
+        self.jitter = jitter
+        self.miss = miss
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+
+    @property
+    def active(self) -> bool:
+        return bool(self.mode)
+
+    def _delay(self, fixture: dict) -> float:
+        base = fixture.get("latency", 0.0) if self.latency == "recorded" else float(self.latency or 0)
+        if self.jitter:
+            base *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(base, 0.0)
+
+    def _lookup(self, prompt: str, route: Any) -> tuple[str, Optional[dict]]:
+        key = fixture_key(prompt, getattr(route, "model", None))
+        fixture = self.store.get(key)
+        if fixture is None and self.mode == "replay" and self.miss == "route":
+            fixture = self.store.latest_for_route(getattr(route, "name", None))
+        if fixture is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return key, fixture
+
+    def _save(self, key: str, prompt: str, route: Any, response: str, latency: float) -> None:
+        self.recorded += 1
+        self.store.put(key, {
+            "route": getattr(route, "name", None),
+            "model": getattr(route, "model", None),
+            "prompt_sha256": key,
+            "prompt_preview": prompt[:200],
+            "latency": round(latency, 4),
+            "response": response,
+        })
+
+    def _check_miss(self, key: str) -> None:
+        if self.mode == "replay" and self.miss != "live":
+            raise ReplayMiss(f"没有夹具 {key[:12]}（LLM_REPLAY_DIR={self.store.directory}）")
+
+    async def complete(self, prompt: str, route: Any, live: Callable) -> str:
+        """live: 无参数、返回协程的函数，真正调用模型"""
+        key, fixture = self._lookup(prompt, route)
+        if fixture is not None:
+            await asyncio.sleep(self._delay(fixture))
+            return fixture["response"]
+        self._check_miss(key)
+        start = time.perf_counter()
+        response = await live()
+        if self.mode == "record" or self.miss == "live":
+            self._save(key, prompt, route, response, time.perf_counter() - start)
+        return response
+
+    async def stream(self, prompt: str, route: Any, live: Callable):
+        """live: 无参数、返回异步生成器的函数；回放时把回复切成若干段，延迟平均分摊"""
+        key, fixture = self._lookup(prompt, route)
+        if fixture is not None:
+            text = fixture["response"] or ""
+            size = max(1, -(-len(text) // LLM_REPLAY_STREAM_CHUNKS))
+            pieces = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+            pause = self._delay(fixture) / len(pieces)
+            for piece in pieces:
+                await asyncio.sleep(pause)
+                if piece:
+                    yield piece
+            return
+        self._check_miss(key)
+        start = time.perf_counter()
+        parts: list[str] = []
+        async for delta in live():
+            parts.append(delta)
+            yield delta
+        if self.mode == "record" or self.miss == "live":
+            self._save(key, prompt, route, "".join(parts), time.perf_counter() - start)
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "fixtures": len(self.store) if self.store is not None else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "recorded": self.recorded,
+        }
+
+
+# 进程内共享的实例
+replayer = Replayer()
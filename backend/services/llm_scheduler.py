@@ -0,0 +1,422 @@
+# backend/services/llm_scheduler.py
+"""
+模型请求调度：重试、对冲请求、熔断和多服务商故障转移
+
+- 按顺序排列的服务商（base_url + model）列表，前一个不可用时转到下一个
+- 可重试的错误（超时、连接错误、429、5xx）做指数退避 + 全抖动（full jitter）
+- 对冲请求：第一个请求超过该服务商上这个模型的 p95 延迟还没返回，就再发一个（优先发给下一个服务商），
+  谁先回来用谁，另一个取消
+- 每个服务商一个熔断器：连续失败 LLM_BREAKER_FAILURES 次后熔断 LLM_BREAKER_COOLDOWN 秒，
+  之后放一个探测请求（半开），成功才恢复；探测请求被取消时让出探测名额
+- 每个服务商、每个模型的延迟分布、失败、对冲次数，GET /llm/stats 可以看到
+  （快模型和强模型的延迟差很多，混在一起算 p95 会让快路由的对冲来得太晚）
+- 路由指定的模型名只发给接受路由的服务商（首选服务商）；备用服务商用自己配置的模型，
+  或者按配置里的 models 映射成它那边的模型名
+- 推理模型（gpt-5、o 系列）用 max_completion_tokens，并在路由的输出上限上加推理预算，
+  否则推理 token 会把上限吃光、返回空内容
+"""
+import os
+import re
+import time
+import random
+import asyncio
+from collections import deque
+from typing import Any, Optional
+
+from backend.services import metrics
+from backend.services.log import get_logger
+
+logger = get_logger("llm")
+
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+# 延迟样本不够时不对冲；够了之后对冲延迟 = max(p95, LLM_HEDGE_MIN_DELAY)
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+LLM_STATS_WINDOW = int(os.getenv("LLM_STATS_WINDOW", "512"))
+# 推理模型的模型名（正则，匹配去掉 "openai/" 之类前缀后的名字）
+LLM_REASONING_MODELS = re.compile(os.getenv("LLM_REASONING_MODELS", r"^(gpt-5|o\d)"))
+# 推理模型在路由输出上限之外额外留给推理 token 的预算
+LLM_REASONING_BUDGET = int(os.getenv("LLM_REASONING_BUDGET", "8192"))
+
+# 换一个服务商也不会好的错误（请求本身有问题）
+_FATAL_STATUS = {400, 413, 422}
+# 这个服务商不行，但别的服务商可能可以（鉴权、模型不存在）
+_FAILOVER_STATUS = {401, 403, 404}
+
+
+class LLMUnavailableError(Exception):
+    """所有服务商都失败了（或者都在熔断中）"""
+
+
+def percentile(samples, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class LatencyStats:
+    """最近 LLM_STATS_WINDOW 次成功请求的延迟，以及累计的成功 / 失败 / 对冲次数"""
+
+    def __init__(self, window: int = LLM_STATS_WINDOW):
+        self.latencies: deque = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record_success(self, latency: float) -> None:
+        self.successes += 1
+        self.latencies.append(latency)
+
+    def record_failure(self, timeout: bool = False) -> None:
+        self.failures += 1
+        if timeout:
+            self.timeouts += 1
+
+    def percentile(self, pct: float) -> float:
+        return percentile(self.latencies, pct)
+
+    def snapshot(self) -> dict:
+        return {
+            "successes": self.successes,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "samples": len(self.latencies),
+            "p50_ms": round(self.percentile(50) * 1000, 1),
+            "p95_ms": round(self.percentile(95) * 1000, 1),
+            "p99_ms": round(self.percentile(99) * 1000, 1),
+        }
+
+
+class CircuitBreaker:
+    """closed → (连续失败) → open → (冷却结束) → half_open → 探测成功 closed / 失败 open"""
+
+    def __init__(self, failures: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.consecutive = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.consecutive = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.consecutive += 1
+        if self._probing or self.consecutive >= self.threshold:
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def release(self) -> None:
+        """探测请求没有结果就被取消了（对冲输掉、客户端断开）：让出探测名额，下一个请求接着探测"""
+        self._probing = False
+
+
+def is_reasoning_model(model: str) -> bool:
+    return bool(LLM_REASONING_MODELS.search(model.rsplit("/", 1)[-1]))
+
+
+def token_limit(model: str, max_tokens: Optional[int]) -> dict:
+    """输出上限参数：推理模型用 max_completion_tokens，且要算上推理 token"""
+    if not max_tokens:
+        return {}
+    if is_reasoning_model(model):
+        return {"max_completion_tokens": max_tokens + LLM_REASONING_BUDGET}
+    return {"max_tokens": max_tokens}
+
+
+class Provider:
+    """
+    model         路由没有指定模型时使用的默认模型
+    models        路由模型名 → 这个服务商上的模型名
+    accept_routes 是否直接使用路由指定的模型名（路由表是按首选服务商写的）；
+                  为 False 且 models 里没有映射时退回 model
+    stats         实际请求的模型名 → LatencyStats
+    """
+    __slots__ = ("name", "base_url", "model", "models", "accept_routes", "client", "breaker", "stats")
+
+    def __init__(self, name: str, base_url: str, model: str, client: Any,
+                 models: Optional[dict] = None, accept_routes: bool = True):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.models = models or {}
+        self.accept_routes = accept_routes
+        # AsyncOpenAI，需要以 max_retries=0 创建，重试由调度器负责
+        self.client = client
+        self.breaker = CircuitBreaker()
+        self.stats: dict[str, LatencyStats] = {}
+
+    def stats_for(self, model: str) -> LatencyStats:
+        """model 是这个服务商上实际请求的模型名（model_for 的结果）"""
+        stats = self.stats.get(model)
+        if stats is None:
+            stats = self.stats[model] = LatencyStats()
+        return stats
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        stats = self.stats.get(model)
+        if not LLM_HEDGE or stats is None or len(stats.latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return max(stats.percentile(LLM_HEDGE_PERCENTILE), LLM_HEDGE_MIN_DELAY)
+
+    def model_for(self, requested: Optional[str]) -> str:
+        """路由指定的模型在这个服务商上实际请求的模型名"""
+        if not requested:
+            return self.model
+        if requested in self.models:
+            return self.models[requested]
+        return requested if self.accept_routes else self.model
+
+
+def classify(exc: BaseException) -> str:
+    """retry: 同一个服务商退避后重试；failover: 直接换下一个服务商；fatal: 不再尝试"""
+    if isinstance(exc, asyncio.TimeoutError):
+        return "retry"
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        response = getattr(exc, "response", None)
+        status = getattr(response, "status_code", None)
+    if status in _FATAL_STATUS:
+        return "fatal"
+    if status in _FAILOVER_STATUS:
+        return "failover"
+    # 429、5xx、连接错误、读超时等
+    return "retry"
+
+
+def backoff_delay(attempt: int) -> float:
+    """指数退避 + 全抖动：在 [0, min(上限, 基数 * 2^attempt)] 里均匀取值"""
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _record_usage(provider: Provider, model: str, usage: Any) -> None:
+    if usage is None:
+        return
+    metrics.llm_tokens.inc(getattr(usage, "prompt_tokens", 0) or 0,
+                           provider=provider.name, model=model, kind="prompt")
+    metrics.llm_tokens.inc(getattr(usage, "completion_tokens", 0) or 0,
+                           provider=provider.name, model=model, kind="completion")
+
+
+def _describe(exc: BaseException) -> str:
+    return f"{type(exc).__name__}: {exc}" if str(exc) else type(exc).__name__
+
+
+class LLMScheduler:
+    def __init__(self, providers: list[Provider], semaphore: asyncio.Semaphore):
+        if not providers:
+            raise ValueError("至少需要一个模型服务商")
+        self.providers = providers
+        self.semaphore = semaphore
+
+    def _candidates(self):
+        """
+        按配置顺序产出 (服务商, 是否半开探测)，全部熔断时仍然试第一个，避免彻底不可用
+
+        轮到某个服务商时才问它的熔断器：半开的探测名额只由真正去试的请求占用，
+        前面的服务商成功了，后面的备用服务商不会被白白占住探测名额
+        """
+        tried = False
+        for provider in self.providers:
+            probe = provider.breaker.state == "half_open"
+            if provider.breaker.allow():
+                tried = True
+                yield provider, probe
+        if not tried:
+            yield self.providers[0], False
+
+    def _hedge_target(self, primary: Provider) -> Provider:
+        for provider in self.providers:
+            if provider is not primary and provider.breaker.state == "closed":
+                return provider
+        return primary
+
+    @staticmethod
+    def _create(provider: Provider, messages: list, timeout: float, model: Optional[str],
+                max_tokens: Optional[int], stream: bool = False):
+        """model 为路由指定的模型，由 provider.model_for 换成这个服务商上的模型名"""
+        model = provider.model_for(model)
+        extra = token_limit(model, max_tokens)
+        if stream:
+            extra["stream"] = True
+        return provider.client.chat.completions.create(
+            model=model, messages=messages, timeout=timeout, **extra,
+        )
+
+    async def _attempt(self, provider: Provider, messages: list, timeout: float,
+                       model: Optional[str] = None, max_tokens: Optional[int] = None,
+                       probe: bool = False) -> str:
+        """probe: 这次尝试占着 provider 半开状态的探测名额"""
+        start = time.perf_counter()
+        used = provider.model_for(model)
+        try:
+            async with self.semaphore:
+                completion = await asyncio.wait_for(
+                    self._create(provider, messages, timeout, model, max_tokens), timeout,
+                )
+            content = completion.choices[0].message.content
+        except asyncio.CancelledError:
+            # 对冲输掉或者客户端断开被取消，不算这个服务商失败
+            if probe:
+                provider.breaker.release()
+            metrics.llm_attempt_seconds.observe(time.perf_counter() - start, provider=provider.name,
+                                                model=used, outcome="cancelled")
+            raise
+        except BaseException as e:
+            elapsed = time.perf_counter() - start
+            provider.stats_for(used).record_failure(timeout=isinstance(e, asyncio.TimeoutError))
+            provider.breaker.record_failure()
+            metrics.llm_attempt_seconds.observe(elapsed, provider=provider.name,
+                                                model=used, outcome="error")
+            raise
+        elapsed = time.perf_counter() - start
+        provider.stats_for(used).record_success(elapsed)
+        provider.breaker.record_success()
+        metrics.llm_attempt_seconds.observe(elapsed, provider=provider.name, model=used, outcome="ok")
+        _record_usage(provider, used, getattr(completion, "usage", None))
+        return content
+
+    async def _hedged(self, provider: Provider, messages: list, timeout: float,
+                      model: Optional[str], max_tokens: Optional[int], probe: bool = False) -> str:
+        stats = provider.stats_for(provider.model_for(model))
+        # 半开探测不对冲：只有一个探测名额，探测结果也要算在这个服务商头上
+        delay = None if probe else provider.hedge_delay(provider.model_for(model))
+        primary = asyncio.ensure_future(self._attempt(provider, messages, timeout, model, max_tokens, probe))
+        if delay is None:
+            return await primary
+
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                backup = self._hedge_target(provider)
+                stats.hedges += 1
+                hedge = asyncio.ensure_future(self._attempt(backup, messages, timeout, model, max_tokens))
+                tasks.add(hedge)
+            first_error: Optional[BaseException] = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            stats.hedge_wins += 1
+                        return task.result()
+                    first_error = first_error or task.exception()
+            raise first_error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def complete(self, messages: list, timeout: float, model: Optional[str] = None,
+                       max_tokens: Optional[int] = None) -> str:
+        errors: list[str] = []
+        for provider, probe in self._candidates():
+            for attempt in range(LLM_MAX_ATTEMPTS):
+                if attempt:
+                    await asyncio.sleep(backoff_delay(attempt - 1))
+                try:
+                    return await self._hedged(provider, messages, timeout, model, max_tokens, probe)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    kind = classify(e)
+                    errors.append(f"{provider.name}#{attempt + 1} {_describe(e)}")
+                    logger.warning("%s 第 %d 次失败 (%s): %s", provider.name, attempt + 1, kind, _describe(e))
+                    if kind == "fatal":
+                        raise
+                    if kind == "failover" or provider.breaker.state != "closed":
+                        break
+        raise LLMUnavailableError("所有模型服务都失败了: " + "; ".join(errors))
+
+    async def stream(self, messages: list, timeout: float, model: Optional[str] = None,
+                     max_tokens: Optional[int] = None):
+        """
+        流式调用：只在第一个增量到达之前重试 / 故障转移，已经输出过内容就不能再换了
+        """
+        errors: list[str] = []
+        for provider, probe in self._candidates():
+            for attempt in range(LLM_MAX_ATTEMPTS):
+                if attempt:
+                    await asyncio.sleep(backoff_delay(attempt - 1))
+                started = False
+                start = time.perf_counter()
+                used = provider.model_for(model)
+                try:
+                    async with self.semaphore:
+                        stream = await asyncio.wait_for(
+                            self._create(provider, messages, timeout, model, max_tokens, stream=True), timeout,
+                        )
+                        async for chunk in stream:
+                            # 服务商支持时，最后一个 chunk 带 usage
+                            _record_usage(provider, used, getattr(chunk, "usage", None))
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.content
+                            if delta:
+                                started = True
+                                yield delta
+                except (asyncio.CancelledError, GeneratorExit):
+                    # 调用方取消或者提前关闭了流
+                    if probe:
+                        provider.breaker.release()
+                    raise
+                except Exception as e:
+                    provider.stats_for(used).record_failure(timeout=isinstance(e, asyncio.TimeoutError))
+                    provider.breaker.record_failure()
+                    metrics.llm_attempt_seconds.observe(time.perf_counter() - start, provider=provider.name,
+                                                        model=used, outcome="error")
+                    kind = classify(e)
+                    errors.append(f"{provider.name}#{attempt + 1} {_describe(e)}")
+                    logger.warning("%s 流式第 %d 次失败 (%s): %s", provider.name, attempt + 1, kind, _describe(e))
+                    if started or kind == "fatal":
+                        raise
+                    if kind == "failover" or provider.breaker.state != "closed":
+                        break
+                    continue
+                elapsed = time.perf_counter() - start
+                provider.stats_for(used).record_success(elapsed)
+                provider.breaker.record_success()
+                metrics.llm_attempt_seconds.observe(elapsed, provider=provider.name,
+                                                    model=used, outcome="ok")
+                return
+        raise LLMUnavailableError("所有模型服务都失败了: " + "; ".join(errors))
+
+    def stats(self) -> dict:
+        return {
+            p.name: {"model": p.model, "base_url": p.base_url, "breaker": p.breaker.state,
+                     "models": {model: stats.snapshot() for model, stats in p.stats.items()}}
+            for p in self.providers
+        }
@@ -0,0 +1,70 @@
+# backend/services/log.py
+"""
+分级、采样的日志
+
+以前热路径上直接 print 整份源码和模型原始回复，请求一多 stdout 就被刷满，还拖慢请求。
+现在：
+- 按 LOG_LEVEL 分级（默认 INFO），大段内容（源码、模型回复）只在 DEBUG 级别输出
+- DEBUG 日志按 LOG_SAMPLE_RATE 采样，打开 DEBUG 也不会每个请求都刷屏
+- preview() 把长文本截断成前 LOG_MAX_CHARS 个字符并注明原长度
+"""
+import os
+import random
+import logging
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# DEBUG 级别日志的采样率，1 表示全部输出
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+LOG_MAX_CHARS = int(os.getenv("LOG_MAX_CHARS", "300"))
+
+
+class SamplingFilter(logging.Filter):
+    """INFO 及以上全部保留，DEBUG 按采样率保留"""
+
+    def __init__(self, rate: float = LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+def _configure() -> logging.Logger:
+    root = logging.getLogger("truedebug")
+    root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        handler.addFilter(SamplingFilter())
+        root.addHandler(handler)
+        root.propagate = False
+    return root
+
+
+_root = _configure()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """例如 get_logger("pipeline") → truedebug.pipeline"""
+    return _root.getChild(name)
+
+
+class preview:
+    """
+    截断后的长文本，作为日志参数使用：logger.debug("回复: %s", preview(resp))
+
+    真正输出时才转成字符串，DEBUG 关闭或没被采样到时不做任何格式化
+    """
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit: int = LOG_MAX_CHARS):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        text = self.value if isinstance(self.value, str) else repr(self.value)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}…(共 {len(text)} 字符)"
@@ -0,0 +1,221 @@
+# backend/services/metrics.py
+"""
+进程内指标，GET /metrics 以 Prometheus 文本格式输出
+
+不依赖 prometheus_client：只需要 Counter / Gauge / Histogram 三种类型和带标签的序列，
+记录一次只是几次字典查找和加法，放在热路径上开销可以忽略。
+
+另外支持采集回调（collector）：缓存命中率、活跃会话数这类已经在别处统计的值，
+在抓取时现取，不用在每次请求里重复记录。
+"""
+import time
+import asyncio
+import functools
+from typing import Callable, Iterable, Optional
+
+# 默认的延迟桶（秒），覆盖从缓存命中到长时间模型调用
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._series: dict = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._series.get(self._key(labels), 0)
+
+    def render(self) -> list[str]:
+        return self.header() + [f"{self.name}{_labels(self.label_names, key)} {_number(value)}"
+                                for key, value in sorted(self._series.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self._series[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            # [每个桶的计数..., 总次数, 总和]
+            series = self._series[key] = [0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+        series[-2] += 1
+        series[-1] += value
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series[-2] if series else 0
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {series[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {series[-2]}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(series[-1])}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._collectors: list[Callable[[], Iterable[_Metric]]] = []
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def collector(self, fn: Callable[[], Iterable[_Metric]]) -> Callable:
+        """注册采集回调，抓取时调用，返回临时构造的指标"""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        for collect in self._collectors:
+            try:
+                for metric in collect():
+                    lines += metric.render()
+            except Exception as e:
+                lines.append(f"# collector {getattr(collect, '__name__', collect)} failed: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+# 进程内共享的实例
+registry = Registry()
+
+# ===== 公共指标 =====
+
+http_request_seconds = registry.histogram(
+    "truedebug_http_request_seconds", "HTTP 请求从收到到返回响应头的耗时", ("path", "method", "status"))
+step_seconds = registry.histogram(
+    "truedebug_step_seconds", "单个 step 的执行耗时（含缓存查询、等待预取）", ("step", "mode"))
+step_handler_seconds = registry.histogram(
+    "truedebug_step_handler_seconds", "handle_stepN 的耗时（缓存未命中时真正的计算）", ("step", "outcome"))
+llm_call_seconds = registry.histogram(
+    "truedebug_llm_call_seconds", "claude_prompt / claude_stream 一次调用的耗时（含重试、对冲）", ("route", "kind", "outcome"))
+llm_attempt_seconds = registry.histogram(
+    "truedebug_llm_attempt_seconds", "发给单个服务商的一次请求的耗时", ("provider", "model", "outcome"))
+llm_tokens = registry.counter(
+    "truedebug_llm_tokens_total", "模型返回的 token 用量", ("provider", "model", "kind"))
+json_parse_failures = registry.counter(
+    "truedebug_json_parse_failures_total", "模型输出解析 / 校验失败的次数", ("step", "stage"))
+patch_checks = registry.counter(
+    "truedebug_patch_checks_total", "Step 4 补丁校验结果（exact / normalized / repaired / rejected / recalled / rule）",
+    ("outcome",))
+kb_lookups = registry.counter(
+    "truedebug_kb_lookups_total", "Step 1~4 查历史会话知识库的次数", ("step", "outcome"))
+rule_matches = registry.counter(
+    "truedebug_rule_matches_total", "Step 2 静态 bug 模式规则的命中次数（none 表示没有命中）", ("rule",))
+admission_wait_seconds = registry.histogram(
+    "truedebug_admission_wait_seconds", "模型调用在准入队列里等待的时间", ("priority", "outcome"))
+admission_rejections = registry.counter(
+    "truedebug_admission_rejections_total", "准入控制拒绝（HTTP 429）的次数", ("priority", "reason"))
+
+
+def timed(histogram: Histogram, **labels) -> Callable:
+    """
+    给 async 函数计时的装饰器，额外带上 outcome 标签（ok / error / cancelled）
+
+    例如 @metrics.timed(metrics.step_handler_seconds, step="1")
+    """
+    def decorate(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = await fn(*args, **kwargs)
+                outcome = "ok"
+                return result
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, outcome=outcome, **labels)
+        return wrapper
+    return decorate
+
+
+def gauge_from(name: str, help_text: str, values: dict, label: Optional[str] = None) -> Gauge:
+    """采集回调里用：把 {标签值: 数值} 转成一个临时 Gauge"""
+    gauge = Gauge(name, help_text, (label,) if label else ())
+    for key, value in values.items():
+        if label:
+            gauge.set(value, **{label: key})
+        else:
+            gauge.set(value)
+    return gauge
+
+
+def render() -> str:
+    return registry.render()
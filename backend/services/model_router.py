@@ -0,0 +1,85 @@
+# backend/services/model_router.py
+"""
+按 step 选择模型的路由表
+
+不是每一步都需要最强的模型：Step 1 的复现说明、Step 3 的插桩建议、Step 5 的回归结果估计
+用快模型就够了，只有 Step 2 的成因假设和 Step 4 的补丁生成用强模型。
+
+每条路由有自己的模型、超时和输出 token 上限；快模型的输出在修复之后仍然不符合 schema 时，
+structured_output 会按 escalate_to 换成更强的路由整步重新生成（自动升级）。
+
+LLM_ROUTES 用 JSON 覆盖默认表（只写需要改的字段即可），例如
+{"step3": {"model": "openai/gpt-5-nano", "timeout": 20}, "step4": {"max_tokens": 8000}}
+"""
+import os
+import json
+from typing import Optional
+
+from backend.services.claude_client import GPT_MODEL, LLM_TIMEOUT
+
+# 轻量步骤使用的快模型
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "openai/gpt-5-mini")
+LLM_FAST_TIMEOUT = float(os.getenv("LLM_FAST_TIMEOUT", "45"))
+# 快模型输出不合格时是否自动换强模型重试
+LLM_ESCALATE = os.getenv("LLM_ESCALATE", "1") == "1"
+LLM_ROUTES = os.getenv("LLM_ROUTES", "")
+
+_DEFAULT_ROUTES = {
+    "strong": {"model": GPT_MODEL, "timeout": LLM_TIMEOUT, "max_tokens": None, "escalate_to": None},
+    "fast": {"model": LLM_FAST_MODEL, "timeout": LLM_FAST_TIMEOUT, "max_tokens": 2048, "escalate_to": "strong"},
+    "step1": {"model": LLM_FAST_MODEL, "timeout": LLM_FAST_TIMEOUT, "max_tokens": 2048, "escalate_to": "strong"},
+    "step2": {"model": GPT_MODEL, "timeout": LLM_TIMEOUT, "max_tokens": 4096, "escalate_to": None},
+    "step3": {"model": LLM_FAST_MODEL, "timeout": LLM_FAST_TIMEOUT, "max_tokens": 2048, "escalate_to": "strong"},
+    "step4": {"model": GPT_MODEL, "timeout": LLM_TIMEOUT, "max_tokens": None, "escalate_to": None},
+    "step5": {"model": LLM_FAST_MODEL, "timeout": LLM_FAST_TIMEOUT, "max_tokens": 1024, "escalate_to": "strong"},
+}
+
+
+class Route:
+    """
+    model        模型名（覆盖服务商配置里的默认模型）
+    timeout      单次尝试的超时（秒）
+    max_tokens   输出 token 上限，None 表示不限制
+    escalate_to  输出不合格时升级到的路由名，None 表示不升级
+    """
+    __slots__ = ("name", "model", "timeout", "max_tokens", "escalate_to")
+
+    def __init__(self, name: str, model: str, timeout: float, max_tokens: Optional[int] = None,
+                 escalate_to: Optional[str] = None):
+        self.name = name
+        self.model = model
+        self.timeout = timeout
+        self.max_tokens = max_tokens
+        self.escalate_to = escalate_to
+
+    def to_dict(self) -> dict:
+        return {"model": self.model, "timeout": self.timeout,
+                "max_tokens": self.max_tokens, "escalate_to": self.escalate_to}
+
+
+def _load_routes() -> dict[str, Route]:
+    table = {name: dict(config) for name, config in _DEFAULT_ROUTES.items()}
+    for name, override in (json.loads(LLM_ROUTES) if LLM_ROUTES else {}).items():
+        table.setdefault(name, dict(_DEFAULT_ROUTES["strong"])).update(override)
+    return {name: Route(name, **config) for name, config in table.items()}
+
+
+routes = _load_routes()
+
+
+def route_for(label: str) -> Route:
+    """label 为 "step1" ~ "step5"，没有配置的步骤走强模型"""
+    return routes.get(label) or routes["strong"]
+
+
+def escalation(route: Route) -> Optional[Route]:
+    if not LLM_ESCALATE or not route.escalate_to:
+        return None
+    target = routes.get(route.escalate_to)
+    if target is None or target.model == route.model:
+        return None
+    return target
+
+
+def table() -> dict:
+    return {name: route.to_dict() for name, route in routes.items()}
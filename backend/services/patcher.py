@@ -0,0 +1,365 @@
+# backend/services/patcher.py
+"""
+Unified diff 解析、应用与校验
+
+Step 4 的补丁由模型生成，只针对单个文件（--- buggy.py / +++ fixed.py）。
+模型写的 diff 行号经常不对，上下文也常有出入（丢了缩进、行尾空格、多写或少写一行上下文），
+所以每个 hunk 按下面的顺序逐级放宽去找位置，找到的位置离声明的行号越近越好：
+
+1. exact       上下文和删除行与原文逐行一致
+2. whitespace  忽略行尾空白
+3. indent      忽略行首和行尾空白；新增行按原文和补丁之间的缩进差重新缩进
+4. fuzz        以上都不行时，去掉 hunk 开头 / 结尾最多 PATCH_MAX_FUZZ 行上下文再试（和 GNU patch 的 fuzz 一样）
+
+上下文行始终输出原文，不用补丁里的版本。应用失败时给出具体原因：哪个 hunk、
+最接近的位置在哪一行、补丁期望什么、原文实际是什么。
+"""
+import os
+import re
+import time
+import difflib
+from typing import Optional
+
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+# fuzz 级别最多去掉的上下文行数（开头、结尾分别计算）
+PATCH_MAX_FUZZ = int(os.getenv("PATCH_MAX_FUZZ", "2"))
+
+LEVELS = ("exact", "whitespace", "indent")
+_NORMALIZE = {
+    "exact": lambda line: line,
+    "whitespace": lambda line: line.rstrip(),
+    "indent": lambda line: line.strip(),
+}
+
+
+class PatchError(Exception):
+    """
+    补丁无法应用，message 是给用户看的原因
+
+    stage 是出错的阶段（parse / apply / compile），hunk 是出错的 hunk 序号（从 1 开始），
+    line 是原文里相关的行号
+    """
+
+    def __init__(self, message: str, stage: str = "apply", hunk: Optional[int] = None,
+                 line: Optional[int] = None):
+        super().__init__(message)
+        self.stage = stage
+        self.hunk = hunk
+        self.line = line
+
+
+class Hunk:
+    __slots__ = ("old_start", "old_len", "new_start", "new_len", "lines")
+
+    def __init__(self, old_start: Optional[int], old_len: Optional[int],
+                 new_start: Optional[int], new_len: Optional[int]):
+        self.old_start = old_start
+        self.old_len = old_len
+        self.new_start = new_start
+        self.new_len = new_len
+        # (tag, text)，tag 是 " " / "-" / "+"
+        self.lines: list[tuple[str, str]] = []
+
+    @property
+    def old_lines(self) -> list[str]:
+        return [text for tag, text in self.lines if tag in " -"]
+
+    @property
+    def new_lines(self) -> list[str]:
+        return [text for tag, text in self.lines if tag in " +"]
+
+    @property
+    def changed(self) -> bool:
+        return any(tag != " " for tag, _ in self.lines)
+
+    def trimmed(self, head: int, tail: int) -> "Hunk":
+        """去掉开头 head 行、结尾 tail 行上下文（只去上下文行，遇到改动行就停）"""
+        lines = list(self.lines)
+        for _ in range(head):
+            if lines and lines[0][0] == " ":
+                lines.pop(0)
+        for _ in range(tail):
+            if lines and lines[-1][0] == " ":
+                lines.pop()
+        hunk = Hunk(self.old_start, None, None, None)
+        hunk.lines = lines
+        return hunk
+
+
+class Placement:
+    """一个 hunk 在原文中的落点"""
+    __slots__ = ("hunk", "pos", "size", "level", "fuzz", "offset")
+
+    def __init__(self, hunk: Hunk, pos: int, size: int, level: str, fuzz: int, offset: Optional[int]):
+        self.hunk = hunk
+        self.pos = pos
+        self.size = size
+        self.level = level
+        self.fuzz = fuzz
+        self.offset = offset
+
+    def to_dict(self, index: int) -> dict:
+        return {"hunk": index, "line": self.pos + 1, "offset": self.offset,
+                "level": self.level, "fuzz": self.fuzz}
+
+
+def parse_patch(patch_text: str) -> list[Hunk]:
+    """
+    解析 unified diff，返回 hunk 列表
+
+    模型经常省略 @@ 里的行号（只写 "@@"），这时 old_start 为 None，应用时按内容定位
+    """
+    hunks: list[Hunk] = []
+    current: Optional[Hunk] = None
+
+    # 末尾的空行不是上下文行
+    for raw in patch_text.replace("\r\n", "\n").rstrip("\n").split("\n"):
+        if raw.startswith("--- ") or raw.startswith("+++ "):
+            current = None
+            continue
+        if raw.startswith("@@"):
+            match = _HUNK_HEADER.match(raw)
+            if match:
+                old_start, old_len, new_start, new_len = match.groups()
+                current = Hunk(int(old_start), int(old_len) if old_len is not None else 1,
+                               int(new_start), int(new_len) if new_len is not None else 1)
+            else:
+                current = Hunk(None, None, None, None)
+            hunks.append(current)
+            continue
+        if current is None:
+            continue
+        if raw.startswith("\\"):  # "\ No newline at end of file"
+            continue
+        tag, text = (raw[:1], raw[1:]) if raw else (" ", "")
+        if tag not in " -+":
+            # 模型有时丢掉上下文行开头的空格
+            tag, text = " ", raw
+        current.lines.append((tag, text))
+
+    if not hunks:
+        raise PatchError("补丁里没有任何 hunk（缺少 @@ 段）", stage="parse")
+    if not any(hunk.changed for hunk in hunks):
+        raise PatchError("补丁没有任何 + / - 行，不会改动代码", stage="parse")
+    return hunks
+
+
+class _Index:
+    """原文按各级归一化后的行 → 行号列表，查找 hunk 时先用最少见的一行定位候选位置"""
+
+    def __init__(self, lines: list[str]):
+        self.lines = lines
+        self._normalized: dict[str, list[str]] = {}
+        self._positions: dict[str, dict[str, list[int]]] = {}
+
+    def normalized(self, level: str) -> list[str]:
+        if level not in self._normalized:
+            self._normalized[level] = [_NORMALIZE[level](line) for line in self.lines]
+        return self._normalized[level]
+
+    def positions(self, level: str) -> dict[str, list[int]]:
+        if level not in self._positions:
+            table: dict[str, list[int]] = {}
+            for pos, line in enumerate(self.normalized(level)):
+                table.setdefault(line, []).append(pos)
+            self._positions[level] = table
+        return self._positions[level]
+
+    def find(self, block: list[str], level: str, hint: int, start: int) -> Optional[int]:
+        """离 hint 最近、且不早于 start 的匹配位置"""
+        if not block:
+            return max(start, min(hint, len(self.lines)))
+        normalize = _NORMALIZE[level]
+        wanted = [normalize(line) for line in block]
+        # 用最不常见的一行做锚点，候选位置最少
+        table = self.positions(level)
+        anchor = min(range(len(wanted)), key=lambda i: len(table.get(wanted[i], ())))
+        text = self.normalized(level)
+        size = len(wanted)
+        best = None
+        for anchor_pos in table.get(wanted[anchor], ()):
+            pos = anchor_pos - anchor
+            if pos < start or pos + size > len(text) or text[pos:pos + size] != wanted:
+                continue
+            if best is None or abs(pos - hint) < abs(best - hint):
+                best = pos
+        return best
+
+
+def _locate(index: _Index, hunk: Hunk, hint: int, start: int,
+            max_fuzz: int) -> Optional[Placement]:
+    for fuzz in range(max_fuzz + 1):
+        variants = [(hunk, 0, 0)] if fuzz == 0 else [(hunk.trimmed(h, fuzz - h), h, fuzz - h)
+                                                       for h in range(fuzz + 1)]
+        for level in LEVELS:
+            for variant, head, _tail in variants:
+                if fuzz and len(variant.lines) == len(hunk.lines):
+                    continue
+                old = variant.old_lines
+                pos = index.find(old, level, hint + head, start)
+                if pos is not None:
+                    offset = pos - (hunk.old_start - 1 + head) if hunk.old_start else None
+                    return Placement(variant, pos, len(old), level, fuzz, offset)
+    return None
+
+
+def _indent(line: str) -> str:
+    return line[:len(line) - len(line.lstrip())]
+
+
+def _reindent(text: str, delta: int) -> str:
+    if not text.strip() or not delta:
+        return text
+    if delta > 0:
+        return " " * delta + text
+    removable = len(_indent(text))
+    return text[min(-delta, removable):]
+
+
+def _render(placement: Placement, original: list[str]) -> list[str]:
+    """按落点生成替换后的行：上下文取原文，新增行按缩进差调整"""
+    window = original[placement.pos:placement.pos + placement.size]
+    delta = 0
+    if placement.level == "indent":
+        pairs = [(orig, text) for orig, text in zip(window, placement.hunk.old_lines) if text.strip()]
+        if pairs:
+            delta = len(_indent(pairs[0][0])) - len(_indent(pairs[0][1]))
+    output: list[str] = []
+    cursor = 0
+    for tag, text in placement.hunk.lines:
+        if tag == " ":
+            output.append(window[cursor])
+            cursor += 1
+        elif tag == "-":
+            cursor += 1
+        else:
+            output.append(_reindent(text, delta))
+    return output
+
+
+def _explain(index: _Index, hunk: Hunk, hunk_no: int, hint: int, start: int) -> PatchError:
+    """找不到位置时，给出最接近的位置和第一处不一致的行"""
+    old = hunk.old_lines
+    stripped = index.normalized("indent")
+    wanted = [line.strip() for line in old]
+
+    # 在 start 之前能找到：hunk 顺序颠倒或与前一个 hunk 重叠
+    if start and index.find(old, "indent", hint, 0) is not None:
+        return PatchError(f"第 {hunk_no} 个 hunk 与前一个 hunk 重叠或顺序颠倒", hunk=hunk_no)
+
+    missing = [text for tag, text in hunk.lines if tag == "-" and text.strip()
+               and text.strip() not in index.positions("indent")]
+    if missing:
+        return PatchError(f"第 {hunk_no} 个 hunk 要删除的行在原文中不存在: `{missing[0].strip()}`", hunk=hunk_no)
+
+    best, best_score = None, -1
+    size = len(wanted)
+    for pos in range(max(0, start), max(len(stripped) - size, 0) + 1):
+        score = sum(1 for a, b in zip(stripped[pos:pos + size], wanted) if a == b)
+        if score > best_score or (score == best_score and abs(pos - hint) < abs(best - hint)):
+            best, best_score = pos, score
+    if best is None or best_score <= 0:
+        return PatchError(f"第 {hunk_no} 个 hunk 的上下文在原文中找不到", hunk=hunk_no)
+    for offset, expected in enumerate(wanted):
+        actual = stripped[best + offset] if best + offset < len(stripped) else None
+        if actual != expected:
+            where = f"原文第 {best + offset + 1} 行是 `{actual}`" if actual is not None else "原文已经结束"
+            return PatchError(
+                f"第 {hunk_no} 个 hunk 无法应用：最接近的位置在原文第 {best + 1} 行，"
+                f"补丁期望 `{expected}`，{where}", hunk=hunk_no, line=best + offset + 1)
+    return PatchError(f"第 {hunk_no} 个 hunk 的上下文在原文中找不到", hunk=hunk_no)
+
+
+def apply_hunks(source: str, patch_text: str, max_fuzz: int = PATCH_MAX_FUZZ) -> tuple[str, list[dict]]:
+    """
+    把补丁应用到 source 上，返回 (新源码, 每个 hunk 的落点)
+
+    落点: {"hunk": 1, "line": 15, "offset": 0, "level": "exact", "fuzz": 0}，
+    offset 是实际位置与 @@ 声明行号的差（没有行号时为 None）
+    """
+    hunks = parse_patch(patch_text)
+    trailing_newline = source.endswith("\n")
+    lines = source.split("\n")
+    if trailing_newline:
+        lines.pop()
+
+    index = _Index(lines)
+    output: list[str] = []
+    placements: list[dict] = []
+    cursor = 0
+    for hunk_no, hunk in enumerate(hunks, start=1):
+        hint = (hunk.old_start - 1) if hunk.old_start else cursor
+        placement = _locate(index, hunk, hint, cursor, max_fuzz)
+        if placement is None:
+            raise _explain(index, hunk, hunk_no, hint, cursor)
+        output.extend(lines[cursor:placement.pos])
+        output.extend(_render(placement, lines))
+        cursor = placement.pos + placement.size
+        placements.append(placement.to_dict(hunk_no))
+    output.extend(lines[cursor:])
+
+    result = "\n".join(output)
+    return (result + "\n" if trailing_newline else result), placements
+
+
+def apply_patch(source: str, patch_text: str) -> str:
+    """把补丁应用到 source 上，返回新源码；无法应用时抛出 PatchError"""
+    return apply_hunks(source, patch_text)[0]
+
+
+def check_syntax(source: str, file_name: str = "main.py") -> Optional[PatchError]:
+    """编译检查（只检查语法，不执行）；不是 Python 文件时跳过"""
+    if not file_name.endswith(".py"):
+        return None
+    try:
+        compile(source, file_name, "exec", dont_inherit=True)
+    except SyntaxError as e:
+        text = (e.text or "").strip()
+        detail = f": `{text}`" if text else ""
+        return PatchError(f"补丁应用后有语法错误（第 {e.lineno} 行 {e.msg}）{detail}",
+                          stage="compile", line=e.lineno)
+    except ValueError as e:  # 源码里有空字节等
+        return PatchError(f"补丁应用后无法编译: {e}", stage="compile")
+    return None
+
+
+def make_patch(source: str, patched: str, file_name: str = "main.py") -> str:
+    """重新生成一份行号、上下文都准确的 unified diff"""
+    return "".join(difflib.unified_diff(
+        source.splitlines(keepends=True), patched.splitlines(keepends=True),
+        fromfile=f"a/{file_name}", tofile=f"b/{file_name}"))
+
+
+def verify_patch(source: str, patch_text: str, file_name: str = "main.py",
+                 max_fuzz: int = PATCH_MAX_FUZZ) -> dict:
+    """
+    解析、应用并编译检查补丁
+
+    返回:
+        {
+          "applied": bool,
+          "compiles": bool / None（没应用上时为 None）,
+          "exact": 所有 hunk 都是原样、按声明的行号应用的,
+          "hunks": [...每个 hunk 的落点...],
+          "patched": 应用后的源码 / None,
+          "error": 拒绝原因, "stage": "parse" / "apply" / "compile", "hunk": 出错的 hunk, "line": 相关行号,
+          "duration_ms": 耗时
+        }
+    """
+    start = time.perf_counter()
+    report: dict = {"applied": False, "compiles": None, "exact": False, "hunks": [], "patched": None}
+    try:
+        patched, placements = apply_hunks(source, patch_text or "", max_fuzz)
+    except PatchError as e:
+        report.update(error=str(e), stage=e.stage, hunk=e.hunk, line=e.line)
+    else:
+        report.update(applied=True, hunks=placements, patched=patched,
+                      exact=all(p["level"] == "exact" and not p["fuzz"] and p["offset"] == 0
+                                for p in placements))
+        problem = check_syntax(patched, file_name)
+        report["compiles"] = problem is None
+        if problem is not None:
+            report.update(error=str(problem), stage=problem.stage, line=problem.line)
+    report["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return report
@@ -0,0 +1,125 @@
+# backend/services/probe_runtime.py
+"""
+插桩探针的运行时部分：把探针插进 AST，以及收集命中记录的列式环形缓冲区
+
+这个文件不导入 backend 包：instrument.py 会把它的源码原样拼进沙箱运行脚本里，
+进程内（生成插桩后的源码给用户看）和沙箱里用的是同一份实现。
+"""
+import ast
+from array import array
+
+
+class TraceBuffer:
+    """
+    每次探针命中记一行：序号、探针 id、行号、取值（repr 截断）
+
+    按列存储（array + list），容量固定，写满后覆盖最旧的行，
+    紧凑循环里的探针再多也不会把内存撑爆；每个探针的总命中数单独计数。
+    断言探针只在条件不成立（或求值出错）时才记一行。
+    """
+
+    def __init__(self, capacity: int = 4096, value_limit: int = 120, asserts=()):
+        self.capacity = capacity
+        self.value_limit = value_limit
+        self.asserts = set(asserts)
+        self.total = 0
+        self.seq = array("Q", bytes(8 * capacity))
+        self.probe = array("H", bytes(2 * capacity))
+        self.line = array("I", bytes(4 * capacity))
+        self.values: list = [None] * capacity
+        self.hits: dict = {}
+        self.violations: dict = {}
+
+    def _repr(self, value) -> str:
+        try:
+            text = repr(value)
+        except Exception as e:  # 用户对象的 __repr__ 也可能出错
+            text = f"<repr 失败: {type(e).__name__}>"
+        if len(text) > self.value_limit:
+            text = text[:self.value_limit] + "…"
+        return text
+
+    def hit(self, probe_id: int, line: int, thunk) -> None:
+        """探针回调：thunk 在这里才求值，表达式出错只记录错误而不影响用户代码"""
+        self.hits[probe_id] = self.hits.get(probe_id, 0) + 1
+        try:
+            values = thunk()
+            failed = False
+        except Exception as e:
+            values = (f"<{type(e).__name__}: {e}>",)
+            failed = True
+        if probe_id in self.asserts:
+            if not failed and all(values):
+                return
+            self.violations[probe_id] = self.violations.get(probe_id, 0) + 1
+        row = values if failed else tuple(self._repr(v) for v in values)
+
+        slot = self.total % self.capacity
+        self.seq[slot] = self.total
+        self.probe[slot] = probe_id
+        self.line[slot] = line
+        self.values[slot] = row
+        self.total += 1
+
+    def export(self) -> dict:
+        """按时间顺序导出仍在缓冲区里的行（列式）"""
+        size = min(self.total, self.capacity)
+        start = self.total - size
+        order = [(start + i) % self.capacity for i in range(size)]
+        return {
+            "total": self.total,
+            "dropped": self.total - size,
+            "capacity": self.capacity,
+            "seq": [self.seq[i] for i in order],
+            "probe": [self.probe[i] for i in order],
+            "line": [self.line[i] for i in order],
+            "values": [list(self.values[i]) for i in order],
+            "hits": {str(k): v for k, v in self.hits.items()},
+            "violations": {str(k): v for k, v in self.violations.items()},
+        }
+
+
+def _statement_lists(tree: ast.AST):
+    """遍历所有语句列表（body / orelse / finalbody / except 分支 / match 分支）"""
+    for node in ast.walk(tree):
+        for field in ("body", "orelse", "finalbody"):
+            stmts = getattr(node, field, None)
+            if isinstance(stmts, list) and stmts and isinstance(stmts[0], ast.stmt):
+                yield stmts
+
+
+def apply_probes(tree: ast.Module, insertions: list) -> ast.Module:
+    """
+    按 (line, col) 定位语句，把探针调用插到它前面（before）或后面（after）
+
+    插入的节点复用锚点语句的行号，用户代码的 traceback 行号保持不变
+    insertions: [{"line": 17, "col": 8, "where": "before", "call": "__probe__(1, 17, lambda: (i,))"}]
+    """
+    wanted: dict = {}
+    for ins in insertions:
+        wanted.setdefault((ins["line"], ins["col"]), []).append(ins)
+
+    for stmts in list(_statement_lists(tree)):
+        index = 0
+        while index < len(stmts):
+            anchor = stmts[index]
+            pending = wanted.pop((anchor.lineno, anchor.col_offset), None)
+            if not pending:
+                index += 1
+                continue
+            before = [ins for ins in pending if ins["where"] == "before"]
+            after = [ins for ins in pending if ins["where"] != "before"]
+            nodes_before = [_probe_stmt(ins["call"], anchor) for ins in before]
+            nodes_after = [_probe_stmt(ins["call"], anchor) for ins in after]
+            stmts[index:index + 1] = nodes_before + [anchor] + nodes_after
+            index += len(nodes_before) + 1 + len(nodes_after)
+    return ast.fix_missing_locations(tree)
+
+
+def _probe_stmt(call: str, anchor: ast.stmt) -> ast.stmt:
+    node = ast.parse(call, mode="exec").body[0]
+    for child in ast.walk(node):
+        if hasattr(child, "lineno"):
+            child.lineno = child.end_lineno = anchor.lineno
+            child.col_offset = child.end_col_offset = anchor.col_offset
+    return node
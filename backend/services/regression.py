@@ -0,0 +1,225 @@
+# backend/services/regression.py
+"""
+Step 5 回归测试引擎：真正执行测试，而不是让模型编造 ✅/❌
+
+1. 把 Step 4 的 unified diff 应用到代码副本上，写入临时工作区
+2. 静态发现 unittest 用例（AST，不导入测试模块）
+3. 把用例分片，在沙箱 worker 进程池里并行执行，记录每个用例的结果和耗时
+4. 同时在固定墙钟预算内做覆盖率引导 fuzz（见 backend/services/fuzzer.py），
+   结果记在 regression_results 的 fuzz_10x 里：有独立崩溃就是 ❌
+"""
+import os
+import ast
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+from typing import Optional
+
+from backend.services import fuzzer
+from backend.services.patcher import apply_patch, PatchError
+from backend.services.sandbox import sandbox_pool
+
+REGRESSION_WORKERS = int(os.getenv("REGRESSION_WORKERS", str(os.cpu_count() or 2)))
+REGRESSION_TIMEOUT = float(os.getenv("REGRESSION_TIMEOUT", "30"))
+REGRESSION_CPU_SECONDS = int(os.getenv("REGRESSION_CPU_SECONDS", "20"))
+# regression_results 里 fuzz 结果的 key，沿用 Step 5 一直以来的名字（现在是预算内的覆盖率引导 fuzz）
+FUZZ_RESULT_KEY = "fuzz_10x"
+
+_TEST_RUNNER = '''
+import io, json, time, unittest, contextlib
+PARAMS = json.loads(__PARAMS__)
+results = []
+for test_id in PARAMS["tests"]:
+    buf = io.StringIO()
+    outcome = unittest.TestResult()
+    start = time.perf_counter()
+    try:
+        suite = unittest.defaultTestLoader.loadTestsFromName(test_id)
+        with contextlib.redirect_stdout(buf), contextlib.redirect_stderr(buf):
+            suite.run(outcome)
+        problems = outcome.failures + outcome.errors
+        if problems:
+            status, detail = "fail", problems[0][1]
+        elif outcome.skipped:
+            status, detail = "skip", outcome.skipped[0][1]
+        else:
+            status, detail = "pass", None
+    except Exception as e:
+        status, detail = "error", f"{type(e).__name__}: {e}"
+    results.append({
+        "id": test_id,
+        "status": status,
+        "detail": detail[-2000:] if detail else None,
+        "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+    })
+__sandbox_result__ = results
+'''
+
+
+def _runner(template: str, params: dict) -> str:
+    return template.replace("__PARAMS__", repr(json.dumps(params, ensure_ascii=False)))
+
+
+# ===== 用例发现 =====
+
+def module_name(rel_path: str) -> str:
+    return rel_path[:-3].replace("/", ".") if rel_path.endswith(".py") else rel_path.replace("/", ".")
+
+
+def discover_tests(rel_path: str, source: str) -> list[str]:
+    """返回 unittest 用例 id，例如 demo.test_cases.TestProcessItems.test_case_001_normal_list"""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return []
+    module = module_name(rel_path)
+    test_ids = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        bases = [ast.unparse(base) for base in node.bases]
+        if not any(base.endswith("TestCase") for base in bases):
+            continue
+        for item in node.body:
+            if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)) and item.name.startswith("test"):
+                test_ids.append(f"{module}.{node.name}.{item.name}")
+    return test_ids
+
+
+def select_tests(test_ids: list[str], targets: Optional[list[str]] = None,
+                 case_names: Optional[list[str]] = None) -> list[str]:
+    """
+    按 targets（"demo/test_cases.py::TestProcessItems"、"TestProcessItems::test_x"）
+    或 bug report 的 test_cases（"case_001_normal_list"）过滤用例
+    """
+    selected = test_ids
+    if targets:
+        wanted = []
+        for target in targets:
+            path, _, rest = target.partition("::") if "::" in target else ("", "", target)
+            prefix = module_name(path) if path else ""
+            dotted = rest.replace("::", ".")
+            for test_id in test_ids:
+                if prefix and not test_id.startswith(prefix + "."):
+                    continue
+                if not dotted or f".{dotted}." in f".{test_id}." or test_id.endswith(f".{dotted}"):
+                    wanted.append(test_id)
+        selected = [t for t in test_ids if t in wanted]
+    if case_names:
+        names = {name if name.startswith("test") else f"test_{name}" for name in case_names}
+        matched = [t for t in selected if t.rsplit(".", 1)[-1] in names]
+        selected = matched or selected
+    return selected
+
+
+def case_label(test_id: str) -> str:
+    name = test_id.rsplit(".", 1)[-1]
+    return name[len("test_"):] if name.startswith("test_") else name
+
+
+# ===== 执行 =====
+
+def _write(root: str, rel_path: str, content: str) -> None:
+    path = os.path.join(root, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+
+async def _run_in_sandbox(gate: asyncio.Semaphore, workspace: str, code: str, name: str) -> dict:
+    async with gate:
+        return await sandbox_pool.run(
+            code, name, timeout=REGRESSION_TIMEOUT,
+            extra={"sys_path": [workspace], "cpu_seconds": REGRESSION_CPU_SECONDS},
+        )
+
+
+async def run_tests(workspace: str, test_ids: list[str], gate: asyncio.Semaphore) -> list[dict]:
+    """把用例轮转分片到 REGRESSION_WORKERS 个 worker 并行执行"""
+    if not test_ids:
+        return []
+    shard_count = min(REGRESSION_WORKERS, len(test_ids))
+    shards = [test_ids[i::shard_count] for i in range(shard_count)]
+    runs = await asyncio.gather(*(
+        _run_in_sandbox(gate, workspace, _runner(_TEST_RUNNER, {"tests": shard}), "regression_runner.py")
+        for shard in shards
+    ))
+
+    results = []
+    for shard, run in zip(shards, runs):
+        payload = run.get("payload")
+        if isinstance(payload, list):
+            results.extend(payload)
+            continue
+        # 整个分片没跑完（超时、被 rlimit 杀掉等），分片里的用例都算失败
+        reason = run.get("exception_message") or run.get("status")
+        results.extend({"id": test_id, "status": "error", "detail": reason, "duration_ms": None}
+                       for test_id in shard)
+    return results
+
+
+async def run_regression(file_name: str, source: str, patch_text: Optional[str],
+                         tests: list[tuple[str, str]], targets: Optional[list[str]] = None,
+                         case_names: Optional[list[str]] = None,
+                         fuzz_budget: float = fuzzer.FUZZ_BUDGET, project: Optional[str] = None) -> dict:
+    """
+    应用补丁并执行回归测试，同时 fuzz 打过补丁的代码 fuzz_budget 秒（0 表示不 fuzz）
+
+    返回:
+        {
+          "regression_results": {"case_001_normal_list": "✅", ..., "fuzz_10x": "✅"},
+          "tests": [...每个用例的状态和耗时...],
+          "fuzz": {...每个目标函数的执行次数、覆盖的边数和去重后的崩溃...},
+          "fuzz_summary": {"passed", "unique_crashes", "execs", "budget_s", "workers"},
+          "patch_applied": bool,
+          "error": 补丁无法应用时的原因,
+          "duration_ms": 总耗时
+        }
+    """
+    start = time.perf_counter()
+    if not patch_text:
+        return {"regression_results": {"patch_apply": "❌"}, "patch_applied": False,
+                "error": "Step 4 没有给出补丁", "tests": [], "fuzz": {}, "fuzz_summary": None}
+    try:
+        patched = apply_patch(source, patch_text)
+    except PatchError as e:
+        return {"regression_results": {"patch_apply": "❌"}, "patch_applied": False,
+                "error": str(e), "tests": [], "fuzz": {}, "fuzz_summary": None}
+
+    workspace = tempfile.mkdtemp(prefix="truedebug-regression-")
+    try:
+        _write(workspace, file_name, patched)
+        for rel_path, content in tests:
+            _write(workspace, rel_path, content)
+
+        test_ids = [t for rel_path, content in tests for t in discover_tests(rel_path, content)]
+        test_ids = select_tests(test_ids, targets, case_names)
+
+        gate = asyncio.Semaphore(REGRESSION_WORKERS)
+        test_results, fuzz_report = await asyncio.gather(
+            run_tests(workspace, test_ids, gate),
+            fuzzer.fuzz(workspace, module_name(file_name), file_name, patched,
+                        [content for _, content in tests], budget=fuzz_budget,
+                        # 语料按打补丁之前的源码分目录，同一份代码的各个候选补丁共用
+                        project=fuzzer.project_key(file_name, project, source)),
+        )
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    regression_results = {
+        case_label(r["id"]): "✅" if r["status"] in ("pass", "skip") else "❌" for r in test_results
+    }
+    fuzz_summary = {key: value for key, value in fuzz_report.items() if key != "targets"}
+    if fuzz_report["targets"]:
+        regression_results[FUZZ_RESULT_KEY] = "✅" if fuzz_report["passed"] else "❌"
+
+    return {
+        "regression_results": regression_results,
+        "tests": test_results,
+        "fuzz": fuzz_report["targets"],
+        "fuzz_summary": fuzz_summary,
+        "patch_applied": True,
+        "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+    }
@@ -0,0 +1,170 @@
+# backend/services/result_cache.py
+"""
+按内容寻址的 step 结果缓存
+
+key = hash(step, 规范化后的代码, 上游 step 输出, 用户选择的假设, prompt 模板版本)
+
+- 代码改动 / 上游输出变化 / prompt 模板升级都会自然 miss
+- 两个用户提交相同代码时共享同一份结果
+- 内存层：LRU + TTL + 字节预算
+- 可选磁盘层（RESULT_CACHE_DIR）：进程重启、CI 重跑时仍然命中
+"""
+import os
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Any, Optional
+
+from backend.services.log import get_logger
+
+logger = get_logger("result_cache")
+
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1024"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", str(24 * 3600)))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+
+
+def normalize_code(code: Any) -> str:
+    """
+    规范化代码，避免换行符、行尾空白等无意义差异导致 miss
+
+    CLI 传过来的 code 可能是 bug report 字典，按排序后的 JSON 处理
+    """
+    if code is None:
+        return ""
+    if not isinstance(code, str):
+        code = json.dumps(code, ensure_ascii=False, sort_keys=True)
+    lines = code.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+def make_key(step: str, code: Any, upstream: Any = None, hypothesis: Any = None,
+             prompt_version: str = "1") -> str:
+    payload = json.dumps(
+        {
+            "step": step,
+            "code": normalize_code(code),
+            "upstream": upstream,
+            "hypothesis": hypothesis,
+            "prompt_version": prompt_version,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_entries: int = RESULT_CACHE_MAX_ENTRIES,
+                 max_bytes: int = RESULT_CACHE_MAX_BYTES,
+                 ttl: float = RESULT_CACHE_TTL,
+                 cache_dir: str = RESULT_CACHE_DIR):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        # key -> (写入时间, 字节数, 结果)
+        self._entries: "OrderedDict[str, tuple[float, int, Any]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            stored_at, _, value = entry
+            if time.time() - stored_at <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self._remove(key)
+
+        value = self._disk_get(key)
+        if value is not None:
+            self._put(key, value)
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        self._put(key, value)
+        self._disk_set(key, value)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    # ===== 内存层 =====
+
+    def _put(self, key: str, value: Any) -> None:
+        size = len(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.time(), size, value)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    # ===== 磁盘层 =====
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _disk_get(self, key: str) -> Optional[Any]:
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _disk_set(self, key: str, value: Any) -> None:
+        if not self.cache_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("写入磁盘缓存失败: %s", e)
+
+
+# 进程内共享的实例
+result_cache = ResultCache()
@@ -0,0 +1,217 @@
+# backend/services/sandbox.py
+"""
+真实执行用户代码的沙箱（Step 1 复现用）
+
+- 预热的 worker 进程池：进程提前启动好，任务到来时只需要写一行 JSON
+- 每个 worker 只执行一个任务就退出（进程级隔离），池子在后台自动补充
+- 限制 CPU 时间 / 内存 / 输出文件大小（rlimit）和墙钟时间（超时杀掉 worker 的整个进程组）
+- 用户代码在新的 mount / network / pid 命名空间里运行：看不到服务端的工作目录、HOME 和临时目录，
+  没有网络；服务端以 root 运行时再降权到 SANDBOX_USER（细节见 sandbox_worker.py）
+- 建不起隔离的机器上默认不执行，SANDBOX_ALLOW_UNISOLATED=1 才退回只有 rlimit 的执行方式
+- 返回 stdout / stderr、异常类型、traceback 和耗时
+"""
+import os
+import re
+import sys
+import json
+import time
+import signal
+import shutil
+import asyncio
+import tempfile
+from typing import Optional
+
+SANDBOX_POOL_SIZE = int(os.getenv("SANDBOX_POOL_SIZE", "4"))
+SANDBOX_CPU_SECONDS = int(os.getenv("SANDBOX_CPU_SECONDS", "5"))
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "512"))
+SANDBOX_FILE_MB = int(os.getenv("SANDBOX_FILE_MB", "16"))
+SANDBOX_WALL_TIMEOUT = float(os.getenv("SANDBOX_WALL_TIMEOUT", "10"))
+SANDBOX_OUTPUT_LIMIT = int(os.getenv("SANDBOX_OUTPUT_LIMIT", "65536"))
+# 服务端以 root 运行时，用户代码降权成这个用户；设为空表示不降权
+SANDBOX_USER = os.getenv("SANDBOX_USER", "nobody")
+# 对用户代码隐藏的目录（os.pathsep 分隔），默认是服务端工作目录、HOME 和临时目录
+SANDBOX_HIDE_PATHS = [p for p in os.getenv(
+    "SANDBOX_HIDE_PATHS", os.pathsep.join([os.getcwd(), os.path.expanduser("~"), tempfile.gettempdir()])
+).split(os.pathsep) if p]
+# 建不起命名空间隔离时是否仍然执行（只剩 rlimit 和进程组清理）
+SANDBOX_ALLOW_UNISOLATED = os.getenv("SANDBOX_ALLOW_UNISOLATED", "0") == "1"
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox_worker.py")
+
+# 代码自己捕获并打印的 traceback（例如 demo/buggy.py 的 main）
+_HANDLED_TRACEBACK = re.compile(
+    r"Traceback \(most recent call last\):\n(?:[ \t].*\n)*?([A-Za-z_][\w.]*): ?(.*)"
+)
+
+
+class _Worker:
+    __slots__ = ("proc", "workdir")
+
+    def __init__(self, proc: asyncio.subprocess.Process, workdir: str):
+        self.proc = proc
+        self.workdir = workdir
+
+
+class SandboxPool:
+    def __init__(self, size: int = SANDBOX_POOL_SIZE, cpu_seconds: int = SANDBOX_CPU_SECONDS,
+                 memory_mb: int = SANDBOX_MEMORY_MB, file_mb: int = SANDBOX_FILE_MB,
+                 wall_timeout: float = SANDBOX_WALL_TIMEOUT, output_limit: int = SANDBOX_OUTPUT_LIMIT):
+        self.size = size
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.file_mb = file_mb
+        self.wall_timeout = wall_timeout
+        self.output_limit = output_limit
+        self._idle: list[_Worker] = []
+        self._refill_tasks: set[asyncio.Task] = set()
+
+    async def _spawn(self) -> _Worker:
+        workdir = tempfile.mkdtemp(prefix="truedebug-sandbox-")
+        env = {"PATH": os.environ.get("PATH", ""), "HOME": workdir, "LANG": "C.UTF-8"}
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-I", WORKER_PATH,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            cwd=workdir,
+            env=env,
+            # 自己一个 session，超时时连同用户代码起的子进程一起杀掉
+            start_new_session=True,
+        )
+        return _Worker(proc, workdir)
+
+    def _refill(self) -> None:
+        """后台补充 worker，保持池子是热的"""
+        missing = self.size - len(self._idle) - len(self._refill_tasks)
+        for _ in range(max(0, missing)):
+            task = asyncio.ensure_future(self._spawn())
+            self._refill_tasks.add(task)
+
+            def _done(t: asyncio.Task) -> None:
+                self._refill_tasks.discard(t)
+                if not t.cancelled() and t.exception() is None:
+                    self._idle.append(t.result())
+
+            task.add_done_callback(_done)
+
+    async def _acquire(self) -> _Worker:
+        while self._idle:
+            worker = self._idle.pop()
+            if worker.proc.returncode is None:
+                return worker
+            shutil.rmtree(worker.workdir, ignore_errors=True)
+        return await self._spawn()
+
+    async def run(self, code: str, filename: str = "main.py", argv: Optional[list] = None,
+                  timeout: Optional[float] = None, extra: Optional[dict] = None) -> dict:
+        """在一个隔离的 worker 里执行 code，返回结构化的运行结果"""
+        timeout = timeout or self.wall_timeout
+        worker = await self._acquire()
+        self._refill()
+
+        job = {
+            "code": code,
+            "filename": filename,
+            "argv": argv or [],
+            "cpu_seconds": self.cpu_seconds,
+            "memory_mb": self.memory_mb,
+            "file_mb": self.file_mb,
+            "output_limit": self.output_limit,
+            "user": SANDBOX_USER,
+            "hide_paths": SANDBOX_HIDE_PATHS,
+            "allow_unisolated": SANDBOX_ALLOW_UNISOLATED,
+        }
+        if extra:
+            job.update(extra)
+
+        start = time.perf_counter()
+        try:
+            stdout, _ = await asyncio.wait_for(
+                worker.proc.communicate((json.dumps(job, ensure_ascii=False) + "\n").encode("utf-8")),
+                timeout,
+            )
+            result = self._parse(stdout, worker.proc.returncode)
+        except asyncio.TimeoutError:
+            _kill_group(worker.proc)
+            await worker.proc.wait()
+            result = {"status": "timeout", "exception_type": None,
+                      "exception_message": f"运行超过 {timeout:g}s 被终止"}
+        except asyncio.CancelledError:
+            _kill_group(worker.proc)
+            raise
+        finally:
+            shutil.rmtree(worker.workdir, ignore_errors=True)
+
+        result["wall_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        _detect_handled_exception(result)
+        return result
+
+    def _parse(self, stdout: bytes, returncode: int) -> dict:
+        try:
+            return json.loads(stdout.decode("utf-8"))
+        except ValueError:
+            pass
+        # 没有结果：通常是被 rlimit 信号杀掉了
+        if returncode is not None and returncode < 0:
+            signal_no = -returncode
+            if signal_no == 24:  # SIGXCPU
+                return {"status": "cpu_limit", "exception_type": None,
+                        "exception_message": f"超出 CPU 时间限制 ({self.cpu_seconds}s)"}
+            return {"status": "killed", "exception_type": None,
+                    "exception_message": f"进程被信号 {signal_no} 终止"}
+        return {"status": "sandbox_error", "exception_type": None,
+                "exception_message": f"worker 异常退出 (exit code {returncode})"}
+
+    async def close(self) -> None:
+        for task in list(self._refill_tasks):
+            task.cancel()
+        for worker in self._idle:
+            if worker.proc.returncode is None:
+                _kill_group(worker.proc)
+                await worker.proc.wait()
+            shutil.rmtree(worker.workdir, ignore_errors=True)
+        self._idle.clear()
+
+
+def _kill_group(proc: asyncio.subprocess.Process) -> None:
+    """杀掉 worker 所在的整个进程组（pid 命名空间的 init 也在里面，它一退出命名空间里的进程全部被杀）"""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _detect_handled_exception(result: dict) -> None:
+    """代码自己 try/except 后打印了 traceback 的情况，也把异常信息提取出来"""
+    if result.get("exception_type") or result.get("status") != "ok":
+        return
+    matches = list(_HANDLED_TRACEBACK.finditer(result.get("stderr") or ""))
+    if not matches:
+        return
+    last = matches[-1]
+    result["handled"] = True
+    result["exception_type"] = last.group(1).rsplit(".", 1)[-1]
+    result["exception_message"] = last.group(2).strip()
+    result["traceback"] = last.group(0)
+
+
+def describe(result: dict) -> str:
+    """把运行结果转成 Step 1 的 run_result 文案"""
+    status = result.get("status")
+    exc = result.get("exception_type")
+    message = result.get("exception_message") or ""
+    if status == "error":
+        return f"程序崩溃 ({exc}: {message})"
+    if status == "ok" and exc:
+        return f"程序捕获并打印了异常 ({exc}: {message})"
+    if status == "ok":
+        lines = (result.get("stdout") or "").strip().splitlines()
+        tail = lines[-1] if lines else "无输出"
+        return f"程序正常结束，最后输出: {tail}"
+    if status == "exit":
+        return f"程序以退出码 {result.get('exit_code')} 结束"
+    return message or f"运行失败 ({status})"
+
+
+# 进程内共享的实例
+sandbox_pool = SandboxPool()
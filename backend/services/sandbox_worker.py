@@ -0,0 +1,327 @@
+# backend/services/sandbox_worker.py
+"""
+沙箱 worker 进程
+
+由 backend/services/sandbox.py 以 `python -I sandbox_worker.py` 预先启动并放进池子里（各自一个 session），
+从 stdin 读取一行 JSON 任务，执行一次用户代码后把结果 JSON 写回 stdout，然后退出。
+
+进程结构（worker 自己从不执行用户代码）:
+    worker ── 隔离（新的 mount / network / pid 命名空间；非 root 时先建 user 命名空间）
+      └─ init ── pid 命名空间里的 1 号进程，只负责等待；它退出时内核会杀掉命名空间里剩下的所有进程
+           └─ runner ── 降权到 SANDBOX_USER（root 启动时）、设 rlimit，执行用户代码
+- 文件系统：job["hide_paths"]（服务端工作目录、HOME、临时目录等）被换成空的 tmpfs，
+  只把解释器、这次任务的工作目录和 sys_path 重新挂回去；没有网络（新的 network 命名空间里连 lo 都没启用）
+- runner 只保留 stdout / stderr 文件和一条回报管道，worker 写给服务端的 stdout 它碰不到；
+  回报内容由用户代码所在的进程生成，只当作"程序自己的说法"，状态以 worker 看到的退出情况为准
+- 建不起隔离（不是 Linux、内核不支持命名空间）时拒绝执行，除非任务带了 allow_unisolated
+
+这个文件必须保持独立（不导入 backend 包），因为 -I 模式下没有项目路径。
+"""
+import io
+import os
+import sys
+import json
+import time
+import signal
+import traceback
+
+CLONE_NEWNS = 0x00020000
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWPID = 0x20000000
+CLONE_NEWNET = 0x40000000
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_REMOUNT = 32
+MS_BIND = 4096
+MS_REC = 16384
+MS_PRIVATE = 1 << 18
+
+_libc = None
+
+
+class IsolationError(Exception):
+    """没法建立隔离"""
+
+
+def _call(name: str, *args) -> None:
+    global _libc
+    if _libc is None:
+        import ctypes
+        _libc = ctypes.CDLL(None, use_errno=True)
+    if getattr(_libc, name)(*args) != 0:
+        import ctypes
+        errno = ctypes.get_errno()
+        raise IsolationError(f"{name} 失败: {os.strerror(errno)}")
+
+
+def _mount(source, target: str, fstype, flags: int, data=None) -> None:
+    import ctypes
+    encode = lambda value: value.encode() if value is not None else None  # noqa: E731
+    _call("mount", encode(source), encode(target), encode(fstype), ctypes.c_ulong(flags), encode(data))
+
+
+def _write_file(path: str, text: str) -> None:
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _inside(path: str, root: str) -> bool:
+    return path == root or path.startswith(root.rstrip("/") + "/")
+
+
+def isolate(job: dict, workdir: str) -> None:
+    """
+    在 worker 里建立命名空间：之后 fork 出的进程都在新的 mount / network / pid 命名空间里
+    """
+    if not sys.platform.startswith("linux"):
+        raise IsolationError("只有 Linux 支持命名空间隔离")
+    uid, gid = os.geteuid(), os.getegid()
+    flags = CLONE_NEWNS | CLONE_NEWNET | CLONE_NEWPID
+    if uid != 0:
+        flags |= CLONE_NEWUSER
+    _call("unshare", flags)
+    if uid != 0:
+        # 命名空间里的 root 就是外面的当前用户，只是多了在命名空间里挂载的能力
+        _write_file("/proc/self/setgroups", "deny")
+        _write_file("/proc/self/uid_map", f"0 {uid} 1")
+        _write_file("/proc/self/gid_map", f"0 {gid} 1")
+    _mount(None, "/", None, MS_REC | MS_PRIVATE)
+
+    expose = {os.path.realpath(p) for p in (sys.prefix, sys.base_prefix, sys.exec_prefix,
+                                             sys.base_exec_prefix, workdir)}
+    expose |= {os.path.realpath(p) for p in job.get("sys_path") or []}
+    hides = []
+    for path in sorted({os.path.realpath(p) for p in job.get("hide_paths") or []}):
+        # 不隐藏根目录、解释器所在目录，也不重复隐藏已经被上一级盖住的目录
+        if path == "/" or not os.path.isdir(path) or any(_inside(path, e) for e in expose) \
+                or any(_inside(path, h) for h in hides):
+            continue
+        hides.append(path)
+    # 先拿到要重新挂回去的目录的句柄，盖上 tmpfs 之后原路径就看不到了
+    handles = {path: os.open(path, os.O_PATH | os.O_DIRECTORY)
+               for path in expose if os.path.isdir(path) and any(_inside(path, h) for h in hides)}
+    size = f"{max(int(job.get('file_mb') or 16) * 4, 16)}m"
+    for path in hides:
+        _mount("tmpfs", path, "tmpfs", MS_NOSUID | MS_NODEV, f"mode=1777,size={size}")
+    for path, fd in sorted(handles.items()):
+        os.makedirs(path, mode=0o755, exist_ok=True)
+        _mount(f"/proc/self/fd/{fd}", path, None, MS_BIND | MS_REC)
+        if path != os.path.realpath(workdir):  # 只有这次任务的工作目录可写
+            _mount(None, path, None, MS_BIND | MS_REMOUNT | MS_RDONLY | MS_NOSUID | MS_NODEV)
+        os.close(fd)
+
+
+def sandbox_identity(job: dict) -> tuple[int, int] | None:
+    """root 启动时 runner 降权成的 (uid, gid)；job["user"] 为空表示不降权"""
+    if os.geteuid() != 0 or not job.get("user"):
+        return None
+    import pwd
+    try:
+        entry = pwd.getpwnam(job["user"])
+    except KeyError:
+        raise IsolationError(f"沙箱用户不存在: {job['user']}")
+    return entry.pw_uid, entry.pw_gid
+
+
+def apply_limits(job: dict) -> None:
+    try:
+        import resource
+    except ImportError:  # 非 POSIX 平台只能依赖父进程的墙钟超时
+        return
+
+    cpu = job.get("cpu_seconds")
+    if cpu:
+        resource.setrlimit(resource.RLIMIT_CPU, (int(cpu), int(cpu) + 1))
+    memory_mb = job.get("memory_mb")
+    if memory_mb:
+        limit = int(memory_mb) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    file_mb = job.get("file_mb")
+    if file_mb:
+        limit = int(file_mb) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_FSIZE, (limit, limit))
+
+
+def read_limited(fd: int, limit: int) -> tuple[str, bool]:
+    """从 worker 自己持有的句柄读输出文件（runner 换掉文件名也影响不到这里）"""
+    data = os.pread(fd, limit + 1, 0)
+    truncated = len(data) > limit
+    return data[:limit].decode("utf-8", errors="replace"), truncated
+
+
+def user_traceback(exc: BaseException) -> str:
+    """只保留用户代码的栈帧，去掉 worker 自己的 exec 调用"""
+    tb = exc.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename == __file__:
+        tb = tb.tb_next
+    return "".join(traceback.format_exception(type(exc), exc, tb))
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def run_user_code(job: dict, filename: str, identity, out_fd: int, err_fd: int, report_fd: int) -> None:
+    """runner 进程：降权、重定向输出、执行用户代码，把结果写进回报管道；从不返回"""
+    try:
+        null = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null, 0)
+        os.dup2(out_fd, 1)
+        os.dup2(err_fd, 2)
+        # worker 写给服务端的 stdout、job 管道等句柄一律关掉，只留回报管道
+        os.closerange(3, report_fd)
+        os.closerange(report_fd + 1, 65536)
+        if identity is not None:
+            uid, gid = identity
+            os.setgroups([])
+            os.setgid(gid)
+            os.setuid(uid)
+        sys.stdout = io.TextIOWrapper(os.fdopen(1, "wb", closefd=False), encoding="utf-8",
+                                      errors="replace", line_buffering=True)
+        sys.stderr = io.TextIOWrapper(os.fdopen(2, "wb", closefd=False), encoding="utf-8",
+                                      errors="replace", line_buffering=True)
+        sys.path.insert(0, os.getcwd())
+        for path in job.get("sys_path") or []:
+            sys.path.insert(0, path)
+        sys.argv = [filename] + list(job.get("argv") or [])
+        apply_limits(job)
+
+        result = {"status": "ok", "exit_code": 0, "exception_type": None,
+                  "exception_message": None, "traceback": None}
+        globs = {"__name__": "__main__", "__file__": filename, "__builtins__": __builtins__}
+        start = time.perf_counter()
+        try:
+            code = compile(job["code"], filename, "exec")
+            exec(code, globs)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            result.update(status="exit" if code else "ok", exit_code=code)
+        except BaseException as e:
+            result.update(
+                status="error",
+                exit_code=1,
+                exception_type=type(e).__name__,
+                exception_message=str(e),
+                traceback=user_traceback(e),
+            )
+        result["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        # 由框架生成的运行脚本（回归测试等）通过这个全局变量回传结构化数据
+        result["payload"] = globs.get("__sandbox_result__")
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # 单独一行写在最后：用户代码事先往管道里写的东西都在它前面
+        _write_all(report_fd, b"\n" + json.dumps(result, ensure_ascii=False, default=repr).encode("utf-8"))
+    finally:
+        os._exit(0)
+
+
+def run_init(job: dict, filename: str, identity, out_fd: int, err_fd: int, report_fd: int,
+             isolated: bool) -> None:
+    """pid 命名空间的 1 号进程：起 runner、等它结束，以 runner 的结局退出；从不返回"""
+    status = 1
+    try:
+        if isolated:
+            try:  # 只看得到命名空间里的进程
+                _mount("proc", "/proc", "proc", MS_NOSUID | MS_NODEV | MS_NOEXEC)
+            except IsolationError:
+                pass
+        pid = os.fork()
+        if pid == 0:
+            run_user_code(job, filename, identity, out_fd, err_fd, report_fd)
+        os.close(report_fd)
+        _, raw = os.waitpid(pid, 0)
+        status = 128 + os.WTERMSIG(raw) if os.WIFSIGNALED(raw) else os.WEXITSTATUS(raw)
+    finally:
+        os._exit(status)
+
+
+def _outcome(report: bytes, status: int, job: dict) -> dict:
+    """runner 的回报只取最后一行的已知字段；没有回报时按退出情况判断"""
+    try:
+        reported = json.loads(report.rsplit(b"\n", 1)[-1].decode("utf-8")) if report else None
+    except ValueError:
+        reported = None
+    if isinstance(reported, dict) and reported.get("status") in ("ok", "exit", "error"):
+        keys = ("status", "exit_code", "exception_type", "exception_message", "traceback",
+                "duration_ms", "payload")
+        return {key: reported.get(key) for key in keys}
+    if status > 128:
+        signal_no = status - 128
+        if signal_no == signal.SIGXCPU:
+            return {"status": "cpu_limit", "exception_type": None,
+                    "exception_message": f"超出 CPU 时间限制 ({job.get('cpu_seconds')}s)"}
+        return {"status": "killed", "exception_type": None, "exception_message": f"进程被信号 {signal_no} 终止"}
+    # 用户代码直接 os._exit() 了
+    return {"status": "exit" if status else "ok", "exit_code": status, "exception_type": None,
+            "exception_message": None, "traceback": None}
+
+
+def run_job(job: dict) -> dict:
+    workdir = os.getcwd()
+    filename = os.path.basename(job.get("filename") or "main.py")
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(job["code"])
+    out_fd = os.open(".sandbox_stdout", os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+    err_fd = os.open(".sandbox_stderr", os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+
+    identity = sandbox_identity(job)
+    if identity is not None:
+        os.chown(workdir, *identity)
+        for path in job.get("sys_path") or []:
+            # 服务端为这次任务建的临时工作区（mkdtemp 是 0700），降权后的 runner 要能读
+            os.chmod(path, 0o755)
+    isolated = True
+    try:
+        isolate(job, workdir)
+    except (IsolationError, OSError) as e:
+        if not job.get("allow_unisolated"):
+            return {"status": "sandbox_error", "exception_type": "IsolationError",
+                    "exception_message": f"无法隔离执行环境，拒绝执行: {e}", "traceback": None}
+        isolated = False
+
+    read_fd, report_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        run_init(job, filename, identity, out_fd, err_fd, report_fd, isolated)
+    os.close(report_fd)
+    chunks = []
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_fd)
+    _, raw = os.waitpid(pid, 0)
+    status = 128 + os.WTERMSIG(raw) if os.WIFSIGNALED(raw) else os.WEXITSTATUS(raw)
+
+    result = _outcome(b"".join(chunks), status, job)
+    result["isolated"] = isolated
+    limit = int(job.get("output_limit") or 65536)
+    result["stdout"], result["stdout_truncated"] = read_limited(out_fd, limit)
+    result["stderr"], result["stderr_truncated"] = read_limited(err_fd, limit)
+    return result
+
+
+def main() -> None:
+    # 预先导入常用模块，任务到来时不再付出这部分启动开销
+    import collections, itertools, functools, re, math, random, unittest, ctypes, pwd  # noqa: F401
+
+    line = sys.stdin.readline()
+    if not line:
+        return
+    job = json.loads(line)
+    try:
+        result = run_job(job)
+    except BaseException as e:  # worker 自身出错也要回报，而不是静默退出
+        result = {"status": "sandbox_error", "exception_type": type(e).__name__,
+                  "exception_message": str(e), "traceback": traceback.format_exc()}
+    _write_all(1, json.dumps(result, ensure_ascii=False, default=repr).encode("utf-8"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+# backend/services/session_journal.py
+"""
+每个会话一份只追加的 step 日志，支持回退和分支
+
+会话存储只保留每一步的最新输出，而且 step 结果按内容寻址缓存：用户回退后用同样的输入重跑，
+只会命中缓存拿到同一份输出。日志（SQLite，WAL 模式）记下每一次 step 调用：
+
+    blobs     内容寻址的 JSON（代码、step 输出），同样的内容只存一份，分支之间共享
+    entries   一次 step 调用：step、choice、缓存 key、代码哈希、输出哈希、parent（上一条）；只追加
+    branches  会话的分支：head 指向分支最新的一条，fork_step / salt 用来让回退后的 step 重新计算
+    sessions  每个会话当前所在的分支，以及分过几次叉（新分支的 salt，压缩后也不复用）
+
+- rollback(user_id, N)：从最近一次 Step N 的上一条分出新分支，会话存储恢复成当时的状态，
+  前 N-1 步不重算；新分支的 salt 混进 N 及以后各步的缓存 key，重跑 Step N 时会真正调用模型
+- checkout(user_id, branch)：切回任意分支，直接用日志里的输出恢复会话，不调用模型
+- 会话存储里的记录被淘汰后，从当前分支的 head 重建
+- compact()：空闲超过 JOURNAL_COMPACT_AFTER 的会话只保留当前分支、每步一条；
+  超过 JOURNAL_RETAIN 的整个删除，然后清理没人引用的 blob 并截断 WAL。
+  写入时按 JOURNAL_COMPACT_INTERVAL 在后台线程里触发（写入本身不等它），锁按会话逐个拿，
+  压缩期间的写入只等一个会话；清理 blob 和截断 WAL 用单独的连接、分小批进行，不占写入用的锁。
+  也可以单独跑：
+
+    python -m backend.services.session_journal --compact
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Optional
+
+from backend.services.data_dir import data_path, ensure_parent
+from backend.services.log import get_logger
+from backend.services.result_cache import normalize_code
+
+logger = get_logger("session_journal")
+
+JOURNAL_ENABLED = os.getenv("JOURNAL_ENABLED", "1") == "1"
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", data_path("session_journal.db"))
+# 空闲多久之后压缩（秒）
+JOURNAL_COMPACT_AFTER = float(os.getenv("JOURNAL_COMPACT_AFTER", str(24 * 3600)))
+# 空闲多久之后整个删除（秒）
+JOURNAL_RETAIN = float(os.getenv("JOURNAL_RETAIN", str(7 * 24 * 3600)))
+# 顺带压缩的最小间隔（秒），0 表示只手动压缩
+JOURNAL_COMPACT_INTERVAL = float(os.getenv("JOURNAL_COMPACT_INTERVAL", "3600"))
+# 清理 blob 时每个写事务最多删多少条，事务越短，和它抢 SQLite 写锁的 step 写入等得越少
+JOURNAL_GC_BATCH = int(os.getenv("JOURNAL_GC_BATCH", "500"))
+
+MAIN_BRANCH = "main"
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS blobs ("
+    " hash TEXT PRIMARY KEY,"
+    " data TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS entries ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    " session TEXT NOT NULL,"
+    " branch TEXT NOT NULL,"
+    " parent INTEGER,"
+    " step INTEGER NOT NULL,"
+    " choice TEXT,"
+    " cache_key TEXT,"
+    " code_hash TEXT,"
+    " output_hash TEXT NOT NULL,"
+    " created_at REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS idx_entries_session ON entries(session)",
+    # 清理 blob 时按哈希查引用
+    "CREATE INDEX IF NOT EXISTS idx_entries_output ON entries(output_hash)",
+    "CREATE INDEX IF NOT EXISTS idx_entries_code ON entries(code_hash)",
+    "CREATE TABLE IF NOT EXISTS branches ("
+    " session TEXT NOT NULL,"
+    " branch TEXT NOT NULL,"
+    " head INTEGER,"
+    " fork_step INTEGER NOT NULL DEFAULT 0,"
+    " salt INTEGER NOT NULL DEFAULT 0,"
+    " created_at REAL NOT NULL,"
+    " PRIMARY KEY (session, branch))",
+    "CREATE TABLE IF NOT EXISTS sessions ("
+    " session TEXT PRIMARY KEY,"
+    " branch TEXT NOT NULL,"
+    " updated_at REAL NOT NULL,"
+    " forks INTEGER NOT NULL DEFAULT 0,"
+    " compacted INTEGER NOT NULL DEFAULT 0)",
+    "CREATE INDEX IF NOT EXISTS idx_journal_sessions_updated ON sessions(updated_at)",
+)
+
+# 从 head 沿 parent 往回走，得到整条分支（最新的在前）
+_LINEAGE = (
+    "WITH RECURSIVE lineage(id, parent, step, choice, cache_key, code_hash, output_hash, branch, created_at) AS ("
+    " SELECT id, parent, step, choice, cache_key, code_hash, output_hash, branch, created_at"
+    " FROM entries WHERE id = ?"
+    " UNION ALL"
+    " SELECT e.id, e.parent, e.step, e.choice, e.cache_key, e.code_hash, e.output_hash, e.branch, e.created_at"
+    " FROM entries e JOIN lineage l ON e.id = l.parent)"
+    " SELECT id, parent, step, choice, cache_key, code_hash, output_hash, branch, created_at"
+    " FROM lineage ORDER BY id DESC"
+)
+
+
+def _hash(data: str) -> str:
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class JournalError(Exception):
+    """回退 / 切换分支的参数不合法"""
+
+
+class SessionJournal:
+    def __init__(self, path: str = JOURNAL_PATH, compact_interval: float = JOURNAL_COMPACT_INTERVAL):
+        self.path = path
+        self.compact_interval = compact_interval
+        self._last_compact = time.time()
+        self._compactor: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._open_lock = threading.Lock()
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """第一次用到时才打开数据库"""
+        if self._db is None:
+            with self._open_lock:
+                if self._db is None:
+                    conn = sqlite3.connect(ensure_parent(self.path), check_same_thread=False, isolation_level=None)
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                    for statement in _SCHEMA:
+                        conn.execute(statement)
+                    self._db = conn
+        return self._db
+
+    # ===== 写入 =====
+
+    def _put_blob(self, value: Any) -> str:
+        # 不排序 key：恢复出来的输出和当初返回给客户端的一致
+        data = json.dumps(value, ensure_ascii=False, default=str)
+        digest = _hash(data)
+        self._conn.execute("INSERT OR IGNORE INTO blobs (hash, data) VALUES (?, ?)", (digest, data))
+        return digest
+
+    def _active(self, session: str) -> Optional[tuple]:
+        """(branch, head, fork_step, salt)；会话还没有日志时为 None"""
+        return self._conn.execute(
+            "SELECT b.branch, b.head, b.fork_step, b.salt FROM sessions s"
+            " JOIN branches b ON b.session = s.session AND b.branch = s.branch"
+            " WHERE s.session = ?", (session,)
+        ).fetchone()
+
+    def append(self, session: str, step: int, output: Any, choice: Optional[str] = None,
+               cache_key: Optional[str] = None, code: Any = None) -> int:
+        """记录一次 step 调用，返回日志条目 id"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                active = self._active(session)
+                if active is None:
+                    branch, head = MAIN_BRANCH, None
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO branches (session, branch, head, created_at) VALUES (?, ?, NULL, ?)",
+                        (session, branch, now))
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO sessions (session, branch, updated_at) VALUES (?, ?, ?)",
+                        (session, branch, now))
+                else:
+                    branch, head = active[0], active[1]
+                code_hash = self._put_blob(normalize_code(code)) if code is not None else None
+                cur = self._conn.execute(
+                    "INSERT INTO entries (session, branch, parent, step, choice, cache_key, code_hash,"
+                    " output_hash, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (session, branch, head, step, None if choice is None else str(choice), cache_key,
+                     code_hash, self._put_blob(output), now))
+                entry_id = cur.lastrowid
+                self._conn.execute("UPDATE branches SET head = ? WHERE session = ? AND branch = ?",
+                                   (entry_id, session, branch))
+                self._conn.execute("UPDATE sessions SET updated_at = ?, compacted = 0 WHERE session = ?",
+                                   (now, session))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        self._maybe_compact()
+        return entry_id
+
+    # ===== 读取 =====
+
+    def _lineage(self, head: Optional[int]) -> list[tuple]:
+        if head is None:
+            return []
+        return self._conn.execute(_LINEAGE, (head,)).fetchall()
+
+    def _fold(self, lineage: list[tuple]) -> dict[int, Any]:
+        """按时间顺序重放分支上的写入，得到和会话存储一致的 step → 输出"""
+        latest: dict[int, str] = {}
+        for row in reversed(lineage):
+            latest[row[2]] = row[6]
+        steps: dict[int, Any] = {}
+        for step, digest in latest.items():
+            row = self._conn.execute("SELECT data FROM blobs WHERE hash = ?", (digest,)).fetchone()
+            if row is not None:
+                steps[step] = json.loads(row[0])
+        return steps
+
+    def state(self, session: str) -> dict[int, Any]:
+        """当前分支 head 处每一步的输出"""
+        with self._lock:
+            active = self._active(session)
+            return self._fold(self._lineage(active[1])) if active is not None else {}
+
+    def salted(self, session: str, step: int, key: Optional[str]) -> Optional[str]:
+        """回退出来的分支上，fork_step 及以后各步的缓存 key 混入 salt，避免命中回退前的结果"""
+        if key is None:
+            return key
+        with self._lock:
+            active = self._active(session)
+        if active is None or not active[3] or step < active[2]:
+            return key
+        return _hash(f"{key}:{active[3]}")
+
+    def history(self, session: str) -> dict:
+        """会话的全部分支，以及当前分支上的每一次 step 调用（最新的在前）"""
+        with self._lock:
+            active = self._active(session)
+            if active is None:
+                return {"error": f"会话 {session} 没有日志"}
+            branches = self._conn.execute(
+                "SELECT branch, head, fork_step, created_at FROM branches WHERE session = ? ORDER BY created_at",
+                (session,)).fetchall()
+            lineage = self._lineage(active[1])
+        return {
+            "branch": active[0],
+            "branches": [{"branch": name, "head": head, "fork_step": fork_step or None, "created_at": created}
+                         for name, head, fork_step, created in branches],
+            "entries": [{"id": row[0], "parent": row[1], "step": row[2], "choice": row[3], "branch": row[7],
+                         "output": row[6][:12], "created_at": row[8]}
+                        for row in lineage],
+        }
+
+    # ===== 回退 / 分支 =====
+
+    def rollback(self, session: str, step: int) -> dict:
+        """
+        从当前分支上最近一次 Step step 之前分出新分支并切过去，返回 {"branch": ..., "steps": {step: 输出}}
+
+        新分支与原分支共享前面的条目，不复制、不重算
+        """
+        now = time.time()
+        with self._lock:
+            active = self._active(session)
+            if active is None:
+                raise JournalError(f"会话 {session} 没有日志")
+            lineage = self._lineage(active[1])
+            target = next((row for row in lineage if row[2] == step), None)
+            if target is None:
+                raise JournalError(f"当前分支上没有执行过 Step {step}")
+            base = target[1]
+            # salt 单调递增，不同分支的缓存 key 不会撞上
+            salt = self._conn.execute("SELECT forks FROM sessions WHERE session = ?",
+                                      (session,)).fetchone()[0] + 1
+            branch = f"b{salt}"
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO branches (session, branch, head, fork_step, salt, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)", (session, branch, base, step, salt, now))
+                self._conn.execute("UPDATE sessions SET branch = ?, forks = ?, updated_at = ? WHERE session = ?",
+                                   (branch, salt, now, session))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            steps = {s: value for s, value in self._fold(self._lineage(base)).items() if s < step}
+        logger.info("会话 %s 从 Step %s 回退，新分支 %s", session, step, branch)
+        return {"branch": branch, "steps": steps}
+
+    def checkout(self, session: str, branch: str) -> dict:
+        """切换到已有分支，返回 {"branch": ..., "steps": {step: 输出}}"""
+        with self._lock:
+            row = self._conn.execute("SELECT head FROM branches WHERE session = ? AND branch = ?",
+                                     (session, branch)).fetchone()
+            if row is None:
+                raise JournalError(f"会话 {session} 没有分支 {branch}")
+            self._conn.execute("UPDATE sessions SET branch = ?, updated_at = ? WHERE session = ?",
+                               (branch, time.time(), session))
+            steps = self._fold(self._lineage(row[0]))
+        return {"branch": branch, "steps": steps}
+
+    def delete(self, session: str) -> None:
+        with self._lock:
+            self._delete(session)
+
+    def _delete(self, session: str) -> None:
+        for table in ("entries", "branches", "sessions"):
+            self._conn.execute(f"DELETE FROM {table} WHERE session = ?", (session,))
+
+    # ===== 压缩 =====
+
+    def _compact_session(self, session: str) -> int:
+        """只保留当前分支，每一步保留最新的一条，重新串成一条链；返回删除的条目数"""
+        active = self._active(session)
+        if active is None:
+            return 0
+        branch, head = active[0], active[1]
+        lineage = self._lineage(head)
+        keep: dict[int, tuple] = {}
+        for row in lineage:
+            keep.setdefault(row[2], row)
+        kept = sorted(keep.values(), key=lambda row: row[0])
+        total = self._conn.execute("SELECT COUNT(*) FROM entries WHERE session = ?", (session,)).fetchone()[0]
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("DELETE FROM entries WHERE session = ? AND id NOT IN (%s)"
+                               % ",".join("?" * len(kept)), (session, *(row[0] for row in kept)))
+            parent = None
+            for row in kept:
+                self._conn.execute("UPDATE entries SET parent = ?, branch = ? WHERE id = ?",
+                                   (parent, MAIN_BRANCH, row[0]))
+                parent = row[0]
+            self._conn.execute("DELETE FROM branches WHERE session = ?", (session,))
+            self._conn.execute(
+                "INSERT INTO branches (session, branch, head, fork_step, salt, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (session, MAIN_BRANCH, parent, active[2], active[3], time.time()))
+            self._conn.execute("UPDATE sessions SET branch = ?, compacted = 1 WHERE session = ?",
+                               (MAIN_BRANCH, session))
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        logger.debug("压缩会话 %s（原分支 %s）: %s → %s 条", session, branch, total, len(kept))
+        return total - len(kept)
+
+    def compact(self, compact_after: float = JOURNAL_COMPACT_AFTER, retain: float = JOURNAL_RETAIN) -> dict:
+        """压缩空闲会话、删除过期会话、清理没人引用的 blob，返回统计"""
+        start = time.perf_counter()
+        now = time.time()
+        with self._lock:
+            expired = [row[0] for row in self._conn.execute(
+                "SELECT session FROM sessions WHERE updated_at < ?", (now - retain,)).fetchall()]
+        for session in expired:
+            with self._lock:
+                # 拿到锁之前会话可能又有了写入
+                if self._idle_since(session, now - retain):
+                    self._delete(session)
+        with self._lock:
+            idle = [row[0] for row in self._conn.execute(
+                "SELECT session FROM sessions WHERE updated_at < ? AND compacted = 0",
+                (now - compact_after,)).fetchall()]
+        entries = 0
+        for session in idle:
+            with self._lock:
+                if self._idle_since(session, now - compact_after):
+                    entries += self._compact_session(session)
+        blobs = self._collect_blobs()
+        stats = {"deleted_sessions": len(expired), "compacted_sessions": len(idle), "dropped_entries": entries,
+                 "dropped_blobs": blobs, "duration_ms": round((time.perf_counter() - start) * 1000, 1)}
+        logger.info("日志压缩: %s", stats)
+        return stats
+
+    def _collect_blobs(self) -> int:
+        """
+        删除没有条目引用的 blob，然后截断 WAL，返回删除的 blob 数
+
+        用单独的连接，不拿 self._lock：先只读地找出候选，再分批删除；删除语句里重新检查引用，
+        找候选之后才被新条目引用的 blob 不会被删掉（写入在同一个事务里先写 blob 再写条目）
+        """
+        self._conn  # 确保库和表已经建好
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            orphans = [row[0] for row in conn.execute(
+                "SELECT hash FROM blobs WHERE NOT EXISTS (SELECT 1 FROM entries WHERE output_hash = blobs.hash)"
+                " AND NOT EXISTS (SELECT 1 FROM entries WHERE code_hash = blobs.hash)").fetchall()]
+            deleted = 0
+            for i in range(0, len(orphans), JOURNAL_GC_BATCH):
+                batch = orphans[i:i + JOURNAL_GC_BATCH]
+                deleted += conn.execute(
+                    "DELETE FROM blobs WHERE hash IN (%s)"
+                    " AND NOT EXISTS (SELECT 1 FROM entries WHERE output_hash = blobs.hash)"
+                    " AND NOT EXISTS (SELECT 1 FROM entries WHERE code_hash = blobs.hash)"
+                    % ",".join("?" * len(batch)), batch).rowcount
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+        return deleted
+
+    def _idle_since(self, session: str, cutoff: float) -> bool:
+        row = self._conn.execute("SELECT updated_at FROM sessions WHERE session = ?", (session,)).fetchone()
+        return row is not None and row[0] < cutoff
+
+    def _maybe_compact(self) -> None:
+        """到时间了就在后台线程里压缩，同一时间最多一个"""
+        if self.compact_interval <= 0 or time.time() - self._last_compact < self.compact_interval:
+            return
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._last_compact = time.time()
+        self._compactor = threading.Thread(target=self._compact_quietly, name="journal-compact", daemon=True)
+        self._compactor.start()
+
+    def _compact_quietly(self) -> None:
+        try:
+            self.compact()
+        except Exception:
+            logger.exception("日志压缩失败")
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {table: self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                      for table in ("sessions", "branches", "entries", "blobs")}
+        return {"path": self.path, **counts}
+
+
+# 进程内共享的实例；JOURNAL_ENABLED=0 时为 None
+session_journal = SessionJournal() if JOURNAL_ENABLED else None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="会话日志维护")
+    parser.add_argument("--compact", action="store_true", help="压缩空闲会话并删除过期会话")
+    parser.add_argument("--compact-after", type=float, default=JOURNAL_COMPACT_AFTER)
+    parser.add_argument("--retain", type=float, default=JOURNAL_RETAIN)
+    args = parser.parse_args()
+    journal = session_journal or SessionJournal()
+    if args.compact:
+        print(json.dumps(journal.compact(args.compact_after, args.retain), ensure_ascii=False))
+    print(json.dumps(journal.stats(), ensure_ascii=False))
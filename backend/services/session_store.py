@@ -0,0 +1,374 @@
+# backend/services/session_store.py
+"""
+有界、可淘汰的会话存储，替代 app.py 里六个只增不减的 stepN_cache 字典
+
+- 每个 user_id 一条紧凑记录（SessionRecord，使用 __slots__）
+- 空闲超时（SESSION_TTL）+ 会话数上限（SESSION_MAX，按最近写入做 LRU）：三个后端都只在写入时刷新，
+  读取不算活跃（每一步都会写回会话，读了不写的只有查看类请求）
+- 后端可插拔（SESSION_BACKEND）:
+    memory  进程内（默认）
+    sqlite  本地 SQLite 文件（默认 $DATA_DIR/sessions.db），多个 uvicorn worker 共享，重启不丢
+    redis   任何兼容 Redis 协议的服务（RESP），无需额外依赖
+- 协程里用 aget / aset_step / arestore / adelete：sqlite、redis 后端的阻塞调用放到线程池，
+  不卡事件循环；内存后端直接调用
+"""
+import os
+import json
+import time
+import socket
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+from urllib.parse import urlparse
+
+from backend.services.data_dir import data_path, ensure_parent
+
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "1000"))
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", data_path("sessions.db"))
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://127.0.0.1:6379/0")
+
+STEP_FIELDS = ("step1", "step2", "step3", "step4", "step5", "step6")
+
+
+class SessionRecord:
+    """一个会话的全部 step 输出"""
+    __slots__ = ("user_id", "updated_at") + STEP_FIELDS
+
+    def __init__(self, user_id: str, updated_at: float | None = None, **steps: Any):
+        self.user_id = user_id
+        self.updated_at = updated_at if updated_at is not None else time.time()
+        for field in STEP_FIELDS:
+            setattr(self, field, steps.get(field))
+
+    def get_step(self, step: int) -> Any:
+        return getattr(self, f"step{step}")
+
+    def set_step(self, step: int, value: Any) -> None:
+        setattr(self, f"step{step}", value)
+
+    def to_dict(self) -> dict:
+        data = {"user_id": self.user_id, "updated_at": self.updated_at}
+        for field in STEP_FIELDS:
+            data[field] = getattr(self, field)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SessionRecord":
+        steps = {field: data.get(field) for field in STEP_FIELDS}
+        return cls(data["user_id"], data.get("updated_at"), **steps)
+
+
+# ===== 后端 =====
+
+class MemoryBackend:
+    """进程内后端，OrderedDict 按最近写入排序，淘汰是 O(1) 的"""
+
+    def __init__(self):
+        self._records: "OrderedDict[str, SessionRecord]" = OrderedDict()
+
+    def get(self, user_id: str) -> Optional[SessionRecord]:
+        # 读取不调整顺序：和 sqlite / redis 后端一样按最近写入淘汰（write-LRU），
+        # 顺序和 updated_at 一致，purge 才能只看队头
+        return self._records.get(user_id)
+
+    def put(self, record: SessionRecord) -> None:
+        self._records[record.user_id] = record
+        self._records.move_to_end(record.user_id)
+
+    def delete(self, user_id: str) -> None:
+        self._records.pop(user_id, None)
+
+    def count(self) -> int:
+        return len(self._records)
+
+    def purge(self, ttl: float, max_sessions: int) -> int:
+        removed = 0
+        deadline = time.time() - ttl
+        while self._records:
+            oldest = next(iter(self._records.values()))
+            if oldest.updated_at >= deadline and len(self._records) <= max_sessions:
+                break
+            self._records.popitem(last=False)
+            removed += 1
+        return removed
+
+
+class SqliteBackend:
+    """SQLite 文件后端，WAL 模式，多进程可同时读写"""
+
+    def __init__(self, path: str = SESSION_SQLITE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._open_lock = threading.Lock()
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """第一次用到时才打开数据库"""
+        if self._db is None:
+            with self._open_lock:
+                if self._db is None:
+                    conn = sqlite3.connect(ensure_parent(self.path), check_same_thread=False, isolation_level=None)
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS sessions ("
+                        " user_id TEXT PRIMARY KEY,"
+                        " data TEXT NOT NULL,"
+                        " updated_at REAL NOT NULL)"
+                    )
+                    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at)")
+                    self._db = conn
+        return self._db
+
+    def get(self, user_id: str) -> Optional[SessionRecord]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return SessionRecord.from_dict(json.loads(row[0]))
+
+    def put(self, record: SessionRecord) -> None:
+        data = json.dumps(record.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)",
+                (record.user_id, data, record.updated_at),
+            )
+
+    def delete(self, user_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def purge(self, ttl: float, max_sessions: int) -> int:
+        with self._lock:
+            cur = self._conn.execute(
+                "DELETE FROM sessions WHERE updated_at < ?", (time.time() - ttl,)
+            )
+            removed = cur.rowcount
+            cur = self._conn.execute(
+                "DELETE FROM sessions WHERE user_id IN ("
+                " SELECT user_id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (max_sessions,),
+            )
+            removed += cur.rowcount
+        return removed
+
+
+class RespClient:
+    """极简 Redis 协议 (RESP2) 客户端，只实现会话存储需要的命令"""
+
+    def __init__(self, url: str = SESSION_REDIS_URL):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.db = int((parsed.path or "/0").lstrip("/") or 0)
+        self.password = parsed.password
+        self._lock = threading.Lock()
+        self._sock = None
+        self._file = None
+
+    def _connect(self) -> None:
+        self._sock = socket.create_connection((self.host, self.port), timeout=5)
+        self._file = self._sock.makefile("rb")
+        if self.password:
+            self._command("AUTH", self.password)
+        if self.db:
+            self._command("SELECT", self.db)
+
+    def command(self, *args: Any) -> Any:
+        with self._lock:
+            if self._sock is None:
+                self._connect()
+            try:
+                return self._command(*args)
+            except OSError:
+                # 连接断开时重连一次
+                self.close()
+                self._connect()
+                return self._command(*args)
+
+    def close(self) -> None:
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock = None
+                self._file = None
+
+    def _command(self, *args: Any) -> Any:
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        self._sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self) -> Any:
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("Redis 连接已关闭")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RuntimeError(f"Redis 错误: {payload.decode()}")
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._file.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RuntimeError(f"无法解析的 Redis 响应: {line!r}")
+
+
+class RedisBackend:
+    """
+    Redis 协议后端
+
+    每个会话一个 key（带 EX 过期，即空闲 TTL），另用一个有序集合记录最近写入时间，
+    用于在会话数超限时按 LRU 淘汰
+    """
+
+    def __init__(self, url: str = SESSION_REDIS_URL, prefix: str = "truedebug:session:",
+                 ttl: float = SESSION_TTL):
+        self.client = RespClient(url)
+        self.prefix = prefix
+        self.index_key = f"{prefix}index"
+        self.ttl = ttl
+
+    def _key(self, user_id: str) -> str:
+        return f"{self.prefix}{user_id}"
+
+    def get(self, user_id: str) -> Optional[SessionRecord]:
+        data = self.client.command("GET", self._key(user_id))
+        if data is None:
+            return None
+        return SessionRecord.from_dict(json.loads(data))
+
+    def put(self, record: SessionRecord) -> None:
+        data = json.dumps(record.to_dict(), ensure_ascii=False, default=str)
+        self.client.command("SET", self._key(record.user_id), data, "EX", max(1, int(self.ttl)))
+        self.client.command("ZADD", self.index_key, record.updated_at, record.user_id)
+
+    def delete(self, user_id: str) -> None:
+        self.client.command("DEL", self._key(user_id))
+        self.client.command("ZREM", self.index_key, user_id)
+
+    def count(self) -> int:
+        return self.client.command("ZCARD", self.index_key)
+
+    def purge(self, ttl: float, max_sessions: int) -> int:
+        # 过期的 key 已经由 Redis 自己删除，这里只清理索引
+        removed = self.client.command("ZREMRANGEBYSCORE", self.index_key, "-inf", time.time() - ttl)
+        overflow = self.count() - max_sessions
+        if overflow > 0:
+            victims = self.client.command("ZRANGE", self.index_key, 0, overflow - 1)
+            for user_id in victims:
+                self.delete(user_id.decode())
+            removed += len(victims)
+        return removed
+
+
+def create_backend(name: str = SESSION_BACKEND):
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sqlite":
+        return SqliteBackend(SESSION_SQLITE_PATH)
+    if name == "redis":
+        return RedisBackend(SESSION_REDIS_URL, ttl=SESSION_TTL)
+    raise ValueError(f"未知的 SESSION_BACKEND: {name}")
+
+
+# ===== 会话存储 =====
+
+class SessionStore:
+    def __init__(self, backend=None, ttl: float = SESSION_TTL, max_sessions: int = SESSION_MAX,
+                 purge_interval: float = 30.0):
+        self.backend = backend if backend is not None else create_backend()
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.purge_interval = purge_interval
+        self._last_purge = 0.0
+        self.evictions = 0
+
+    def get(self, user_id: str) -> Optional[SessionRecord]:
+        self._maybe_purge()
+        record = self.backend.get(user_id)
+        if record is None:
+            return None
+        if time.time() - record.updated_at > self.ttl:
+            self.backend.delete(user_id)
+            self.evictions += 1
+            return None
+        return record
+
+    def get_step(self, user_id: str, step: int) -> Any:
+        record = self.get(user_id)
+        return record.get_step(step) if record is not None else None
+
+    def set_step(self, user_id: str, step: int, value: Any) -> None:
+        record = self.get(user_id) or SessionRecord(user_id)
+        record.set_step(step, value)
+        record.updated_at = time.time()
+        self.backend.put(record)
+        self._maybe_purge(force=self.backend.count() > self.max_sessions)
+
+    def restore(self, user_id: str, steps: dict[int, Any]) -> SessionRecord:
+        """用给定的 step 输出整体替换会话记录（回退 / 切换分支 / 从日志重建）"""
+        record = SessionRecord(user_id, **{f"step{step}": value for step, value in steps.items()})
+        self.backend.put(record)
+        return record
+
+    def delete(self, user_id: str) -> None:
+        self.backend.delete(user_id)
+
+    def count(self) -> int:
+        return self.backend.count()
+
+    # ----- 协程接口 -----
+
+    async def _call(self, fn, *args: Any) -> Any:
+        if isinstance(self.backend, MemoryBackend):
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    async def aget(self, user_id: str) -> Optional[SessionRecord]:
+        return await self._call(self.get, user_id)
+
+    async def aset_step(self, user_id: str, step: int, value: Any) -> None:
+        await self._call(self.set_step, user_id, step, value)
+
+    async def arestore(self, user_id: str, steps: dict[int, Any]) -> SessionRecord:
+        return await self._call(self.restore, user_id, steps)
+
+    async def adelete(self, user_id: str) -> None:
+        await self._call(self.delete, user_id)
+
+    def _maybe_purge(self, force: bool = False) -> None:
+        now = time.time()
+        if not force and now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        self.evictions += self.backend.purge(self.ttl, self.max_sessions)
+
+
+# 进程内共享的实例
+session_store = SessionStore()
@@ -0,0 +1,310 @@
+# backend/services/structured_output.py
+"""
+模型结构化输出的解析、校验和修复
+
+以前每个 run_stepN 都直接 json.loads(resp)，模型多包一层 ```json、
+在 JSON 后面加一句解释、或者回复被截断，整个 step 就抛异常，只能整步重跑。
+
+1. 宽松解析：去掉 markdown 围栏，按括号匹配截出第一个 JSON 对象，去掉尾随逗号；
+   回复被截断时，用 JsonFieldStream 取出已经完整的顶层字段（部分恢复）
+2. 按每个 step 的 RESPONSE_SCHEMA 校验（JSON Schema 的一个小子集）
+3. 缺失的模板字段（step / question / options）直接用 schema 里的 default 补上；
+   其他个别字段缺失或不合格时，发一个只要求这些字段的修复请求，合并回原结果；
+   修复也失败时才整步重新生成（STRUCTURED_FULL_RETRIES 次），
+   路由配置了 escalate_to 时重新生成改用更强的模型（model_router）
+"""
+import os
+import re
+import json
+from typing import Any, Optional
+
+from backend.services.claude_client import claude_prompt
+from backend.services import model_router, metrics
+from backend.services.log import get_logger
+from backend.services.json_stream import JsonFieldStream
+
+logger = get_logger("structured_output")
+
+# 针对缺失字段的修复请求次数
+STRUCTURED_REPAIR_ATTEMPTS = int(os.getenv("STRUCTURED_REPAIR_ATTEMPTS", "1"))
+# 修复无效后整步重新生成的次数
+STRUCTURED_FULL_RETRIES = int(os.getenv("STRUCTURED_FULL_RETRIES", "1"))
+
+_FENCE = re.compile(r"```(?:json|JSON)?\s*\n?(.*?)```", re.S)
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+}
+
+# 解析 / 修复的计数
+_counters = {
+    "parsed": 0,
+    "lenient": 0,
+    "partial": 0,
+    "invalid": 0,
+    "defaults": 0,
+    "repairs": 0,
+    "repaired": 0,
+    "full_retries": 0,
+    "escalations": 0,
+    "failures": 0,
+}
+
+
+def stats() -> dict:
+    return dict(_counters)
+
+
+class StructuredOutputError(Exception):
+    """修复和重试之后仍然拿不到合格的结构化输出"""
+
+    def __init__(self, message: str, raw: str, errors: list[str]):
+        super().__init__(message)
+        self.raw = raw
+        self.errors = errors
+
+
+class ParseResult:
+    """
+    value     解析出的对象（部分恢复时只有完整的字段），完全解析不出时为 None
+    complete  原文是完整的 JSON 对象
+    notes     解析时做过的修正，例如 "去掉 markdown 围栏"
+    """
+    __slots__ = ("value", "complete", "notes")
+
+    def __init__(self, value: Optional[dict], complete: bool, notes: list[str]):
+        self.value = value
+        self.complete = complete
+        self.notes = notes
+
+
+# ===== 解析 =====
+
+def _balanced_object(text: str) -> Optional[str]:
+    """从第一个 { 开始按括号匹配截出完整对象，字符串里的括号不算；没闭合时返回 None"""
+    start = text.find("{")
+    if start < 0:
+        return None
+    depth = 0
+    in_string = escape = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in "{[":
+            depth += 1
+        elif c in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+
+def _recover_partial(text: str) -> Optional[dict]:
+    """回复被截断：保留已经完整的顶层字段，以及未闭合数组里已经完整的元素"""
+    parser = JsonFieldStream()
+    fields: dict[str, Any] = {}
+    elements: dict[str, list] = {}
+    for path, value in parser.feed(text):
+        if path.endswith("]") and "[" in path:
+            elements.setdefault(path[:path.rindex("[")], []).append(value)
+        else:
+            fields[path] = value
+    for key, items in elements.items():
+        fields.setdefault(key, items)
+    return fields or None
+
+
+def parse_json(text: Optional[str]) -> ParseResult:
+    """宽松地从模型回复里解析出一个 JSON 对象"""
+    notes: list[str] = []
+    text = text or ""
+    try:
+        value = json.loads(text)
+        if isinstance(value, dict):
+            return ParseResult(value, True, notes)
+    except ValueError:
+        pass
+
+    fenced = _FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+        notes.append("去掉 markdown 围栏")
+
+    candidate = _balanced_object(text)
+    if candidate is not None:
+        if candidate.strip() != text.strip():
+            notes.append("去掉 JSON 前后的多余文本")
+        for attempt in (candidate, _TRAILING_COMMA.sub(r"\1", candidate)):
+            try:
+                value = json.loads(attempt)
+            except ValueError:
+                continue
+            if attempt is not candidate:
+                notes.append("去掉尾随逗号")
+            if isinstance(value, dict):
+                return ParseResult(value, True, notes)
+
+    partial = _recover_partial(text)
+    if partial is not None:
+        notes.append("回复不完整，只恢复了完整的字段")
+    return ParseResult(partial, False, notes)
+
+
+# ===== 校验 =====
+
+def validate(value: Any, schema: dict, path: str = "") -> list[str]:
+    """按 schema 校验，返回错误列表，例如 ["hypotheses[1].evidence: 缺少字段"]"""
+    errors: list[str] = []
+    label = path or "(根)"
+    expected = schema.get("type")
+    if expected:
+        python_type = _TYPES[expected]
+        # bool 是 int 的子类，不能算作数字
+        if not isinstance(value, python_type) or (expected in ("integer", "number") and isinstance(value, bool)):
+            return [f"{label}: 应为 {expected}，实际是 {type(value).__name__}"]
+
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{label}: 取值必须是 {schema['enum']} 之一")
+    if "pattern" in schema and isinstance(value, str) and not re.search(schema["pattern"], value):
+        errors.append(f"{label}: {schema.get('description') or '格式不符合要求'}")
+    if isinstance(value, str) and schema.get("minLength") and len(value.strip()) < schema["minLength"]:
+        errors.append(f"{label}: 不能为空")
+
+    if isinstance(value, dict):
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{path + '.' if path else ''}{key}: 缺少字段")
+        properties = schema.get("properties", {})
+        for key, item in value.items():
+            sub = properties.get(key, schema.get("additionalProperties"))
+            if isinstance(sub, dict):
+                errors += validate(item, sub, f"{path + '.' if path else ''}{key}")
+
+    if isinstance(value, list):
+        if len(value) < schema.get("minItems", 0):
+            errors.append(f"{label}: 至少需要 {schema['minItems']} 项")
+        if isinstance(schema.get("items"), dict):
+            for index, item in enumerate(value):
+                errors += validate(item, schema["items"], f"{path}[{index}]")
+    return errors
+
+
+def _top_level_keys(errors: list[str]) -> list[str]:
+    keys: list[str] = []
+    for error in errors:
+        key = re.split(r"[.\[:]", error, maxsplit=1)[0].strip()
+        if key and key != "(根)" and key not in keys:
+            keys.append(key)
+    return keys
+
+
+# ===== 修复 =====
+
+def _fill_defaults(value: dict, schema: dict) -> list[str]:
+    """
+    缺失的顶层字段如果在 schema 里有固定的 default（step、question、options 这类模板字段），
+    直接补上，不必为它们发修复请求；回复被截断时丢的往往就是这些末尾字段
+    """
+    filled = []
+    for key, sub in schema.get("properties", {}).items():
+        if key not in value and "default" in sub:
+            value[key] = json.loads(json.dumps(sub["default"]))
+            filled.append(key)
+    return filled
+
+
+def build_repair_prompt(prompt: str, value: dict, errors: list[str], keys: list[str], schema: dict) -> str:
+    """
+    只要求模型重新给出有问题的顶层字段
+
+    原 prompt 原样放在前面（服务端前缀缓存能命中），输出只有这几个字段，比整步重跑便宜得多
+    """
+    field_schema = {key: schema.get("properties", {}).get(key, {}) for key in keys}
+    problems = "\n".join(f"- {e}" for e in errors)
+    return f"""{prompt}
+
+你之前对上面任务的回复有问题：
+{problems}
+
+已经解析出的内容：
+{json.dumps(value, ensure_ascii=False)}
+
+请只输出需要补全或修正的字段 {", ".join(keys)} 组成的 JSON 对象，不要重复其他字段，不要添加额外解释。
+这些字段的要求（JSON Schema）：
+{json.dumps(field_schema, ensure_ascii=False)}
+"""
+
+
+async def complete_json(prompt: str, raw: str, schema: dict, label: str = "",
+                        route: Optional[model_router.Route] = None) -> dict:
+    """
+    把模型回复变成符合 schema 的 dict：宽松解析 → 校验 → 定向修复 → 整步重试
+
+    route: 生成 raw 所用的路由，修复请求沿用它；整步重试时如果可以升级，换成更强的路由
+    全部失败时抛出 StructuredOutputError
+    """
+    errors: list[str] = []
+    for attempt in range(STRUCTURED_FULL_RETRIES + 1):
+        if attempt:
+            _counters["full_retries"] += 1
+            upgrade = model_router.escalation(route) if route is not None else None
+            if upgrade is not None:
+                _counters["escalations"] += 1
+                logger.info("%s 输出不合格，从 %s 升级到 %s", label, route.model, upgrade.model)
+                route = upgrade
+            logger.info("%s 整步重新生成 (%d/%d)", label, attempt, STRUCTURED_FULL_RETRIES)
+            raw = await claude_prompt(prompt, route=route)
+
+        result = parse_json(raw)
+        if result.notes:
+            _counters["lenient"] += 1
+            logger.debug("%s 宽松解析: %s", label, ", ".join(result.notes))
+        if not result.complete and result.value is not None:
+            _counters["partial"] += 1
+        value = result.value
+        if value is None:
+            _counters["invalid"] += 1
+            metrics.json_parse_failures.inc(step=label, stage="parse")
+            errors = ["(根): 回复里没有 JSON 对象"]
+            continue
+
+        if _fill_defaults(value, schema):
+            _counters["defaults"] += 1
+        errors = validate(value, schema)
+        for _ in range(STRUCTURED_REPAIR_ATTEMPTS):
+            keys = _top_level_keys(errors)
+            if not errors or not keys:
+                break
+            _counters["repairs"] += 1
+            logger.info("%s 修复字段 %s: %s", label, keys, errors)
+            fix = parse_json(await claude_prompt(build_repair_prompt(prompt, value, errors, keys, schema),
+                                                 route=route)).value
+            if fix:
+                value = {**value, **{k: v for k, v in fix.items() if k in keys}}
+            errors = validate(value, schema)
+            if not errors:
+                _counters["repaired"] += 1
+
+        if not errors:
+            _counters["parsed"] += 1
+            return value
+        _counters["invalid"] += 1
+        metrics.json_parse_failures.inc(step=label, stage="validate")
+
+    _counters["failures"] += 1
+    metrics.json_parse_failures.inc(step=label, stage="final")
+    raise StructuredOutputError(f"{label} 模型输出不符合格式: {'; '.join(errors)}", raw, errors)
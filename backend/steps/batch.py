@@ -0,0 +1,307 @@
+"""
+批量调试：对一批 bug report 并发跑非交互协议（默认选择）
+
+- 输入：一个目录（每个 *.json 是一份 bug report）或一个 JSONL 文件（每行一份）
+- 固定大小的 worker 池并发执行 pipeline.run_all，结果缓存 / 模型连接池全部共享
+- 每完成一份就往输出 JSONL 追加一行并 flush；重新运行时跳过输出里已经成功的 id（断点续跑）
+- 统计吞吐（份 / 分钟）和每一步的延迟直方图
+- 模型调用在准入队列里记为 batch 优先级，交互请求优先（见 backend/services/admission.py）
+
+用法:
+    python -m backend.steps.batch demo/reports/ --out results.jsonl --workers 8
+    python -m backend.steps.batch reports.jsonl --out results.jsonl --choices '{"3": "b"}'
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from typing import Iterable, Optional
+
+from backend.services import admission
+from backend.services.session_store import session_store
+from backend.steps import pipeline
+
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "8"))
+# 延迟直方图的桶上界（毫秒），最后还有一个 +Inf 桶
+BATCH_HISTOGRAM_BUCKETS = [float(b) for b in os.getenv(
+    "BATCH_HISTOGRAM_BUCKETS", "100,250,500,1000,2500,5000,10000,30000,60000").split(",")]
+
+_STEPS = [f"step{step}" for step in range(1, pipeline.LAST_STEP + 1)]
+
+
+class LatencyHistogram:
+    """累计直方图：counts[i] 是耗时 <= buckets[i] 的次数，最后一个是 +Inf"""
+    __slots__ = ("buckets", "counts", "total", "sum_ms")
+
+    def __init__(self, buckets: list[float] = BATCH_HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+
+    def observe(self, ms: float) -> None:
+        self.total += 1
+        self.sum_ms += ms
+        for index, bound in enumerate(self.buckets):
+            if ms <= bound:
+                self.counts[index] += 1
+        self.counts[-1] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """按桶上界估计分位数（落在 +Inf 桶时返回 None）"""
+        if not self.total:
+            return None
+        rank = q * self.total
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return bound
+        return None
+
+    def to_dict(self) -> dict:
+        labels = [f"le_{int(b) if b.is_integer() else b}" for b in self.buckets] + ["le_inf"]
+        return {
+            "count": self.total,
+            "avg_ms": round(self.sum_ms / self.total, 1) if self.total else None,
+            "p50_le_ms": self.quantile(0.5),
+            "p95_le_ms": self.quantile(0.95),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class BatchStats:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.total = 0
+        self.skipped = 0
+        self.completed = 0
+        self.failed = 0
+        self.report_latency = LatencyHistogram()
+        self.step_latency = {step: LatencyHistogram() for step in _STEPS}
+
+    def record(self, record: dict) -> None:
+        if record["status"] == "ok":
+            self.completed += 1
+        else:
+            self.failed += 1
+        self.report_latency.observe(record["duration_ms"])
+        for step, ms in (record.get("timings_ms") or {}).items():
+            if step in self.step_latency:
+                self.step_latency[step].observe(ms)
+
+    def snapshot(self) -> dict:
+        elapsed = time.perf_counter() - self.started_at
+        done = self.completed + self.failed
+        return {
+            "total": self.total,
+            "skipped": self.skipped,
+            "completed": self.completed,
+            "failed": self.failed,
+            "elapsed_s": round(elapsed, 2),
+            "reports_per_minute": round(done / elapsed * 60, 2) if elapsed > 0 else 0.0,
+            "report_latency": self.report_latency.to_dict(),
+            "step_latency": {step: hist.to_dict() for step, hist in self.step_latency.items() if hist.total},
+        }
+
+
+# ===== 输入 =====
+
+def _inline_files(report: dict, base_dir: str) -> dict:
+    """
+    bug report 里的 code_file / test_file 相对于 report 所在目录，
+    服务端按 CODE_ROOT 解析不一定找得到，这里先读进来放到 source / tests
+    """
+    report = dict(report)
+    for path_field, content_field in (("code_file", "source"), ("test_file", "tests")):
+        rel_path = report.get(path_field)
+        if not rel_path or report.get(content_field) or (content_field == "source" and report.get("code")):
+            continue
+        path = os.path.join(base_dir, rel_path)
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                report[content_field] = f.read()
+    return report
+
+
+def load_reports(path: str) -> list[tuple[str, dict]]:
+    """
+    读取一批 bug report，返回 [(id, report)]
+
+    id 取 report 里的 "id" 字段，没有时目录模式用相对文件名，JSONL 模式用行号
+    """
+    reports: list[tuple[str, dict]] = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(path, name), "r", encoding="utf-8") as f:
+                report = json.load(f)
+            if isinstance(report, dict):
+                reports.append((str(report.get("id") or name), _inline_files(report, path)))
+        return reports
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            report = json.loads(line)
+            if isinstance(report, dict):
+                reports.append((str(report.get("id") or f"line-{number}"), _inline_files(report, base_dir)))
+    return reports
+
+
+def read_checkpoint(out_path: str) -> set[str]:
+    """输出文件里已经成功的 id；失败的和写了一半的行不算，续跑时会重做"""
+    done: set[str] = set()
+    if not os.path.exists(out_path):
+        return done
+    with open(out_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get("status") == "ok":
+                done.add(record.get("id"))
+    return done
+
+
+# ===== 执行 =====
+
+async def _run_one(batch_id: str, report_id: str, report: dict, choices: Optional[dict]) -> dict:
+    user_id = f"batch:{batch_id}:{report_id}"
+    start = time.perf_counter()
+    try:
+        outcome = await pipeline.run_all(user_id, report, choices)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        outcome = {"error": f"{type(e).__name__}: {e}"}
+    finally:
+        # 批量会话跑完就没用了，不占会话存储的名额
+        await session_store.adelete(user_id)
+    record = {
+        "id": report_id,
+        "status": "error" if "error" in outcome else "ok",
+        "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+        "timings_ms": outcome.get("timings_ms", {}),
+        "results": outcome.get("results", {}),
+    }
+    if "error" in outcome:
+        record["error"] = outcome["error"]
+        record["failed_step"] = outcome.get("failed_step")
+    return record
+
+
+async def run_batch(reports: Iterable[tuple[str, dict]], workers: int = BATCH_WORKERS,
+                    choices: Optional[dict] = None, stats: Optional[BatchStats] = None, owner: str = "batch"):
+    """
+    用 workers 个并发 worker 跑完所有 report，按完成顺序逐个产出结果记录
+
+    所有 worker 的模型调用在准入队列里记在 owner 名下，和其他用户公平分享模型并发
+
+    调用方停止迭代（例如 HTTP 客户端断开）时，正在跑的 report 一并取消
+    """
+    stats = stats or BatchStats()
+    batch_id = uuid.uuid4().hex[:8]
+    pending: asyncio.Queue = asyncio.Queue()
+    for item in reports:
+        pending.put_nowait(item)
+    finished: asyncio.Queue = asyncio.Queue()
+
+    async def worker() -> None:
+        admission.bind(admission.CallContext(owner, "batch"))
+        while True:
+            try:
+                report_id, report = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            try:
+                record = await _run_one(batch_id, report_id, report, choices)
+            except Exception as e:
+                # _run_one 的 try 之外出错（例如 finally 里删会话失败）也要交一条结果，
+                # worker 退出的话 run_batch 会一直等这一份
+                record = {
+                    "id": report_id,
+                    "status": "error",
+                    "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+                    "timings_ms": {},
+                    "results": {},
+                    "error": f"{type(e).__name__}: {e}",
+                    "failed_step": None,
+                }
+            await finished.put(record)
+
+    remaining = pending.qsize()
+    tasks = [asyncio.ensure_future(worker()) for _ in range(max(1, min(workers, remaining)))]
+    try:
+        for _ in range(remaining):
+            record = await finished.get()
+            stats.record(record)
+            yield record
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def run_to_file(reports: list[tuple[str, dict]], out_path: str, workers: int = BATCH_WORKERS,
+                      choices: Optional[dict] = None, resume: bool = True) -> dict:
+    """跑一批 report，结果逐行追加到 out_path，返回统计"""
+    stats = BatchStats()
+    stats.total = len(reports)
+    if resume:
+        done = read_checkpoint(out_path)
+        todo = [(report_id, report) for report_id, report in reports if report_id not in done]
+        stats.skipped = len(reports) - len(todo)
+        if stats.skipped:
+            print(f"[BATCH] 断点续跑：跳过已完成的 {stats.skipped} 份")
+    else:
+        todo = reports
+        open(out_path, "w").close()
+
+    with open(out_path, "a", encoding="utf-8") as out:
+        async for record in run_batch(todo, workers, choices, stats):
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            done_count = stats.completed + stats.failed
+            print(f"[BATCH] {done_count}/{len(todo)} {record['id']} {record['status']} "
+                  f"{record['duration_ms']:.0f}ms")
+    return stats.snapshot()
+
+
+def print_summary(summary: dict) -> None:
+    print(f"\n完成 {summary['completed']}，失败 {summary['failed']}，跳过 {summary['skipped']}，"
+          f"用时 {summary['elapsed_s']}s，吞吐 {summary['reports_per_minute']} 份/分钟")
+    print(f"{'step':<8}{'count':>7}{'avg_ms':>10}{'p50<=':>9}{'p95<=':>9}")
+    rows = list(summary["step_latency"].items()) + [("total", summary["report_latency"])]
+    for name, hist in rows:
+        print(f"{name:<8}{hist['count']:>7}{str(hist['avg_ms']):>10}"
+              f"{str(hist['p50_le_ms']):>9}{str(hist['p95_le_ms']):>9}")
+
+
+async def _main_async(args) -> None:
+    reports = load_reports(args.input)
+    choices = json.loads(args.choices) if args.choices else None
+    summary = await run_to_file(reports, args.out, args.workers, choices, resume=not args.no_resume)
+    print_summary(summary)
+    if args.stats:
+        with open(args.stats, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="批量调试 bug report")
+    parser.add_argument("input", help="bug report 目录（*.json）或 JSONL 文件")
+    parser.add_argument("--out", default="batch_results.jsonl", help="结果 JSONL（追加写入，支持断点续跑）")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--choices", help='覆盖默认选择，例如 \'{"3": "b"}\'')
+    parser.add_argument("--no-resume", action="store_true", help="清空输出文件，全部重跑")
+    parser.add_argument("--stats", help="把统计（吞吐、延迟直方图）写到这个 JSON 文件")
+    asyncio.run(_main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
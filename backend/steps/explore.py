@@ -0,0 +1,189 @@
+# backend/steps/explore.py
+"""
+并行探索：对 Step 2 给出的每个假设同时跑 Step 3~5
+
+交互模式下用户只能选一个假设，选错了就要从 Step 3 重来，最坏情况是三个串行的会话。
+探索模式为每个假设开一个分支（独立的会话记录，Step 1/2 共用），
+- 同时最多 EXPLORE_CONCURRENCY 个分支在跑
+- 每一步都走 pipeline.run_cached，和交互模式共享结果缓存与 single-flight
+- 某个分支的补丁通过了全部回归测试时（EXPLORE_EARLY_STOP），取消其余还没跑完的分支
+- 最后按 回归是否全部通过 → 补丁是否仍复现崩溃 → 通过的用例数 → 耗时 给分支排名，
+  排名第一的分支写回用户的会话，之后直接请求 /step6 就能拿到汇总
+"""
+import os
+import time
+import asyncio
+from typing import Any, Optional
+
+from backend.services.log import get_logger
+from backend.services.session_store import SessionRecord
+from backend.services.structured_output import StructuredOutputError
+from backend.steps import pipeline
+
+logger = get_logger("explore")
+
+EXPLORE_CONCURRENCY = int(os.getenv("EXPLORE_CONCURRENCY", "3"))
+EXPLORE_EARLY_STOP = os.getenv("EXPLORE_EARLY_STOP", "1") == "1"
+
+# 分支里 Step 4 / 5 的选择：全部采纳插桩、跑回归
+BRANCH_CHOICES = {4: "1", 5: "1"}
+
+
+class Branch:
+    """一个假设的探索分支"""
+    __slots__ = ("hypothesis", "record", "status", "failed_step", "error", "timings_ms", "started_at")
+
+    def __init__(self, hypothesis: dict, record: SessionRecord):
+        self.hypothesis = hypothesis
+        self.record = record
+        # pending → running → passed / failed / error / cancelled
+        self.status = "pending"
+        self.failed_step: Optional[int] = None
+        self.error: Optional[str] = None
+        self.timings_ms: dict[str, float] = {}
+        self.started_at: Optional[float] = None
+
+    @property
+    def regression(self) -> Optional[dict]:
+        step5 = self.record.get_step(5)
+        return step5.get("regression_results") if isinstance(step5, dict) else None
+
+    @property
+    def verification(self) -> Optional[dict]:
+        step4 = self.record.get_step(4)
+        return step4.get("verification") if isinstance(step4, dict) else None
+
+    def passed(self) -> bool:
+        results = self.regression
+        return bool(results) and all(value == "✅" for value in results.values())
+
+    def score(self) -> tuple:
+        """越小越好；没跑完的分支排在最后"""
+        results = self.regression or {}
+        passed = sum(1 for value in results.values() if value == "✅")
+        reproduces = (self.verification or {}).get("reproduces")
+        return (
+            0 if results else 1,
+            0 if self.passed() else 1,
+            1 if reproduces else 0,
+            -passed,
+            len(results) - passed,
+            sum(self.timings_ms.values()),
+        )
+
+    def to_dict(self, rank: int) -> dict:
+        step4 = self.record.get_step(4)
+        return {
+            "rank": rank,
+            "hypothesis": self.hypothesis,
+            "status": self.status,
+            "failed_step": self.failed_step,
+            "error": self.error,
+            "regression_results": self.regression,
+            "verification": self.verification,
+            "patch": step4.get("patch") if isinstance(step4, dict) else None,
+            "timings_ms": self.timings_ms,
+        }
+
+
+async def _run_branch(branch: Branch, code: Any, gate: asyncio.Semaphore) -> Branch:
+    async with gate:
+        branch.status = "running"
+        branch.started_at = time.perf_counter()
+        choices = {3: branch.hypothesis.get("id"), **BRANCH_CHOICES}
+        for step in (3, 4, 5):
+            prepared = pipeline.prepare_step(step, code, choices[step], branch.record)
+            if prepared.error is not None:
+                branch.status, branch.failed_step, branch.error = "error", step, prepared.error
+                return branch
+            start = time.perf_counter()
+            try:
+                result = await pipeline.run_cached(prepared.key, prepared.run)
+            except StructuredOutputError as e:
+                branch.status, branch.failed_step, branch.error = "error", step, str(e)
+                return branch
+            finally:
+                branch.timings_ms[f"step{step}"] = round((time.perf_counter() - start) * 1000, 1)
+            branch.record.set_step(step, result)
+        branch.status = "passed" if branch.passed() else "failed"
+        return branch
+
+
+async def _ensure_step2(user_id: str, code: Any) -> tuple[Optional[SessionRecord], Optional[str]]:
+    """会话里还没有 Step 1/2 时先按默认选择跑完"""
+    record = await pipeline.load_record(user_id)
+    for step in (1, 2):
+        if record is not None and record.get_step(step) is not None:
+            continue
+        outcome = await pipeline.execute_step(step, user_id, code, pipeline.DEFAULT_CHOICES.get(step))
+        if "error" in outcome:
+            return None, f"step{step} 失败: {outcome['error']}"
+        record = await pipeline.load_record(user_id)
+    return record, None
+
+
+async def explore(user_id: str, code: Any, concurrency: int = EXPLORE_CONCURRENCY,
+                  early_stop: bool = EXPLORE_EARLY_STOP) -> dict:
+    """
+    对全部假设并行跑 Step 3~5，返回排名：
+
+        {
+          "best": "a",
+          "ranking": [{"rank": 1, "hypothesis": {...}, "status": "passed", "regression_results": {...},
+                       "patch": "...", "timings_ms": {...}}, ...],
+          "early_stopped": bool,
+          "duration_ms": 总耗时
+        }
+    """
+    start = time.perf_counter()
+    base, error = await _ensure_step2(user_id, code)
+    if error is not None:
+        return {"error": error}
+    step2_output = base.get_step(2)
+    hypotheses = [h for h in (step2_output or {}).get("hypotheses") or [] if isinstance(h, dict) and h.get("id")] \
+        if isinstance(step2_output, dict) else []
+    if not hypotheses:
+        return {"error": "Step 2 没有给出可探索的假设"}
+
+    gate = asyncio.Semaphore(max(1, concurrency))
+    branches = [Branch(h, SessionRecord(f"{user_id}#explore-{h['id']}", step1=base.get_step(1),
+                                        step2=step2_output))
+                for h in hypotheses]
+    tasks = {asyncio.ensure_future(_run_branch(b, code, gate)): b for b in branches}
+    early_stopped = False
+    try:
+        for next_done in asyncio.as_completed(list(tasks)):
+            try:
+                branch = await next_done
+            except Exception as e:  # 模型不可用等：只影响这一个分支
+                logger.warning("探索分支出错: %s", e)
+                continue
+            logger.info("分支 %s: %s", branch.hypothesis.get("id"), branch.status)
+            if early_stop and branch.status == "passed":
+                early_stopped = any(not t.done() for t in tasks)
+                break
+    finally:
+        for task, branch in tasks.items():
+            if not task.done():
+                task.cancel()
+                branch.status = "cancelled"
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    for task, branch in tasks.items():
+        if branch.status == "running" and task.done() and not task.cancelled() and task.exception() is not None:
+            branch.status, branch.error = "error", str(task.exception())
+
+    ranked = sorted(branches, key=lambda b: b.score())
+    best = ranked[0]
+    if best.regression is not None:
+        # 最优分支写回用户的会话，之后的 /step6 汇总的就是它
+        for step in (3, 4, 5):
+            await pipeline.commit_step(user_id, step, best.record.get_step(step), code,
+                                 best.hypothesis.get("id") if step == 3 else BRANCH_CHOICES[step])
+
+    return {
+        "best": best.hypothesis.get("id") if best.regression is not None else None,
+        "ranking": [b.to_dict(rank) for rank, b in enumerate(ranked, start=1)],
+        "early_stopped": early_stopped,
+        "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+    }
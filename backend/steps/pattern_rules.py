@@ -0,0 +1,131 @@
+# backend/steps/pattern_rules.py
+"""
+静态 bug 模式的快速路径（检测器见 backend/services/bug_patterns.py）
+
+Step 2 之前在进程内跑一遍 AST 检测器，结合 Step 1 的真实异常和 traceback 打分：
+- 有被 Step 1 的真实异常佐证（异常类型和出错行都对得上）、且置信度不低于 RULES_MIN_CONFIDENCE 的命中时，
+  Step 2 直接给出假设（带 rule / line），不调用模型
+- 用户选了规则给出的假设时，Step 3 给出对应的插桩计划，Step 4 直接生成修复的 unified diff
+  （按当前源码生成、编译检查过）
+规则解释不了的 bug（没有命中、置信度不够、用户选了别的假设）照常交给模型。
+"""
+import os
+import time
+from typing import Any, Optional
+
+from backend.services import bug_patterns, metrics, patcher
+from backend.services.log import get_logger
+from backend.services.session_store import SessionRecord
+from backend.steps import utils, prompt_builder
+
+logger = get_logger("pattern_rules")
+
+RULES_ENABLED = os.getenv("RULES_ENABLED", "1") == "1"
+RULES_MIN_CONFIDENCE = float(os.getenv("RULES_MIN_CONFIDENCE", "0.85"))
+
+
+def findings(code: Any, step1_output: Any) -> tuple[Optional[tuple[str, str]], list[bug_patterns.Finding]]:
+    """((文件名, 源码), 有真实异常佐证且置信度够高的命中)；拿不到源码时为 (None, [])"""
+    source = utils.extract_source(code)
+    if source is None:
+        return None, []
+    file_name, text = source
+    execution = (step1_output.get("execution") or {}) if isinstance(step1_output, dict) else {}
+    frames = prompt_builder.user_frames(execution.get("traceback"), file_name)
+    found = bug_patterns.detect(text, execution.get("exception_type"), frames[-1][0] if frames else None)
+    return source, [f for f in found if f.corroborated and f.confidence >= RULES_MIN_CONFIDENCE]
+
+
+def _rule_of(value: Any) -> Optional[tuple[str, int]]:
+    """Step 2 的假设 {"rule": ..., "line": ...} 或 Step 3 的输出 {"rule": {"rule": ..., "line": ...}}"""
+    if not isinstance(value, dict):
+        return None
+    rule = value.get("rule")
+    if isinstance(rule, dict):
+        return rule.get("rule"), rule.get("line")
+    return (rule, value.get("line")) if rule else None
+
+
+def _find(code: Any, step1_output: Any, rule: tuple[str, int]):
+    source, confident = findings(code, step1_output)
+    return source, next((f for f in confident if (f.rule, f.line) == rule), None)
+
+
+def rules_step2(code: Any, step1_output: Any) -> Optional[dict]:
+    start = time.perf_counter()
+    _, confident = findings(code, step1_output)
+    if not confident:
+        metrics.rule_matches.inc(rule="none")
+        return None
+    for finding in confident:
+        metrics.rule_matches.inc(rule=finding.rule)
+    logger.info("Step 2 静态规则命中: %s", [(f.rule, f.line, round(f.confidence, 2)) for f in confident])
+    return {
+        "step": "Step 2/6",
+        "hypotheses": [{"id": chr(ord("a") + index), "title": f.title, "evidence": f.evidence,
+                        "rule": f.rule, "line": f.line, "confidence": round(f.confidence, 2)}
+                       for index, f in enumerate(confident)],
+        "question": "请选择可信假设，返回对应 id",
+        "static_analysis": {"findings": [f.to_dict() for f in confident],
+                            "duration_ms": round((time.perf_counter() - start) * 1000, 1)},
+    }
+
+
+def rules_step3(code: Any, hypothesis: Any, step1_output: Any) -> Optional[dict]:
+    rule = _rule_of(hypothesis)
+    if rule is None:
+        return None
+    _, finding = _find(code, step1_output, rule)
+    if finding is None:
+        return None
+    return {
+        "step": "Step 3/6",
+        "hypothesis": finding.title,
+        "instrumentation_plan": finding.plan,
+        "question": "是否采纳这些插桩？",
+        "options": {"1": "全部采纳", "2": "自定义组合上述插桩"},
+        "rule": {"rule": finding.rule, "line": finding.line},
+    }
+
+
+def rules_step4(code: Any, step3_output: Any, step1_output: Any) -> Optional[dict]:
+    rule = _rule_of(step3_output)
+    if rule is None:
+        return None
+    source, finding = _find(code, step1_output, rule)
+    if finding is None:
+        return None
+    file_name, text = source
+    patched = bug_patterns.apply_fix(text, finding, file_name)
+    if patched is None:
+        logger.warning("规则 %s 第 %s 行的修复编译不过，交给模型", finding.rule, finding.line)
+        return None
+    patch = patcher.make_patch(text, patched, file_name)
+    check = patcher.verify_patch(text, patch, file_name)
+    metrics.patch_checks.inc(outcome="rule")
+    patch_check = {key: value for key, value in check.items() if key != "patched"}
+    patch_check.update(outcome="rule", repairs=0)
+    return {
+        "step": "Step 4/6",
+        "patch": patch,
+        "impact_scope": [finding.function] if finding.function else [],
+        "question": "是否应用此补丁？",
+        "options": {"1": "确认", "2": "回退"},
+        "patch_check": patch_check,
+        "rule": {"rule": finding.rule, "line": finding.line},
+    }
+
+
+def answer(step: int, code: Any, choice: Optional[str], record: Optional[SessionRecord]) -> Optional[dict]:
+    """按 step 走静态规则，能直接回答时返回这一步的完整输出，否则返回 None"""
+    if not RULES_ENABLED:
+        return None
+    get = record.get_step if record is not None else (lambda _: None)
+    step1_output = get(1)
+    if step == 2 and choice == "1" and step1_output is not None:
+        return rules_step2(code, step1_output)
+    if step == 3:
+        return rules_step3(code, utils.extract_hypothesis(get(2), choice), step1_output)
+    if step == 4 and choice == "1":
+        return rules_step4(code, get(3), step1_output)
+    return None
@@ -0,0 +1,489 @@
+"""
+Step 1~6 的服务端执行管线
+
+- execute_step: 单个 step 的完整执行（读会话 → 查缓存 → 调模型 → 写会话）
+- run_cached: 内容寻址缓存 + 同 key 请求合并（single-flight）
+- speculate_next: 在用户还在阅读第 N 步输出时，按最可能的选择预先计算第 N+1 步
+- stream_step: 流式执行单个 step，字段一完整就推给客户端
+- run_all: 一次请求跑完整个协议（非交互，使用默认选择）
+- rollback / checkout: 借助会话日志回退到某一步之前、切换分支，只重算回退的那一步
+- Step 1~4 先查历史会话知识库（backend/steps/recall.py），再试静态 bug 模式规则
+  （backend/steps/pattern_rules.py），两者都回答不了才调用模型
+"""
+import time
+import asyncio
+from typing import Any, Callable, Optional
+
+from backend.services.claude_client import claude_stream
+from backend.services.json_stream import JsonFieldStream
+from backend.services.structured_output import complete_json, StructuredOutputError
+from backend.services import model_router, metrics, admission
+from backend.services.log import get_logger
+from backend.services.result_cache import result_cache, make_key
+from backend.services.session_store import session_store, SessionRecord
+from backend.services.session_journal import session_journal, JournalError
+from backend.steps import utils, recall, pattern_rules, step_one, step_two, step_three, step_four, step_five
+
+logger = get_logger("pipeline")
+
+LAST_STEP = 6
+
+# 流式接口拿到完整回复后按这些 schema 校验 / 修复
+RESPONSE_SCHEMAS = {
+    1: step_one.RESPONSE_SCHEMA,
+    2: step_two.RESPONSE_SCHEMA,
+    3: step_three.RESPONSE_SCHEMA,
+    4: step_four.RESPONSE_SCHEMA,
+    5: step_five.RESPONSE_SCHEMA,
+}
+
+# 非交互模式 / 预取时使用的默认选择：
+# step2 "1" 确认复现, step3 "a" 第一个假设, step4 "1" 全部采纳插桩, step5 "1" 跑回归
+DEFAULT_CHOICES: dict[int, Optional[str]] = {1: None, 2: "1", 3: "a", 4: "1", 5: "1"}
+
+
+class _Flight:
+    """
+    一次正在进行的 step 计算，等待者计数为 0 时才允许取消
+
+    context 是这次计算的模型调用在准入队列里的身份（用户、优先级），
+    预取（background）被交互请求等待时提升优先级
+    """
+    __slots__ = ("task", "waiters", "context")
+
+    def __init__(self, task: asyncio.Task, context: admission.CallContext):
+        self.task = task
+        self.waiters = 0
+        self.context = context
+
+
+_inflight: dict[str, _Flight] = {}
+# user_id -> (key, flight)，每个会话最多一个预取
+_speculative: dict[str, tuple[str, _Flight]] = {}
+
+
+def _start_flight(key: str, make_coro: Callable, priority: Optional[str] = None) -> _Flight:
+    caller = admission.current() or admission.CallContext("anonymous")
+    # 每个计算一个独立的上下文：提升它的优先级不影响发起者的其他调用
+    context = admission.CallContext(caller.user, priority or caller.priority)
+
+    async def run():
+        admission.bind(context)
+        return await make_coro()
+
+    flight = _Flight(asyncio.ensure_future(run()), context)
+
+    def _done(task: asyncio.Task) -> None:
+        _inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        result = task.result()
+        if isinstance(result, dict):
+            result_cache.set(key, result)
+
+    flight.task.add_done_callback(_done)
+    _inflight[key] = flight
+    return flight
+
+
+async def run_cached(key: str, make_coro: Callable) -> Any:
+    """
+    先查缓存；miss 时如果同一个 key 已经在计算（并发请求或预取），直接等它
+
+    只缓存结构化（dict）结果，"无效的选项" 之类的提示字符串不进缓存
+    """
+    cached_result = result_cache.get(key)
+    if cached_result is not None:
+        logger.debug("缓存命中 key=%s", key[:12])
+        return cached_result
+
+    flight = _inflight.get(key)
+    if flight is None:
+        flight = _start_flight(key, make_coro)
+    else:
+        admission.promote(flight.context)
+    flight.waiters += 1
+    try:
+        return await asyncio.shield(flight.task)
+    except asyncio.CancelledError:
+        # 最后一个等待者离开（例如客户端断开）时才真正取消模型调用
+        if flight.waiters == 1 and not flight.task.done():
+            flight.task.cancel()
+        raise
+    finally:
+        flight.waiters -= 1
+
+
+class PreparedStep:
+    """
+    组装好的一次 step 调用
+
+    error   缺少上游输出时的错误信息
+    key     内容寻址缓存 key
+    run     返回执行协程的工厂函数
+    prompt  返回模型 prompt（或返回 prompt 的协程）的工厂函数；这个选择不需要调用模型时为 None（流式接口用）
+    finish  流式接口拿到模型 JSON 之后的补充处理（可以是协程），例如附上插桩 trace、校验补丁
+    """
+    __slots__ = ("error", "key", "run", "prompt", "finish")
+
+    def __init__(self, error: Optional[str] = None, key: Optional[str] = None,
+                 run: Optional[Callable] = None, prompt: Optional[Callable] = None,
+                 finish: Optional[Callable] = None):
+        self.error = error
+        self.key = key
+        self.run = run
+        self.prompt = prompt
+        self.finish = finish
+
+
+def cache_code(code: Any) -> dict:
+    """
+    缓存 key 里的代码：bug report 本身加上实际执行的源码和测试
+
+    CLI 往往只传 code_file，源码是服务端从磁盘读的；文件改了，key 必须跟着变
+    """
+    return {"report": code, "source": utils.extract_source(code), "tests": utils.extract_tests(code)}
+
+
+def prepare_step(step: int, code: Any, choice: Optional[str], record: Optional[SessionRecord]) -> PreparedStep:
+    """根据会话里已有的上游输出，组装第 step 步的调用"""
+    get = record.get_step if record is not None else (lambda _: None)
+    keyed = cache_code(code)
+
+    if step == 1:
+        key = make_key("step1", keyed, prompt_version=step_one.PROMPT_VERSION)
+        # 能在沙箱里真实运行时不需要模型
+        prompt = None if utils.extract_source(code) is not None else (lambda: step_one.build_step1_prompt(code))
+        return PreparedStep(None, key, lambda: step_one.handle_step1(code), prompt)
+
+    if step == 2:
+        step1_output = get(1)
+        if step1_output is None:
+            return PreparedStep("未找到步骤 1 输出，请先执行 step1")
+        key = make_key("step2", keyed, upstream=[step1_output, choice],
+                       prompt_version=step_two.PROMPT_VERSION)
+        run = lambda: step_two.handle_step2(code, step1_output, choice)
+        if choice != "1":
+            return PreparedStep(None, key, run)
+        # 先跑测试做故障定位，把可疑代码行放进 prompt
+        localization: dict[str, Any] = {}
+
+        async def prompt() -> str:
+            localization["report"] = await step_two.collect_localization(code)
+            return step_two.build_step2_prompt(code, step1_output, localization["report"])
+
+        return PreparedStep(None, key, run, prompt,
+                            lambda result: step_two.attach_localization(result, localization.get("report")))
+
+    # Step 1 的 traceback 决定 prompt 里的代码切片（稳定前缀），后面每一步都要带上
+    step1_output = get(1)
+
+    if step == 3:
+        # 获取步骤二中得到的假设成因
+        hypothesis = utils.extract_hypothesis(get(2), choice)
+        if hypothesis is None:
+            return PreparedStep("未找到步骤 2 输出，请先执行 step2")
+        key = make_key("step3", keyed, upstream=[step1_output], hypothesis=hypothesis,
+                       prompt_version=step_three.PROMPT_VERSION)
+        return PreparedStep(None, key, lambda: step_three.handle_step3(code, hypothesis, choice, step1_output),
+                            lambda: step_three.build_step3_prompt(code, hypothesis, step1_output))
+
+    if step in (4, 5):
+        hypothesis = utils.extract_hypothesis(get(2), choice)
+        # 获取步骤三中的插桩计划
+        step3_output = get(3)
+        if hypothesis is None and isinstance(step3_output, dict):
+            # 这里的 choice 是 "1"/"2" 而不是假设 id，退回使用 step3 记录的假设
+            hypothesis = step3_output.get("hypothesis")
+
+        if step == 4:
+            if step3_output is None:
+                return PreparedStep("未找到步骤 3 输出，请先执行 step3")
+            key = make_key("step4", keyed, upstream=[step1_output, step3_output, choice, step_four.STEP4_CANDIDATES],
+                           hypothesis=hypothesis, prompt_version=step_four.PROMPT_VERSION)
+            run = lambda: step_four.handle_step4(code, hypothesis, step3_output, choice, step1_output)
+            # 多候选模式要并行生成、本地验证后再挑一个，没有单一的 token 流可推
+            if choice != "1" or step_four.multi_candidate(code):
+                return PreparedStep(None, key, run)
+            # 先按插桩计划跑一遍拿到 trace，再拼 prompt
+            evidence: dict[str, Any] = {}
+
+            async def prompt() -> str:
+                evidence["instrumentation"] = await step_four.collect_evidence(code, step3_output)
+                return step_four.build_step4_prompt(code, hypothesis, step3_output, evidence["instrumentation"],
+                                                    step1_output)
+
+            async def finish(result):
+                result = step_four.attach_evidence(result, evidence.get("instrumentation"))
+                return await step_four.check_patch(code, result, step1_output)
+
+            return PreparedStep(None, key, run, prompt, finish)
+
+        # 获取步骤四中的修复补丁
+        step4_output = get(4)
+        if step4_output is None:
+            return PreparedStep("未找到步骤 4 输出，请先执行 step4")
+        key = make_key("step5", keyed, upstream=[step1_output, step3_output, step4_output, choice],
+                       hypothesis=hypothesis, prompt_version=step_five.PROMPT_VERSION)
+        # 能在本地真实执行回归测试时不需要模型
+        prompt = (lambda: step_five.build_step5_prompt(code, hypothesis, step3_output, step4_output, step1_output)) \
+            if choice == "1" and utils.extract_source(code) is None else None
+        return PreparedStep(None, key,
+                            lambda: step_five.handle_step5(code, hypothesis, step3_output, step4_output, choice,
+                                                           step1_output),
+                            prompt)
+
+    raise ValueError(f"无效的 step: {step}")
+
+
+async def load_record(user_id: str) -> Optional[SessionRecord]:
+    """读会话；会话存储里的记录已被淘汰时，从会话日志当前分支的 head 重建"""
+    record = await session_store.aget(user_id)
+    if record is None and session_journal is not None:
+        steps = await asyncio.to_thread(session_journal.state, user_id)
+        if steps:
+            logger.info("会话 %s 已被淘汰，从日志恢复 %s 步", user_id, len(steps))
+            record = await session_store.arestore(user_id, steps)
+    return record
+
+
+async def prepare_for(step: int, user_id: str, code: Any, choice: Optional[str],
+                      record: Optional[SessionRecord]) -> PreparedStep:
+    """
+    prepare_step + 回退出来的分支给缓存 key 加 salt（回退后重跑不会命中回退前的结果）
+
+    没有回退过的步骤先查知识库、再试静态规则，能回答时直接返回，不调用模型；
+    回退过的步骤两者都跳过，用户回退正是因为不想要之前的答案
+    """
+    prepared = prepare_step(step, code, choice, record)
+    if prepared.error is not None:
+        return prepared
+    key = prepared.key
+    if session_journal is not None:
+        prepared.key = await asyncio.to_thread(session_journal.salted, user_id, step, key)
+    if prepared.key == key:
+        # 知识库查询（SQLite）和历史补丁的应用 / 编译检查都放到线程里
+        recalled = await asyncio.to_thread(recall.recall, step, code, choice, record)
+        if recalled is None:
+            recalled = pattern_rules.answer(step, code, choice, record)
+        if recalled is not None:
+            return PreparedStep(None, prepared.key, lambda: _resolved(recalled))
+    return prepared
+
+
+async def _resolved(value: Any) -> Any:
+    return value
+
+
+async def finish_session(user_id: str, code: Any, record: Optional[SessionRecord]) -> dict:
+    """Step 6: 汇总写回会话，并把走完的会话记进知识库"""
+    result = build_summary(record)
+    await commit_step(user_id, LAST_STEP, result, code)
+    await asyncio.to_thread(recall.remember, code, record)
+    return result
+
+
+async def commit_step(user_id: str, step: int, result: Any, code: Any = None, choice: Optional[str] = None,
+                      key: Optional[str] = None) -> None:
+    """写回会话，并在会话日志里追加一条（SQLite 写入放到线程里，不阻塞事件循环）"""
+    await session_store.aset_step(user_id, step, result)
+    if session_journal is not None:
+        await asyncio.to_thread(session_journal.append, user_id, step, result, choice=choice, cache_key=key,
+                                code=code)
+
+
+async def _switch(user_id: str, outcome: dict) -> dict:
+    _drop_speculation(user_id)
+    await session_store.arestore(user_id, outcome["steps"])
+    return {"result": {"branch": outcome["branch"], "steps": sorted(outcome["steps"])}}
+
+
+async def rollback(user_id: str, step: int) -> dict:
+    """回退到 Step step 之前：会话恢复成当时的状态（前面的步骤不重算），之后重跑 Step step 会重新调用模型"""
+    if session_journal is None:
+        return {"error": "会话日志未开启（JOURNAL_ENABLED=0），无法回退"}
+    if not 1 <= step <= LAST_STEP:
+        return {"error": f"无效的 step: {step}"}
+    try:
+        return await _switch(user_id, await asyncio.to_thread(session_journal.rollback, user_id, step))
+    except JournalError as e:
+        return {"error": str(e)}
+
+
+async def checkout(user_id: str, branch: str) -> dict:
+    """切换到会话日志里的另一个分支，不调用模型"""
+    if session_journal is None:
+        return {"error": "会话日志未开启（JOURNAL_ENABLED=0）"}
+    try:
+        return await _switch(user_id, await asyncio.to_thread(session_journal.checkout, user_id, branch))
+    except JournalError as e:
+        return {"error": str(e)}
+
+
+def build_summary(record: Optional[SessionRecord]) -> dict:
+    """Step 6: 汇总前五步的输出"""
+    get = record.get_step if record is not None else (lambda _: None)
+    step3_output = get(3)
+    step2_output = {"hypothesis": step3_output.get("hypothesis")} if isinstance(step3_output, dict) else None
+
+    return {
+        "step": "Step 6/6",
+        "summary": {
+            "step1_minimal_case": get(1),
+            "step2_hypothesis": step2_output,
+            "step3_instrument_plan": step3_output,
+            "step4_fix_patch": get(4),
+            "step5_regression": get(5),
+        }
+    }
+
+
+async def execute_step(step: int, user_id: str, code: Any, choice: Optional[str] = None) -> dict:
+    """执行单个 step 并写回会话，返回 {"result": ...} 或 {"error": ...}"""
+    start = time.perf_counter()
+    try:
+        return await _execute_step(step, user_id, code, choice)
+    finally:
+        metrics.step_seconds.observe(time.perf_counter() - start, step=step, mode="execute")
+
+
+async def _execute_step(step: int, user_id: str, code: Any, choice: Optional[str]) -> dict:
+    record = await load_record(user_id)
+
+    if step == LAST_STEP:
+        return {"result": await finish_session(user_id, code, record)}
+
+    prepared = await prepare_for(step, user_id, code, choice, record)
+    if prepared.error is not None:
+        return {"error": prepared.error}
+
+    _drop_speculation(user_id, keep_key=prepared.key)
+    try:
+        result = await run_cached(prepared.key, prepared.run)
+    except StructuredOutputError as e:
+        return {"error": str(e)}
+    await commit_step(user_id, step, result, code, choice, prepared.key)
+    return {"result": result}
+
+
+async def stream_step(step: int, user_id: str, code: Any, choice: Optional[str] = None):
+    """
+    execute_step 的流式版本，产出 (event, data):
+
+    token   模型输出的文本增量
+    field   一个已经完整的字段，data = {"path": "hypotheses[0]", "value": ...}
+    result  完整结果（已写回会话和缓存）
+    error   出错信息
+    """
+    start = time.perf_counter()
+    try:
+        async for item in _stream_step(step, user_id, code, choice):
+            yield item
+    finally:
+        metrics.step_seconds.observe(time.perf_counter() - start, step=step, mode="stream")
+
+
+async def _stream_step(step: int, user_id: str, code: Any, choice: Optional[str]):
+    record = await load_record(user_id)
+
+    if step == LAST_STEP:
+        yield "result", await finish_session(user_id, code, record)
+        return
+
+    prepared = await prepare_for(step, user_id, code, choice, record)
+    if prepared.error is not None:
+        yield "error", prepared.error
+        return
+
+    _drop_speculation(user_id, keep_key=prepared.key)
+
+    # 缓存命中、已经在计算（例如预取）或者这个选择不需要模型时，走非流式路径
+    result = result_cache.get(prepared.key)
+    if result is None and (prepared.key in _inflight or prepared.prompt is None):
+        try:
+            result = await run_cached(prepared.key, prepared.run)
+        except StructuredOutputError as e:
+            yield "error", str(e)
+            return
+
+    if result is None:
+        prompt = prepared.prompt()
+        if asyncio.iscoroutine(prompt):
+            prompt = await prompt
+        route = model_router.route_for(f"step{step}")
+        parser = JsonFieldStream()
+        async for delta in claude_stream(prompt, route=route):
+            yield "token", delta
+            for path, value in parser.feed(delta):
+                yield "field", {"path": path, "value": value}
+        try:
+            result = await complete_json(prompt, parser.text, RESPONSE_SCHEMAS[step], f"step{step}", route)
+        except StructuredOutputError as e:
+            yield "error", str(e)
+            return
+        if prepared.finish is not None:
+            result = prepared.finish(result)
+            if asyncio.iscoroutine(result):
+                result = await result
+        result_cache.set(prepared.key, result)
+    elif isinstance(result, dict):
+        for path, value in result.items():
+            yield "field", {"path": path, "value": value}
+
+    await commit_step(user_id, step, result, code, choice, prepared.key)
+    yield "result", result
+
+
+async def speculate_next(user_id: str, code: Any, step: int) -> Optional[int]:
+    """
+    第 step 步完成后，按默认选择在后台预先计算下一步，结果进入缓存
+
+    用户确认时 execute_step 会命中缓存或直接等待这个预取任务
+    """
+    next_step = step + 1
+    if next_step >= LAST_STEP:
+        return None
+
+    record = await load_record(user_id)
+    prepared = await prepare_for(next_step, user_id, code, DEFAULT_CHOICES[next_step], record)
+    key = prepared.key
+    if prepared.error is not None or result_cache.get(key) is not None:
+        return None
+
+    _drop_speculation(user_id, keep_key=key)
+    flight = _inflight.get(key) or _start_flight(key, prepared.run, "background")
+    _speculative[user_id] = (key, flight)
+    logger.debug("预取 user_id=%s step%s key=%s", user_id, next_step, key[:12])
+    return next_step
+
+
+def _drop_speculation(user_id: str, keep_key: Optional[str] = None) -> None:
+    """用户做了不同的选择时，取消没人等待的预取任务"""
+    entry = _speculative.pop(user_id, None)
+    if entry is None:
+        return
+    key, flight = entry
+    if key == keep_key:
+        return
+    if flight.waiters == 0 and not flight.task.done():
+        flight.task.cancel()
+
+
+async def run_all(user_id: str, code: Any, choices: Optional[dict] = None) -> dict:
+    """
+    一次跑完 step1~6，choices 可以覆盖默认选择，例如 {"3": "b"}
+
+    某一步出错时停止，返回已经完成的步骤和错误信息；timings_ms 是每一步的耗时
+    """
+    choices = choices or {}
+    results: dict[str, Any] = {}
+    timings: dict[str, float] = {}
+    for step in range(1, LAST_STEP + 1):
+        choice = choices.get(str(step), DEFAULT_CHOICES.get(step))
+        start = time.perf_counter()
+        outcome = await execute_step(step, user_id, code, choice)
+        timings[f"step{step}"] = round((time.perf_counter() - start) * 1000, 1)
+        if "error" in outcome:
+            return {"results": results, "error": outcome["error"], "failed_step": step, "timings_ms": timings}
+        results[f"step{step}"] = outcome["result"]
+    return {"results": results, "timings_ms": timings}
@@ -0,0 +1,277 @@
+"""
+带 token 预算的 prompt 组装
+
+以前每个 build_stepN_prompt 都把整份 code 和上游 step 的完整 dict 原样塞进 prompt，
+越往后 prompt 越长。这里统一处理：
+
+1. 代码切片：只保留 traceback 最内层用户帧所在的函数（以及假设/补丁点名的函数），
+   外层调用帧只保留函数头和调用那一行，其余定义只列名字
+2. 上游输出摘要：只取后续步骤真正用得到的字段
+3. 稳定前缀：开头的说明 + 代码切片 + Step 1 摘要只依赖 code 和 Step 1 输出，同一个会话里
+   Step 2~5 的 prompt 前缀完全相同，模型服务端的前缀缓存可以命中
+4. token 预算：前缀各部分有独立上限（保证前缀稳定），其余段落按优先级截断
+"""
+import os
+import re
+import ast
+import json
+from typing import Any, Optional
+
+from backend.services.blob_store import blob_store
+from backend.steps import utils
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+# 代码切片占预算的比例；单独计算，不受后面段落长短影响
+PROMPT_CODE_SHARE = float(os.getenv("PROMPT_CODE_SHARE", "0.6"))
+# Step 1 结果摘要同样属于稳定前缀
+PROMPT_STEP1_SHARE = float(os.getenv("PROMPT_STEP1_SHARE", "0.1"))
+
+PROMPT_HEADER = "你是一个调试助手。"
+
+_FRAME = re.compile(r'File "([^"]+)", line (\d+), in ([^\s]+)')
+_CJK = re.compile(r"[⺀-鿿가-힯＀-￯]")
+_TRUNCATED = "…(已截断)"
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估计 token 数：中日韩字符按 1 个算，其余字符按 4 个一 token"""
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    if estimate_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) + 4 <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + _TRUNCATED
+
+
+# ===== 代码切片 =====
+
+def _definitions(tree: ast.Module) -> list[tuple[ast.AST, Optional[ast.ClassDef]]]:
+    """模块顶层的函数，以及类里的方法（带上所属的类）"""
+    found = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            found.append((node, None))
+        elif isinstance(node, ast.ClassDef):
+            for item in node.body:
+                if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    found.append((item, node))
+    return found
+
+
+def _start_line(node: ast.AST) -> int:
+    decorators = getattr(node, "decorator_list", [])
+    return min([node.lineno] + [d.lineno for d in decorators])
+
+
+def _label(node: ast.AST, owner: Optional[ast.ClassDef]) -> str:
+    return f"{owner.name}.{node.name}" if owner is not None else node.name
+
+
+def user_frames(traceback_text: Optional[str], file_name: str) -> list[tuple[int, str]]:
+    """traceback 里属于这个文件的帧，(行号, 函数名)，从外到内"""
+    if not traceback_text:
+        return []
+    base = os.path.basename(file_name)
+    return [(int(line), func) for path, line, func in _FRAME.findall(traceback_text)
+            if os.path.basename(path) == base]
+
+
+def _select(tree: ast.Module, file_name: str, traceback_text: Optional[str],
+            hints: Optional[list[str]]) -> tuple[list, dict]:
+    """
+    选出要完整展示的函数和只展示调用处的外层调用帧
+
+    返回 (full, callers)，full = [(node, owner)]，callers = {id(node): (node, owner, [调用行号])}
+    """
+    definitions = _definitions(tree)
+
+    def enclosing(line: int):
+        for node, owner in definitions:
+            if _start_line(node) <= line <= node.end_lineno:
+                return node, owner
+        return None
+
+    full: list = []
+    callers: dict = {}
+    frames = user_frames(traceback_text, file_name)
+    if frames:
+        innermost = enclosing(frames[-1][0])
+        if innermost is not None:
+            full.append(innermost)
+        for line, _ in frames[:-1]:
+            found = enclosing(line)
+            if found is not None and found not in full:
+                callers.setdefault(id(found[0]), (found[0], found[1], []))[2].append(line)
+
+    hint_text = "\n".join(h for h in hints or [] if h)
+    for node, owner in definitions:
+        if (node, owner) not in full and re.search(rf"(?<![\w.]){re.escape(node.name)}(?!\w)", hint_text):
+            full.append((node, owner))
+            callers.pop(id(node), None)
+    return full, callers
+
+
+def _render_function(lines: list[str], node: ast.AST, owner: Optional[ast.ClassDef]) -> tuple[int, str]:
+    start = _start_line(node)
+    body = "\n".join(lines[start - 1:node.end_lineno])
+    if owner is not None:
+        body = f"{lines[owner.lineno - 1]}\n    ...\n{body}"
+    return start, f"# --- 第 {start}-{node.end_lineno} 行: {_label(node, owner)} ---\n{body}"
+
+
+def slice_source(file_name: str, source: str, traceback_text: Optional[str] = None,
+                 hints: Optional[list[str]] = None) -> str:
+    """
+    按 traceback 和提示文本切出相关代码，找不到任何焦点时返回整份源码
+
+    hints: 假设、补丁等文本，里面点名的函数也会完整保留
+    """
+    tree = blob_store.parse(source)
+    if tree is None:
+        return source
+    full, callers = _select(tree, file_name, traceback_text, hints)
+    if not full and not callers:
+        return source
+    lines = source.split("\n")
+
+    parts: list[tuple[int, str]] = []
+    # import 和一行的模块级常量，模型写补丁时常常需要
+    preamble = [n for n in tree.body if isinstance(n, (ast.Import, ast.ImportFrom))
+                or (isinstance(n, (ast.Assign, ast.AnnAssign)) and n.lineno == n.end_lineno)]
+    if preamble:
+        parts.append((preamble[0].lineno, "\n".join(lines[n.lineno - 1] for n in preamble)))
+
+    parts += [_render_function(lines, node, owner) for node, owner in full]
+
+    for node, owner, call_lines in callers.values():
+        header = "\n".join(lines[_start_line(node) - 1:node.body[0].lineno - 1]).rstrip()
+        calls = "\n".join(f"    ...\n{lines[line - 1]}  # 第 {line} 行" for line in sorted(set(call_lines)))
+        parts.append((node.lineno, f"# --- 调用方 {_label(node, owner)}（只保留调用处）---\n{header}\n{calls}\n    ..."))
+
+    shown = {id(node) for node, _ in full} | set(callers)
+    others = [f"{_label(node, owner)}()" for node, owner in _definitions(tree) if id(node) not in shown]
+    if others:
+        parts.append((len(lines) + 1, "# 其他定义（未展示）: " + ", ".join(others)))
+
+    parts.sort(key=lambda item: item[0])
+    header = f"# 文件 {file_name}（节选，共 {len(lines)} 行，行号为原文件行号）"
+    return header + "\n" + "\n\n".join(text for _, text in parts)
+
+
+def _step1_traceback(step1_output: Any) -> Optional[str]:
+    if not isinstance(step1_output, dict):
+        return None
+    execution = step1_output.get("execution") or {}
+    return execution.get("traceback") or None
+
+
+def code_context(code: Any, step1_output: Any = None, budget: int = PROMPT_TOKEN_BUDGET) -> str:
+    """
+    代码部分（稳定前缀）：只依赖 code 和 Step 1 的 traceback
+
+    拿不到 Python 源码时（比如只有 issue 链接抓到的非 .py 内容）退回原始 code
+    """
+    limit = int(budget * PROMPT_CODE_SHARE)
+    source = utils.extract_source(code)
+    if source is None:
+        raw = code if isinstance(code, str) else json.dumps(blob_store.expand(code), ensure_ascii=False)
+        return truncate_to_tokens(raw, limit)
+    file_name, text = source
+    sliced = slice_source(file_name, text, _step1_traceback(step1_output))
+    return truncate_to_tokens(sliced, limit)
+
+
+def focus_code(code: Any, step1_output: Any, hints: list[str], budget: int = PROMPT_TOKEN_BUDGET) -> Optional[str]:
+    """假设 / 补丁点名、但稳定前缀里没有完整展示的函数，作为额外段落放在前缀之后"""
+    source = utils.extract_source(code)
+    if source is None:
+        return None
+    file_name, text = source
+    tree = blob_store.parse(text)
+    if tree is None:
+        return None
+    shown, callers = _select(tree, file_name, _step1_traceback(step1_output), None)
+    if not shown and not callers:  # 前缀已经是整份源码
+        return None
+    named, _ = _select(tree, file_name, None, hints)
+    lines = text.split("\n")
+    extra = [_render_function(lines, node, owner) for node, owner in named if (node, owner) not in shown]
+    if not extra:
+        return None
+    return truncate_to_tokens("\n\n".join(body for _, body in sorted(extra, key=lambda item: item[0])),
+                              int(budget * (1 - PROMPT_CODE_SHARE) / 2))
+
+
+# ===== 上游输出摘要 =====
+
+def summarize_step1(step1_output: Any) -> str:
+    if not isinstance(step1_output, dict):
+        return str(step1_output or "")
+    parts = [f"运行结果: {step1_output.get('run_result')}"]
+    execution = step1_output.get("execution") or {}
+    if execution.get("exception_type"):
+        parts.append(f"异常: {execution['exception_type']}: {execution.get('exception_message')}")
+    if execution.get("traceback"):
+        tail = execution["traceback"].strip().split("\n")[-8:]
+        parts.append("traceback（末尾）:\n" + "\n".join(tail))
+    return "\n".join(parts)
+
+
+def summarize_hypothesis(hypothesis: Any) -> str:
+    if isinstance(hypothesis, dict):
+        title = hypothesis.get("title") or ""
+        evidence = hypothesis.get("evidence")
+        return f"{title}（证据: {evidence}）" if evidence else title
+    return str(hypothesis or "")
+
+
+def summarize_plan(step3_output: Any) -> str:
+    plan = step3_output.get("instrumentation_plan") if isinstance(step3_output, dict) else None
+    if not plan:
+        return str(step3_output or "")
+    return "\n".join(f"{index}. {item}" for index, item in enumerate(plan, start=1))
+
+
+def summarize_patch(step4_output: Any) -> str:
+    if not isinstance(step4_output, dict):
+        return str(step4_output or "")
+    parts = [step4_output.get("patch") or "(无补丁)"]
+    scope = step4_output.get("impact_scope")
+    if scope:
+        parts.append("影响范围: " + "; ".join(map(str, scope)))
+    return "\n".join(parts)
+
+
+# ===== 组装 =====
+
+def assemble(code: Any, step1_output: Any, sections: list[tuple[str, str, int]], task: str,
+             budget: int = PROMPT_TOKEN_BUDGET) -> str:
+    """
+    组装最终 prompt: [说明 + 代码切片 + Step 1 结果]（稳定前缀）+ 上游摘要段落 + 任务说明
+
+    sections: [(标题, 内容, 优先级)]，超出预算时先截断优先级低的段落；任务说明不截断
+    """
+    prefix = f"{PROMPT_HEADER}\n用户的代码如下：\n{code_context(code, step1_output, budget)}\n"
+    if step1_output is not None:
+        summary = truncate_to_tokens(summarize_step1(step1_output), int(budget * PROMPT_STEP1_SHARE))
+        prefix += f"Step 1 的运行结果（最小化可复现用例 MRE）:\n{summary}\n"
+    remaining = budget - estimate_tokens(prefix) - estimate_tokens(task)
+
+    bodies = {index: text for index, (_, text, _) in enumerate(sections) if text}
+    # 低优先级的段落先让出预算：按优先级从高到低分配，每段最多拿剩余的全部
+    for index in sorted(bodies, key=lambda i: -sections[i][2]):
+        share = max(remaining, 64)
+        bodies[index] = truncate_to_tokens(bodies[index], share)
+        remaining -= estimate_tokens(bodies[index])
+
+    middle = "".join(f"{sections[i][0]}:\n{bodies[i]}\n" for i in sorted(bodies))
+    return f"{prefix}{middle}\n{task}"
@@ -0,0 +1,216 @@
+# backend/steps/recall.py
+"""
+Step 1~4 的知识库快速路径：近似重复的 bug 直接复用历史会话的诊断和补丁
+
+- Step 1  只在拿不到源码、需要模型模拟运行时查（能在沙箱里真实运行就没必要猜）
+- Step 2  按历史会话排名给出假设，用户当时采纳的假设排在最前，附上对应的补丁
+- Step 3  用户选的正是某条历史记录采纳的假设时，复用它的插桩计划
+- Step 4  同上，并且历史补丁能在当前源码上应用、编译通过时才复用（行号 / 上下文按当前源码重新生成）
+没有命中时返回 None，照常调用模型。Step 6 汇总完成后把会话记进知识库（remember）。
+"""
+from typing import Any, Optional
+
+from backend.services import metrics, patcher
+from backend.services.knowledge_base import knowledge_base, exception_signature, exception_from_text
+from backend.services.log import get_logger
+from backend.services.result_cache import normalize_code
+from backend.services.session_store import SessionRecord
+from backend.steps import utils, prompt_builder
+
+logger = get_logger("recall")
+
+
+def fingerprint(code: Any, step1_output: Any = None) -> tuple[str, Optional[str], Optional[str]]:
+    """
+    (用于相似度的代码文本, 异常类型, 异常签名)
+
+    有源码时用按 traceback 切出的代码切片（和 prompt 的稳定前缀一致），否则用规范化后的整份 code
+    """
+    execution = (step1_output.get("execution") or {}) if isinstance(step1_output, dict) else {}
+    source = utils.extract_source(code)
+    if source is None:
+        text = normalize_code(code)
+    else:
+        file_name, body = source
+        text = prompt_builder.slice_source(file_name, body, execution.get("traceback"))
+    if not isinstance(step1_output, dict):
+        return text, None, None
+    exception = execution.get("exception_type") or exception_from_text(step1_output.get("run_result"))
+    return text, exception, exception_signature(exception, execution.get("exception_message"))
+
+
+def _title(hypothesis: Any) -> str:
+    title = hypothesis.get("title") if isinstance(hypothesis, dict) else hypothesis
+    return " ".join(str(title or "").split())
+
+
+def _meta(match: dict) -> dict:
+    data = match["data"]
+    return {
+        "id": match["id"],
+        "similarity": match["similarity"],
+        "hypothesis": data["hypothesis"]["title"],
+        "patch": data.get("patch"),
+        "regression_results": data.get("regression"),
+        "confirmations": match["confirmations"],
+    }
+
+
+def _lookup(step: int, code: Any, step1_output: Any = None) -> list[dict]:
+    text, exception, _ = fingerprint(code, step1_output)
+    matches = knowledge_base.lookup(text, exception)
+    metrics.kb_lookups.inc(step=step, outcome="hit" if matches else "miss")
+    return matches
+
+
+def recall_step1(code: Any) -> Optional[dict]:
+    if utils.extract_source(code) is not None:
+        return None
+    matches = _lookup(1, code)
+    if not matches or not isinstance(matches[0]["data"].get("step1"), dict):
+        return None
+    return {**matches[0]["data"]["step1"], "prior_fix": _meta(matches[0])}
+
+
+def recall_step2(code: Any, step1_output: Any) -> Optional[dict]:
+    matches = _lookup(2, code, step1_output)
+    if not matches:
+        return None
+    hypotheses: list[dict] = []
+    seen: set[str] = set()
+
+    def add(hypothesis: dict, evidence: str) -> None:
+        title = _title(hypothesis)
+        if title and title not in seen:
+            seen.add(title)
+            hypotheses.append({"id": chr(ord("a") + len(hypotheses)), "title": hypothesis["title"],
+                               "evidence": evidence})
+
+    # 每条命中记录采纳的假设按排名在前，最相似那条会话里没被采纳的假设放在后面备选
+    for match in matches:
+        accepted = match["data"]["hypothesis"]
+        add(accepted, f"历史会话 #{match['id']}（相似度 {match['similarity']:.2f}）采纳并修复: "
+                      f"{accepted.get('evidence') or ''}".rstrip(": "))
+    for other in matches[0]["data"].get("hypotheses") or []:
+        if isinstance(other, dict) and other.get("title"):
+            add(other, other.get("evidence") or "")
+    logger.info("Step 2 命中知识库: %s", [(m["id"], m["similarity"]) for m in matches])
+    return {
+        "step": "Step 2/6",
+        "hypotheses": hypotheses,
+        "question": "请选择可信假设，返回对应 id",
+        "prior_fixes": [_meta(m) for m in matches],
+    }
+
+
+def _same_hypothesis(matches: list[dict], hypothesis: Any) -> list[dict]:
+    title = _title(hypothesis)
+    return [m for m in matches if title and _title(m["data"]["hypothesis"]) == title]
+
+
+def recall_step3(code: Any, hypothesis: Any, step1_output: Any) -> Optional[dict]:
+    matches = [m for m in _same_hypothesis(_lookup(3, code, step1_output), hypothesis) if m["data"].get("plan")]
+    if not matches:
+        return None
+    return {
+        "step": "Step 3/6",
+        "hypothesis": matches[0]["data"]["hypothesis"]["title"],
+        "instrumentation_plan": matches[0]["data"]["plan"],
+        "question": "是否采纳这些插桩？",
+        "options": {"1": "全部采纳", "2": "自定义组合上述插桩"},
+        "prior_fix": _meta(matches[0]),
+    }
+
+
+def recall_step4(code: Any, hypothesis: Any, step1_output: Any) -> Optional[dict]:
+    source = utils.extract_source(code)
+    if source is None:
+        return None
+    file_name, text = source
+    matches = _same_hypothesis(_lookup(4, code, step1_output), hypothesis)
+    for index, match in enumerate(matches):
+        check = patcher.verify_patch(text, match["data"].get("patch"), file_name)
+        if check.get("error"):
+            logger.info("历史补丁 #%s 不适用于当前源码: %s", match["id"], check["error"])
+            continue
+        metrics.patch_checks.inc(outcome="recalled")
+        patch_check = {key: value for key, value in check.items() if key != "patched"}
+        patch_check.update(outcome="recalled", repairs=0)
+        return {
+            "step": "Step 4/6",
+            "patch": patcher.make_patch(text, check["patched"], file_name),
+            "impact_scope": match["data"].get("impact_scope") or [],
+            "question": "是否应用此补丁？",
+            "options": {"1": "确认", "2": "回退"},
+            "patch_check": patch_check,
+            "prior_fix": _meta(match),
+            "alternates": [_meta(m) for m in matches[index + 1:]],
+        }
+    return None
+
+
+def recall(step: int, code: Any, choice: Optional[str], record: Optional[SessionRecord]) -> Optional[dict]:
+    """按 step 查知识库，命中时返回这一步的完整输出，否则返回 None"""
+    if knowledge_base is None:
+        return None
+    get = record.get_step if record is not None else (lambda _: None)
+    step1_output = get(1)
+    if step == 1:
+        return recall_step1(code)
+    if step == 2 and choice == "1" and step1_output is not None:
+        return recall_step2(code, step1_output)
+    if step == 3:
+        hypothesis = utils.extract_hypothesis(get(2), choice)
+        return recall_step3(code, hypothesis, step1_output) if hypothesis is not None else None
+    if step == 4 and choice == "1" and isinstance(get(3), dict):
+        return recall_step4(code, get(3).get("hypothesis"), step1_output)
+    return None
+
+
+def _verified(code: Any, step4_output: dict, step5_output: Any) -> bool:
+    """Step 5 的回归结果全部通过；有 Step 4 的补丁校验时还要求它能应用、编译通过"""
+    results = step5_output.get("regression_results") if isinstance(step5_output, dict) else None
+    if not isinstance(results, dict) or not results or not all(v == "✅" for v in results.values()):
+        return False
+    check = step4_output.get("patch_check")
+    if isinstance(check, dict):
+        return bool(check.get("applied")) and bool(check.get("compiles"))
+    return True
+
+
+def remember(code: Any, record: Optional[SessionRecord]) -> Optional[int]:
+    """
+    Step 6 汇总之后调用：会话完整、补丁校验和回归测试都通过时记进知识库，返回新条目 id
+
+    这次的补丁本身就来自知识库时不重复存，只给那条记录加一次确认（同样要求回归通过）；
+    知识库是同步的 SQLite，调用方要放到线程里执行
+    """
+    if knowledge_base is None or record is None:
+        return None
+    step1, step2, step3, step4, step5 = (record.get_step(step) for step in range(1, 6))
+    if not all(isinstance(value, dict) for value in (step1, step2, step3, step4)) or not step4.get("patch"):
+        return None
+    # 来自知识库的补丁也要这次通过回归才算数，没通过的不能给原记录加确认
+    if not _verified(code, step4, step5):
+        return None
+    prior = step4.get("prior_fix")
+    if isinstance(prior, dict) and prior.get("id"):
+        knowledge_base.confirm(prior["id"])
+        return None
+
+    title = _title(step3.get("hypothesis"))
+    accepted = next((h for h in step2.get("hypotheses") or [] if isinstance(h, dict) and _title(h) == title),
+                    {"title": step3.get("hypothesis")})
+    results = step5.get("regression_results") if isinstance(step5, dict) else None
+    text, exception, signature = fingerprint(code, step1)
+    source = utils.extract_source(code)
+    return knowledge_base.add(text, exception, signature, source[0] if source else None, step4["patch"], {
+        "step1": step1,
+        "hypotheses": step2.get("hypotheses"),
+        "hypothesis": {"title": accepted.get("title"), "evidence": accepted.get("evidence")},
+        "plan": step3.get("instrumentation_plan"),
+        "patch": step4["patch"],
+        "impact_scope": step4.get("impact_scope"),
+        "regression": results if isinstance(results, dict) else None,
+        "passed": sum(1 for v in (results or {}).values() if v == "✅") if isinstance(results, dict) else 0,
+    })
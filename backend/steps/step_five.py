@@ -1,21 +1,84 @@
 from backend.services.claude_client import claude_prompt
+from backend.services import structured_output
+from backend.services import model_router
+from backend.services import metrics
+from backend.services.log import get_logger, preview
+from backend.services import regression
+from backend.steps import utils, prompt_builder
 import json
 
-async def handle_step5(code: str, hypothesis: str, instrument: str, fix_patch: str, choice: str | None = None) -> str:
+logger = get_logger("step5")
+
+# prompt 模板版本号，修改 build_step*_prompt 时递增，旧的缓存结果随之失效
+PROMPT_VERSION = "3"
+
+# 模型输出的结构（JSON Schema 子集），由 structured_output 校验和修复
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "required": ["step", "regression_results", "question", "options"],
+    "properties": {
+        "step": {"type": "string", "default": "Step 5/6"},
+        "regression_results": {"type": "object", "additionalProperties": {"type": "string", "enum": ["✅", "❌"]}},
+        "question": {"type": "string", "default": "是否确认进入最后一步?"},
+        "options": {"type": "object", "additionalProperties": {"type": "string"}, "default": {"1": "确认", "2": "否"}},
+    },
+}
+
+@metrics.timed(metrics.step_handler_seconds, step="5")
+async def handle_step5(code: str, hypothesis: str, instrument: str, fix_patch: str, choice: str | None = None,
+                       step1_output: dict | None = None) -> str:
     
     if choice == "1":  # 需要跑回归测试用例
-        return await run_step5(code, hypothesis, instrument, fix_patch)
+        return await run_step5(code, hypothesis, instrument, fix_patch, step1_output)
     elif choice == "2": # 不需要跑回归测试用例，直接进入 Step6
         return "不需要跑回归测试用例，直接进入 Step6"
     else:
         return "无效的选项，请输入 1 或 2"
     
-async def run_step5(code: str, hypothesis: str, instrument: str, fix_patch: str) -> str:
-    prompt = build_step5_prompt(code, hypothesis, instrument, fix_patch)
-    resp = await claude_prompt(prompt)
-    print("claude_resp5:", resp)
-    resp = json.loads(resp)
-    print("resp_dict5:", resp)
+async def run_step5(code: str, hypothesis: str, instrument: str, fix_patch: str,
+                    step1_output: dict | None = None) -> str:
+    """
+    Step 5: 应用补丁并真实执行回归测试和 fuzz
+
+    拿不到可执行的 Python 源码时，退回让模型估计
+    """
+    source = utils.extract_source(code)
+    if source is None:
+        return await simulate_step5(code, hypothesis, instrument, fix_patch, step1_output)
+
+    file_name, text = source
+    patch = fix_patch.get("patch") if isinstance(fix_patch, dict) else fix_patch
+    options = code if isinstance(code, dict) else {}
+    report = await regression.run_regression(
+        file_name, text, patch, utils.extract_tests(code),
+        targets=options.get("test_targets"),
+        case_names=options.get("test_cases"),
+        project=options.get("project"),
+    )
+    logger.info("回归结果: %s", report["regression_results"])
+    return {
+        "step": "Step 5/6",
+        "regression_results": report["regression_results"],
+        "details": {
+            "patch_applied": report["patch_applied"],
+            "error": report.get("error"),
+            "tests": report["tests"],
+            "fuzz": report["fuzz"],
+            "fuzz_summary": report.get("fuzz_summary"),
+            "duration_ms": report.get("duration_ms"),
+        },
+        "question": "是否确认进入最后一步?",
+        "options": {"1": "确认", "2": "否"}
+    }
+
+async def simulate_step5(code: str, hypothesis: str, instrument: str, fix_patch: str,
+                         step1_output: dict | None = None) -> str:
+    prompt = build_step5_prompt(code, hypothesis, instrument, fix_patch, step1_output)
+    route = model_router.route_for("step5")
+    resp = await claude_prompt(prompt, route=route)
+    logger.debug("模型原始回复: %s", preview(resp))
+    resp = await structured_output.complete_json(prompt, resp, RESPONSE_SCHEMA, "step5", route)
+    logger.debug("解析结果: %s", preview(resp))
     return resp
 
 # def build_step5_prompt(code: str, hypothesis: str, instrument: str, fix_patch: str) -> str:
@@ -42,16 +105,9 @@ async def run_step5(code: str, hypothesis: str, instrument: str, fix_patch: str)
 # }}
 # """
 
-def build_step5_prompt(code: str, hypothesis: str, instrument: str, fix_patch: str) -> str:
-    return f"""
-你是一个调试助手。
-用户的代码如下：
-{code}
-这个是 Step 2的结果, 给出了假设成因:{hypothesis}
-这个是 Step 3的结果, 给出了插桩计划:{instrument}
-这个是 Step 4的结果, 给出了插桩计划:{fix_patch}
-
-你的任务：
+def build_step5_prompt(code: str, hypothesis: str, instrument: str, fix_patch: str,
+                       step1_output: dict | None = None) -> str:
+    task = f"""你的任务：
 1.基于补丁，生成回归测试结果，至少覆盖以下场景：
     case_001
     case_002
@@ -75,3 +131,8 @@ JSON 模板如下：：
 "options": {{"1": "确认", "2": "否"}}
 }}
 """
+    return prompt_builder.assemble(code, step1_output, [
+        ("这个是 Step 2的结果, 给出了假设成因", prompt_builder.summarize_hypothesis(hypothesis), 2),
+        ("这个是 Step 3的结果, 给出了插桩计划", prompt_builder.summarize_plan(instrument), 1),
+        ("这个是 Step 4的结果, 给出了修复补丁", prompt_builder.summarize_patch(fix_patch), 3),
+    ], task)
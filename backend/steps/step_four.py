@@ -1,24 +1,280 @@
 from backend.services.claude_client import claude_prompt
+from backend.services import structured_output
+from backend.services import model_router
+from backend.services import metrics
+from backend.services.log import get_logger, preview
+from backend.services import instrument as instrument_engine
+from backend.services import patcher
+from backend.services import regression
+from backend.services.sandbox import sandbox_pool, describe
+from backend.steps import utils, prompt_builder
+import os
 import json
+import asyncio
 
-async def handle_step4(code: str, hypothesis: str, instrument: str, choice: str | None = None) -> str:
+logger = get_logger("step4")
+
+# prompt 模板版本号，修改 build_step*_prompt 时递增，旧的缓存结果随之失效
+PROMPT_VERSION = "5"
+
+# 补丁应用不上 / 编译不过时，带着拒绝原因让模型定向修正的次数
+STEP4_PATCH_REPAIRS = int(os.getenv("STEP4_PATCH_REPAIRS", "1"))
+# 一次生成的候选补丁数：>1 且能拿到源码时并行生成、并行跑回归测试，返回排名第一的
+STEP4_CANDIDATES = int(os.getenv("STEP4_CANDIDATES", "3"))
+# 给候选排名时每个候选的 fuzz 预算（秒），默认 0 不 fuzz（只按回归测试排名），需要时再打开
+STEP4_FUZZ_BUDGET = float(os.getenv("STEP4_FUZZ_BUDGET", "0"))
+
+# 每个候选各自的修复思路，让候选之间有差异（同时 prompt 不同，各自的缓存 / 夹具也不同）
+CANDIDATE_STRATEGIES = (
+    "给出最小、最直接的修复",
+    "从根因出发修复，必要时一并调整相关的边界条件或数据流",
+    "在不改变正常输入行为的前提下，增加防御性的检查",
+)
+
+# 模型输出的结构（JSON Schema 子集），由 structured_output 校验和修复
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "required": ["step", "patch", "impact_scope", "question", "options"],
+    "properties": {
+        "step": {"type": "string", "default": "Step 4/6"},
+        # 没有 @@ 段的补丁在 Step 5 根本应用不了，这里就要求修复
+        "patch": {"type": "string", "pattern": r"(?m)^@@", "description": "补丁必须是包含 @@ 段的 unified diff"},
+        "impact_scope": {"type": "array", "items": {"type": "string"}},
+        "question": {"type": "string", "default": "是否应用此补丁？"},
+        "options": {"type": "object", "additionalProperties": {"type": "string"}, "default": {"1": "确认", "2": "回退"}},
+    },
+}
+
+@metrics.timed(metrics.step_handler_seconds, step="4")
+async def handle_step4(code: str, hypothesis: str, instrument: str, choice: str | None = None,
+                       step1_output: dict | None = None) -> str:
     
     if choice == "1":  # 全部采纳
-        return await run_step4(code, hypothesis, instrument)
+        return await run_step4(code, hypothesis, instrument, step1_output)
     elif choice == "2":
         # todo: 这个情况比较复杂，暂时先不开发
         return ""
     else:
         return "无效的选项，请输入 1 或 2"
     
-async def run_step4(code: str, hypothesis: str, instrument: str) -> str:
-    prompt = build_step4_prompt(code, hypothesis, instrument)
-    resp = await claude_prompt(prompt)
-    print("claude_resp4:", resp)
-    resp = json.loads(resp)
-    print("resp_dict4:", resp)
+async def run_step4(code: str, hypothesis: str, instrument: str, step1_output: dict | None = None) -> str:
+    instrumentation = await collect_evidence(code, instrument)
+    if multi_candidate(code):
+        return await run_candidates(code, hypothesis, instrument, instrumentation, step1_output)
+    prompt = build_step4_prompt(code, hypothesis, instrument, instrumentation, step1_output)
+    route = model_router.route_for("step4")
+    resp = await claude_prompt(prompt, route=route)
+    logger.debug("模型原始回复: %s", preview(resp))
+    resp = await structured_output.complete_json(prompt, resp, RESPONSE_SCHEMA, "step4", route)
+    logger.debug("解析结果: %s", preview(resp))
+    return await check_patch(code, attach_evidence(resp, instrumentation), step1_output)
+
+async def collect_evidence(code, instrument) -> dict | None:
+    """
+    按 Step 3 的插桩计划改写代码并在沙箱里运行，返回探针和 trace
+
+    拿不到源码或者没有插桩计划时返回 None，prompt 退回只有计划文本的版本
+    """
+    source = utils.extract_source(code)
+    plan = instrument.get("instrumentation_plan") if isinstance(instrument, dict) else None
+    if source is None or not plan:
+        return None
+    file_name, text = source
+    return await instrument_engine.run_instrumented(file_name, text, plan)
+
+def attach_evidence(resp, instrumentation: dict | None):
+    """把插桩结果放进 Step 4 输出，客户端和 Step 6 都能看到 trace"""
+    if instrumentation is not None and isinstance(resp, dict):
+        resp["instrumentation"] = instrumentation
+    return resp
+
+async def check_patch(code, resp, step1_output: dict | None = None):
+    """
+    在用户提交的源码上应用并编译检查补丁，结果放进 resp["patch_check"]
+
+    - 能应用、能编译：行号或上下文有偏差时把 patch 换成重新生成的准确 diff，Step 5 直接可用
+    - 应用不上或有语法错误：带着具体的拒绝原因和原文片段让模型定向修正，
+      最多 STEP4_PATCH_REPAIRS 次，不必等到 Step 5 才发现
+    拿不到源码时原样返回
+    """
+    source = utils.extract_source(code)
+    if source is None or not isinstance(resp, dict):
+        return resp
+    file_name, text = source
+    check = patcher.verify_patch(text, resp.get("patch"), file_name)
+    repairs = 0
+    while check.get("error") and repairs < STEP4_PATCH_REPAIRS:
+        repairs += 1
+        logger.info("补丁被拒绝（%s），定向修正第 %d 次: %s", check.get("stage"), repairs, check["error"])
+        prompt = build_patch_repair_prompt(code, resp.get("patch"), check, text, step1_output)
+        route = model_router.route_for("step4")
+        try:
+            fixed = await structured_output.complete_json(prompt, await claude_prompt(prompt, route=route),
+                                                          RESPONSE_SCHEMA, "step4", route)
+        except structured_output.StructuredOutputError as e:
+            logger.warning("补丁修正失败: %s", e)
+            break
+        resp = {**resp, **fixed}
+        check = patcher.verify_patch(text, resp.get("patch"), file_name)
+
+    if check.get("error"):
+        outcome = "rejected"
+    elif check["exact"]:
+        outcome = "repaired" if repairs else "exact"
+    else:
+        resp["patch"] = patcher.make_patch(text, check["patched"], file_name)
+        outcome = "repaired" if repairs else "normalized"
+    metrics.patch_checks.inc(outcome=outcome)
+    resp["patch_check"] = {key: value for key, value in check.items() if key != "patched"}
+    resp["patch_check"].update(outcome=outcome, repairs=repairs)
+    return resp
+
+def multi_candidate(code) -> bool:
+    """能在本地验证候选时才值得一次生成多个"""
+    return STEP4_CANDIDATES > 1 and utils.extract_source(code) is not None
+
+async def run_candidates(code, hypothesis, instrument, instrumentation: dict | None,
+                         step1_output: dict | None = None, count: int = STEP4_CANDIDATES) -> dict:
+    """
+    并行生成 count 个候选补丁，每个候选在各自的临时工作区里应用并跑回归测试，
+    同时在沙箱里重新运行打过补丁的程序，按
+    是否仍然复现崩溃 → 通过的用例数 → fuzz 崩溃数 → 改动行数 → 耗时 排序
+
+    先看复现：测试有时断言的正是 bug 本身（例如 demo 的用例断言 IndexError），
+    只看通过数会把什么都没修的补丁排在前面
+
+    返回排名第一的候选，其余放在 alternates 里；所有候选都应用不上时，
+    退回对第一个候选做定向修正
+    """
+    file_name, text = utils.extract_source(code)
+    tests = utils.extract_tests(code)
+    options = code if isinstance(code, dict) else {}
+    route = model_router.route_for("step4")
+
+    async def evaluate(index: int) -> dict:
+        strategy = CANDIDATE_STRATEGIES[index % len(CANDIDATE_STRATEGIES)]
+        prompt = build_step4_prompt(code, hypothesis, instrument, instrumentation, step1_output, strategy)
+        resp = await structured_output.complete_json(prompt, await claude_prompt(prompt, route=route),
+                                                     RESPONSE_SCHEMA, "step4", route)
+        check = patcher.verify_patch(text, resp.get("patch"), file_name)
+        candidate = {"index": index, "strategy": strategy, "resp": resp, "check": check,
+                     "report": None, "rerun": None}
+        if check.get("error"):
+            return candidate
+        if not check["exact"]:
+            resp["patch"] = patcher.make_patch(text, check["patched"], file_name)
+        candidate["report"], candidate["rerun"] = await asyncio.gather(
+            regression.run_regression(file_name, text, resp["patch"], tests,
+                                      targets=options.get("test_targets"), case_names=options.get("test_cases"),
+                                      fuzz_budget=STEP4_FUZZ_BUDGET, project=options.get("project")),
+            sandbox_pool.run(check["patched"], file_name),
+        )
+        return candidate
+
+    outcomes = await asyncio.gather(*(evaluate(i) for i in range(count)), return_exceptions=True)
+    candidates, seen = [], set()
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            logger.warning("候选补丁生成失败: %s", outcome)
+            continue
+        # 不同思路也可能得到同一个补丁，只保留一份
+        patched = outcome["check"].get("patched") or outcome["resp"].get("patch")
+        if patched in seen:
+            continue
+        seen.add(patched)
+        candidates.append(outcome)
+    if not candidates:
+        raise next(o for o in outcomes if isinstance(o, BaseException))
+
+    candidates.sort(key=candidate_score)
+    best, rest = candidates[0], candidates[1:]
+    logger.info("候选补丁: %d 个, 排名: %s", len(candidates),
+                [(c["index"], candidate_score(c)[:3]) for c in candidates])
+    resp = attach_evidence(best["resp"], instrumentation)
+    if best["report"] is None:
+        # 一个都应用不上：走单补丁的定向修正
+        return await check_patch(code, resp, step1_output)
+
+    check = best["check"]
+    outcome = "exact" if check["exact"] else "normalized"
+    metrics.patch_checks.inc(outcome=outcome)
+    resp["patch_check"] = {key: value for key, value in check.items() if key != "patched"}
+    resp["patch_check"].update(outcome=outcome, repairs=0)
+    resp["verification"] = dict(summarize_candidate(best), rank=1)
+    resp["alternates"] = [{
+        "rank": rank,
+        "strategy": c["strategy"],
+        "patch": c["resp"].get("patch"),
+        "impact_scope": c["resp"].get("impact_scope"),
+        "verification": summarize_candidate(c),
+    } for rank, c in enumerate(rest, start=2)]
     return resp
 
+def _diff_lines(patch: str | None) -> int:
+    return sum(1 for line in (patch or "").splitlines()
+               if line[:1] in "+-" and not line.startswith(("+++", "---")))
+
+def _still_crashes(rerun: dict | None) -> bool:
+    """打过补丁的程序运行时仍然崩溃，或者仍然打印了被捕获的异常"""
+    return bool(rerun) and (rerun.get("status") not in ("ok", "exit") or bool(rerun.get("exception_type")))
+
+def candidate_score(candidate: dict) -> tuple:
+    """越小越好；应用不上或编译不过的候选排在最后"""
+    check, report = candidate["check"], candidate["report"]
+    if report is None or not check.get("compiles"):
+        return (1, 1, 0, 0, 0, 0.0)
+    tests = report.get("tests") or []
+    passed = sum(1 for t in tests if t["status"] in ("pass", "skip"))
+    crashes = sum(len(f.get("crashes") or []) for f in (report.get("fuzz") or {}).values())
+    return (0, int(_still_crashes(candidate["rerun"])), -passed, crashes,
+            _diff_lines(candidate["resp"].get("patch")), report.get("duration_ms") or 0.0)
+
+def summarize_candidate(candidate: dict) -> dict:
+    check, report = candidate["check"], candidate["report"]
+    if report is None:
+        return {"applied": check.get("applied"), "error": check.get("error")}
+    tests = report.get("tests") or []
+    _, still_crashes, negative_passed, crashes, diff_lines, duration = candidate_score(candidate)
+    return {
+        "applied": True,
+        "compiles": check.get("compiles"),
+        "reproduces": bool(still_crashes),
+        "run_result": describe(candidate["rerun"]) if candidate["rerun"] else None,
+        "passed": -negative_passed,
+        "failed": len(tests) + negative_passed,
+        "fuzz_crashes": crashes,
+        "diff_lines": diff_lines,
+        "duration_ms": duration,
+        "regression_results": report.get("regression_results"),
+    }
+
+def _excerpt(text: str, line: int | None, radius: int = 8) -> str:
+    """原文里出错位置附近的几行，带行号"""
+    lines = text.splitlines()
+    center = (line or 1) - 1
+    start, end = max(0, center - radius), min(len(lines), center + radius + 1)
+    return "\n".join(f"{number + 1:>4} | {lines[number]}" for number in range(start, end))
+
+def build_patch_repair_prompt(code, patch: str | None, check: dict, text: str,
+                              step1_output: dict | None = None) -> str:
+    task = """你的任务：
+1.上一版补丁不能用，原因见上面的"拒绝原因"。请基于用户代码重新生成补丁，修复同一个 bug。
+2.上下文行和删除行必须与原文逐字一致（包括缩进），@@ 里的行号要与原文对应；补丁应用后必须能通过编译。
+3.最终必须输出 严格的 JSON 格式，字段与上一版相同，不要添加额外解释。
+{
+  "step": "Step 4/6",
+  "patch": "--- buggy.py\\n+++ fixed.py\\n<补丁内容示例>",
+  "impact_scope": ["影响函数: func_a"],
+  "question": "是否应用此补丁？",
+  "options": {"1": "确认", "2": "回退"}
+}
+"""
+    return prompt_builder.assemble(code, step1_output, [
+        ("上一版补丁", patch, 3),
+        ("拒绝原因", check.get("error"), 4),
+        ("原文中相关位置附近的代码（带行号）", _excerpt(text, check.get("line")) if check.get("line") else None, 2),
+    ], task)
+
 # def build_step4_prompt(code: str, hypothesis: str, instrument: str) -> str:
 #     return f"""
 # 你是一个调试助手。
@@ -40,16 +296,15 @@ async def run_step4(code: str, hypothesis: str, instrument: str) -> str:
 # }}
 # """
 
-def build_step4_prompt(code: str, hypothesis: str, instrument: str) -> str:
-    return f"""
-你是一个调试助手。
-用户的代码如下：
-{code}
-这个是 Step 2的结果, 给出了假设成因:{hypothesis}
-这个是 Step 3的结果, 给出了插桩计划:{instrument}
-
-你的任务：
-1.基于用户代码、假设和插桩计划,生成一个最小修复补丁(diff 格式）。
+def build_step4_prompt(code: str, hypothesis: str, instrument: str, instrumentation: dict | None = None,
+                       step1_output: dict | None = None, strategy: str | None = None) -> str:
+    summary = prompt_builder.summarize_hypothesis(hypothesis)
+    plan = prompt_builder.summarize_plan(instrument)
+    evidence = None
+    if instrumentation is not None:
+        evidence = instrumentation.get("evidence") or instrumentation.get("error")
+    task = f"""你的任务：
+1.基于用户代码、假设、插桩计划和 trace 证据,生成一个最小修复补丁(diff 格式）。
     1.1.使用标准的 unified diff 格式，包含 --- buggy.py 和 +++ fixed.py。
     1.2.补丁需能解决 Step 2 提出的 bug。
 2.列出补丁的影响范围，比如受影响的测试用例、下游函数。
@@ -66,4 +321,11 @@ SON 模板如下(保持字段名不变,只替换impact_scope内容):
   "question": "是否应用此补丁？",
   "options": {{"1": "确认", "2": "回退"}}
 }}
-"""
\ No newline at end of file
+"""
+    return prompt_builder.assemble(code, step1_output, [
+        ("这个是 Step 2的结果, 给出了假设成因", summary, 4),
+        ("这个是 Step 3的结果, 给出了插桩计划", plan, 2),
+        ("按插桩计划真实运行代码得到的 trace（每行是一次探针命中）", evidence, 3),
+        ("假设和插桩涉及的其他函数", prompt_builder.focus_code(code, step1_output, [summary, plan]), 2),
+        ("这一版补丁的修复思路", strategy, 5),
+    ], task)
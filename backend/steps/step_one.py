@@ -1,16 +1,76 @@
 from backend.services.claude_client import claude_prompt
+from backend.services import structured_output
+from backend.services import model_router
+from backend.services import metrics
+from backend.services.log import get_logger, preview
+from backend.services.sandbox import sandbox_pool, describe
 from backend.steps.step_two import run_step2,handle_step2
+from backend.steps import utils, prompt_builder
 import json
 
+logger = get_logger("step1")
+
+# prompt 模板版本号，修改 build_step*_prompt 时递增，旧的缓存结果随之失效
+PROMPT_VERSION = "3"
+
+# 模型输出的结构（JSON Schema 子集），由 structured_output 校验和修复
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "required": ["step", "run_result", "question", "options"],
+    "properties": {
+        "step": {"type": "string", "default": "Step 1/6"},
+        "mre_file": {"type": "string"},
+        "run_result": {"type": "string", "minLength": 1},
+        "question": {"type": "string", "default": "确认此用例是否能复现问题?"},
+        "options": {"type": "object", "additionalProperties": {"type": "string"}, "default": {"1": "确认", "2": "回退"}},
+    },
+}
+
 async def run_step1(code: str) -> str:
     """
-    Step 1: 调用 Claude，返回调试结果
+    Step 1: 在沙箱里真实运行代码，返回调试结果
+
+    拿不到可执行的 Python 源码时，退回让模型模拟运行
+    """
+    source = utils.extract_source(code)
+    if source is not None:
+        file_name, text = source
+        return await execute_step1(file_name, text)
+    return await simulate_step1(code)
+
+async def execute_step1(file_name: str, source: str) -> dict:
+    """
+    在沙箱 worker 里运行代码，真实的异常和 traceback 会原样进入 Step 2 的 prompt
+    """
+    run = await sandbox_pool.run(source, file_name)
+    logger.info("沙箱复现: status=%s wall_ms=%s", run.get("status"), run.get("wall_ms"))
+    return {
+        "step": "Step 1/6",
+        "mre_file": file_name,
+        "run_result": describe(run),
+        "execution": {
+            "status": run.get("status"),
+            "exception_type": run.get("exception_type"),
+            "exception_message": run.get("exception_message"),
+            "traceback": run.get("traceback"),
+            "stdout": run.get("stdout"),
+            "stderr": run.get("stderr"),
+            "duration_ms": run.get("wall_ms"),
+        },
+        "question": "确认此用例是否能复现问题?",
+        "options": {"1": "确认", "2": "回退"}
+    }
+
+async def simulate_step1(code: str) -> dict:
+    """
+    Step 1: 调用 Claude 模拟运行，返回调试结果
     """
     prompt = build_step1_prompt(code)
-    resp = await claude_prompt(prompt)
-    print("claude_resp:", resp)
-    resp = json.loads(resp)
-    print("resp_dict:", resp)
+    route = model_router.route_for("step1")
+    resp = await claude_prompt(prompt, route=route)
+    logger.debug("模型原始回复: %s", preview(resp))
+    resp = await structured_output.complete_json(prompt, resp, RESPONSE_SCHEMA, "step1", route)
+    logger.debug("解析结果: %s", preview(resp))
     return resp
 
 # def build_step1_prompt(code: str) -> str:
@@ -35,11 +95,7 @@ def build_step1_prompt(code: str) -> str:
     """
     构造 Step 1 的 Prompt
     """
-    return f"""
-你是一个调试助手。
-用户提供了一段可能有错误的代码：{code}
-
-你的任务：
+    task = f"""你的任务：
 1. 尝试运行（或模拟运行）这段代码，并推理它的运行结果。
 2.如果代码能正常运行，描述主要输出。
 3.如果代码会报错，请写出崩溃原因和报错信息（包括异常类型）。
@@ -53,7 +109,9 @@ def build_step1_prompt(code: str) -> str:
   "options": {{"1": "确认", "2": "回退"}}
 }}
 """
+    return prompt_builder.assemble(code, None, [], task)
 
+@metrics.timed(metrics.step_handler_seconds, step="1")
 async def handle_step1(code: str, choice: str | None = None) -> str:
     """
     根据用户选择控制流程
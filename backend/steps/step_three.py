@@ -1,9 +1,33 @@
 from backend.services.claude_client import claude_prompt
+from backend.services import structured_output
+from backend.services import model_router
+from backend.services import metrics
+from backend.services.log import get_logger, preview
+from backend.steps import prompt_builder
 import json
+
+logger = get_logger("step3")
 # from step_four import run_step4
 
-async def handle_step3(code: str, hypothesis: str, choice: str | None = None) -> str:
-    return await run_step3(code, hypothesis)
+# prompt 模板版本号，修改 build_step*_prompt 时递增，旧的缓存结果随之失效
+PROMPT_VERSION = "2"
+
+# 模型输出的结构（JSON Schema 子集），由 structured_output 校验和修复
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "required": ["step", "hypothesis", "instrumentation_plan", "question", "options"],
+    "properties": {
+        "step": {"type": "string", "default": "Step 3/6"},
+        "hypothesis": {"type": "string"},
+        "instrumentation_plan": {"type": "array", "minItems": 1, "items": {"type": "string", "minLength": 1}},
+        "question": {"type": "string", "default": "是否采纳这些插桩？"},
+        "options": {"type": "object", "additionalProperties": {"type": "string"}, "default": {"1": "全部采纳", "2": "自定义组合上述插桩"}},
+    },
+}
+
+@metrics.timed(metrics.step_handler_seconds, step="3")
+async def handle_step3(code: str, hypothesis: str, choice: str | None = None, step1_output: dict | None = None) -> str:
+    return await run_step3(code, hypothesis, step1_output)
 
     # if choice == "1":
     #     return await run_step4(code, "all")
@@ -12,12 +36,13 @@ async def handle_step3(code: str, hypothesis: str, choice: str | None = None) ->
     # else:
     #     return "无效的选项，请输入 1 或 2"
     
-async def run_step3(code: str, hypothesis: str) -> str:
-    prompt = build_step3_prompt(code, hypothesis)
-    resp = await claude_prompt(prompt)
-    print("claude_resp_3:", resp)
-    resp = json.loads(resp)
-    print("resp_dict_3:", resp)
+async def run_step3(code: str, hypothesis: str, step1_output: dict | None = None) -> str:
+    prompt = build_step3_prompt(code, hypothesis, step1_output)
+    route = model_router.route_for("step3")
+    resp = await claude_prompt(prompt, route=route)
+    logger.debug("模型原始回复: %s", preview(resp))
+    resp = await structured_output.complete_json(prompt, resp, RESPONSE_SCHEMA, "step3", route)
+    logger.debug("解析结果: %s", preview(resp))
     return resp
 
 # def build_step3_prompt(code: str, hypothesis: str) -> str:
@@ -41,14 +66,9 @@ async def run_step3(code: str, hypothesis: str) -> str:
 # }}
 # """
 
-def build_step3_prompt(code: str, hypothesis: str) -> str:
-    return f"""
-你是一个调试助手。
-用户的代码如下：
-{code}
-Step 2 用户选择的假设是: {hypothesis}
-
-你的任务：
+def build_step3_prompt(code: str, hypothesis: str, step1_output: dict | None = None) -> str:
+    summary = prompt_builder.summarize_hypothesis(hypothesis)
+    task = f"""你的任务：
 1.基于用户代码和假设，生成一个插桩计划 (instrumentation_plan)，用于帮助定位问题。
 2.插桩应与假设相关，比如打印变量值、在关键路径加断言等。
 3.至少生成 2 条插桩建议。
@@ -56,7 +76,7 @@ Step 2 用户选择的假设是: {hypothesis}
 最终必须输出 严格的 JSON 格式, 保持键不变, 不要添加额外解释(instrumentation_plan保持字段名不变, 只替换内容):
 {{
   "step": "Step 3/6",
-  "hypothesis": "{hypothesis}",
+  "hypothesis": {json.dumps(summary, ensure_ascii=False)},
   "instrumentation_plan": [
     "在 loop 入口打印 i, len(list)",
     "在 case_003 输入时打印 list 长度",
@@ -65,4 +85,8 @@ Step 2 用户选择的假设是: {hypothesis}
   "question": "是否采纳这些插桩？",
   "options": {{"1": "全部采纳", "2": "自定义组合上述插桩"}}
 }}
-"""
\ No newline at end of file
+"""
+    return prompt_builder.assemble(code, step1_output, [
+        ("Step 2 用户选择的假设是", summary, 3),
+        ("假设涉及的其他函数", prompt_builder.focus_code(code, step1_output, [summary]), 2),
+    ], task)
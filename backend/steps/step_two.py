@@ -1,9 +1,45 @@
 from backend.services.claude_client import claude_prompt
+from backend.services import structured_output
+from backend.services import model_router
+from backend.services import metrics
+from backend.services import fault_localization
+from backend.services.log import get_logger, preview
+from backend.steps import prompt_builder
+from backend.steps import utils
 from backend.steps.step_three import run_step3
 import re
 import json
 from typing import Optional
 
+logger = get_logger("step2")
+
+# prompt 模板版本号，修改 build_step*_prompt 时递增，旧的缓存结果随之失效
+PROMPT_VERSION = "3"
+
+# 模型输出的结构（JSON Schema 子集），由 structured_output 校验和修复
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "required": ["step", "hypotheses", "question"],
+    "properties": {
+        "step": {"type": "string", "default": "Step 2/6"},
+        "hypotheses": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "required": ["id", "title", "evidence"],
+                "properties": {
+                    "id": {"type": "string", "minLength": 1},
+                    "title": {"type": "string", "minLength": 1},
+                    "evidence": {"type": "string"},
+                },
+            },
+        },
+        "question": {"type": "string", "default": "请选择可信假设，返回对应 id"},
+    },
+}
+
+@metrics.timed(metrics.step_handler_seconds, step="2")
 async def handle_step2(code: str, step1_output: Optional[str] = None , hypothesis: Optional[str] = None) -> str:
     
     # if hypothesis is None:
@@ -22,11 +58,31 @@ async def handle_step2(code: str, step1_output: Optional[str] = None , hypothesi
         return "输入否，重新请求step1"
     
 async def run_step2(code: str, step1_output: str | None = None , hypothesis: str | None = None) -> str:
-    prompt = build_step2_prompt(code, step1_output)
-    resp = await claude_prompt(prompt)
-    print("claude_resp2:", resp)
-    resp = json.loads(resp)
-    print("resp_dict2:", resp)
+    localization = await collect_localization(code)
+    prompt = build_step2_prompt(code, step1_output, localization)
+    route = model_router.route_for("step2")
+    resp = await claude_prompt(prompt, route=route)
+    logger.debug("模型原始回复: %s", preview(resp))
+    resp = await structured_output.complete_json(prompt, resp, RESPONSE_SCHEMA, "step2", route)
+    logger.debug("解析结果: %s", preview(resp))
+    return attach_localization(resp, localization)
+
+async def collect_localization(code) -> dict | None:
+    """
+    在沙箱里跑测试用例并做频谱故障定位（Ochiai / Tarantula），返回可疑代码行的排名
+
+    拿不到源码时返回 None，prompt 退回只有代码和 Step 1 结果的版本
+    """
+    source = utils.extract_source(code)
+    if source is None:
+        return None
+    file_name, text = source
+    return await fault_localization.localize(file_name, text, utils.extract_tests(code))
+
+def attach_localization(resp, localization: dict | None):
+    """把可疑代码行的排名放进 Step 2 输出，客户端可以和假设对照着看"""
+    if localization is not None and isinstance(resp, dict):
+        resp["fault_localization"] = localization
     return resp
 
 # def build_step2_prompt(code: str, step1_output: str | None = None) -> str:
@@ -60,16 +116,12 @@ async def run_step2(code: str, step1_output: str | None = None , hypothesis: str
 # }}
 # """
 
-def build_step2_prompt(code: str, step1_output: str | None = None) -> str:
-    return f"""
-你是一个调试助手。
-用户提供了一段有错误的代码：{code}
-这是 Step 1 的结果，给出了最小化可复现用例 (MRE): {step1_output}
-
-你的任务：
+def build_step2_prompt(code: str, step1_output: str | None = None, localization: dict | None = None) -> str:
+    task = f"""你的任务：
 1.基于代码和 Step 1 的运行结果，推理可能的 bug 假设 (hypotheses)。
 2.每个假设包含 id、title(简短标题)、evidence(证据来源）。
 3.至少生成 2 个不同的假设。
+4.如果给出了可疑代码行，优先围绕排名靠前的行提出假设，并在 evidence 里引用行号。
 
 最终必须输出 JSON, 保持固定结构, 不要包含额外解释。
 
@@ -96,6 +148,9 @@ def build_step2_prompt(code: str, step1_output: str | None = None) -> str:
   "question": "请选择可信假设，返回对应 id"
 }}
 """
+    return prompt_builder.assemble(code, step1_output, [
+        ("按测试覆盖做频谱故障定位得到的可疑代码行", fault_localization.summarize_ranking(localization), 3),
+    ], task)
 
 def extract_hypothesis(step2_resp: dict, hypothesis_id: str) -> dict | None:
     """
@@ -1,5 +1,8 @@
+import os
 import json
-from typing import Optional
+from typing import Any, Optional
+
+from backend.services.blob_store import blob_store
 
 def extract_hypothesis(step2_resp: dict, hypothesis_id: str) -> Optional[dict]:
     """
@@ -25,4 +28,111 @@ def extract_hypothesis(step2_resp: dict, hypothesis_id: str) -> Optional[dict]:
         if h.get("id") == hypothesis_id:
             return h
 
-    return None
\ No newline at end of file
+    return None
+
+# 允许按 code_file 从服务端磁盘读取源码的根目录
+CODE_ROOT = os.path.realpath(os.getenv("CODE_ROOT", os.getcwd()))
+
+
+def _safe_relpath(path: Optional[str], default: str = "main.py") -> str:
+    """把客户端给的文件路径规范成不越界的相对路径，例如 demo/buggy.py"""
+    if not path:
+        return default
+    parts = [p for p in path.replace("\\", "/").split("/") if p not in ("", ".", "..")]
+    return "/".join(parts) or default
+
+
+def _read_under_root(rel_path: str) -> Optional[str]:
+    """读取 CODE_ROOT 下的文件，路径越界或不存在时返回 None"""
+    path = os.path.realpath(os.path.join(CODE_ROOT, rel_path))
+    if os.path.commonpath([path, CODE_ROOT]) != CODE_ROOT or not os.path.isfile(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def extract_source(code: Any) -> Optional[tuple[str, str]]:
+    """
+    从请求里的 code 字段取出可执行的 Python 源码
+
+    参数:
+        code: 字符串源码，或 CLI 传来的 bug report 字典（文件内容可以是 blob 引用，见 blob_store）
+
+    返回:
+        (相对文件路径, 源码)，例如 ("demo/buggy.py", "...")，取不到时返回 None
+    """
+    if isinstance(code, str):
+        return ("main.py", code) if code.strip() else None
+    if not isinstance(code, dict):
+        return None
+
+    file_name = _safe_relpath(code.get("code_file"))
+
+    for field in ("source", "code"):
+        value = code.get(field)
+        if isinstance(value, str) and value.strip():
+            return file_name, value
+    # 请求入口（app.resolve_blobs）已经在线程里把 blob 引用换成了内容，这里只剩命令行等直接调用的场景
+    value = blob_store.text(code.get("source_blob"))
+    if value and value.strip():
+        return file_name, value
+
+    # 从 GitHub issue 链接抓取到的代码
+    for item in code.get("code_contents") or []:
+        if item.get("success") and str(item.get("fileName", "")).endswith(".py"):
+            content = item.get("fullContent") or blob_store.text(item.get("blob")) or item.get("content")
+            if content:
+                return _safe_relpath(item.get("filePath") or item["fileName"]), content
+
+    # 本地 bug report（例如 demo/bug_report.json）只给了文件路径
+    if file_name.endswith(".py"):
+        content = _read_under_root(file_name)
+        if content is not None:
+            return file_name, content
+
+    return None
+
+
+def is_test_file(rel_path: str) -> bool:
+    """test_*.py 或 *_test.py"""
+    name = os.path.basename(rel_path)
+    return name.endswith(".py") and (name.startswith("test_") or name.endswith("_test.py"))
+
+
+def extract_tests(code: Any) -> list[tuple[str, str]]:
+    """
+    取出与被调试代码配套的测试文件
+
+    优先使用 bug report 里的 tests（源码）/ tests_blob（blob 引用）/ test_file（路径），
+    否则在 code_file 同目录下查找 test_*.py、*_test.py、test_cases.py
+
+    返回:
+        [(相对文件路径, 源码), ...]
+    """
+    if not isinstance(code, dict):
+        return []
+
+    tests = code.get("tests") or blob_store.text(code.get("tests_blob"))
+    if isinstance(tests, str) and tests.strip():
+        return [(_safe_relpath(code.get("test_file"), "test_main.py"), tests)]
+
+    candidates: list[str] = []
+    if code.get("test_file"):
+        # 只从磁盘读测试文件，不能借 test_file 读出 .env 之类的其它文件
+        rel_path = _safe_relpath(code["test_file"])
+        if is_test_file(rel_path):
+            candidates.append(rel_path)
+    elif code.get("code_file"):
+        directory = os.path.dirname(_safe_relpath(code["code_file"]))
+        root = os.path.join(CODE_ROOT, directory)
+        if os.path.isdir(root):
+            for name in sorted(os.listdir(root)):
+                if is_test_file(name):
+                    candidates.append(f"{directory}/{name}" if directory else name)
+
+    found = []
+    for rel_path in candidates:
+        content = _read_under_root(rel_path)
+        if content is not None:
+            found.append((rel_path, content))
+    return found
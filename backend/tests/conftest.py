@@ -0,0 +1,14 @@
+# backend/tests/conftest.py
+"""
+测试环境：数据库放到临时目录，模型地址指向本机不存在的端口（测试不应该调用模型）
+
+必须在导入 backend 模块之前设置，各模块在导入时读取这些环境变量
+"""
+import os
+import tempfile
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="truedebug-test-"))
+os.environ.setdefault("OPENAI_API_BASE", "http://127.0.0.1:9")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ["LLM_PROVIDERS"] = ""
+os.environ["LLM_REPLAY_MODE"] = ""
@@ -0,0 +1,110 @@
+# backend/tests/test_admission.py
+import asyncio
+
+import pytest
+
+from backend.services.admission import FairScheduler, CallContext, AdmissionRejected
+
+
+def _scheduler(**kwargs) -> FairScheduler:
+    options = dict(capacity=1, rate=1e9, burst=1e9, user_queue=16, queue_limit=256, user_inflight=2, weights={})
+    options.update(kwargs)
+    return FairScheduler(**options)
+
+
+async def _drain(scheduler: FairScheduler, calls: list[tuple[str, str]]) -> list[str]:
+    """依次排上 calls（(用户, 优先级)），每拿到一个名额就记下用户并立即归还，返回放行顺序"""
+    order: list[str] = []
+    holder = CallContext("holder")
+    await scheduler.acquire(holder, 100)
+
+    async def call(user: str, priority: str) -> None:
+        await scheduler.acquire(CallContext(user, priority), 100)
+        order.append(f"{user}/{priority}")
+        scheduler.release()
+
+    tasks = [asyncio.ensure_future(call(user, priority)) for user, priority in calls]
+    await asyncio.sleep(0)
+    scheduler.release()
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_one_user_burst_does_not_starve_another_user():
+    calls = [("alice", "interactive")] * 4 + [("bob", "interactive")]
+    order = asyncio.run(_drain(_scheduler(), calls))
+    # bob 最后才排上，但只排在 alice 的第一个调用之后
+    assert order.index("bob/interactive") == 1
+
+
+def test_interactive_calls_go_before_background():
+    calls = [("alice", "background"), ("bob", "batch"), ("carol", "interactive")]
+    order = asyncio.run(_drain(_scheduler(), calls))
+    assert order == ["carol/interactive", "bob/batch", "alice/background"]
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def scenario() -> FairScheduler:
+        scheduler = _scheduler()
+        await scheduler.acquire(CallContext("holder"), 1)
+        waiter = asyncio.ensure_future(scheduler.acquire(CallContext("alice"), 1))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth()["interactive"] == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        scheduler.release()
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.queue_depth()["interactive"] == 0
+    assert scheduler.active == 0
+
+
+def test_slot_granted_to_a_cancelled_waiter_is_returned():
+    async def scenario() -> FairScheduler:
+        scheduler = _scheduler()
+        await scheduler.acquire(CallContext("holder"), 1)
+        waiter = asyncio.ensure_future(scheduler.acquire(CallContext("alice"), 1))
+        await asyncio.sleep(0)
+        # 放行和取消发生在同一轮事件循环里
+        scheduler.release()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return scheduler
+
+    assert asyncio.run(scenario()).active == 0
+
+
+def test_user_queue_limit_rejects_with_retry_after():
+    async def scenario() -> None:
+        scheduler = _scheduler(user_queue=2)
+        await scheduler.acquire(CallContext("holder"), 1)
+        waiters = [asyncio.ensure_future(scheduler.acquire(CallContext("alice"), 1)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as info:
+            await scheduler.acquire(CallContext("alice"), 1)
+        assert info.value.reason == "user_queue"
+        assert info.value.retry_seconds >= 1
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+
+def test_inflight_limit_and_leave():
+    scheduler = _scheduler(user_inflight=2)
+    first = scheduler.enter("alice")
+    scheduler.enter("alice")
+    with pytest.raises(AdmissionRejected):
+        scheduler.check("alice")
+    with pytest.raises(AdmissionRejected):
+        scheduler.enter("alice")
+    scheduler.leave(first)
+    # check 只检查不计数
+    scheduler.check("alice")
+    assert scheduler._inflight == {"alice": 1}
+    scheduler.leave(scheduler.enter("alice"))
+    assert scheduler._inflight == {"alice": 1}
@@ -0,0 +1,53 @@
+# backend/tests/test_batch.py
+import asyncio
+
+from backend.steps import batch, pipeline
+
+REPORTS = [(f"r{index}", {"bug_description": f"bug {index}"}) for index in range(5)]
+
+
+async def _collect(reports, workers: int) -> list[dict]:
+    async def consume():
+        return [record async for record in batch.run_batch(reports, workers)]
+
+    # 有 worker 死掉时 run_batch 会永远等下去
+    return await asyncio.wait_for(consume(), timeout=5)
+
+
+def test_failed_cleanup_is_reported_instead_of_hanging(monkeypatch):
+    async def run_all(user_id, report, choices):
+        return {"results": {"step1": "ok"}, "timings_ms": {"step1": 1.0}}
+
+    async def adelete(user_id):
+        if user_id.endswith(":r1"):
+            raise OSError("会话存储不可用")
+
+    monkeypatch.setattr(pipeline, "run_all", run_all)
+    monkeypatch.setattr(batch.session_store, "adelete", adelete)
+
+    records = asyncio.run(_collect(REPORTS, workers=2))
+
+    by_id = {record["id"]: record for record in records}
+    assert sorted(by_id) == [report_id for report_id, _ in REPORTS]
+    assert by_id["r1"]["status"] == "error"
+    assert by_id["r1"]["error"] == "OSError: 会话存储不可用"
+    assert all(by_id[report_id]["status"] == "ok" for report_id in ("r0", "r2", "r3", "r4"))
+
+
+def test_pipeline_errors_become_error_records(monkeypatch):
+    async def run_all(user_id, report, choices):
+        if report["bug_description"] == "bug 3":
+            raise ValueError("bad report")
+        return {"results": {}, "timings_ms": {}}
+
+    monkeypatch.setattr(pipeline, "run_all", run_all)
+    stats = batch.BatchStats()
+
+    async def scenario():
+        return [record async for record in batch.run_batch(REPORTS, 3, stats=stats)]
+
+    records = asyncio.run(scenario())
+    [failed] = [record for record in records if record["status"] == "error"]
+    assert failed["id"] == "r3"
+    assert failed["error"] == "ValueError: bad report"
+    assert (stats.completed, stats.failed) == (4, 1)
@@ -0,0 +1,87 @@
+# backend/tests/test_blob_store.py
+import asyncio
+import os
+import threading
+
+import pytest
+
+from backend import app
+from backend.services.blob_store import BlobStore, BlobError, apply_delta, content_hash
+
+BASE = ["line 0", "line 1", "line 2", "line 3", "line 4"]
+
+
+def test_apply_delta_replaces_inserts_and_deletes():
+    delta = [
+        {"start": 4, "end": 5, "lines": []},
+        {"start": 1, "end": 2, "lines": ["LINE 1", "LINE 1b"]},
+        {"start": 3, "end": 3, "lines": ["inserted"]},
+    ]
+    assert apply_delta(BASE, delta) == ["line 0", "LINE 1", "LINE 1b", "line 2", "inserted", "line 3"]
+    # 基准内容不被修改
+    assert BASE[1] == "line 1"
+
+
+def test_apply_delta_end_defaults_to_start():
+    assert apply_delta(BASE, [{"start": 0, "lines": ["header"]}])[:2] == ["header", "line 0"]
+
+
+@pytest.mark.parametrize("delta, message", [
+    ({"start": 0}, "必须是列表"),
+    ([{"start": 3, "end": 2, "lines": []}], "越界"),
+    ([{"start": 0, "end": 6, "lines": []}], "越界"),
+    ([{"start": 0, "end": 2, "lines": []}, {"start": 1, "end": 3, "lines": []}], "不能重叠"),
+    ([{"start": 0, "end": 1, "lines": [1]}], "字符串列表"),
+])
+def test_apply_delta_rejects_invalid_edits(delta, message):
+    with pytest.raises(BlobError, match=message):
+        apply_delta(BASE, delta)
+
+
+def test_put_delta_checks_the_expected_hash(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs.db"))
+    base, created = store.put("\n".join(BASE))
+    assert created
+    delta = [{"start": 2, "end": 3, "lines": ["changed"]}]
+    expected = "\n".join(apply_delta(BASE, delta))
+
+    blob, created = store.put_delta(base.hash, delta, expected=content_hash(expected))
+    assert created and blob.text == expected
+    assert store.text(blob.hash) == expected
+
+    with pytest.raises(BlobError, match="不一致"):
+        store.put_delta(base.hash, delta, expected=content_hash("something else"))
+    with pytest.raises(BlobError, match="基准 blob 不存在"):
+        store.put_delta("0" * 64, delta)
+
+
+def test_database_is_opened_on_first_use(tmp_path):
+    path = tmp_path / "nested" / "blobs.db"
+    store = BlobStore(str(path))
+    assert not os.path.exists(path)
+    store.put("x = 1\n")
+    assert os.path.exists(path)
+
+
+def test_requests_resolve_blobs_once_off_the_event_loop(tmp_path, monkeypatch):
+    store = BlobStore(str(tmp_path / "blobs.db"))
+    source, _ = store.put("x = 1\n")
+    tests, _ = store.put("import unittest\n")
+    threads = []
+    get = store.get
+
+    def spy(digest):
+        threads.append(threading.current_thread())
+        return get(digest)
+
+    monkeypatch.setattr(store, "get", spy)
+    monkeypatch.setattr(app, "blob_store", store)
+
+    report = {"code_file": "a.py", "source_blob": source.hash, "tests_blob": tests.hash}
+    error, (code,) = asyncio.run(app.resolve_blobs(report))
+    assert error is None
+    assert code == {"code_file": "a.py", "source": "x = 1\n", "tests": "import unittest\n"}
+    assert threads and threading.main_thread() not in threads
+
+    error, codes = asyncio.run(app.resolve_blobs(report, {"source_blob": "0" * 64}))
+    assert error["missing_blobs"] == ["0" * 64]
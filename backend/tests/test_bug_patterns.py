@@ -0,0 +1,68 @@
+# backend/tests/test_bug_patterns.py
+from backend.services import bug_patterns
+from backend.steps import pattern_rules
+
+OFF_BY_ONE = """def process(items):
+    for i in range(len(items) + 1):
+        print(items[i])
+"""
+
+
+def _rules(source: str, exception_type=None, frame_line=None) -> list[str]:
+    return [f.rule for f in bug_patterns.detect(source, exception_type, frame_line)]
+
+
+def test_read_only_mutable_default_is_not_reported():
+    source = """def lookup(key, opts={}):
+    return opts.get(key, key)
+"""
+    assert "mutable_default" not in _rules(source)
+
+
+def test_mutated_default_is_reported():
+    source = """def collect(x, acc=[]):
+    acc.append(x)
+    return acc
+"""
+    assert "mutable_default" in _rules(source)
+
+
+def test_guarded_off_by_one_loop_is_not_reported():
+    source = """def process(items):
+    for i in range(len(items) + 1):
+        if i == len(items):
+            break
+        print(items[i])
+"""
+    assert _rules(source) == []
+
+
+def test_uncorroborated_findings_stay_below_the_threshold():
+    for finding in bug_patterns.detect(OFF_BY_ONE):
+        assert not finding.corroborated
+        assert finding.confidence < pattern_rules.RULES_MIN_CONFIDENCE
+
+
+def test_matching_exception_and_frame_corroborate():
+    finding = bug_patterns.detect(OFF_BY_ONE, "IndexError", 3)[0]
+    assert finding.rule == "off_by_one"
+    assert finding.corroborated
+    assert finding.confidence >= pattern_rules.RULES_MIN_CONFIDENCE
+
+
+def test_other_exception_or_frame_does_not_corroborate():
+    for exception_type, frame_line in (("KeyError", 3), ("IndexError", 1)):
+        finding = bug_patterns.detect(OFF_BY_ONE, exception_type, frame_line)[0]
+        assert not finding.corroborated
+        assert finding.confidence < pattern_rules.RULES_MIN_CONFIDENCE
+
+
+def test_rules_only_bypass_the_model_when_corroborated():
+    step1_ok = {"execution": {"status": "ok"}}
+    assert pattern_rules.findings(OFF_BY_ONE, step1_ok)[1] == []
+    traceback = ('Traceback (most recent call last):\n'
+                 '  File "main.py", line 3, in process\n'
+                 '    print(items[i])\n'
+                 'IndexError: list index out of range\n')
+    step1_crash = {"execution": {"status": "error", "exception_type": "IndexError", "traceback": traceback}}
+    assert [f.rule for f in pattern_rules.findings(OFF_BY_ONE, step1_crash)[1]] == ["off_by_one"]
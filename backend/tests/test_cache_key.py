@@ -0,0 +1,51 @@
+# backend/tests/test_cache_key.py
+import pytest
+
+from backend.steps import pipeline, utils
+from backend.services.session_store import SessionRecord
+
+
+@pytest.fixture
+def code_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "CODE_ROOT", str(tmp_path))
+    (tmp_path / "app").mkdir()
+    (tmp_path / "app" / "main.py").write_text("def f(items):\n    return items[0]\n", encoding="utf-8")
+    (tmp_path / "app" / "test_main.py").write_text("import unittest\n", encoding="utf-8")
+    return tmp_path
+
+
+REPORT = {"code_file": "app/main.py", "test_file": "app/test_main.py"}
+
+
+CHOICES = {1: None, 2: "1", 3: "a", 4: "1", 5: "1"}
+
+
+def _keys(code) -> list[str]:
+    record = SessionRecord("u", step1={"run": 1}, step2={"hypotheses": [{"id": "a", "title": "h", "evidence": "e"}]},
+                           step3={"hypothesis": "h"}, step4={"patch": "p"})
+    prepared = [pipeline.prepare_step(step, code, choice, record) for step, choice in CHOICES.items()]
+    assert [p.error for p in prepared] == [None] * len(CHOICES)
+    return [p.key for p in prepared]
+
+
+def test_key_is_stable_for_unchanged_files(code_root):
+    assert _keys(dict(REPORT)) == _keys(dict(REPORT))
+
+
+def test_editing_the_source_file_changes_every_key(code_root):
+    before = _keys(dict(REPORT))
+    (code_root / "app" / "main.py").write_text("def f(items):\n    return items[-1]\n", encoding="utf-8")
+    after = _keys(dict(REPORT))
+    assert all(a != b for a, b in zip(before, after))
+
+
+def test_editing_the_tests_changes_the_key(code_root):
+    before = _keys(dict(REPORT))
+    (code_root / "app" / "test_main.py").write_text("import unittest  # changed\n", encoding="utf-8")
+    assert _keys(dict(REPORT))[0] != before[0]
+
+
+def test_inline_source_is_keyed_on_its_content():
+    first = pipeline.prepare_step(1, "x = 1\n", None, None).key
+    assert pipeline.prepare_step(1, "x = 1\n", None, None).key == first
+    assert pipeline.prepare_step(1, "x = 2\n", None, None).key != first
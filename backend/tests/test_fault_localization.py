@@ -0,0 +1,91 @@
+# backend/tests/test_fault_localization.py
+import pytest
+
+from backend.services.fault_localization import ochiai, rank_lines, summarize_ranking, tarantula
+
+SOURCE = """def total(items):
+    result = 0
+    for i in range(len(items) + 1):
+        result += items[i]
+    return result
+"""
+
+
+def run(status: str, lines: list[int], raised: list[int] = (), unwound: bool = False) -> dict:
+    return {"id": "t", "status": status, "lines": lines, "raised": list(raised), "unwound": unwound}
+
+
+# 三次失败（用例失败、异常从被调试文件抛出但被用例接住、用例导入出错），两次通过，一次跳过
+EXECUTIONS = [
+    run("pass", [2, 3, 4, 5]),
+    run("pass", [2, 3, 5]),
+    run("fail", [2, 3, 4], raised=[4]),
+    run("pass", [2, 3, 4], raised=[4], unwound=True),
+    run("error", []),
+    run("skip", [1, 2, 3, 4, 5]),
+]
+
+
+@pytest.mark.parametrize("ef, ep, failed, passed, expected_ochiai, expected_tarantula", [
+    (2, 1, 3, 2, 2 / 3, (2 / 3) / (2 / 3 + 1 / 2)),
+    (2, 2, 3, 2, 2 / 12 ** 0.5, (2 / 3) / (2 / 3 + 1)),
+    (1, 0, 1, 0, 1.0, 1.0),
+    (0, 2, 3, 2, 0.0, 0.0),
+    (1, 1, 0, 2, 0.0, 0.0),
+])
+def test_formulas(ef, ep, failed, passed, expected_ochiai, expected_tarantula):
+    assert ochiai(ef, ep, failed) == pytest.approx(expected_ochiai)
+    assert tarantula(ef, ep, failed, passed) == pytest.approx(expected_tarantula)
+
+
+@pytest.mark.parametrize("executions, formula, counts, expected", [
+    # 第 4 行只被一次通过执行覆盖，最可疑；第 2、3 行同分同 ef，按行号；第 5 行没有失败执行覆盖，不出现
+    (EXECUTIONS, "ochiai", (3, 2), [(4, 0.6667, 2, 1, 2), (2, 0.5774, 2, 2, 0), (3, 0.5774, 2, 2, 0)]),
+    (EXECUTIONS, "tarantula", (3, 2), [(4, 0.5714, 2, 1, 2), (2, 0.4, 2, 2, 0), (3, 0.4, 2, 2, 0)]),
+    # 同分时异常抛出点排在前面
+    ([run("fail", [2, 4], raised=[4]), run("fail", [2, 4])], "ochiai", (2, 0),
+     [(4, 1.0, 2, 0, 1), (2, 1.0, 2, 0, 0)]),
+    # 同分同抛出次数时失败覆盖多的排在前面：ef=2/ep=2 和 ef=1/ep=0 在 F=4 时 ochiai 都是 0.5
+    ([run("fail", [2, 3]), run("fail", [2]), run("fail", [5]), run("fail", [5]),
+      run("pass", [2]), run("pass", [2])], "ochiai", (4, 2),
+     [(5, 0.7071, 2, 0, 0), (2, 0.5, 2, 2, 0), (3, 0.5, 1, 0, 0)]),
+    # 跳过的用例不参与计算
+    ([run("skip", [2]), run("pass", [3])], "ochiai", (0, 1), []),
+])
+def test_rank_lines(executions, formula, counts, expected):
+    failed, passed, ranking = rank_lines(executions, SOURCE, formula)
+    assert (failed, passed) == counts
+    assert [(r["line"], r[formula], r["ef"], r["ep"], r["raised"]) for r in ranking] == expected
+
+
+def test_rank_lines_limit_and_code():
+    _, _, ranking = rank_lines(EXECUTIONS + [run("fail", [99])], SOURCE, "ochiai", limit=2)
+    assert len(ranking) == 2
+    assert ranking[0]["code"] == "result += items[i]"
+    _, _, ranking = rank_lines([run("fail", [99])], SOURCE, "ochiai")
+    assert ranking[0]["code"] == ""
+
+
+def _report(**overrides) -> dict:
+    failed, passed, ranking = rank_lines(EXECUTIONS, SOURCE, "ochiai")
+    report = {"formula": "ochiai", "executions": {"failed": failed, "passed": passed}, "ranking": ranking}
+    return {**report, **overrides}
+
+
+@pytest.mark.parametrize("report, expected", [
+    (None, None),
+    ({"error": "没有可执行的测试用例或 __main__ 入口"}, None),
+    (_report(ranking=[], note="没有失败的执行，无法定位可疑代码行"), "没有失败的执行，无法定位可疑代码行"),
+])
+def test_summarize_without_ranking(report, expected):
+    assert summarize_ranking(report) == expected
+
+
+def test_summarize_top_lines():
+    text = summarize_ranking(_report(), top_n=2)
+    assert text.splitlines() == [
+        "失败执行 3 次、通过执行 2 次，按 ochiai 排序：",
+        "1. 第 4 行 `result += items[i]`: ochiai=0.67 tarantula=0.57"
+        "（失败执行覆盖 2/3，通过执行覆盖 1/2，在此抛出异常 2 次）",
+        "2. 第 2 行 `result = 0`: ochiai=0.58 tarantula=0.40（失败执行覆盖 2/3，通过执行覆盖 2/2）",
+    ]
@@ -0,0 +1,68 @@
+# backend/tests/test_fuzzer.py
+import signal
+import time
+
+import pytest
+
+from backend.services import fuzz_runtime
+from backend.services.fuzzer import discover_targets
+
+TARGET = '''
+def classify(n: int) -> str:
+    if n < 0:
+        return "negative"
+    if n == 0:
+        return "zero"
+    if n > 1000:
+        raise ValueError("too big")
+    return "positive"
+'''
+
+
+@pytest.fixture
+def tiny_module(tmp_path, monkeypatch):
+    (tmp_path / "fuzz_tiny_target.py").write_text(TARGET, encoding="utf-8")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    handler = signal.getsignal(signal.SIGALRM)
+    yield "fuzz_tiny_target"
+    signal.signal(signal.SIGALRM, handler)
+
+
+def _run(module: str, seeds: list[str], budget: float, plateau: float) -> tuple[dict, float]:
+    targets = discover_targets(TARGET, [])
+    params = {
+        "module": module,
+        "targets": [{"name": "classify", "specs": targets["classify"]["specs"], "seeds": seeds}],
+        "budget": budget, "seed": 0, "words": {"int": [1000], "str": []},
+        "timeout": 1.0, "minimize_seconds": 0.5, "plateau": plateau,
+    }
+    start = time.perf_counter()
+    result = fuzz_runtime.run(params)
+    return result["targets"]["classify"], time.perf_counter() - start
+
+
+def test_new_edges_grow_the_corpus_and_find_the_crash(tiny_module):
+    baseline, _ = _run(tiny_module, ["[5]"], budget=0.001, plateau=0)
+    result, _ = _run(tiny_module, ["[5]"], budget=2, plateau=0.3)
+
+    # 只跑种子时只覆盖 positive 分支；变异出的负数、0、大数各自走到新边并进语料
+    assert len(result["edges"]) > len(baseline["edges"])
+    assert result["new_inputs"]
+    assert result["corpus"] > baseline["corpus"]
+    [crash] = result["crashes"]
+    assert crash["exception_type"] == "ValueError"
+    assert crash["signature"].startswith("ValueError@classify:")
+    assert crash["count"] >= 1
+
+
+def test_plateau_stops_before_the_budget(tiny_module):
+    result, elapsed = _run(tiny_module, ["[5]"], budget=10, plateau=0.2)
+
+    # 这个函数很快就没有新边了，不会把 10 秒预算跑完
+    assert elapsed < 5
+    assert result["execs"] > 0
+
+
+def test_without_plateau_the_budget_is_used(tiny_module):
+    _, elapsed = _run(tiny_module, ["[5]"], budget=0.5, plateau=0)
+    assert elapsed >= 0.5
@@ -0,0 +1,52 @@
+# backend/tests/test_json_stream.py
+import json
+
+from backend.services.json_stream import JsonFieldStream
+
+RESPONSE = {
+    "step": "Step 2/6",
+    "hypotheses": [
+        {"id": "a", "title": "循环上界 len(items) + 1", "evidence": "items[i] 在 \"i == len\" 时越界 {]"},
+        {"id": "b", "title": "列表被修改", "evidence": "无"},
+    ],
+    "question": "请选择可信假设",
+}
+
+
+def _feed(parser: JsonFieldStream, text: str, size: int) -> list:
+    events = []
+    for start in range(0, len(text), size):
+        events.extend(parser.feed(text[start:start + size]))
+    return events
+
+
+def test_fields_and_array_elements_are_emitted_as_they_complete():
+    text = json.dumps(RESPONSE, ensure_ascii=False)
+    parser = JsonFieldStream()
+    events = _feed(parser, text, 1)
+    assert [path for path, _ in events] == ["step", "hypotheses[0]", "hypotheses[1]", "hypotheses", "question"]
+    values = dict(events)
+    assert values["hypotheses[0]"] == RESPONSE["hypotheses"][0]
+    assert values["hypotheses"] == RESPONSE["hypotheses"]
+    assert parser.done
+    assert parser.text == text
+
+
+def test_chunk_boundaries_do_not_change_the_result():
+    text = json.dumps(RESPONSE, ensure_ascii=False, indent=2)
+    expected = _feed(JsonFieldStream(), text, len(text))
+    for size in (1, 2, 3, 7, 64):
+        assert _feed(JsonFieldStream(), text, size) == expected
+
+
+def test_preamble_and_code_fence_are_skipped():
+    text = "好的，结果如下：\n```json\n" + json.dumps({"run_result": "ok", "options": {"1": "确认"}}) + "\n```"
+    events = _feed(JsonFieldStream(), text, 5)
+    assert events == [("run_result", "ok"), ("options", {"1": "确认"})]
+
+
+def test_nothing_is_emitted_for_an_unfinished_value():
+    parser = JsonFieldStream()
+    assert parser.feed('{"patch": "--- a/main.py\\n+++ b/') == []
+    assert parser.feed('main.py\\n", "impact') == [("patch", "--- a/main.py\n+++ b/main.py\n")]
+    assert not parser.done
@@ -0,0 +1,93 @@
+# backend/tests/test_llm_client.py
+import asyncio
+import time
+
+import httpx
+
+from backend.bench.fake_llm_server import FakeLLMServer
+from backend.services import claude_client
+from backend.services.llm_scheduler import LLMScheduler
+
+LATENCY = 0.1
+
+
+class CountingServer(FakeLLMServer):
+    """记下 TCP 连接数和同时在处理的请求数"""
+
+    def __init__(self, **kwargs):
+        super().__init__(responder=self._respond, **kwargs)
+        self.connections = 0
+        self.active = 0
+        self.peak = 0
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        await super()._handle(reader, writer)
+
+    def _respond(self, prompt: str) -> str:
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        asyncio.get_running_loop().call_later(LATENCY / 2, self._finished)
+        return self.content
+
+    def _finished(self) -> None:
+        self.active -= 1
+
+
+def _use_server(monkeypatch, server: FakeLLMServer, concurrency: int) -> httpx.AsyncClient:
+    http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=16, max_keepalive_connections=16))
+    monkeypatch.setattr(claude_client, "API_BASE", server.base_url)
+    monkeypatch.setattr(claude_client, "LLM_PROVIDERS", "")
+    monkeypatch.setattr(claude_client, "_http_client", http_client)
+    scheduler = LLMScheduler(claude_client._load_providers(), asyncio.Semaphore(concurrency))
+    monkeypatch.setattr(claude_client, "scheduler", scheduler)
+    return http_client
+
+
+def test_concurrent_prompts_are_bounded_and_reuse_connections(monkeypatch):
+    async def scenario():
+        server = CountingServer(port=0, latency=LATENCY)
+        await server.start()
+        http_client = _use_server(monkeypatch, server, concurrency=2)
+        try:
+            start = time.perf_counter()
+            results = await asyncio.gather(*(claude_client.claude_prompt(f"prompt {i}") for i in range(6)))
+            return server, results, time.perf_counter() - start
+        finally:
+            await http_client.aclose()
+            await server.stop()
+
+    server, results, elapsed = asyncio.run(scenario())
+    assert results == [server.content] * 6
+    assert server.requests == 6
+    # 信号量只放 2 个请求同时在途，6 个请求至少要排 3 轮
+    assert server.peak == 2
+    assert elapsed >= 3 * LATENCY
+    # keep-alive 连接池：连接数不超过并发数，而不是每个请求一条
+    assert server.connections <= 2
+
+
+def test_event_loop_is_not_blocked_while_waiting(monkeypatch):
+    async def scenario():
+        server = FakeLLMServer(port=0, latency=LATENCY * 3)
+        await server.start()
+        http_client = _use_server(monkeypatch, server, concurrency=4)
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(LATENCY / 10)
+                ticks += 1
+
+        ticking = asyncio.ensure_future(ticker())
+        try:
+            await claude_client.claude_prompt("hello")
+        finally:
+            ticking.cancel()
+            await http_client.aclose()
+            await server.stop()
+        return ticks
+
+    # 模型调用期间事件循环还在调度别的协程
+    assert asyncio.run(scenario()) >= 10
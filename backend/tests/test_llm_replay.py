@@ -0,0 +1,91 @@
+# backend/tests/test_llm_replay.py
+import asyncio
+
+import httpx
+import pytest
+
+from backend.bench.fake_llm_server import FakeLLMServer
+from backend.services import claude_client
+from backend.services.llm_replay import Replayer, ReplayMiss
+from backend.services.llm_scheduler import LLMScheduler
+from backend.services.model_router import Route
+
+ROUTE = Route("step2", "fast-model", timeout=5)
+
+
+def _use_replayer(monkeypatch, directory: str, mode: str, **options) -> Replayer:
+    replayer = Replayer()
+    replayer.configure(mode=mode, directory=directory, **options)
+    monkeypatch.setattr(claude_client, "replayer", replayer)
+    return replayer
+
+
+def _use_server(monkeypatch, server: FakeLLMServer) -> httpx.AsyncClient:
+    http_client = httpx.AsyncClient()
+    monkeypatch.setattr(claude_client, "API_BASE", server.base_url)
+    monkeypatch.setattr(claude_client, "LLM_PROVIDERS", "")
+    monkeypatch.setattr(claude_client, "_http_client", http_client)
+    scheduler = LLMScheduler(claude_client._load_providers(), asyncio.Semaphore(4))
+    monkeypatch.setattr(claude_client, "scheduler", scheduler)
+    return http_client
+
+
+async def _prompt_and_stream(prompt: str) -> tuple[str, str]:
+    answer = await claude_client.claude_prompt(prompt, route=ROUTE)
+    streamed = "".join([delta async for delta in claude_client.claude_stream(f"{prompt} (stream)", route=ROUTE)])
+    return answer, streamed
+
+
+def test_recorded_calls_replay_without_the_model(monkeypatch, tmp_path):
+    directory = str(tmp_path / "fixtures")
+
+    async def record():
+        server = FakeLLMServer(port=0, latency=0, responder=lambda prompt: f"回复: {prompt}")
+        await server.start()
+        http_client = _use_server(monkeypatch, server)
+        try:
+            return await _prompt_and_stream("定位 IndexError"), server.requests
+        finally:
+            await http_client.aclose()
+            await server.stop()
+
+    recorder = _use_replayer(monkeypatch, directory, "record")
+    recorded, requests = asyncio.run(record())
+    assert requests == 2
+    assert recorder.stats()["recorded"] == 2
+
+    # 回放：服务已经停了，新的 Replayer 从磁盘读夹具
+    replayer = _use_replayer(monkeypatch, directory, "replay")
+    replayed = asyncio.run(_prompt_and_stream("定位 IndexError"))
+
+    assert replayed == recorded
+    assert recorded[0] == "回复: 定位 IndexError"
+    assert replayer.stats() == {"mode": "replay", "fixtures": 2, "hits": 2, "misses": 0, "recorded": 0}
+
+
+def test_replay_miss(monkeypatch, tmp_path):
+    directory = str(tmp_path / "fixtures")
+    _use_replayer(monkeypatch, directory, "replay")
+    with pytest.raises(ReplayMiss):
+        asyncio.run(claude_client.claude_prompt("没录过", route=ROUTE))
+
+
+def test_replay_miss_falls_back_to_the_route(tmp_path):
+    directory = str(tmp_path / "fixtures")
+
+    async def live():
+        return "录下的回复"
+
+    async def unreachable():
+        raise AssertionError("回放时不应该调用模型")
+
+    async def scenario():
+        recorder = Replayer()
+        recorder.configure(mode="record", directory=directory)
+        await recorder.complete("原始代码", ROUTE, live)
+        replayer = Replayer()
+        replayer.configure(mode="replay", directory=directory, miss="route")
+        # 代码带了随机扰动，prompt 不同，但同一条路由有录制
+        return await replayer.complete("扰动后的代码", ROUTE, unreachable)
+
+    assert asyncio.run(scenario()) == "录下的回复"
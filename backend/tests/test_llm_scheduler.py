@@ -0,0 +1,192 @@
+# backend/tests/test_llm_scheduler.py
+import asyncio
+import time
+
+import httpx
+import pytest
+from openai import AsyncOpenAI
+
+from backend.bench.fake_llm_server import FakeLLMServer
+from backend.services import llm_scheduler
+from backend.services.llm_scheduler import LLMScheduler, Provider, CircuitBreaker
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(llm_scheduler, "LLM_BACKOFF_BASE", 0.001)
+    monkeypatch.setattr(llm_scheduler, "LLM_BACKOFF_MAX", 0.001)
+
+
+async def _providers(*servers: FakeLLMServer) -> list[Provider]:
+    providers = []
+    for index, server in enumerate(servers):
+        await server.start()
+        client = AsyncOpenAI(api_key="test", base_url=server.base_url, http_client=httpx.AsyncClient(),
+                             max_retries=0)
+        providers.append(Provider(server.content, server.base_url, "default-model", client,
+                                  accept_routes=index == 0))
+    return providers
+
+
+async def _close(providers: list[Provider], *servers: FakeLLMServer) -> None:
+    for provider in providers:
+        await provider.client.close()
+    for server in servers:
+        await server.stop()
+
+
+def _half_open(provider: Provider) -> None:
+    provider.breaker = CircuitBreaker(failures=1, cooldown=60)
+    provider.breaker.opened_at = time.monotonic() - 60
+
+
+def test_breaker_opens_after_failures_and_fails_over():
+    async def scenario():
+        a = FakeLLMServer(port=0, latency=0, content="a", error_rate=1.0)
+        b = FakeLLMServer(port=0, latency=0, content="b")
+        providers = await _providers(a, b)
+        providers[0].breaker = CircuitBreaker(failures=2, cooldown=60)
+        scheduler = LLMScheduler(providers, asyncio.Semaphore(4))
+        try:
+            first = await scheduler.complete(MESSAGES, 5)
+            requests_to_a = a.requests
+            second = await scheduler.complete(MESSAGES, 5)
+            return first, second, requests_to_a, a.requests, providers[0].breaker.state
+        finally:
+            await _close(providers, a, b)
+
+    first, second, requests_to_a, later_requests_to_a, state = asyncio.run(scenario())
+    assert first == second == "b"
+    assert requests_to_a == 2
+    # 熔断期间不再请求 a
+    assert later_requests_to_a == 2
+    assert state == "open"
+
+
+def test_unattempted_backup_keeps_its_probe_slot():
+    async def scenario():
+        a = FakeLLMServer(port=0, latency=0, content="a")
+        b = FakeLLMServer(port=0, latency=0, content="b")
+        providers = await _providers(a, b)
+        _half_open(providers[1])
+        scheduler = LLMScheduler(providers, asyncio.Semaphore(4))
+        try:
+            answer = await scheduler.complete(MESSAGES, 5)
+            probing = providers[1].breaker._probing
+            # a 熔断后，b 的探测名额还在，请求转到 b 并把它恢复
+            providers[0].breaker.opened_at = time.monotonic()
+            fallback = await scheduler.complete(MESSAGES, 5)
+            return answer, probing, fallback, providers[1].breaker.state
+        finally:
+            await _close(providers, a, b)
+
+    answer, probing, fallback, state = asyncio.run(scenario())
+    assert answer == "a"
+    assert not probing
+    assert fallback == "b"
+    assert state == "closed"
+
+
+def test_cancelled_probe_releases_the_slot():
+    async def scenario():
+        a = FakeLLMServer(port=0, latency=1.0, content="a")
+        b = FakeLLMServer(port=0, latency=0, content="b")
+        providers = await _providers(a, b)
+        _half_open(providers[0])
+        scheduler = LLMScheduler(providers, asyncio.Semaphore(4))
+        try:
+            call = asyncio.ensure_future(scheduler.complete(MESSAGES, 5))
+            await asyncio.sleep(0.1)
+            assert providers[0].breaker._probing
+            call.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await call
+            released = not providers[0].breaker._probing
+            a.latency = 0
+            answer = await scheduler.complete(MESSAGES, 5)
+            return released, answer, providers[0].breaker.state
+        finally:
+            await _close(providers, a, b)
+
+    released, answer, state = asyncio.run(scenario())
+    assert released
+    # 下一个请求重新探测 a，而不是永远转给 b
+    assert answer == "a"
+    assert state == "closed"
+
+
+def test_cancelled_stream_probe_releases_the_slot():
+    async def scenario():
+        a = FakeLLMServer(port=0, latency=1.0, content="a")
+        providers = await _providers(a)
+        _half_open(providers[0])
+        scheduler = LLMScheduler(providers, asyncio.Semaphore(4))
+
+        async def consume():
+            async for _ in scheduler.stream(MESSAGES, 5):
+                pass
+
+        try:
+            call = asyncio.ensure_future(consume())
+            await asyncio.sleep(0.1)
+            call.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await call
+            return providers[0].breaker._probing
+        finally:
+            await _close(providers, a)
+
+    assert asyncio.run(scenario()) is False
+
+
+def _warm(provider: Provider, model: str, latency: float, samples: int = 20) -> None:
+    for _ in range(samples):
+        provider.stats_for(model).record_success(latency)
+
+
+def test_slow_primary_is_hedged_to_the_backup(monkeypatch):
+    monkeypatch.setattr(llm_scheduler, "LLM_HEDGE_MIN_DELAY", 0.05)
+
+    async def scenario():
+        a = FakeLLMServer(port=0, latency=1.0, content="a")
+        b = FakeLLMServer(port=0, latency=0, content="b")
+        providers = await _providers(a, b)
+        _warm(providers[0], "fast-model", 0.01)
+        scheduler = LLMScheduler(providers, asyncio.Semaphore(4))
+        try:
+            start = time.perf_counter()
+            answer = await scheduler.complete(MESSAGES, 5, model="fast-model")
+            return answer, time.perf_counter() - start, providers[0].stats["fast-model"], b.requests
+        finally:
+            await _close(providers, a, b)
+
+    answer, elapsed, stats, backup_requests = asyncio.run(scenario())
+    assert answer == "b"
+    assert elapsed < 0.5
+    assert (stats.hedges, stats.hedge_wins) == (1, 1)
+    assert backup_requests == 1
+
+
+def test_hedge_delay_is_per_model(monkeypatch):
+    monkeypatch.setattr(llm_scheduler, "LLM_HEDGE_MIN_DELAY", 0.05)
+
+    async def scenario():
+        a = FakeLLMServer(port=0, latency=0.2, content="a")
+        b = FakeLLMServer(port=0, latency=0, content="b")
+        providers = await _providers(a, b)
+        # 只有强模型的样本：快模型没有样本，不对冲；强模型的 p95 很高，也不对冲
+        _warm(providers[0], "strong-model", 5.0)
+        scheduler = LLMScheduler(providers, asyncio.Semaphore(4))
+        try:
+            fast = await scheduler.complete(MESSAGES, 5, model="fast-model")
+            strong = await scheduler.complete(MESSAGES, 5, model="strong-model")
+            return fast, strong, b.requests, sorted(scheduler.stats()["a"]["models"])
+        finally:
+            await _close(providers, a, b)
+
+    fast, strong, backup_requests, models = asyncio.run(scenario())
+    assert fast == strong == "a"
+    assert backup_requests == 0
+    assert models == ["fast-model", "strong-model"]
@@ -0,0 +1,126 @@
+# backend/tests/test_patcher.py
+import pytest
+
+from backend.services.patcher import apply_hunks, apply_patch, verify_patch, PatchError
+
+SOURCE = """def process(items):
+    total = 0
+    for i in range(len(items) + 1):
+        total += items[i]
+    return total
+
+
+def main():
+    print(process([1, 2, 3]))
+"""
+
+
+def test_exact_hunk_applies_at_declared_line():
+    patch = """--- a/main.py
++++ b/main.py
+@@ -2,3 +2,3 @@
+     total = 0
+-    for i in range(len(items) + 1):
++    for i in range(len(items)):
+         total += items[i]
+"""
+    patched, placements = apply_hunks(SOURCE, patch)
+    assert "for i in range(len(items)):" in patched
+    assert placements == [{"hunk": 1, "line": 2, "offset": 0, "level": "exact", "fuzz": 0}]
+
+
+def test_wrong_line_numbers_are_relocated():
+    patch = """--- a/main.py
++++ b/main.py
+@@ -40,3 +40,3 @@
+     total = 0
+-    for i in range(len(items) + 1):
++    for i in range(len(items)):
+         total += items[i]
+"""
+    patched, placements = apply_hunks(SOURCE, patch)
+    assert "for i in range(len(items)):" in patched
+    assert placements[0]["line"] == 2
+    assert placements[0]["offset"] == -38
+
+
+def test_lost_indentation_is_restored_from_the_original():
+    patch = """--- a/main.py
++++ b/main.py
+@@ -2,3 +2,3 @@
+ total = 0
+-for i in range(len(items) + 1):
++for i in range(len(items)):
+     total += items[i]
+"""
+    patched, placements = apply_hunks(SOURCE, patch)
+    assert placements[0]["level"] == "indent"
+    assert "\n    for i in range(len(items)):\n" in patched
+    # 上下文行输出原文
+    assert "\n    total = 0\n" in patched
+
+
+def test_mismatched_edge_context_is_fuzzed_away():
+    patch = """--- a/main.py
++++ b/main.py
+@@ -2,4 +2,4 @@
+     totals = 0
+     for i in range(len(items) + 1):
+-        total += items[i]
++        total += items[i] if i < len(items) else 0
+     return total
+"""
+    patched, placements = apply_hunks(SOURCE, patch)
+    assert placements[0]["fuzz"] == 1
+    assert "    total = 0\n" in patched
+    assert "total += items[i] if i < len(items) else 0" in patched
+
+
+def test_missing_removed_line_is_rejected_with_reason():
+    patch = """--- a/main.py
++++ b/main.py
+@@ -2,3 +2,3 @@
+     total = 0
+-    for index in range(len(items) + 1):
++    for index in range(len(items)):
+         total += items[i]
+"""
+    with pytest.raises(PatchError) as info:
+        apply_patch(SOURCE, patch)
+    assert info.value.hunk == 1
+    assert "要删除的行在原文中不存在" in str(info.value)
+    assert "for index in range(len(items) + 1):" in str(info.value)
+
+
+def test_unmatched_context_reports_nearest_position():
+    patch = """--- a/main.py
++++ b/main.py
+@@ -1,4 +1,4 @@
+ def process(items):
+     total = 1
+-    for i in range(len(items) + 1):
++    for i in range(len(items)):
+         total += items[i]
+"""
+    with pytest.raises(PatchError) as info:
+        apply_hunks(SOURCE, patch, max_fuzz=0)
+    message = str(info.value)
+    assert "最接近的位置在原文第 1 行" in message
+    assert "补丁期望 `total = 1`，原文第 2 行是 `total = 0`" in message
+    assert info.value.line == 2
+
+
+def test_verify_patch_reports_compile_errors():
+    patch = """--- a/main.py
++++ b/main.py
+@@ -2,3 +2,3 @@
+     total = 0
+-    for i in range(len(items) + 1):
++    for i in range(len(items)
+         total += items[i]
+"""
+    report = verify_patch(SOURCE, patch)
+    assert report["applied"] is True
+    assert report["compiles"] is False
+    assert report["stage"] == "compile"
+    assert report["line"] == 3
@@ -0,0 +1,54 @@
+# backend/tests/test_recall.py
+import pytest
+
+from backend.services.knowledge_base import KnowledgeBase
+from backend.services.session_store import SessionRecord
+from backend.steps import recall
+
+CODE = "def first(items):\n    return items[1]\n"
+PASSED = {"regression_results": {"test_first": "✅", "fuzz_10x": "✅"}}
+FAILED = {"regression_results": {"test_first": "❌", "fuzz_10x": "✅"}}
+
+
+@pytest.fixture
+def kb(tmp_path, monkeypatch):
+    knowledge_base = KnowledgeBase(str(tmp_path / "kb.db"))
+    monkeypatch.setattr(recall, "knowledge_base", knowledge_base)
+    return knowledge_base
+
+
+def _record(step5, prior_fix=None) -> SessionRecord:
+    step4 = {"patch": "--- a/main.py\n+++ b/main.py\n", "patch_check": {"applied": True, "compiles": True}}
+    if prior_fix is not None:
+        step4["prior_fix"] = prior_fix
+    return SessionRecord("u", step1={"run_result": "IndexError: list index out of range"},
+                         step2={"hypotheses": [{"title": "off by one", "evidence": "items[1]"}]},
+                         step3={"hypothesis": "off by one"}, step4=step4, step5=step5)
+
+
+def _confirmations(kb: KnowledgeBase, entry_id: int) -> int:
+    return kb._conn.execute("SELECT confirmations FROM entries WHERE id = ?", (entry_id,)).fetchone()[0]
+
+
+def test_verified_session_is_remembered(kb):
+    entry_id = recall.remember(CODE, _record(PASSED))
+    assert entry_id is not None
+    assert kb.stats()["entries"] == 1
+
+
+def test_failing_regression_is_not_remembered(kb):
+    assert recall.remember(CODE, _record(FAILED)) is None
+    assert recall.remember(CODE, _record({"regression_results": {}})) is None
+    assert kb.stats()["entries"] == 0
+
+
+def test_recalled_patch_is_confirmed_only_when_it_passes_again(kb):
+    entry_id = recall.remember(CODE, _record(PASSED))
+    prior = {"id": entry_id}
+
+    assert recall.remember(CODE, _record(FAILED, prior)) is None
+    assert _confirmations(kb, entry_id) == 0
+
+    assert recall.remember(CODE, _record(PASSED, prior)) is None
+    assert _confirmations(kb, entry_id) == 1
+    assert kb.stats()["entries"] == 1
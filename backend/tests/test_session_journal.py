@@ -0,0 +1,134 @@
+# backend/tests/test_session_journal.py
+import asyncio
+import threading
+
+import pytest
+
+from backend.services.session_journal import SessionJournal, JournalError, MAIN_BRANCH
+from backend.services.session_store import session_store
+from backend.steps import pipeline
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return SessionJournal(str(tmp_path / "journal.db"), compact_interval=0)
+
+
+def _run(journal: SessionJournal, session: str, outputs: dict) -> None:
+    for step, output in outputs.items():
+        journal.append(session, step, output, choice="1", cache_key=f"key{step}")
+
+
+def test_rollback_forks_a_branch_and_keeps_earlier_steps(journal):
+    _run(journal, "s", {1: {"run": 1}, 2: {"hypotheses": ["a"]}, 3: {"plan": "p"}})
+
+    outcome = journal.rollback("s", 2)
+    assert outcome["steps"] == {1: {"run": 1}}
+    assert journal.state("s") == {1: {"run": 1}}
+
+    history = journal.history("s")
+    assert history["branch"] == outcome["branch"] != MAIN_BRANCH
+    assert {b["branch"] for b in history["branches"]} == {MAIN_BRANCH, outcome["branch"]}
+
+
+def test_rollback_salts_cache_keys_from_the_fork_step(journal):
+    _run(journal, "s", {1: {"run": 1}, 2: {"hypotheses": ["a"]}})
+    assert journal.salted("s", 2, "key2") == "key2"
+
+    journal.rollback("s", 2)
+    assert journal.salted("s", 1, "key1") == "key1"
+    first = journal.salted("s", 2, "key2")
+    assert first != "key2"
+    assert journal.salted("s", 3, "key3") != "key3"
+
+    # 再回退一次，salt 不同，不会命中上一个分支的结果
+    journal.append("s", 2, {"hypotheses": ["b"]})
+    journal.rollback("s", 2)
+    assert journal.salted("s", 2, "key2") not in ("key2", first)
+
+
+def test_checkout_switches_between_branches(journal):
+    _run(journal, "s", {1: {"run": 1}, 2: {"hypotheses": ["a"]}})
+    branch = journal.rollback("s", 2)["branch"]
+    journal.append("s", 2, {"hypotheses": ["b"]})
+
+    assert journal.checkout("s", MAIN_BRANCH)["steps"] == {1: {"run": 1}, 2: {"hypotheses": ["a"]}}
+    assert journal.state("s")[2] == {"hypotheses": ["a"]}
+    assert journal.checkout("s", branch)["steps"] == {1: {"run": 1}, 2: {"hypotheses": ["b"]}}
+
+
+def test_invalid_rollback_and_checkout_raise(journal):
+    with pytest.raises(JournalError):
+        journal.rollback("nobody", 1)
+    _run(journal, "s", {1: {"run": 1}})
+    with pytest.raises(JournalError):
+        journal.rollback("s", 4)
+    with pytest.raises(JournalError):
+        journal.checkout("s", "b42")
+
+
+def test_compact_keeps_the_current_branch_state(journal):
+    _run(journal, "s", {1: {"run": 1}, 2: {"hypotheses": ["a"]}, 3: {"plan": "p"}})
+    journal.rollback("s", 2)
+    journal.append("s", 2, {"hypotheses": ["b"]})
+    before = journal.state("s")
+
+    stats = journal.compact(compact_after=0, retain=3600)
+    assert stats["compacted_sessions"] == 1
+    assert stats["dropped_entries"] > 0
+    assert journal.state("s") == before
+    assert [b["branch"] for b in journal.history("s")["branches"]] == [MAIN_BRANCH]
+
+    journal.compact(compact_after=0, retain=0)
+    assert journal.state("s") == {}
+
+
+def test_blob_gc_runs_without_the_write_lock(journal):
+    _run(journal, "s", {1: {"run": 1}, 2: {"hypotheses": ["a"]}})
+    journal.delete("s")
+    dropped = []
+    with journal._lock:
+        # 持有写入锁时 GC 也能跑完
+        worker = threading.Thread(target=lambda: dropped.append(journal._collect_blobs()))
+        worker.start()
+        worker.join(5)
+    assert not worker.is_alive()
+    assert dropped == [2]
+    assert journal.stats()["blobs"] == 0
+
+
+def test_blob_referenced_again_is_kept(journal):
+    _run(journal, "s", {1: {"run": 1}})
+    journal.delete("s")
+    journal.append("t", 1, {"run": 1})
+    assert journal._collect_blobs() == 0
+    assert journal.state("t") == {1: {"run": 1}}
+
+
+def test_pipeline_calls_the_journal_off_the_event_loop(journal, monkeypatch):
+    threads = []
+
+    def spy(method):
+        def wrapper(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return method(*args, **kwargs)
+        return wrapper
+
+    for name in ("append", "state", "salted", "rollback"):
+        monkeypatch.setattr(journal, name, spy(getattr(journal, name)))
+    monkeypatch.setattr(pipeline, "session_journal", journal)
+
+    async def scenario():
+        await pipeline.commit_step("journal-user", 1, {"run": 1}, key="k1")
+        await pipeline.commit_step("journal-user", 2, {"hypotheses": ["a"]}, key="k2")
+        await pipeline.rollback("journal-user", 2)
+        await session_store.adelete("journal-user")
+        record = await pipeline.load_record("journal-user")
+        prepared = await pipeline.prepare_for(2, "journal-user", "x = 1\n", "1", record)
+        return record, prepared
+
+    record, prepared = asyncio.run(scenario())
+    assert record.get_step(1) == {"run": 1}
+    assert prepared.error is None
+    assert len(threads) == 5
+    assert threading.main_thread() not in threads
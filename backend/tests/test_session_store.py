@@ -0,0 +1,191 @@
+# backend/tests/test_session_store.py
+import socketserver
+import threading
+import time
+
+import pytest
+
+from backend.services.session_store import (
+    MemoryBackend, RedisBackend, SessionRecord, SessionStore, SqliteBackend,
+)
+
+
+class FakeRedis(socketserver.ThreadingTCPServer):
+    """只实现 RedisBackend 用到的命令的 RESP 服务，数据放在内存里"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeRedisHandler)
+        self.strings: dict[bytes, bytes] = {}
+        self.expires: dict[bytes, int] = {}
+        self.zsets: dict[bytes, dict[bytes, float]] = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"redis://127.0.0.1:{self.server_address[1]}/0"
+
+    def execute(self, name: str, args: list[bytes]):
+        if name == "GET":
+            return self.strings.get(args[0])
+        if name == "SET":
+            self.strings[args[0]] = args[1]
+            if len(args) == 4 and args[2].upper() == b"EX":
+                self.expires[args[0]] = int(args[3])
+            return "OK"
+        if name == "DEL":
+            return int(self.strings.pop(args[0], None) is not None)
+        zset = self.zsets.setdefault(args[0], {})
+        if name == "ZADD":
+            added = args[2] not in zset
+            zset[args[2]] = float(args[1])
+            return int(added)
+        if name == "ZREM":
+            return int(zset.pop(args[1], None) is not None)
+        if name == "ZCARD":
+            return len(zset)
+        if name == "ZREMRANGEBYSCORE":
+            low, high = float(args[1]), float(args[2])
+            victims = [member for member, score in zset.items() if low <= score <= high]
+            for member in victims:
+                del zset[member]
+            return len(victims)
+        if name == "ZRANGE":
+            members = sorted(zset, key=lambda member: (zset[member], member))
+            start, stop = int(args[1]), int(args[2])
+            return members[start:stop + 1 if stop >= 0 else None]
+        raise ValueError(f"ERR unknown command '{name}'")
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            count = int(line[1:-2])
+            args = []
+            for _ in range(count):
+                length = int(self.rfile.readline()[1:-2])
+                args.append(self.rfile.read(length + 2)[:-2])
+            try:
+                with self.server.lock:
+                    reply = self.server.execute(args[0].decode().upper(), args[1:])
+            except ValueError as exc:
+                self.wfile.write(f"-{exc}\r\n".encode())
+                continue
+            self.wfile.write(_encode(reply))
+
+
+def _encode(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, str):
+        return f"+{value}\r\n".encode()
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if isinstance(value, bytes):
+        return f"${len(value)}\r\n".encode() + value + b"\r\n"
+    return f"*{len(value)}\r\n".encode() + b"".join(_encode(item) for item in value)
+
+
+@pytest.fixture
+def fake_redis():
+    server = FakeRedis()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        yield MemoryBackend()
+    elif request.param == "sqlite":
+        yield SqliteBackend(str(tmp_path / "sessions.db"))
+    else:
+        server = request.getfixturevalue("fake_redis")
+        redis = RedisBackend(server.url, ttl=60)
+        yield redis
+        redis.client.close()
+
+
+def _put(backend, user_id: str, updated_at: float, **steps) -> None:
+    backend.put(SessionRecord(user_id, updated_at, **steps))
+
+
+def test_round_trip_and_delete(backend):
+    _put(backend, "alice", time.time(), step1={"run_result": "IndexError"}, step4={"patch": "补丁"})
+
+    record = backend.get("alice")
+    assert record.step1 == {"run_result": "IndexError"}
+    assert record.step4 == {"patch": "补丁"}
+    assert record.step2 is None
+    assert backend.count() == 1
+
+    backend.delete("alice")
+    assert backend.get("alice") is None
+    assert backend.count() == 0
+
+
+def test_purge_drops_idle_then_least_recently_written(backend):
+    now = time.time()
+    _put(backend, "idle", now - 120)
+    for index, user_id in enumerate(["a", "b", "c"]):
+        _put(backend, user_id, now - 10 + index)
+
+    assert backend.purge(ttl=60, max_sessions=2) == 2
+    # 空闲会话的 key 在 Redis 里靠 EX 自己过期，这里只看计数
+    assert backend.count() == 2
+    assert backend.get("a") is None
+    assert {backend.get("b").user_id, backend.get("c").user_id} == {"b", "c"}
+
+
+def test_reads_do_not_refresh_eviction_order(backend):
+    now = time.time()
+    _put(backend, "a", now - 2)
+    _put(backend, "b", now - 1)
+    # 按最近写入淘汰：读 a 不会让它排到 b 后面
+    assert backend.get("a") is not None
+    _put(backend, "c", now)
+
+    backend.purge(ttl=60, max_sessions=2)
+    assert backend.get("a") is None
+    assert backend.get("b") is not None
+
+
+def test_redis_key_expires_with_ttl(fake_redis):
+    redis = RedisBackend(fake_redis.url, ttl=90)
+    try:
+        _put(redis, "alice", time.time())
+    finally:
+        redis.client.close()
+    assert fake_redis.expires[b"truedebug:session:alice"] == 90
+    assert set(fake_redis.zsets[b"truedebug:session:index"]) == {b"alice"}
+
+
+def test_sqlite_opens_lazily_and_survives_reopen(tmp_path):
+    path = tmp_path / "nested" / "sessions.db"
+    backend = SqliteBackend(str(path))
+    assert not path.exists()
+
+    store = SessionStore(backend, ttl=60, max_sessions=10)
+    store.set_step("alice", 1, {"run_result": "ok"})
+    assert path.exists()
+
+    # 另一个进程（worker）打开同一个文件能读到
+    reopened = SessionStore(SqliteBackend(str(path)), ttl=60, max_sessions=10)
+    assert reopened.get_step("alice", 1) == {"run_result": "ok"}
+
+
+def test_store_expires_idle_session_on_read(backend):
+    store = SessionStore(backend, ttl=60, max_sessions=10)
+    _put(backend, "idle", time.time() - 120, step1={"run_result": "old"})
+
+    assert store.get("idle") is None
+    assert store.evictions >= 1
+    assert backend.count() == 0
@@ -0,0 +1,128 @@
+# backend/tests/test_structured_output.py
+import asyncio
+import json
+
+import pytest
+
+from backend.services import model_router, structured_output
+from backend.services.structured_output import StructuredOutputError, complete_json, parse_json, validate
+
+SCHEMA = {
+    "type": "object",
+    "required": ["cause", "confidence", "lines"],
+    "properties": {
+        "cause": {"type": "string", "minLength": 1},
+        "confidence": {"type": "integer"},
+        "lines": {"type": "array", "minItems": 1, "items": {"type": "integer"}},
+        "step": {"type": "integer", "default": 2},
+    },
+}
+VALID = {"cause": "off by one", "confidence": 80, "lines": [3]}
+
+
+@pytest.mark.parametrize("text, value, complete, notes", [
+    ('{"a": 1}', {"a": 1}, True, []),
+    ('```json\n{"a": 1}\n```', {"a": 1}, True, ["去掉 markdown 围栏"]),
+    ('```\n{"a": 1}\n```', {"a": 1}, True, ["去掉 markdown 围栏"]),
+    ('好的，结果如下：{"a": "{x}"} 希望有帮助', {"a": "{x}"}, True, ["去掉 JSON 前后的多余文本"]),
+    ('{"a": [1, 2,], "b": {"c": 3,},}', {"a": [1, 2], "b": {"c": 3}}, True, ["去掉尾随逗号"]),
+    ('```json\n{"a": 1,}\n```', {"a": 1}, True, ["去掉 markdown 围栏", "去掉尾随逗号"]),
+    ('{"cause": "off by one", "lines": [3, 4', {"cause": "off by one", "lines": [3]}, False,
+     ["回复不完整，只恢复了完整的字段"]),
+    ('{"cause": "x", "confidence": 8', {"cause": "x"}, False, ["回复不完整，只恢复了完整的字段"]),
+    ("没有 JSON", None, False, []),
+    (None, None, False, []),
+])
+def test_parse_json(text, value, complete, notes):
+    result = parse_json(text)
+    assert result.value == value
+    assert result.complete is complete
+    assert result.notes == notes
+
+
+@pytest.mark.parametrize("value, schema, errors", [
+    (3, {"type": "integer"}, []),
+    (True, {"type": "integer"}, ["(根): 应为 integer，实际是 bool"]),
+    (False, {"type": "number"}, ["(根): 应为 number，实际是 bool"]),
+    (0.5, {"type": "number"}, []),
+    (True, {"type": "boolean"}, []),
+    ("3", {"type": "integer"}, ["(根): 应为 integer，实际是 str"]),
+    ({"cause": "x", "confidence": True, "lines": [1, False]}, SCHEMA,
+     ["confidence: 应为 integer，实际是 bool", "lines[1]: 应为 integer，实际是 bool"]),
+    ({"cause": " ", "lines": []}, SCHEMA,
+     ["confidence: 缺少字段", "cause: 不能为空", "lines: 至少需要 1 项"]),
+])
+def test_validate(value, schema, errors):
+    assert validate(value, schema) == errors
+
+
+class FakeModel:
+    """按顺序返回预设的回复，记下每次调用的 prompt 和路由"""
+
+    def __init__(self, *replies: str):
+        self.replies = list(replies)
+        self.calls: list[tuple[str, object]] = []
+
+    async def __call__(self, prompt: str, timeout=None, route=None) -> str:
+        self.calls.append((prompt, route))
+        return self.replies.pop(0)
+
+
+@pytest.fixture
+def model(monkeypatch):
+    monkeypatch.setattr(structured_output, "STRUCTURED_REPAIR_ATTEMPTS", 1)
+    monkeypatch.setattr(structured_output, "STRUCTURED_FULL_RETRIES", 1)
+    monkeypatch.setattr(model_router, "LLM_ESCALATE", True)
+
+    def install(*replies: str) -> FakeModel:
+        fake = FakeModel(*replies)
+        monkeypatch.setattr(structured_output, "claude_prompt", fake)
+        return fake
+
+    return install
+
+
+def _complete(raw: str, route=None) -> dict:
+    return asyncio.run(complete_json("分析这个 bug", raw, SCHEMA, "step1", route))
+
+
+def test_valid_reply_needs_no_model_call(model):
+    fake = model()
+    value = _complete("```json\n" + json.dumps(VALID) + "\n```")
+    assert value == {**VALID, "step": 2}
+    assert fake.calls == []
+
+
+def test_missing_field_is_repaired_alone(model):
+    fake = model('{"confidence": 70, "cause": "不该被采纳"}')
+    route = model_router.routes["step1"]
+    value = _complete('{"cause": "off by one", "lines": [3]', route)
+
+    assert value == {"cause": "off by one", "lines": [3], "confidence": 70, "step": 2}
+    [(prompt, used)] = fake.calls
+    assert prompt.startswith("分析这个 bug")
+    assert "confidence: 缺少字段" in prompt
+    assert "请只输出需要补全或修正的字段 confidence 组成的 JSON 对象" in prompt
+    assert used is route
+
+
+def test_failed_repair_regenerates_on_the_stronger_route(model):
+    fake = model('{"confidence": "high"}', json.dumps(VALID))
+    value = _complete('{"cause": "off by one", "lines": [3]}', model_router.routes["step1"])
+
+    assert value == {**VALID, "step": 2}
+    (_, repair_route), (prompt, retry_route) = fake.calls
+    assert repair_route.name == "step1"
+    assert prompt == "分析这个 bug"
+    assert retry_route is model_router.routes["strong"]
+
+
+def test_gives_up_after_repairs_and_retries(model):
+    fake = model("还是不行", "没有 JSON")
+    with pytest.raises(StructuredOutputError) as caught:
+        _complete('{"cause": "off by one", "confidence": true, "lines": [3]}')
+
+    # 一次修复（解析不出东西），一次整步重试（没有 JSON 对象）
+    assert len(fake.calls) == 2
+    assert caught.value.errors == ["(根): 回复里没有 JSON 对象"]
+    assert caught.value.raw == "没有 JSON"
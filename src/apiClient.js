@@ -1,14 +1,22 @@
 import axios from "axios";
+import crypto from "crypto";
 import chalk from "chalk";
 import dotenv from "dotenv";
 
 // 加载 .env 文件配置
 dotenv.config();
 
+// 收到 429（后端准入队列已满）时按 Retry-After 自动重试的次数
+const MAX_RATE_LIMIT_RETRIES = 3;
+
 class ApiClient {
   constructor(baseURL, options = {}) {
     this.baseURL = baseURL;
     this.githubToken = options.githubToken || process.env.GITHUB_TOKEN;
+    // 源码按内容哈希上传一次（/blobs），之后的请求只带哈希
+    // blobs: 文件 → 上次上传的版本 { hash, lines }，用来算增量；uploaded: 服务端已有的哈希
+    this.blobs = new Map();
+    this.uploaded = new Set();
 
     // 调试信息：显示 token 配置状态
     if (this.githubToken) {
@@ -58,7 +66,27 @@ class ApiClient {
         );
         return response;
       },
-      (error) => {
+      async (error) => {
+        // 后端排队已满（429）：按 Retry-After 等一会儿再重试，最多 MAX_RATE_LIMIT_RETRIES 次
+        const config = error.config;
+        if (
+          error.response?.status === 429 &&
+          config &&
+          (config.rateLimitRetries || 0) < MAX_RATE_LIMIT_RETRIES
+        ) {
+          config.rateLimitRetries = (config.rateLimitRetries || 0) + 1;
+          const seconds =
+            Number(error.response.headers?.["retry-after"]) ||
+            error.response.data?.retry_after ||
+            1;
+          console.log(
+            chalk.yellow(
+              `⏳ 后端繁忙，${seconds}s 后重试 (${config.rateLimitRetries}/${MAX_RATE_LIMIT_RETRIES})`
+            )
+          );
+          await new Promise((resolve) => setTimeout(resolve, seconds * 1000));
+          return this.client.request(config);
+        }
         if (error.code === "ECONNREFUSED") {
           console.error(
             chalk.red("❌ 无法连接到后端服务，请确保Python服务正在运行")
@@ -480,9 +508,110 @@ class ApiClient {
     }
   }
 
+  sha256(text) {
+    return crypto.createHash("sha256").update(text, "utf8").digest("hex");
+  }
+
+  // 行级增量：去掉公共前缀 / 后缀，中间一段整体替换（编辑器里的一次修改通常就是这样）
+  lineDelta(oldLines, newLines) {
+    let start = 0;
+    while (
+      start < oldLines.length &&
+      start < newLines.length &&
+      oldLines[start] === newLines[start]
+    ) {
+      start++;
+    }
+    let oldEnd = oldLines.length;
+    let newEnd = newLines.length;
+    while (
+      oldEnd > start &&
+      newEnd > start &&
+      oldLines[oldEnd - 1] === newLines[newEnd - 1]
+    ) {
+      oldEnd--;
+      newEnd--;
+    }
+    return [{ start, end: oldEnd, lines: newLines.slice(start, newEnd) }];
+  }
+
+  // 上传一份源码，返回哈希；同一个文件之前传过时只发增量，服务端已有时不发
+  async uploadBlob(key, content) {
+    const hash = this.sha256(content);
+    const lines = content.split("\n");
+    const previous = this.blobs.get(key);
+    if (!this.uploaded.has(hash)) {
+      let response;
+      if (previous && this.uploaded.has(previous.hash)) {
+        response = await this.client.post("/blobs", {
+          base: previous.hash,
+          delta: this.lineDelta(previous.lines, lines),
+          hash,
+        });
+      }
+      if (!response || response.data.error) {
+        response = await this.client.post("/blobs", { content });
+      }
+      if (response.data.error) {
+        throw new Error(`上传源码失败: ${response.data.error}`);
+      }
+      this.uploaded.add(hash);
+    }
+    this.blobs.set(key, { hash, lines });
+    return hash;
+  }
+
+  // 把 code（bug report）里的源码换成 blob 引用
+  async withBlobRefs(code) {
+    if (typeof code === "string") {
+      return code.trim() ? { source_blob: await this.uploadBlob("source:main.py", code) } : code;
+    }
+    if (!code || typeof code !== "object") {
+      return code;
+    }
+    const ref = { ...code };
+    if (typeof ref.source === "string") {
+      ref.source_blob = await this.uploadBlob(`source:${ref.code_file || ""}`, ref.source);
+      delete ref.source;
+    }
+    if (typeof ref.tests === "string") {
+      ref.tests_blob = await this.uploadBlob(`tests:${ref.test_file || ""}`, ref.tests);
+      delete ref.tests;
+    }
+    if (Array.isArray(ref.code_contents)) {
+      ref.code_contents = await Promise.all(
+        ref.code_contents.map(async (item) => {
+          if (!item?.success || typeof item.fullContent !== "string") {
+            return item;
+          }
+          const { fullContent, ...rest } = item;
+          const key = `file:${item.filePath || item.fileName}`;
+          return { ...rest, blob: await this.uploadBlob(key, fullContent) };
+        })
+      );
+    }
+    return ref;
+  }
+
+  // 发送带 code 的请求：源码换成 blob 引用；服务端的 blob 被清理过时重新上传全文再试一次
+  async postWithBlobs(url, payload, config) {
+    const send = async () =>
+      this.client.post(
+        url,
+        { ...payload, code: await this.withBlobRefs(payload.code) },
+        config
+      );
+    let response = await send();
+    if (response.data?.missing_blobs) {
+      this.uploaded.clear();
+      response = await send();
+    }
+    return response;
+  }
+
   async generateMRE(bugReport) {
     try {
-      const response = await this.client.post("/step1", bugReport);
+      const response = await this.postWithBlobs("/step1", bugReport);
       return response.data;
     } catch (error) {
       // 如果后端不可用，返回模拟数据
@@ -504,7 +633,7 @@ process_items(items)  # 会抛出 IndexError
 
   async analyzeRootCause(bugReport) {
     try {
-      const response = await this.client.post("/step2", bugReport);
+      const response = await this.postWithBlobs("/step2", bugReport);
       return response.data.result.hypotheses;
     } catch (error) {
       // 如果后端不可用，返回模拟数据
@@ -531,7 +660,7 @@ process_items(items)  # 会抛出 IndexError
 
   async generateInstrumentation(bugReport) {
     try {
-      const response = await this.client.post("/step3", bugReport);
+      const response = await this.postWithBlobs("/step3", bugReport);
       return response.data.result.instrumentation_plan || response.data.result;
     } catch (error) {
       console.log(chalk.yellow("⚠️  使用模拟数据 (后端服务不可用)"));
@@ -547,7 +676,7 @@ process_items(items)  # 会抛出 IndexError
 
   async runExperiment(mreCode) {
     try {
-      const response = await this.client.post("/step4", mreCode);
+      const response = await this.postWithBlobs("/step4", mreCode);
       return response.data.result;
     } catch (error) {
       console.log(chalk.yellow("⚠️  使用模拟数据 (后端服务不可用)"));
@@ -567,7 +696,7 @@ process_items(items)  # 会抛出 IndexError
 
   async generatePatch(hypothesis) {
     try {
-      const response = await this.client.post("/step5", hypothesis);
+      const response = await this.postWithBlobs("/step5", hypothesis);
       return response.data.result.regression_results;
     } catch (error) {
       console.log(chalk.yellow("⚠️  使用模拟数据 (后端服务不可用)"));
@@ -588,7 +717,7 @@ process_items(items)  # 会抛出 IndexError
 
   async runRegressionTest(patchedCode) {
     try {
-      const response = await this.client.post("/step6", patchedCode);
+      const response = await this.postWithBlobs("/step6", patchedCode);
       return response.data;
     } catch (error) {
       console.log(chalk.yellow("⚠️  使用模拟数据 (后端服务不可用)"));
@@ -606,6 +735,98 @@ process_items(items)  # 会抛出 IndexError
       };
     }
   }
+
+  // 一次请求跑完 step1~6（服务端流水线），choices 可覆盖默认选择，例如 { 3: "b" }
+  async runDebug(bugReport, choices = {}) {
+    const response = await this.postWithBlobs(
+      "/debug",
+      { ...bugReport, mode: "auto", choices },
+      { timeout: 600000 }
+    );
+    return response.data;
+  }
+
+  // 交互模式：执行指定 step，服务端会在后台预取下一步
+  async runDebugStep(bugReport, step, choice) {
+    const response = await this.postWithBlobs("/debug", {
+      ...bugReport,
+      mode: "interactive",
+      step,
+      choice,
+    });
+    return response.data;
+  }
+
+  // 探索模式：服务端对 Step 2 的每个假设并行跑 Step 3~5，返回分支排名（最优分支写回会话）
+  async runExplore(bugReport, { concurrency, earlyStop = true } = {}) {
+    const response = await this.postWithBlobs(
+      "/debug",
+      { ...bugReport, mode: "explore", concurrency, early_stop: earlyStop },
+      { timeout: 600000 }
+    );
+    return response.data;
+  }
+
+  // 回退到 step 之前：服务端从会话日志分出新分支，之后重新请求这一步会重新计算
+  async rollbackSession(userId, step) {
+    const response = await this.client.post("/session/rollback", {
+      user_id: userId,
+      step,
+    });
+    return response.data;
+  }
+
+  // 切换到会话日志里已有的分支
+  async checkoutBranch(userId, branch) {
+    const response = await this.client.post("/session/checkout", {
+      user_id: userId,
+      branch,
+    });
+    return response.data;
+  }
+
+  // 会话的分支和每一次 step 调用
+  async getSessionJournal(userId) {
+    const response = await this.client.get(
+      `/session/${encodeURIComponent(userId)}/journal`
+    );
+    return response.data;
+  }
+
+  // 批量模式：服务端并发跑非交互协议，结果以 JSONL 流式返回
+  // onRecord 每收到一份 report 的结果调用一次，返回最后一行的统计（吞吐、每一步的延迟直方图）
+  async runBatch(reports, { workers, choices, skip = [] } = {}, onRecord = () => {}) {
+    const response = await this.client.post(
+      "/batch",
+      { reports, workers, choices, skip },
+      { responseType: "stream", timeout: 0 }
+    );
+
+    let buffer = "";
+    let summary = null;
+    const handleLine = (line) => {
+      if (!line.trim()) return;
+      const record = JSON.parse(line);
+      if (record.summary) {
+        summary = record.summary;
+      } else if (record.error && !record.id) {
+        throw new Error(record.error);
+      } else {
+        onRecord(record);
+      }
+    };
+
+    for await (const chunk of response.data) {
+      buffer += chunk.toString("utf-8");
+      let newline;
+      while ((newline = buffer.indexOf("\n")) >= 0) {
+        handleLine(buffer.slice(0, newline));
+        buffer = buffer.slice(newline + 1);
+      }
+    }
+    handleLine(buffer);
+    return summary;
+  }
 }
 
 export default ApiClient;
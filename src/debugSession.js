@@ -61,15 +61,18 @@ class DebugSession {
           // Step 4 回退到 Step 2
           console.log(chalk.yellow("🔄 回退到 Step 2 (假设成因)"));
           i = 1; // 回退到Step 2 (索引1)
+          await this.rollbackServer(i);
           continue;
         } else if (i === 4) {
           // Step 5 回退到 Step 4
           console.log(chalk.yellow("🔄 回退到 Step 4 (实验执行)"));
           i = 3; // 回退到Step 4 (索引3)
+          await this.rollbackServer(i);
           continue;
         } else {
           console.log(chalk.yellow("🔄 回退到上一步"));
           i--; // 回退到上一步
+          await this.rollbackServer(i);
           continue;
         }
       } else if (result === "continue") {
@@ -83,6 +86,18 @@ class DebugSession {
     }
   }
 
+  // 通知服务端回退：steps 的第 i 项对应服务端的 Step i+1，重新执行时会重新计算而不是返回旧结果
+  async rollbackServer(i) {
+    try {
+      const result = await this.apiClient.rollbackSession("1", i + 1);
+      if (result.error) {
+        console.log(chalk.gray(`ℹ️  服务端未回退: ${result.error}`));
+      }
+    } catch (error) {
+      console.log(chalk.gray(`ℹ️  服务端未回退: ${error.message}`));
+    }
+  }
+
   async loadBugReport() {
     try {
       const bugReport = await this.apiClient.fetchGitHubIssue(this.githubUrl);
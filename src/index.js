@@ -7,6 +7,7 @@ import boxen from "boxen";
 import fs from "fs";
 import path from "path";
 import DebugSession from "./debugSession.js";
+import ApiClient from "./apiClient.js";
 
 const program = new Command();
 
@@ -66,6 +67,132 @@ program
     }
   });
 
+// 读取一批 bug report：目录（每个 *.json 一份）或 JSONL（每行一份）
+// code_file / test_file 相对于 report 所在目录，先读进来放到 source / tests
+function loadBatchReports(input) {
+  const entries = [];
+  const inline = (report, baseDir) => {
+    const fields = [
+      ["code_file", "source"],
+      ["test_file", "tests"],
+    ];
+    for (const [pathField, contentField] of fields) {
+      const relPath = report[pathField];
+      if (!relPath || report[contentField]) continue;
+      if (contentField === "source" && report.code) continue;
+      const fullPath = path.join(baseDir, relPath);
+      if (fs.existsSync(fullPath) && fs.statSync(fullPath).isFile()) {
+        report[contentField] = fs.readFileSync(fullPath, "utf-8");
+      }
+    }
+    return report;
+  };
+
+  if (fs.statSync(input).isDirectory()) {
+    for (const name of fs.readdirSync(input).sort()) {
+      if (!name.endsWith(".json")) continue;
+      const report = JSON.parse(fs.readFileSync(path.join(input, name), "utf-8"));
+      entries.push({ id: String(report.id || name), code: inline(report, input) });
+    }
+    return entries;
+  }
+
+  const baseDir = path.dirname(path.resolve(input));
+  fs.readFileSync(input, "utf-8")
+    .split("\n")
+    .forEach((line, index) => {
+      if (!line.trim()) return;
+      const report = JSON.parse(line);
+      entries.push({
+        id: String(report.id || `line-${index + 1}`),
+        code: inline(report, baseDir),
+      });
+    });
+  return entries;
+}
+
+// 输出文件里已经成功的 id，续跑时跳过
+function readBatchCheckpoint(outPath) {
+  const done = new Set();
+  if (!fs.existsSync(outPath)) return done;
+  for (const line of fs.readFileSync(outPath, "utf-8").split("\n")) {
+    try {
+      const record = JSON.parse(line);
+      if (record.status === "ok") done.add(record.id);
+    } catch {
+      // 写了一半的行，续跑时重做
+    }
+  }
+  return done;
+}
+
+program
+  .command("batch")
+  .description("批量调试：并发跑一批 bug report（非交互，使用默认选择）")
+  .argument("<input>", "bug report 目录（*.json）或 JSONL 文件")
+  .option("-s, --server <url>", "后端服务地址", process.env.SERVER_URL || "http://localhost:8000")
+  .option("-o, --out <file>", "结果 JSONL（追加写入，支持断点续跑）", "batch_results.jsonl")
+  .option("-w, --workers <n>", "并发 worker 数", (value) => parseInt(value, 10), 8)
+  .option("--choices <json>", '覆盖默认选择，例如 \'{"3": "b"}\'')
+  .option("--no-resume", "清空输出文件，全部重跑")
+  .action(async (input, options) => {
+    const reports = loadBatchReports(input);
+    if (!options.resume) fs.writeFileSync(options.out, "");
+    const done = readBatchCheckpoint(options.out);
+    const todo = reports.filter((report) => !done.has(report.id));
+    if (done.size) {
+      console.log(chalk.gray(`⏭️  断点续跑：跳过已完成的 ${reports.length - todo.length} 份`));
+    }
+    if (!todo.length) {
+      console.log(chalk.green("✅ 全部已完成"));
+      return;
+    }
+
+    const apiClient = new ApiClient(options.server);
+    const out = fs.openSync(options.out, "a");
+    let finished = 0;
+    try {
+      const summary = await apiClient.runBatch(
+        todo,
+        {
+          workers: options.workers,
+          choices: options.choices ? JSON.parse(options.choices) : undefined,
+        },
+        (record) => {
+          fs.writeSync(out, JSON.stringify(record) + "\n");
+          finished += 1;
+          const mark = record.status === "ok" ? chalk.green("✅") : chalk.red("❌");
+          console.log(
+            `${mark} [${finished}/${todo.length}] ${record.id} ` +
+              chalk.gray(`${Math.round(record.duration_ms)}ms`) +
+              (record.error ? chalk.red(` step${record.failed_step}: ${record.error}`) : "")
+          );
+        }
+      );
+      if (summary) {
+        console.log(
+          chalk.cyan(
+            `\n📊 完成 ${summary.completed}，失败 ${summary.failed}，` +
+              `用时 ${summary.elapsed_s}s，吞吐 ${summary.reports_per_minute} 份/分钟`
+          )
+        );
+        for (const [step, hist] of Object.entries(summary.step_latency)) {
+          console.log(
+            chalk.gray(
+              `  ${step}: n=${hist.count} avg=${hist.avg_ms}ms ` +
+                `p50<=${hist.p50_le_ms}ms p95<=${hist.p95_le_ms}ms`
+            )
+          );
+        }
+      }
+    } catch (error) {
+      console.error(chalk.red("❌ 批量调试出错:"), error.message);
+      process.exit(1);
+    } finally {
+      fs.closeSync(out);
+    }
+  });
+
 program
   .command("init")
   .description("初始化示例bug报告")